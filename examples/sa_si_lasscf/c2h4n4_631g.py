@@ -61,7 +61,9 @@ print (si)
 states_casdm1s = las.states_make_casdm1s ()
 
 # You can get the 1- and 2-RDMs of the LASSI solutions like this
-roots_casdm1s, roots_casdm2s = lassi.roots_make_rdm12s (las, las.ci, si)
+# (dense=False keeps them packed; unpack one root at a time with get)
+roots_casdm12s = lassi.roots_make_rdm12s (las, las.ci, si, dense=False)
+roots_casdm1s = np.stack ([roots_casdm12s.get (iroot, iroot)[0] for iroot in range (si.shape[1])], axis=0)
 
 # No super-convenient molden API yet
 # By default orbitals are state-averaged natural-orbitals at the end
@@ -291,71 +291,559 @@ void FCICSFaddrs2str (uint64_t * strings, int * addrs, int nstr, int * gentable_
     free (gentable);
 }
 
-void FCICSFhdiag (double * hdiag, double * hdiag_det, double * eri, uint64_t * astrs, uint64_t * bstrs, unsigned int norb, unsigned int nconf, unsigned int ndet)
+
+/* Direct evaluation of the Hamiltonian in the CSF basis. Configurations are given as a pair of full-length orbital bit strings
+   (doubly-occupied, singly-occupied). The determinants of a configuration are generated from the spin strings of its
+   nspin unpaired electrons in the same (cistring) order as the rows of the corresponding umat from get_spin_evecs, so that
+   <CSF_I|H|CSF_J> = umat_I^T <det_I|H|det_J> umat_J. The determinant matrix elements follow PySCF's convention that all
+   alpha creation operators precede all beta creation operators. */
+
+static int _cnt_bits (uint64_t str, int * orbs)
+{
+    int n = 0;
+    while (str){
+        orbs[n] = __builtin_ctzll (str);
+        str &= str - 1ULL;
+        n++;
+    }
+    return n;
+}
+
+static int _str_parity (uint64_t str, int iorb)
+{
+    /* (-1)^(number of electrons in str below orbital iorb) */
+    return (__builtin_popcountll (str & ((1ULL << iorb) - 1ULL)) & 1) ? -1 : 1;
+}
+
+static int _exc_sign (uint64_t ket, int * des, int * cre, int nexc)
+{
+    /* sign of <bra| cre[0]' cre[1]' ... des[1] des[0] |ket> */
+    int i, sgn = 1;
+    for (i = 0; i < nexc; i++){
+        sgn *= _str_parity (ket, des[i]);
+        ket ^= 1ULL << des[i];
+    }
+    for (i = nexc-1; i >= 0; i--){
+        sgn *= _str_parity (ket, cre[i]);
+        ket ^= 1ULL << cre[i];
+    }
+    return sgn;
+}
+
+static double _ham_det (uint64_t bra_a, uint64_t bra_b, uint64_t ket_a, uint64_t ket_b,
+                        double * h1ea, double * h1eb, double * eri, int norb)
+{
+    const size_t n1 = norb;
+    const size_t n2 = n1 * norb;
+    const size_t n3 = n2 * norb;
+    uint64_t da = bra_a ^ ket_a;
+    uint64_t db = bra_b ^ ket_b;
+    int nda = __builtin_popcountll (da) / 2;
+    int ndb = __builtin_popcountll (db) / 2;
+    if (nda + ndb > 2){ return 0.0; }
+    int occa[64], occb[64], des[2], cre[2], desb[2], creb[2];
+    int nocca, noccb, i, j, k, p, q, sgn;
+    double e = 0.0;
+    if (nda + ndb == 0){
+        nocca = _cnt_bits (ket_a, occa);
+        noccb = _cnt_bits (ket_b, occb);
+        for (i = 0; i < nocca; i++){
+            p = occa[i];
+            e += h1ea[p*n1+p];
+            for (j = 0; j < nocca; j++){
+                q = occa[j];
+                e += 0.5 * (eri[p*n3+p*n2+q*n1+q] - eri[p*n3+q*n2+q*n1+p]);
+            }
+            for (j = 0; j < noccb; j++){
+                q = occb[j];
+                e += eri[p*n3+p*n2+q*n1+q];
+            }
+        }
+        for (i = 0; i < noccb; i++){
+            p = occb[i];
+            e += h1eb[p*n1+p];
+            for (j = 0; j < noccb; j++){
+                q = occb[j];
+                e += 0.5 * (eri[p*n3+p*n2+q*n1+q] - eri[p*n3+q*n2+q*n1+p]);
+            }
+        }
+    } else if (nda == 1 && ndb == 0){
+        des[0] = __builtin_ctzll (da & ket_a);
+        cre[0] = __builtin_ctzll (da & bra_a);
+        p = cre[0]; q = des[0];
+        nocca = _cnt_bits (ket_a, occa);
+        noccb = _cnt_bits (ket_b, occb);
+        e = h1ea[p*n1+q];
+        for (i = 0; i < nocca; i++){
+            k = occa[i];
+            e += eri[p*n3+q*n2+k*n1+k] - eri[p*n3+k*n2+k*n1+q];
+        }
+        for (i = 0; i < noccb; i++){
+            k = occb[i];
+            e += eri[p*n3+q*n2+k*n1+k];
+        }
+        e *= _exc_sign (ket_a, des, cre, 1);
+    } else if (nda == 0 && ndb == 1){
+        des[0] = __builtin_ctzll (db & ket_b);
+        cre[0] = __builtin_ctzll (db & bra_b);
+        p = cre[0]; q = des[0];
+        nocca = _cnt_bits (ket_a, occa);
+        noccb = _cnt_bits (ket_b, occb);
+        e = h1eb[p*n1+q];
+        for (i = 0; i < noccb; i++){
+            k = occb[i];
+            e += eri[p*n3+q*n2+k*n1+k] - eri[p*n3+k*n2+k*n1+q];
+        }
+        for (i = 0; i < nocca; i++){
+            k = occa[i];
+            e += eri[p*n3+q*n2+k*n1+k];
+        }
+        e *= _exc_sign (ket_b, des, cre, 1);
+    } else if (nda == 1 && ndb == 1){
+        des[0] = __builtin_ctzll (da & ket_a);
+        cre[0] = __builtin_ctzll (da & bra_a);
+        desb[0] = __builtin_ctzll (db & ket_b);
+        creb[0] = __builtin_ctzll (db & bra_b);
+        sgn = _exc_sign (ket_a, des, cre, 1) * _exc_sign (ket_b, desb, creb, 1);
+        e = sgn * eri[cre[0]*n3+des[0]*n2+creb[0]*n1+desb[0]];
+    } else {
+        if (nda == 2){
+            _cnt_bits (da & ket_a, des);
+            _cnt_bits (da & bra_a, cre);
+            sgn = _exc_sign (ket_a, des, cre, 2);
+        } else {
+            _cnt_bits (db & ket_b, des);
+            _cnt_bits (db & bra_b, cre);
+            sgn = _exc_sign (ket_b, des, cre, 2);
+        }
+        e = sgn * (eri[cre[0]*n3+des[0]*n2+cre[1]*n1+des[1]]
+                 - eri[cre[0]*n3+des[1]*n2+cre[1]*n1+des[0]]);
+    }
+    return e;
+}
+
+static int _conf_nexc (uint64_t dconf_I, uint64_t sconf_I, uint64_t dconf_J, uint64_t sconf_J)
 {
+    /* Number of electrons that must be moved to turn configuration J into configuration I */
+    uint64_t occ_J = dconf_J | sconf_J;
+    return (2 * __builtin_popcountll (dconf_I & ~occ_J)
+              + __builtin_popcountll (dconf_I & sconf_J)
+              + __builtin_popcountll (sconf_I & ~occ_J));
+}
 
-    unsigned int ndet_lt = ndet * (ndet+1) / 2;
+static void _conf_dets (uint64_t * stra, uint64_t * strb, uint64_t dconf, uint64_t sconf,
+                        uint64_t * spinstrs, int ndet)
+{
+    int somo[64];
+    int nsomo = _cnt_bits (sconf, somo);
+    int idet, ispin;
+    for (idet = 0; idet < ndet; idet++){
+        stra[idet] = dconf;
+        strb[idet] = dconf;
+        for (ispin = 0; ispin < nsomo; ispin++){
+            if (spinstrs[idet] & (1ULL << ispin)){ stra[idet] |= 1ULL << somo[ispin]; }
+            else { strb[idet] |= 1ULL << somo[ispin]; }
+        }
+    }
+}
+
+static void _conf_hblock (double * blk, double * tmp,
+                          uint64_t * stra_I, uint64_t * strb_I, int ndet_I, double * umat_I, int ncsf_I,
+                          uint64_t * stra_J, uint64_t * strb_J, int ndet_J, double * umat_J, int ncsf_J,
+                          double * h1ea, double * h1eb, double * eri, int norb)
+{
+    /* blk[ncsf_I,ncsf_J] = umat_I^T . hdet[ndet_I,ndet_J] . umat_J (all row-major)
+       hdet is very sparse, so tmp = hdet . umat_J is accumulated one nonzero element at a time */
+    const char TRANS_N = 'N';
+    const char TRANS_T = 'T';
+    const double D0 = 0.0;
+    const double D1 = 1.0;
+    int idet, jdet, jcsf;
+    double hij;
+    double * tmp_i;
+    double * umat_j;
+    for (idet = 0; idet < ndet_I*ncsf_J; idet++){ tmp[idet] = 0.0; }
+    for (idet = 0; idet < ndet_I; idet++){
+        tmp_i = tmp + idet*ncsf_J;
+        for (jdet = 0; jdet < ndet_J; jdet++){
+            if (__builtin_popcountll (stra_I[idet] ^ stra_J[jdet])
+              + __builtin_popcountll (strb_I[idet] ^ strb_J[jdet]) > 4){ continue; }
+            hij = _ham_det (stra_I[idet], strb_I[idet], stra_J[jdet], strb_J[jdet], h1ea, h1eb, eri, norb);
+            if (hij == 0.0){ continue; }
+            umat_j = umat_J + jdet*ncsf_J;
+            for (jcsf = 0; jcsf < ncsf_J; jcsf++){ tmp_i[jcsf] += hij * umat_j[jcsf]; }
+        }
+    }
+    dgemm_(&TRANS_N, &TRANS_T, &ncsf_J, &ncsf_I, &ndet_I,
+           &D1, tmp, &ncsf_J, umat_I, &ncsf_I,
+           &D0, blk, &ncsf_J);
+}
 
+void FCICSFhmat (double * hmat, int ncsf_tot,
+                 uint64_t * dconf, uint64_t * sconf, int * conf_nspin, int * conf_csf_offset, int nconf,
+                 double * umat, int64_t * umat_offset, uint64_t * spinstrs, int64_t * spinstrs_offset,
+                 int * nspin_ndet, int * nspin_ncsf, int max_ndet, int max_ncsf,
+                 double * h1ea, double * h1eb, double * eri, int norb)
+{
+    /* hmat[ncsf_tot,ncsf_tot] = Hamiltonian matrix between the CSFs of the nconf configurations, the CSFs of configuration
+       iconf beginning at row conf_csf_offset[iconf]. Only configuration pairs which differ by at most a double excitation
+       are visited; hmat must be zeroed on entry. */
 #pragma omp parallel default(shared)
 {
+    int iconf, jconf, ndet_I, ndet_J, ncsf_I, ncsf_J, icsf, jcsf;
+    int64_t irow, jrow;
+    double * tmp = malloc (max_ndet * max_ncsf * sizeof (double));
+    double * blk = malloc (max_ncsf * max_ncsf * sizeof (double));
+    uint64_t * strs = malloc (4 * max_ndet * sizeof (uint64_t));
+    uint64_t * stra_I = strs;
+    uint64_t * strb_I = strs + max_ndet;
+    uint64_t * stra_J = strs + 2*max_ndet;
+    uint64_t * strb_J = strs + 3*max_ndet;
+#pragma omp for schedule(dynamic)
+    for (iconf = 0; iconf < nconf; iconf++){
+        ndet_I = nspin_ndet[conf_nspin[iconf]];
+        ncsf_I = nspin_ncsf[conf_nspin[iconf]];
+        _conf_dets (stra_I, strb_I, dconf[iconf], sconf[iconf],
+                    spinstrs + spinstrs_offset[conf_nspin[iconf]], ndet_I);
+        for (jconf = 0; jconf <= iconf; jconf++){
+            if (_conf_nexc (dconf[iconf], sconf[iconf], dconf[jconf], sconf[jconf]) > 2){ continue; }
+            ndet_J = nspin_ndet[conf_nspin[jconf]];
+            ncsf_J = nspin_ncsf[conf_nspin[jconf]];
+            _conf_dets (stra_J, strb_J, dconf[jconf], sconf[jconf],
+                        spinstrs + spinstrs_offset[conf_nspin[jconf]], ndet_J);
+            _conf_hblock (blk, tmp,
+                          stra_I, strb_I, ndet_I, umat + umat_offset[conf_nspin[iconf]], ncsf_I,
+                          stra_J, strb_J, ndet_J, umat + umat_offset[conf_nspin[jconf]], ncsf_J,
+                          h1ea, h1eb, eri, norb);
+            for (icsf = 0; icsf < ncsf_I; icsf++){ for (jcsf = 0; jcsf < ncsf_J; jcsf++){
+                irow = conf_csf_offset[iconf] + icsf;
+                jrow = conf_csf_offset[jconf] + jcsf;
+                hmat[(irow*ncsf_tot)+jrow] = blk[(icsf*ncsf_J)+jcsf];
+                hmat[(jrow*ncsf_tot)+irow] = blk[(icsf*ncsf_J)+jcsf];
+            }}
+        }
+    }
+    free (tmp);
+    free (blk);
+    free (strs);
+}
+}
 
-    unsigned int idetconf, iconf, idet_lt, idetx, idety, iorb, nexc;
-    uint64_t exc_str, somo_str, big_idx1, big_idx2, hdiag_idx_lt, hdiag_idx_ut;
-    unsigned int exc[2];
-    int sgn, esgn;
+static void _conf_hdiag (double * hdiag, double * tmp, uint64_t * stra, uint64_t * strb, int ndet,
+                         double * umat, int ncsf, double * h1ea, double * h1eb, double * eri, int norb)
+{
+    /* hdiag[ncsf] = diag (umat^T . hdet[ndet,ndet] . umat) for the determinants of a single configuration, which differ
+       from one another only by exchanging the spins of pairs of unpaired electrons */
+    int idet, jdet, icsf;
+    double hij;
+    double * tmp_i;
+    double * tmp_j;
+    double * umat_i;
+    double * umat_j;
+    for (idet = 0; idet < ndet*ncsf; idet++){ tmp[idet] = 0.0; }
+    for (idet = 0; idet < ndet; idet++){
+        tmp_i = tmp + idet*ncsf;
+        umat_i = umat + idet*ncsf;
+        hij = _ham_det (stra[idet], strb[idet], stra[idet], strb[idet], h1ea, h1eb, eri, norb);
+        for (icsf = 0; icsf < ncsf; icsf++){ tmp_i[icsf] += hij * umat_i[icsf]; }
+        for (jdet = 0; jdet < idet; jdet++){
+            if (__builtin_popcountll (stra[idet] ^ stra[jdet]) > 2){ continue; }
+            hij = _ham_det (stra[idet], strb[idet], stra[jdet], strb[jdet], h1ea, h1eb, eri, norb);
+            if (hij == 0.0){ continue; }
+            tmp_j = tmp + jdet*ncsf;
+            umat_j = umat + jdet*ncsf;
+            for (icsf = 0; icsf < ncsf; icsf++){
+                tmp_i[icsf] += hij * umat_j[icsf];
+                tmp_j[icsf] += hij * umat_i[icsf];
+            }
+        }
+    }
+    for (icsf = 0; icsf < ncsf; icsf++){ hdiag[icsf] = 0.0; }
+    for (idet = 0; idet < ndet; idet++){
+        tmp_i = tmp + idet*ncsf;
+        umat_i = umat + idet*ncsf;
+        for (icsf = 0; icsf < ncsf; icsf++){ hdiag[icsf] += umat_i[icsf] * tmp_i[icsf]; }
+    }
+}
 
-#pragma omp for schedule(static) 
+void FCICSFhdiag_conf (double * hdiag,
+                       uint64_t * dconf, uint64_t * sconf, int * conf_nspin, int * conf_csf_offset, int nconf,
+                       double * umat, int64_t * umat_offset, uint64_t * spinstrs, int64_t * spinstrs_offset,
+                       int * nspin_ndet, int * nspin_ncsf, int max_ndet, int max_ncsf,
+                       double * h1ea, double * h1eb, double * eri, int norb)
+{
+    /* Diagonal of the Hamiltonian in the CSF basis spanning nconf configurations, the CSFs of configuration iconf
+       beginning at hdiag[conf_csf_offset[iconf]] */
+#pragma omp parallel default(shared)
+{
+    int iconf, ndet, ncsf;
+    double * tmp = malloc (max_ndet * max_ncsf * sizeof (double));
+    uint64_t * strs = malloc (2 * max_ndet * sizeof (uint64_t));
+    uint64_t * stra = strs;
+    uint64_t * strb = strs + max_ndet;
+#pragma omp for schedule(dynamic)
+    for (iconf = 0; iconf < nconf; iconf++){
+        ndet = nspin_ndet[conf_nspin[iconf]];
+        ncsf = nspin_ncsf[conf_nspin[iconf]];
+        _conf_dets (stra, strb, dconf[iconf], sconf[iconf],
+                    spinstrs + spinstrs_offset[conf_nspin[iconf]], ndet);
+        _conf_hdiag (hdiag + conf_csf_offset[iconf], tmp, stra, strb, ndet,
+                     umat + umat_offset[conf_nspin[iconf]], ncsf, h1ea, h1eb, eri, norb);
+    }
+    free (tmp);
+    free (strs);
+}
+}
+
+/* CSF-basis sigma vector: H = sum_pq h'_pq E_pq + 1/2 sum_pqrs (pq|rs) E_pq E_rs, with the one-body coupling coefficients
+   <X,i|E_pq|Y,j> between the CSFs of configurations X = E_pq Y looked up from the blocks of get_onebody_coupling.
+   The configuration Y is addressed directly from its occupation strings, so no determinant-basis vector is ever built. */
+
+typedef struct {
+    int p, q, ncsf;
+    double sgn;
+    int64_t csf_offset;
+    int64_t blk;
+} csflink_t;
+
+static int64_t _cistr_addr (uint64_t str, int64_t * binom, int nbinom)
+{
+    // Address of a string among all strings with the same number of set bits, in cistring (ascending) order
+    int64_t addr = 0;
+    int k = 0;
+    while (str){
+        k++;
+        addr += binom[(__builtin_ctzll (str) * nbinom) + k];
+        str &= str - 1;
+    }
+    return addr;
+}
+
+static int64_t _sconf_addr (uint64_t sconf, uint64_t dconf, int64_t * binom, int nbinom)
+{
+    // Address of sconf among the strings of unpaired electrons in the orbitals that are not doubly occupied, as in
+    // csdstring: each singly-occupied orbital is shifted down by the number of doubly-occupied orbitals below it
+    int64_t addr = 0;
+    int k = 0;
+    int p;
+    while (sconf){
+        k++;
+        p = __builtin_ctzll (sconf);
+        p -= __builtin_popcountll (dconf & ((1ULL << p) - 1));
+        addr += binom[(p * nbinom) + k];
+        sconf &= sconf - 1;
+    }
+    return addr;
+}
+
+static int64_t _conf_csf_offset (uint64_t dconf, uint64_t sconf, int norb, int min_npair,
+    int64_t * npair_nsconf, int64_t * npair_csf_offset, int64_t * npair_ncsf, int64_t * binom)
+{
+    int ipair = __builtin_popcountll (dconf) - min_npair;
+    int64_t addr_d = _cistr_addr (dconf, binom, norb+1);
+    int64_t addr_s = _sconf_addr (sconf, dconf, binom, norb+1);
+    return npair_csf_offset[ipair] + ((addr_d * npair_nsconf[ipair]) + addr_s) * npair_ncsf[ipair];
+}
+
+static int64_t _pair_idx (int p, int q)
+{
+    return (p > q) ? ((p * (p + 1) / 2) + q) : ((q * (q + 1) / 2) + p);
+}
+
+static int64_t _onebody_cpl_key (int max_nspin, int nspin, int cpltype, int rq, int rp, int pgtq)
+{
+    // Must match csfstring.onebody_coupling_key
+    int64_t nr = max_nspin + 2;
+    return (((((int64_t) nspin * 5) + cpltype) * nr + rq) * nr + rp) * 2 + pgtq;
+}
 
-    for (idetconf = 0; idetconf < nconf * ndet_lt; idetconf++){
-        iconf = idetconf / ndet_lt;
-        idety = idetconf % ndet_lt;
-        for (idetx = 0; idetx < ndet; idetx++){
-            if (idetx < idety){ idety -= idetx + 1; }
-            else { break; }
+static int _onebody_links (csflink_t * links, uint64_t dconf_X, uint64_t sconf_X, int norb, int min_npair, int max_nspin,
+    int64_t * nspin_ncsf, int64_t * npair_nsconf, int64_t * npair_csf_offset, int64_t * npair_ncsf, int64_t * binom,
+    int64_t * blk_offset)
+{
+    // All configurations Y and orbital pairs p != q such that X = E_pq Y
+    int p, q, occp, occq, nspin_Y, cpltype, lo, hi;
+    int nlink = 0;
+    uint64_t bp, bq, dconf_Y, sconf_Y, between;
+    int64_t blk;
+    for (p = 0; p < norb; p++){
+        bp = 1ULL << p;
+        occp = ((sconf_X & bp) ? 1 : 0) + ((dconf_X & bp) ? 2 : 0);
+        if (occp == 0){ continue; }
+        for (q = 0; q < norb; q++){
+            bq = 1ULL << q;
+            occq = ((sconf_X & bq) ? 1 : 0) + ((dconf_X & bq) ? 2 : 0);
+            if (q == p || occq == 2){ continue; }
+            dconf_Y = dconf_X;
+            sconf_Y = sconf_X;
+            if (occp == 2){ dconf_Y ^= bp; sconf_Y |= bp; }
+            else          { sconf_Y ^= bp; }
+            if (occq == 1){ sconf_Y ^= bq; dconf_Y |= bq; }
+            else          { sconf_Y |= bq; }
+            nspin_Y = __builtin_popcountll (sconf_Y);
+            if (nspin_Y > max_nspin || nspin_ncsf[nspin_Y] == 0){ continue; }
+            cpltype = ((occq == 1) ? 2 : 0) + ((occp == 2) ? 1 : 0);
+            blk = blk_offset[_onebody_cpl_key (max_nspin, nspin_Y, cpltype,
+                __builtin_popcountll (sconf_Y & (bq - 1)), __builtin_popcountll (sconf_Y & (bp - 1)), (p > q))];
+            if (blk < 0){ continue; }
+            lo = (p < q) ? p : q;
+            hi = (p < q) ? q : p;
+            between = ((1ULL << hi) - 1) ^ ((2ULL << lo) - 1);
+            links[nlink].p = p;
+            links[nlink].q = q;
+            links[nlink].ncsf = nspin_ncsf[nspin_Y];
+            links[nlink].sgn = (__builtin_popcountll (dconf_Y & between) & 1) ? -1.0 : 1.0;
+            links[nlink].csf_offset = _conf_csf_offset (dconf_Y, sconf_Y, norb, min_npair,
+                npair_nsconf, npair_csf_offset, npair_ncsf, binom);
+            links[nlink].blk = blk;
+            nlink++;
         }
-        // Careful with possible integer overflow
-        hdiag_idx_lt = ndet;
-        hdiag_idx_lt *= ndet;
-        hdiag_idx_lt *= iconf;
-        hdiag_idx_ut = hdiag_idx_lt;
-        big_idx1 = ndet;
-        big_idx1 *= idety;
-        big_idx2 = ndet;
-        big_idx2 *= idetx;
-        hdiag_idx_lt += big_idx1;
-        hdiag_idx_ut += big_idx2;
-        hdiag_idx_lt += idetx;
-        hdiag_idx_ut += idety;
-        if (idetx == idety){ 
-            hdiag[hdiag_idx_lt] = hdiag_det[(iconf*ndet)+idetx];
-            continue;
+    }
+    return nlink;
+}
+
+void FCICSFcontract1e_ket (double * dket, double * ci, int64_t ncsf_all,
+    uint64_t * dconf_strs, uint64_t * sconf_strs, int64_t * conf_offset, int nconf, int norb, int min_npair, int max_nspin, int64_t * nspin_ncsf, int64_t * npair_nsconf,
+    int64_t * npair_csf_offset, int64_t * npair_ncsf, int64_t * binom, int64_t * blk_offset, double * blk_E)
+{
+    /* dket[pq,I] = sum_J <I|E_pq+E_qp|J> ci[J] (p>q) or <I|E_pp|J> ci[J] (p==q), with the orbital pair index pq
+       lower-triangular packed; dket must be zeroed on entry */
+#pragma omp parallel
+{
+    csflink_t * links = malloc (norb * norb * sizeof (csflink_t));
+    int iconf, ilink, nlink, i, j, p, occp, ncsf_X, ncsf_Y;
+    int64_t pq;
+    double tmp, sgn;
+    double * dx, * x, * y, * blk;
+    #pragma omp for schedule(dynamic)
+    for (iconf = 0; iconf < nconf; iconf++){
+        ncsf_X = nspin_ncsf[__builtin_popcountll (sconf_strs[iconf])];
+        if (ncsf_X == 0){ continue; }
+        dx = dket + conf_offset[iconf];
+        x = ci + conf_offset[iconf];
+        for (p = 0; p < norb; p++){
+            occp = ((sconf_strs[iconf] >> p) & 1) + 2 * ((dconf_strs[iconf] >> p) & 1);
+            if (occp == 0){ continue; }
+            pq = _pair_idx (p, p) * ncsf_all;
+            for (i = 0; i < ncsf_X; i++){ dx[pq+i] = occp * x[i]; }
         }
-        // Fear of integer overflow is only reasonable for off-diagonal elements of a Hamiltonian matrix
-        // It's not reasonable for anything else
-        big_idx1 = (ndet*iconf) + idetx;
-        big_idx2 = (ndet*iconf) + idety;
-        exc_str  = astrs[big_idx1] ^ astrs[big_idx2];
-        somo_str = astrs[big_idx1] ^ bstrs[big_idx1];
-        nexc = 0; esgn = 1; sgn = -1;
-        for (iorb = 0; iorb < norb; iorb++){
-            if (somo_str & 1ULL << iorb){ esgn *= -1; }
-            if (exc_str & 1ULL << iorb){
-                if (nexc < 2){ exc[nexc] = iorb; }
-                nexc++;
-                if (nexc > 2){ break; }
-                sgn *= esgn;
+        nlink = _onebody_links (links, dconf_strs[iconf], sconf_strs[iconf], norb, min_npair, max_nspin,
+            nspin_ncsf, npair_nsconf, npair_csf_offset, npair_ncsf, binom, blk_offset);
+        for (ilink = 0; ilink < nlink; ilink++){
+            ncsf_Y = links[ilink].ncsf;
+            sgn = links[ilink].sgn;
+            pq = _pair_idx (links[ilink].p, links[ilink].q) * ncsf_all;
+            y = ci + links[ilink].csf_offset;
+            blk = blk_E + links[ilink].blk;
+            for (i = 0; i < ncsf_X; i++){
+                tmp = 0;
+                for (j = 0; j < ncsf_Y; j++){ tmp += blk[(i*ncsf_Y)+j] * y[j]; }
+                dx[pq+i] += sgn * tmp;
             }
-        } 
-        if (nexc > 2){ continue; }
-        assert (nexc == 2);
-
-        // Fear of integer overflow is only reasonable for off-diagonal elements of a Hamiltonian matrix
-        // It's not reasonable for anything else
-        big_idx1 = exc[0]*norb*norb*norb + exc[1]*norb*norb + exc[1]*norb + exc[0];
-        hdiag[hdiag_idx_lt] = sgn * eri[big_idx1];
-        hdiag[hdiag_idx_ut] = hdiag[hdiag_idx_lt];
+        }
     }
+    free (links);
+}
+}
 
+void FCICSFcontract1e_bra (double * sigma, double * gket, double * ci, int64_t ncsf_all, double * h1e_s, int with_spin,
+    uint64_t * dconf_strs, uint64_t * sconf_strs, int64_t * conf_offset,
+    int nconf, int norb, int min_npair, int max_nspin, int64_t * nspin_ncsf, int64_t * npair_nsconf,
+    int64_t * npair_csf_offset, int64_t * npair_ncsf, int64_t * binom, int64_t * blk_offset, double * blk_E,
+    double * blk_T)
+{
+    /* sigma[I] = sum_pq,J <I|E_pq|J> gket[pq,J] + sum_pq,J h1e_s[p,q] <I|T_pq|J> ci[J], where T_pq = E^a_pq - E^b_pq,
+       gket is symmetric in p,q and stored with the orbital pair index lower-triangular packed, and h1e_s and blk_T are
+       only touched if with_spin */
+#pragma omp parallel
+{
+    csflink_t * links = malloc (norb * norb * sizeof (csflink_t));
+    int iconf, ilink, nlink, i, j, p, occp, ncsf_X, ncsf_Y, nspin_X;
+    int64_t blk_pp;
+    uint64_t sconf_X;
+    double tmp, sgn, hs;
+    double * sx, * x, * y, * gy, * blk;
+    #pragma omp for schedule(dynamic)
+    for (iconf = 0; iconf < nconf; iconf++){
+        sconf_X = sconf_strs[iconf];
+        nspin_X = __builtin_popcountll (sconf_X);
+        ncsf_X = nspin_ncsf[nspin_X];
+        if (ncsf_X == 0){ continue; }
+        sx = sigma + conf_offset[iconf];
+        x = ci + conf_offset[iconf];
+        for (p = 0; p < norb; p++){
+            occp = ((sconf_X >> p) & 1) + 2 * ((dconf_strs[iconf] >> p) & 1);
+            if (occp == 0){ continue; }
+            gy = gket + (_pair_idx (p, p) * ncsf_all) + conf_offset[iconf];
+            for (i = 0; i < ncsf_X; i++){ sx[i] += occp * gy[i]; }
+            hs = with_spin ? h1e_s[(p*norb)+p] : 0;
+            if (occp != 1 || hs == 0){ continue; }
+            blk_pp = blk_offset[_onebody_cpl_key (max_nspin, nspin_X, 4,
+                __builtin_popcountll (sconf_X & ((1ULL << p) - 1)), __builtin_popcountll (sconf_X & ((1ULL << p) - 1)), 0)];
+            blk = blk_T + blk_pp;
+            for (i = 0; i < ncsf_X; i++){
+                tmp = 0;
+                for (j = 0; j < ncsf_X; j++){ tmp += blk[(i*ncsf_X)+j] * x[j]; }
+                sx[i] += hs * tmp;
+            }
+        }
+        nlink = _onebody_links (links, dconf_strs[iconf], sconf_X, norb, min_npair, max_nspin,
+            nspin_ncsf, npair_nsconf, npair_csf_offset, npair_ncsf, binom, blk_offset);
+        for (ilink = 0; ilink < nlink; ilink++){
+            ncsf_Y = links[ilink].ncsf;
+            sgn = links[ilink].sgn;
+            gy = gket + (_pair_idx (links[ilink].p, links[ilink].q) * ncsf_all) + links[ilink].csf_offset;
+            blk = blk_E + links[ilink].blk;
+            for (i = 0; i < ncsf_X; i++){
+                tmp = 0;
+                for (j = 0; j < ncsf_Y; j++){ tmp += blk[(i*ncsf_Y)+j] * gy[j]; }
+                sx[i] += sgn * tmp;
+            }
+            hs = with_spin ? h1e_s[(links[ilink].p*norb)+links[ilink].q] : 0;
+            if (hs == 0){ continue; }
+            y = ci + links[ilink].csf_offset;
+            blk = blk_T + links[ilink].blk;
+            hs *= sgn;
+            for (i = 0; i < ncsf_X; i++){
+                tmp = 0;
+                for (j = 0; j < ncsf_Y; j++){ tmp += blk[(i*ncsf_Y)+j] * y[j]; }
+                sx[i] += hs * tmp;
+            }
+        }
+    }
+    free (links);
 }
 }
 
+void FCICSFmakemasks (uint32_t * csd_mask, uint32_t * econf_det_mask, uint64_t * stra, uint64_t * strb,
+    int ndeta, int ndetb, int norb, int min_npair, int64_t * npair_csd_offset, int64_t * npair_conf_offset,
+    int64_t * npair_nsconf, int64_t * npair_nspins, int64_t * binom)
+{
+    /* Fill csd_mask[idx_csd] = idx_dd and econf_det_mask[idx_dd] = iconf in a single pass over determinant pairs.
+       Every determinant pair is visited exactly once, so the writes into csd_mask never collide. */
+    int ia, ib, ipair, k;
+    uint64_t a, b, dconf, sconf, spins, opens;
+    int64_t idx_dd, iconf_pair;
+#pragma omp parallel for schedule(static) private(ib, ipair, k, a, b, dconf, sconf, spins, opens, idx_dd, iconf_pair)
+    for (ia = 0; ia < ndeta; ia++){
+        a = stra[ia];
+        for (ib = 0; ib < ndetb; ib++){
+            b = strb[ib];
+            dconf = a & b;
+            sconf = a ^ b;
+            ipair = __builtin_popcountll (dconf) - min_npair;
+            iconf_pair = (_cistr_addr (dconf, binom, norb+1) * npair_nsconf[ipair])
+                       + _sconf_addr (sconf, dconf, binom, norb+1);
+            spins = 0;
+            k = 0;
+            for (opens = sconf; opens; opens &= opens - 1){
+                spins |= ((a >> __builtin_ctzll (opens)) & 1ULL) << k;
+                k++;
+            }
+            idx_dd = ((int64_t) ia * ndetb) + ib;
+            econf_det_mask[idx_dd] = (uint32_t) (npair_conf_offset[ipair] + iconf_pair);
+            csd_mask[npair_csd_offset[ipair] + (iconf_pair * npair_nspins[ipair]) + _cistr_addr (spins, binom, norb+1)]
+                = (uint32_t) idx_dd;
+        }
+    }
+}
@@ -18,6 +18,7 @@
 */
 
 #include <cstdlib>
+#include <cmath>
 
 extern "C" {
 
@@ -117,5 +118,108 @@ void rhf_response(const int Norb, const int Nterms, const int numPairs, int * H1
     free(eigvecs);
 
 }
-}
 
+void rhf_response_sparse(const int Norb, const int Nterms, const int numPairs, int * H1start, int * H1row, int * H1col, double * H0,
+                         const int Nout, int * outrow, int * outcol, const double thresh, double * rdm_deriv){
+
+    /* Same as rhf_response, but only the Nout elements (outrow[elem], outcol[elem]) of each 1-RDM derivative are computed:
+           rdm_deriv[ elem + Nout * deriv ] = d 1RDM[ outrow[elem], outcol[elem] ] / d u_deriv
+       Only the rows of VIRT * work1 belonging to orbitals that appear in outrow or outcol are built, and elements of work1
+       smaller than thresh in absolute value are skipped. H0 is not overwritten. */
+
+    const int size = Norb * Norb;
+    const int nVir = Norb - numPairs;
+
+    double * eigvecs = (double *) malloc(sizeof(double)*size);
+    double * eigvals = (double *) malloc(sizeof(double)*Norb);
+    double * temp    = (double *) malloc(sizeof(double)*nVir*numPairs);
+    int * pos        = (int *) malloc(sizeof(int)*Norb);
+    int * need       = (int *) malloc(sizeof(int)*Norb);
+
+    {
+        int inc = 1;
+        dcopy_( &size, H0, &inc, eigvecs, &inc );
+        char jobz = 'V';
+        char uplo = 'U';
+        int info;
+        int lwork = 3*Norb-1;
+        double * work = (double *) malloc(sizeof(double)*lwork);
+        dsyev_( &jobz, &uplo, &Norb, eigvecs, &Norb, eigvals, work, &lwork, &info );
+        free(work);
+    }
+
+    double * occ  = eigvecs;
+    double * virt = eigvecs + numPairs * Norb;
+
+    // need[ ix ] = orbital index of the ix-th orbital that appears in the output ; pos is the inverse
+    int nNeed = 0;
+    for ( int orb = 0; orb < Norb; orb++ ){ pos[ orb ] = -1; }
+    for ( int elem = 0; elem < Nout; elem++ ){
+        if ( pos[ outrow[ elem ] ] < 0 ){ pos[ outrow[ elem ] ] = nNeed; need[ nNeed++ ] = outrow[ elem ]; }
+        if ( pos[ outcol[ elem ] ] < 0 ){ pos[ outcol[ elem ] ] = nNeed; need[ nNeed++ ] = outcol[ elem ]; }
+    }
+
+    for ( int orb_vir = 0; orb_vir < nVir; orb_vir++ ){
+        for ( int orb_occ = 0; orb_occ < numPairs; orb_occ++ ){
+            temp[ orb_vir + nVir * orb_occ ] = - 1.0 / ( eigvals[ numPairs + orb_vir ] - eigvals[ orb_occ ] );
+        }
+    }
+
+    #pragma omp parallel
+    {
+        double * work1 = (double *) malloc(sizeof(double)*nVir*numPairs);
+        double * work2 = (double *) malloc(sizeof(double)*nNeed*numPairs);
+
+        #pragma omp for schedule(dynamic)
+        for ( int deriv = 0; deriv < Nterms; deriv++ ){
+
+            // work1 = - VIRT.T * H1 * OCC / ( eps_vir - eps_occ )
+            for ( int ix = 0; ix < nVir*numPairs; ix++ ){ work1[ ix ] = 0.0; }
+            for ( int elem = H1start[ deriv ]; elem < H1start[ deriv + 1 ]; elem++ ){
+                double * vrow = virt + H1row[ elem ];
+                double * ocol = occ + H1col[ elem ];
+                for ( int orb_occ = 0; orb_occ < numPairs; orb_occ++ ){
+                    const double o = ocol[ Norb * orb_occ ];
+                    for ( int orb_vir = 0; orb_vir < nVir; orb_vir++ ){
+                        work1[ orb_vir + nVir * orb_occ ] += vrow[ Norb * orb_vir ] * o;
+                    }
+                }
+            }
+
+            // work2[ ix + nNeed * occ ] = 2 * ( VIRT * work1 )[ need[ ix ], occ ]
+            for ( int ix = 0; ix < nNeed*numPairs; ix++ ){ work2[ ix ] = 0.0; }
+            for ( int orb_occ = 0; orb_occ < numPairs; orb_occ++ ){
+                for ( int orb_vir = 0; orb_vir < nVir; orb_vir++ ){
+                    const double value = 2.0 * work1[ orb_vir + nVir * orb_occ ] * temp[ orb_vir + nVir * orb_occ ];
+                    if ( fabs( value ) <= thresh ){ continue; }
+                    for ( int ix = 0; ix < nNeed; ix++ ){
+                        work2[ ix + nNeed * orb_occ ] += value * virt[ need[ ix ] + Norb * orb_vir ];
+                    }
+                }
+            }
+
+            // rdm_deriv = ( work2 * OCC.T + OCC * work2.T )[ outrow, outcol ]
+            for ( int elem = 0; elem < Nout; elem++ ){
+                const int row = outrow[ elem ];
+                const int col = outcol[ elem ];
+                double value = 0.0;
+                for ( int orb_occ = 0; orb_occ < numPairs; orb_occ++ ){
+                    value += work2[ pos[ row ] + nNeed * orb_occ ] * occ[ col + Norb * orb_occ ];
+                    value += work2[ pos[ col ] + nNeed * orb_occ ] * occ[ row + Norb * orb_occ ];
+                }
+                rdm_deriv[ elem + Nout * deriv ] = value;
+            }
+        }
+
+        free(work1);
+        free(work2);
+    }
+
+    free(need);
+    free(pos);
+    free(temp);
+    free(eigvals);
+    free(eigvecs);
+
+}
+}
@@ -359,6 +359,81 @@ void SINT_SDCDERI_DDMAT (double * dense_cderi, double * dense_A, double * dense_
 }
 }
 
+void SINT_SDCDERI_DDMAT_BATCH (double * dense_cderi, double * dense_A, double ** dense_prods, double * wrk,
+    int * iao_sort, int * iao_nent, int * iao_entlist, int * imat_nmo, int nmat, int nao, int naux, int nent_max)
+{
+    /*
+    As SINT_SDCDERI_DDMAT, but for several multiplicands stacked side by side in dense_A, so that the CDERI array is
+    only gathered once for all of them.
+
+    Input:
+        dense_A : array of shape (nao, sum (imat_nmo)); contains the multiplicands A_0 | A_1 | ... concatenated along columns
+        imat_nmo : array of shape (nmat); number of columns of each multiplicand
+        (others as in SINT_SDCDERI_DDMAT)
+
+    Input/output:
+        wrk : array of length nthreads * nent_max * (naux + sum (imat_nmo)); contains 0s on input and garbage on output
+
+    Output:
+        dense_prods : array of nmat pointers; dense_prods[i] is an array of shape (nao, imat_nmo[i], naux)
+    */
+
+    const unsigned int i_one = 1;
+    const unsigned int npair = nao * (nao + 1) / 2;
+    const double d_one = 1.0;
+    const char transCDERI = 'T';
+    const char transA = 'N';
+    int nmo_tot = 0;
+    int imat;
+    for (imat = 0; imat < nmat; imat++){ nmo_tot += imat_nmo[imat]; }
+
+#pragma omp parallel default(shared)
+{
+
+    unsigned int ithread = omp_get_thread_num ();
+    unsigned int iao_ix, iao, jao_ix, jao; // AO indices
+    int my_nent, my_imat, my_nmo, my_off;
+    double * my_cderi;
+    double * my_A;
+    double * my_cderi_wrk;
+    double * my_A_wrk;
+    int * my_entlist;
+    my_cderi_wrk = wrk + (ithread * nent_max * (naux + nmo_tot));
+    my_A_wrk = my_cderi_wrk + (nent_max * naux);
+
+#pragma omp for schedule(static) 
+
+    for (iao_ix = 0; iao_ix < nao; iao_ix++){
+        iao = iao_sort[iao_ix];
+        my_nent = iao_nent[iao];
+        if (my_nent == 0){ continue; }
+        my_entlist = iao_entlist + (iao*nent_max);
+        for (jao_ix = 0; jao_ix < my_nent; jao_ix++){
+            jao = my_entlist[jao_ix];
+            if (iao > jao){ 
+                my_cderi = dense_cderi + ((iao * (iao + 1) / 2) + jao);
+            } else {
+                my_cderi = dense_cderi + ((jao * (jao + 1) / 2) + iao);
+            }
+            my_A = dense_A + (jao * nmo_tot);
+            dcopy_(&naux, my_cderi, &npair, my_cderi_wrk + jao_ix, &my_nent);
+            dcopy_(&nmo_tot, my_A, &i_one, my_A_wrk + jao_ix, &my_nent);
+        }
+        my_off = 0;
+        for (my_imat = 0; my_imat < nmat; my_imat++){
+            my_nmo = imat_nmo[my_imat];
+            if (my_nmo > 0){
+                dgemm_(&transCDERI, &transA, &naux, &my_nmo, &my_nent,
+                    &d_one, my_cderi_wrk, &my_nent, my_A_wrk + (my_off * my_nent), &my_nent,
+                    &d_one, dense_prods[my_imat] + (iao * my_nmo * naux), &naux);
+            }
+            my_off += my_nmo;
+        }
+    }
+
+}
+}
+
 void SINT_SDCDERI_VK (double * dense_cderi, double * dense_int, double * dense_vk, double * wrk,  
     int * iao_sort, int * iao_nent, int * iao_entlist, int nao, int naux, int nent_max)
 {
@@ -6,7 +6,7 @@ from pyscf import gto, scf, ao2mo, fci
 from pyscf.scf.hf import dot_eri_dm
 from pyscf.scf.addons import project_mo_nr2nr
 from pyscf.symm.addons import symmetrize_space, label_orb_symm
-from pyscf.lib import logger
+from pyscf.lib import logger, current_memory
 from pyscf.tools import molden
 from pyscf.lib.numpy_helper import unpack_tril, pack_tril
 from mrh.my_dmet import pyscf_rhf, pyscf_mp2, pyscf_cc, pyscf_casscf, qcdmethelper, pyscf_fci #, chemps2
@@ -61,6 +61,10 @@ def dummy_rhf (frag, oneRDM_imp, chempot_imp):
         matrix_eigen_control_options (represent_operator_in_basis (frag.ints.activeFOCK, frag.loc2imp),
             sort_vecs=1, only_nonzero_vals=False)[1])
 
+# Impurity solvers which can take CDERIs through fragment_object.impham_attach_eri. The FCI solver contracts the dense
+# ERIs itself (pyscf.fci has no density-fitted kernel), so it always gets those.
+CDERI_SOLVERS = ("RHF", "MP2", "CC", "CASSCF")
+
 class fragment_object:
 
     def __init__ (self, ints, frag_orb_list, solver_name, **kwargs): #active_orb_list, name, norbs_bath_max=None, idempotize_thresh=0.0, mf_attr={}, corr_attr={}):
@@ -84,7 +88,7 @@ class fragment_object:
         self.debug_energy = False
         self.imp_maxiter = None # Currently only does anything for casscf solver
         self.quasidirect = True # Currently only does anything for rhf (in development)
-        self.project_cderi = False
+        self.project_cderi = False # Force CDERI impurity integrals; otherwise chosen by plan_impham_integrals
         self.mf_attr = {}
         self.corr_attr = {}
         self.cas_guess_callback = None
@@ -97,6 +101,8 @@ class fragment_object:
         self.quasifrag_gradient = True
         self.approx_hessbath = True
         self.conv_tol_grad = 1e-4
+        self.impham_cache_maxfrac = 0.5 # Max fraction of new impurity orbitals for which cached integrals are updated
+        self.impham_cache_lindep = 1e-8
         for key in kwargs:
             if key in self.__dict__:
                 self.__dict__[key] = kwargs[key]
@@ -157,6 +163,7 @@ class fragment_object:
         self.impham_OEI_S = None
         self.impham_TEI   = None
         self.impham_CDERI = None
+        self.impham_cache = None # (ao2loc, loc2imp, kind, integrals) from the last build, to be updated next time
 
         # Point-group symmetry information
         self.groupname = 'C1'
@@ -786,8 +793,9 @@ class fragment_object:
         grad_comp = fock_loc @ oneRDM_loc
         grad_comp -= grad.T
         # 2-body part
-        eri = self.ints.general_tei ([loc2cenv, self.loc2amo, self.loc2amo, self.loc2amo])
-        eri_grad = np.tensordot (eri, self.twoCDMimp_amo, axes=((1,2,3),(1,2,3))) # NOTE: just saying axes=3 gives an INCORRECT result
+        eri_grad = np.zeros ((loc2cenv.shape[1], self.norbs_as), dtype=loc2cenv.dtype)
+        for i0, i1, eri in self.ints.general_tei_blocks ([loc2cenv, self.loc2amo, self.loc2amo, self.loc2amo]):
+            eri_grad[i0:i1] = np.tensordot (eri, self.twoCDMimp_amo, axes=((1,2,3),(1,2,3))) # NOTE: just saying axes=3 gives an INCORRECT result
         grad_comp += loc2cenv @ eri_grad @ self.amo2loc
         # Testing hessian calculator
         print ("************************************* TEST ****************************************")
@@ -907,10 +915,9 @@ class fragment_object:
         virtbath2loc = loc2virtbath.conjugate ().T
         grad = virtbath2loc @ fock @ oneRDM_loc @ loc2occ
         if self.norbs_as > 0:
-            eri = self.ints.general_tei ([loc2virtbath, self.loc2amo, self.loc2amo, self.loc2amo])
             lamb = np.tensordot (self.amo2loc @ loc2occ, self.twoCDMimp_amo, axes=(0,0))
-            print (eri.shape, lamb.shape)
-            grad += np.tensordot (eri, lamb, axes=((1,2,3),(1,2,3))) # axes=3 is INCORRECT!
+            for i0, i1, eri in self.ints.general_tei_blocks ([loc2virtbath, self.loc2amo, self.loc2amo, self.loc2amo]):
+                grad[i0:i1] += np.tensordot (eri, lamb, axes=((1,2,3),(1,2,3))) # axes=3 is INCORRECT!
         return 2 * grad, occ_labels
             
     def test_Schmidt_basis_energy (self):
@@ -949,6 +956,65 @@ class fragment_object:
 
     # Impurity Hamiltonian
     ###############################################################################################################################
+    def get_impham_integrals (self, kind):
+        ''' Two-electron integrals of the impurity orbitals, either as 8-fold-symmetric ERIs (kind='tei') or as packed
+        CDERIs (kind='cderi'). Between DMET iterations the impurity orbitals usually change by a small rotation plus a few
+        new bath directions, so the integrals of the previous build are rotated into the new basis and only those
+        involving the new directions are transformed from the AO basis. A full transformation is done instead if there is
+        no cache or if the new directions exceed impham_cache_maxfrac of the impurity. '''
+        loc2imp = self.loc2imp
+        full_build = {'tei': lambda: self.ints.dmet_tei (self.loc2emb, self.norbs_imp, symmetry=8),
+                      'cderi': lambda: self.ints.dmet_cderi (self.loc2emb, self.norbs_imp)}[kind]
+        cache = self.impham_cache
+        if cache is None or cache[0] is not self.ints.ao2loc or cache[2] != kind:
+            integrals = full_build ()
+        else:
+            loc2old, ints_old = cache[1], cache[3]
+            update_basis = self.ints.get_imp_update_basis (loc2old, loc2imp, lindep=self.impham_cache_lindep)
+            nxtra = update_basis[0].shape[1]
+            if nxtra > self.impham_cache_maxfrac * self.norbs_imp:
+                integrals = full_build ()
+            elif kind == 'tei':
+                print ("Updating cached impurity ERIs with {} new orbitals".format (nxtra))
+                integrals = self.ints.dmet_tei_update (loc2old, ints_old, loc2imp, symmetry=8,
+                    update_basis=update_basis)
+            else:
+                print ("Updating cached impurity CDERIs with {} new orbitals".format (nxtra))
+                integrals = self.ints.dmet_cderi_update (loc2old, ints_old, loc2imp, update_basis=update_basis)
+        self.impham_cache = (self.ints.ao2loc, loc2imp.copy (), kind, integrals)
+        return integrals
+
+    def plan_impham_integrals (self):
+        ''' Choose the storage of the impurity two-electron integrals. Returns 'jk' for the quasi-direct RHF solver, 'tei'
+        for dense 8-fold-symmetric ERIs and 'cderi' for packed CDERIs of shape (naux, npair). CDERIs are used whenever
+        density fitting is available and either project_cderi is set or the dense ERIs (whose transformation peaks at the
+        size of the 4-fold-symmetric tensor) would not fit in ints.max_memory. Solvers not in CDERI_SOLVERS (FCI), which
+        contract the dense ERIs themselves rather than through impham_attach_eri, always get dense ERIs. '''
+        if self.imp_solver_name == "RHF" and self.quasidirect: return 'jk'
+        if self.ints.with_df is None: return 'tei'
+        if self.imp_solver_name not in CDERI_SOLVERS: return 'tei'
+        if self.project_cderi: return 'cderi'
+        npair = self.norbs_imp * (self.norbs_imp + 1) // 2
+        mem_tei = 8 * npair * npair / 1e6
+        mem_cderi = 8 * self.ints.with_df.get_naoaux () * npair / 1e6
+        mem_avail = self.ints.max_memory - current_memory ()[0]
+        plan = 'tei' if mem_tei < mem_avail else 'cderi'
+        print ("Impurity integral planner: dense ERIs {:.0f} MB, CDERIs {:.0f} MB, {:.0f} MB available -> {}".format (
+            mem_tei, mem_cderi, mem_avail, plan))
+        return plan
+
+    def impham_attach_eri (self, mf):
+        ''' Give the mean-field object mf of an impurity solver the impurity two-electron integrals: density-fitted with
+        mf.with_df._cderi if the impurity Hamiltonian was built with CDERIs, or mf._eri otherwise. Returns mf, which is a
+        new object in the former case. '''
+        if self.impham_CDERI is not None:
+            mf.mol.incore_anyway = False
+            mf = mf.density_fit ()
+            mf.with_df._cderi = self.impham_CDERI
+        else:
+            mf._eri = ao2mo.restore (8, self.impham_TEI, self.norbs_imp)
+        return mf
+
     def construct_impurity_hamiltonian (self, xtra_CONST=0.0):
         w0, t0 = time.time (), time.clock () 
         self.warn_check_Schmidt ("construct_impurity_hamiltonian")
@@ -957,7 +1023,8 @@ class fragment_object:
             self.impham_built = True
             self.imp_solved   = False
             return
-        if self.imp_solver_name == "RHF" and self.quasidirect:
+        impham_plan = self.plan_impham_integrals ()
+        if impham_plan == 'jk':
             ao2imp = np.dot (self.ints.ao2loc, self.loc2imp)
             def my_jk (mol, dm, hermi=1):
                 dm_ao        = represent_operator_in_basis (dm, ao2imp.T)
@@ -966,6 +1033,7 @@ class fragment_object:
                 vk_basis     = represent_operator_in_basis (vk_ao, ao2imp)
                 return vj_basis, vk_basis
             self.impham_TEI = None 
+            self.impham_CDERI = None
             #self.impham_TEI_fiii = None # np.empty ([self.norbs_frag] + [self.norbs_imp for i in range (3)], dtype=np.float64)
             self.impham_get_jk = my_jk
             vj, vk_c = self.impham_get_jk (self.ints.mol, self.get_oneRDM_imp ())
@@ -976,10 +1044,10 @@ class fragment_object:
             sie += np.tensordot (vj, cdm) / 2
             sie -= np.tensordot (vk_c, cdm) / 4
             sie -= np.tensordot (vk_s, sdm) / 4
-        elif self.project_cderi:
+        elif impham_plan == 'cderi':
             self.impham_TEI = None
             self.impham_get_jk = None
-            self.impham_CDERI = self.ints.dmet_cderi (self.loc2emb, self.norbs_imp)
+            self.impham_CDERI = self.get_impham_integrals ('cderi')
             cdm = self.get_oneRDM_imp ()
             sdm = self.get_oneSDM_imp ()
             cdm_pack = cdm + cdm.T
@@ -1000,20 +1068,19 @@ class fragment_object:
         else:
             f = self.loc2frag
             i = self.loc2imp
-            self.impham_TEI = self.ints.dmet_tei (self.loc2emb, self.norbs_imp, symmetry=8) 
+            self.impham_TEI = self.get_impham_integrals ('tei')
             #self.impham_TEI_fiii = self.ints.general_tei ([f, i, i, i])
             self.impham_get_jk = None
+            self.impham_CDERI = None
             cdm = self.get_oneRDM_imp ()
             sdm = self.get_oneSDM_imp ()
-            eri = ao2mo.restore (1, self.impham_TEI, self.norbs_imp)
-            vj = np.tensordot (eri, cdm, axes=2)
-            vk_c = np.tensordot (eri, cdm, axes=((1,2),(0,1)))
-            vk_s = np.tensordot (eri, sdm, axes=((1,2),(0,1)))
+            vj, vk_c = dot_eri_dm (self.impham_TEI, cdm, hermi=1)
+            vk_s = dot_eri_dm (self.impham_TEI, sdm, hermi=1, with_j=False)[1]
             sie = self.E2_cum
             sie += np.tensordot (vj, cdm) / 2
             sie -= np.tensordot (vk_c, cdm) / 4
             sie -= np.tensordot (vk_s, sdm) / 4
-            eri = cdm = sdm = None
+            cdm = sdm = None
 
         #OEI_C = self.ints.dmet_fock (self.loc2emb, self.norbs_imp, self.oneRDMfroz_loc)
         #OEI_S = -self.ints.dmet_k (self.loc2emb, self.norbs_imp, self.oneSDMfroz_loc) / 2
@@ -1115,6 +1182,22 @@ class fragment_object:
         if not self.target_MS: guess_1RDM = guess_1RDM[0] + guess_1RDM[1]
         return guess_1RDM
 
+    def get_chempot_response (self):
+        ''' Mean-field estimate of d(nelec_frag)/d(chempot_frag), from the uncoupled response of the orbitals of the
+        impurity-projected Fock matrix used for the guess 1RDM (see get_guess_1RDM). This requires no impurity solution
+        and is used to take Newton steps on the chemical potential and to decide which fragments need to be re-solved. '''
+        FOCK = represent_operator_in_basis (self.ints.activeFOCK, self.loc2imp)
+        P = represent_operator_in_basis (np.eye (self.norbs_frag), self.frag2imp)
+        evals, evecs = sp.linalg.eigh (FOCK)
+        P = evecs.conjugate ().T @ P @ evecs
+        dN = 0.0
+        for nocc in (int (round ((self.nelec_imp // 2) + self.target_MS)), int (round ((self.nelec_imp // 2) - self.target_MS))):
+            gap = evals[nocc:,None] - evals[None,:nocc]
+            if not gap.size: continue
+            gap[np.abs (gap) < params.num_zero_atol] = params.num_zero_atol
+            dN += 2 * np.sum ((P[nocc:,:nocc]**2) / gap)
+        return dN
+
     def solve_impurity_problem (self, chempot_frag):
         self.warn_check_impham ("solve_impurity_problem")
 
@@ -1180,21 +1263,22 @@ class fragment_object:
         occ_err = linalg.norm (cno_occ[norbs_cinac:])
         olap_err = measure_basis_olap (cext2loc.conjugate ().T, self.loc2imp)
         print ("I think I have {} core external orbitals; occupancy error = {}, overlap error = {}".format (len (cno_occ) - norbs_cinac, occ_err, olap_err))
-        eri_faaa = self.ints.general_tei ([np.eye (self.norbs_tot), self.loc2amo, self.loc2amo, self.loc2amo])
-        eri_iunac = np.tensordot (iunac2loc, eri_faaa, axes=1)
-        eri_core = np.tensordot (self.core2loc, eri_faaa, axes=1)
+        # (f,a|a,a) contracted with the cumulant, one slab of the first index at a time
+        eri_grad_faaa = np.zeros ((self.norbs_tot, self.norbs_as), dtype=self.loc2amo.dtype)
+        for i0, i1, eri in self.ints.general_tei_blocks ([np.eye (self.norbs_tot), self.loc2amo, self.loc2amo, self.loc2amo]):
+            eri_grad_faaa[i0:i1] = np.tensordot (eri, self.twoCDMimp_amo, axes=((1,2,3),(1,2,3)))
         # Active orbital-impurity unac
         grad = fock_loc @ oneRDM_loc
         grad -= grad.T
         grad = iunac2loc @ grad @ self.loc2amo
-        eri_grad = np.tensordot (eri_iunac, self.twoCDMimp_amo, axes=((1,2,3),(1,2,3))) # NOTE: just saying axes=3 gives an INCORRECT result
+        eri_grad = iunac2loc @ eri_grad_faaa
         grad += eri_grad
         print ("Active to imp-unac gradient norm: {}".format (linalg.norm (grad)))
         # Active orbital-core
         grad = fock_loc @ oneRDM_loc
         grad -= grad.T
         grad = self.core2loc @ grad @ self.loc2amo
-        eri_grad = np.tensordot (eri_core, self.twoCDMimp_amo, axes=((1,2,3),(1,2,3))) # NOTE: just saying axes=3 gives an INCORRECT result
+        eri_grad = self.core2loc @ eri_grad_faaa
         grad += eri_grad
         print ("Active to core gradient norm: {}".format (linalg.norm (grad)))
         print ("Imp-inac to imp-extern gradient norm: {}".format (linalg.norm (iext2loc @ fock_loc @ loc2iinac * 2)))
@@ -1380,15 +1464,17 @@ class fragment_object:
                 mo_coeffs = [self.imp2frag, self.imp2amo, self.imp2amo, self.imp2amo]
                 norbs = [self.norbs_frag, self.norbs_as, self.norbs_as, self.norbs_as]
                 V_fiii = ao2mo.incore.general (self.impham_TEI, mo_coeffs, compact=False).reshape (*norbs)
+                E2 = 0.5 * np.tensordot (V_fiii, L_fiii, axes=4)
             elif isinstance (self.impham_CDERI, np.ndarray):
                 with_df = copy.copy (self.ints.with_df)
                 with_df._cderi = self.impham_CDERI
                 mo_coeffs = [self.imp2frag, self.imp2amo, self.imp2amo, self.imp2amo]
                 norbs = [self.norbs_frag, self.norbs_as, self.norbs_as, self.norbs_as]
                 V_fiii = with_df.ao2mo (mo_coeffs, compact=False).reshape (*norbs)
+                E2 = 0.5 * np.tensordot (V_fiii, L_fiii, axes=4)
             else:
-                V_fiii = self.ints.general_tei ([self.loc2frag, self.loc2amo, self.loc2amo, self.loc2amo])
-            E2 = 0.5 * np.tensordot (V_fiii, L_fiii, axes=4)
+                E2 = 0.5 * sum ([np.tensordot (V_blk, L_fiii[i0:i1], axes=4) for i0, i1, V_blk
+                    in self.ints.general_tei_blocks ([self.loc2frag, self.loc2amo, self.loc2amo, self.loc2amo])])
         elif isinstance (self.twoCDM_imp, np.ndarray):
             L_iiif = np.tensordot (self.twoCDM_imp, self.imp2frag, axes=1)
             if isinstance (self.impham_TEI, np.ndarray):
@@ -1403,8 +1489,12 @@ class fragment_object:
                 # (P|if) * R^P_if -> E2
                 # But factors of 2 abound especially with the orbital-pair compacting of CDERI
             else:
-                V_iiif = self.ints.general_tei ([self.loc2frag, self.loc2imp, self.loc2imp, self.loc2imp])
-                E2 = 0.5 * np.tensordot (V_iiif, L_iiif, axes=4)
+                # V_iiif[p,q,r,f] = V_fiii[f,r,q,p] and G_pqrs = G_srqp, so L_fiii[f,r,q,p] = L_iiif[p,q,r,f]. Both
+                # permutations hold only for real orbitals and RDMs.
+                assert (not (np.iscomplexobj (L_iiif) or np.iscomplexobj (self.loc2imp))), "complex 2-RDM or orbitals"
+                L_fiii = L_iiif.transpose (3,2,1,0)
+                E2 = 0.5 * sum ([np.tensordot (V_blk, L_fiii[i0:i1], axes=4) for i0, i1, V_blk
+                    in self.ints.general_tei_blocks ([self.loc2frag, self.loc2imp, self.loc2imp, self.loc2imp])])
         if self.debug_energy:
             print ("get_E_frag {0} :: E2 = {1:.5f}".format (self.frag_name, float (E2)))
 
@@ -1556,6 +1646,38 @@ class fragment_object:
         else:
             return rsp_1RDM_frag.flatten (order='F')
 
+    def get_rsp_1RDM_idx (self, dmet):
+        ''' Row and column indices (rows, cols) such that get_rsp_1RDM_elements (dmet, rsp_1RDM) = rsp_1RDM[rows,cols], or None
+        if the elements aren't a plain selection (i.e., if the fragment or impurity basis isn't a subset of the local orbitals) '''
+        if dmet.doDET_NO:
+            return np.asarray (self.frag_orb_list), np.asarray (self.frag_orb_list)
+        if dmet.incl_bath_errvec or dmet.altcostfunc:
+            return None
+        if not np.array_equal (self.loc2frag, self.get_true_loc2frag ()):
+            return None
+        frag_orb_list = np.asarray (self.frag_orb_list)
+        if dmet.doDET:
+            return frag_orb_list, frag_orb_list
+        cols, rows = np.meshgrid (frag_orb_list, frag_orb_list, indexing='ij')
+        return rows.ravel (), cols.ravel ()
+
+    def get_rsp_1RDM_adjoint (self, dmet, errvec):
+        ''' Adjoint of get_rsp_1RDM_elements: the matrix A such that np.dot (errvec, get_rsp_1RDM_elements (dmet, rsp_1RDM))
+        = np.sum (A * rsp_1RDM) for any rsp_1RDM, in the same basis as rsp_1RDM '''
+        self.warn_check_imp_solve ("get_rsp_1RDM_adjoint")
+        if dmet.altcostfunc:
+            raise RuntimeError("You shouldn't have gotten in to get_rsp_1RDM_adjoint if you're using the constrained-optimization cost function!")
+        if dmet.doDET_NO:
+            adj_1RDM = np.zeros ((dmet.norbs_tot, dmet.norbs_tot), dtype=errvec.dtype)
+            adj_1RDM[self.frag_orb_list,self.frag_orb_list] = errvec
+            return adj_1RDM
+        if dmet.incl_bath_errvec:
+            return represent_operator_in_basis (errvec.reshape (self.norbs_imp, self.norbs_imp, order='F'), self.loc2imp.T)
+        if dmet.doDET:
+            return represent_operator_in_basis (np.diag (errvec), self.loc2frag.T)
+        else:
+            return represent_operator_in_basis (errvec.reshape (self.norbs_frag, self.norbs_frag, order='F'), self.loc2frag.T)
+
 
 
 
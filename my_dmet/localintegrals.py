@@ -18,12 +18,12 @@
 '''
 
 #import qcdmet_paths
-from pyscf import gto, scf, ao2mo, tools, lo
+from pyscf import gto, scf, ao2mo, tools, lo, lib
 from pyscf.lo import nao, orth, boys
 from pyscf.x2c import x2c
 from pyscf.tools import molden
 from pyscf.lib import current_memory
-from pyscf.lib.numpy_helper import tag_array
+from pyscf.lib.numpy_helper import tag_array, pack_tril, unpack_tril
 from pyscf.symm.addons import symmetrize_space, label_orb_symm
 from pyscf.symm.addons import eigh as eigh_symm
 from pyscf.scf.hf import dot_eri_dm
@@ -31,6 +31,7 @@ from pyscf.scf.rohf import get_roothaan_fock
 from pyscf import __config__
 from mrh.my_dmet import rhf as wm_rhf
 from mrh.my_dmet import iao_helper
+from mrh.my_pyscf.df.sparse_df import get_sparsedf
 import numpy as np
 import scipy
 from mrh.util.my_math import is_close_to_integer
@@ -41,14 +42,74 @@ from mrh.util.la import matrix_eigen_control_options, matrix_svd_control_options
 from mrh.util import params
 from math import sqrt
 import itertools
-import time, sys, gc
+import time, sys, gc, os, hashlib
+from collections import OrderedDict
 from functools import reduce, partial
 
 LINEAR_DEP_THR = getattr(__config__, 'df_df_DF_lindep', 1e-12)
+# Localized orbitals (and the localized one-electron operators derived from them) are kept in memory for up to
+# LOC_CACHE_SIZE molecules and, if LOC_CACHE_DIR is set, saved to and loaded from .npz files in that directory
+LOC_CACHE_SIZE = getattr(__config__, 'dmet_localintegrals_LOC_CACHE_SIZE', 8)
+LOC_CACHE_DIR = getattr(__config__, 'dmet_localintegrals_LOC_CACHE_DIR', None)
+_loc_cache = OrderedDict ()
+_boys_last = {} # Last Boys-localized orbitals for each molecule signature without the geometry, for warm starts
+
+def _sha1 (*arrs):
+    h = hashlib.sha1 ()
+    for arr in arrs:
+        h.update (np.ascontiguousarray (arr).tobytes () if isinstance (arr, np.ndarray) else repr (arr).encode ())
+    return h.hexdigest ()
+
+def _mol_signature (mol, active, with_geom=True):
+    sig = [mol.atom_charges (), repr (sorted (mol._basis.items ())), bool (mol.cart), np.asarray (active)]
+    if with_geom: sig.append (np.round (mol.atom_coords (), 10))
+    return _sha1 (*sig)
+
+def _loc_cache_load (key):
+    if key in _loc_cache:
+        _loc_cache.move_to_end (key)
+        return _loc_cache[key]
+    if not LOC_CACHE_DIR: return None
+    path = os.path.join (LOC_CACHE_DIR, 'loc_{}.npz'.format (key))
+    if not os.path.isfile (path): return None
+    try:
+        with np.load (path) as f:
+            entry = {k: f[k] for k in f.files}
+    except (OSError, ValueError):
+        return None
+    _loc_cache_store (key, entry, save=False)
+    return entry
+
+def _loc_cache_store (key, entry, save=True):
+    _loc_cache[key] = entry
+    _loc_cache.move_to_end (key)
+    while len (_loc_cache) > max (LOC_CACHE_SIZE, 0): _loc_cache.popitem (last=False)
+    if not (save and LOC_CACHE_DIR): return
+    path = os.path.join (LOC_CACHE_DIR, 'loc_{}.npz'.format (key))
+    try:
+        os.makedirs (LOC_CACHE_DIR, exist_ok=True)
+        # Write-then-rename so that concurrent processes never see a partial file
+        ptmp = '{}.{}.tmp.npz'.format (path[:-4], os.getpid ())
+        np.savez (ptmp, **entry)
+        os.replace (ptmp, path)
+    except OSError:
+        pass
+
+def _boys_warm_start_orbs (mol, ao2act, mol_prev, ao2loc_prev):
+    ''' Starting orbitals for Boys localization of the span of ao2act at the geometry of mol: the localized orbitals
+    ao2loc_prev of another geometry mol_prev, carried over through the AO overlap between the two geometries, projected
+    onto the span of ao2act and symmetrically orthonormalized '''
+    ovlp = mol.intor_symmetric ('int1e_ovlp')
+    ovlp_cross = gto.intor_cross ('int1e_ovlp', mol, mol_prev)
+    act2loc = ao2act.conjugate ().T @ ovlp_cross @ ao2loc_prev
+    # Match orbitals to their closest counterpart: Lowdin orthonormalization keeps them as close as possible to act2loc
+    u, svals, vh = scipy.linalg.svd (act2loc, full_matrices=False)
+    return ao2act @ (u @ vh)
 
 class localintegrals:
 
-    def __init__( self, the_mf, active_orbs, localizationtype, ao_rotation=None, use_full_hessian=True, localization_threshold=1e-6 ):
+    def __init__( self, the_mf, active_orbs, localizationtype, ao_rotation=None, use_full_hessian=True, localization_threshold=1e-6,
+            use_loc_cache=False, boys_warm_start=False ):
 
         assert (( localizationtype == 'meta_lowdin' ) or ( localizationtype == 'boys' ) or ( localizationtype == 'lowdin' ) or ( localizationtype == 'iao' ))
         self.num_mf_stab_checks = 0
@@ -83,8 +144,22 @@ class localintegrals:
         self.norbs_tot = np.sum( self.active ) # Number of active space orbitals
         self.nelec_tot = int(np.rint( self.mol.nelectron - np.sum( the_mf.mo_occ[ self.active==0 ] ))) # Total number of electrons minus frozen part
 
-        # Localize the orbitals
-        if (( self._which == 'meta_lowdin' ) or ( self._which == 'boys' )):
+        # Localize the orbitals, unless the same molecule has already been localized the same way. Localizations that depend
+        # on the SCF orbitals (IAO, Boys within a subspace) are also keyed on the relevant density matrix
+        loc_key = [localizationtype, _mol_signature (self.mol, active_orbs)]
+        if ao_rotation is not None: loc_key.append (np.asarray (ao_rotation))
+        if self._which == 'iao':
+            loc_key.append (np.round (self.fullRDM_ao, 8))
+        elif self._which == 'boys' and self.norbs_tot != self.mol.nao_nr ():
+            ao2act = the_mf.mo_coeff[:,self.active==1]
+            loc_key.append (np.round (ao2act @ ao2act.conjugate ().T, 8))
+        loc_key = _sha1 (*loc_key)
+        loc_entry = _loc_cache_load (loc_key) if use_loc_cache else None
+        if loc_entry is not None:
+            print ("Localized orbitals taken from the cache")
+            self.ao2loc = loc_entry['ao2loc'].copy ()
+            self.TI_OK = False
+        elif (( self._which == 'meta_lowdin' ) or ( self._which == 'boys' )):
             if ( self._which == 'meta_lowdin' ):
                 assert( self.norbs_tot == self.mol.nao_nr() ) # Full active space required
             if ( self._which == 'boys' ):
@@ -92,7 +167,7 @@ class localintegrals:
             if ( self.norbs_tot == self.mol.nao_nr() ): # If you want the full active, do meta-Lowdin
                 nao.AOSHELL[4] = ['1s0p0d0f', '2s1p0d0f'] # redefine the valence shell for Be
                 self.ao2loc = orth.orth_ao( self.mol, 'meta_lowdin' )
-                if ( ao_rotation != None ):
+                if ( ao_rotation is not None ):
                     self.ao2loc = np.dot( self.ao2loc, ao_rotation.T )
             if ( self._which == 'boys' ):
                 old_verbose = self.mol.verbose
@@ -101,19 +176,25 @@ class localintegrals:
 #                loc = localizer.localizer( self.mol, self.ao2loc, self._which, use_full_hessian )
                 self.mol.verbose = old_verbose
 #                self.ao2loc = loc.optimize( threshold=localization_threshold )
-                self.ao2loc = loc.kernel ()
+                warm_key = _mol_signature (self.mol, active_orbs, with_geom=False)
+                if boys_warm_start and warm_key in _boys_last:
+                    print ("Boys localization warm-started from the orbitals of the previous geometry")
+                    self.ao2loc = loc.kernel (_boys_warm_start_orbs (self.mol, self.ao2loc, *_boys_last[warm_key]))
+                else:
+                    self.ao2loc = loc.kernel ()
+                _boys_last[warm_key] = (self.mol.copy (), self.ao2loc.copy ())
             self.TI_OK = False # Check yourself if OK, then overwrite
-        if ( self._which == 'lowdin' ):
+        elif ( self._which == 'lowdin' ):
             assert( self.norbs_tot == self.mol.nao_nr() ) # Full active space required
             ovlp = self.mol.intor('cint1e_ovlp_sph')
             ovlp_eigs, ovlp_vecs = np.linalg.eigh( ovlp )
             assert ( np.linalg.norm( np.dot( np.dot( ovlp_vecs, np.diag( ovlp_eigs ) ), ovlp_vecs.T ) - ovlp ) < 1e-10 )
             self.ao2loc = np.dot( np.dot( ovlp_vecs, np.diag( np.power( ovlp_eigs, -0.5 ) ) ), ovlp_vecs.T )
             self.TI_OK  = False # Check yourself if OK, then overwrite
-        if ( self._which == 'iao' ):
+        elif ( self._which == 'iao' ):
             assert( self.norbs_tot == self.mol.nao_nr() ) # Full active space assumed
             self.ao2loc = iao_helper.localize_iao( self.mol, the_mf )
-            if ( ao_rotation != None ):
+            if ( ao_rotation is not None ):
                 self.ao2loc = np.dot( self.ao2loc, ao_rotation.T )
             self.TI_OK = False # Check yourself if OK, then overwrite
             #self.molden( 'dump.molden' ) # Debugging mode
@@ -137,8 +218,19 @@ class localintegrals:
 
         # Localized OEI and ERI
         self.activeCONST    = self.mol.energy_nuc() + np.einsum( 'ij,ij->', self.frozenOEI_ao - 0.5*self.frozenJK_ao, self.frozenDM_ao )
-        self.activeOEI      = represent_operator_in_basis (self.frozenOEI_ao, self.ao2loc )
-        self.activeFOCK     = represent_operator_in_basis (self.fullFOCK_ao,  self.ao2loc )
+        ops_key = _sha1 (np.round (self.frozenOEI_ao, 10), np.round (self.fullFOCK_ao, 10))
+        if loc_entry is not None and str (loc_entry.get ('ops_key', '')) == ops_key:
+            self.activeOEI  = loc_entry['activeOEI'].copy ()
+            self.activeFOCK = loc_entry['activeFOCK'].copy ()
+        else:
+            # Cache miss, or same orbitals but different frozen part or Fock matrix (e.g., another charge state):
+            # recompute the operators and replace the stale entry, so that it is not recomputed for every later lookup
+            self.activeOEI  = represent_operator_in_basis (self.frozenOEI_ao, self.ao2loc )
+            self.activeFOCK = represent_operator_in_basis (self.fullFOCK_ao,  self.ao2loc )
+            if use_loc_cache:
+                if loc_entry is not None: _loc_cache.pop (loc_key, None)
+                _loc_cache_store (loc_key, {'ao2loc': self.ao2loc.copy (), 'activeOEI': self.activeOEI.copy (),
+                    'activeFOCK': self.activeFOCK.copy (), 'ops_key': np.asarray (ops_key)})
         self.activeVSPIN    = np.zeros_like (self.activeFOCK) # FIXME: correct behavior for ROHF init!
         self.activeJKidem   = self.activeFOCK - self.activeOEI
         self.activeJKcorr   = np.zeros ((self.norbs_tot, self.norbs_tot), dtype=self.activeOEI.dtype)
@@ -291,7 +383,20 @@ class localintegrals:
         oneRDM_loc = 2 * get_1RDM_from_OEI (OEI, nocc, subspace=loc2wrk)#, symmetry=self.loc2symm, strong_symm=self.enforce_symmetry)
         return oneRDM_loc + self.oneRDMcorr_loc
 
-    def get_wm_1RDM_from_scf_on_OEI (self, OEI, nelec=None, loc2wrk=None, oneRDMguess_loc=None, output=None, working_const=0):
+    def get_wm_1RDM_from_OEI_batch (self, OEIs, nelec=None, loc2wrk=None):
+        ''' get_wm_1RDM_from_OEI for a stack of OEIs of shape (nbatch, norbs_tot, norbs_tot), with all of the working-space
+        eigenproblems solved in one batched call '''
+        nelec   = nelec   or self.nelec_idem
+        loc2wrk = loc2wrk if np.any (loc2wrk) else self.loc2idem
+        nocc    = nelec // 2
+        OEIs_wrk = loc2wrk.conjugate ().T @ np.asarray (OEIs) @ loc2wrk
+        evecs = np.linalg.eigh (OEIs_wrk)[1]
+        loc2occ = loc2wrk @ evecs[:,:,:nocc]
+        oneRDMs_loc = 2 * (loc2occ @ loc2occ.conjugate ().transpose (0,2,1))
+        return oneRDMs_loc + self.oneRDMcorr_loc
+
+    def get_wm_1RDM_from_scf_on_OEI (self, OEI, nelec=None, loc2wrk=None, oneRDMguess_loc=None, output=None, working_const=0,
+            stats=None):
 
         nelec      = nelec   or self.nelec_idem
         loc2wrk    = loc2wrk if np.any (loc2wrk) else self.loc2idem
@@ -309,7 +414,7 @@ class localintegrals:
             self.num_mf_stab_checks, self.get_veff_ao, self.get_jk_ao,
             groupname=self.symmetry, symm_orb=wrk2symm, irrep_name=self.mol.irrep_name,
             irrep_id=self.mol.irrep_id, enforce_symmetry=self.enforce_symmetry,
-            output=output)
+            output=output, stats=stats)
         if self.enforce_symmetry: assert (is_operator_block_adapted (oneRDM_wrk, wrk2symm)), measure_operator_blockbreaking (oneRDM_wrk, wrk2symm)
         oneRDM_loc = represent_operator_in_basis (oneRDM_wrk, loc2wrk.T)
         if self.enforce_symmetry: assert (is_operator_block_adapted (oneRDM_loc, self.loc2symm)), measure_operator_blockbreaking (oneRDM_loc, self.loc2symm)
@@ -328,18 +433,16 @@ class localintegrals:
 
         loc2corr = np.concatenate ([frag.loc2amo for frag in fragments], axis=1)
 
-        # Calculate E2_cum            
-        E2_cum = 0
-        for frag in fragments:
-            if frag.norbs_as > 0:
-                if frag.E2_cum == 0 and np.amax (np.abs (frag.twoCDMimp_amo)) > 0:
-                    V  = self.dmet_tei (frag.loc2amo)
-                    L  = frag.twoCDMimp_amo
-                    frag.E2_cum  = np.tensordot (V, L, axes=4) / 2
-                    K  = self.loc_rhf_k_bis (frag.oneSDMas_loc)
-                    frag.E2_cum += (K * frag.oneSDMas_loc).sum () / 4
-                E2_cum += frag.E2_cum
-            
+        # Calculate E2_cum; the active-space ERIs of all fragments that need them are transformed together
+        new_frags = [frag for frag in fragments if frag.norbs_as > 0 and frag.E2_cum == 0
+            and np.amax (np.abs (frag.twoCDMimp_amo)) > 0]
+        for frag, V in zip (new_frags, self.dmet_tei_batch ([frag.loc2amo for frag in new_frags])):
+            L  = frag.twoCDMimp_amo
+            frag.E2_cum  = np.tensordot (V, L, axes=4) / 2
+            K  = self.loc_rhf_k_bis (frag.oneSDMas_loc)
+            frag.E2_cum += (K * frag.oneSDMas_loc).sum () / 4
+        E2_cum = sum ((frag.E2_cum for frag in fragments if frag.norbs_as > 0))
+
         loc2idem = get_complementary_states (loc2corr)
         test, err = are_bases_orthogonal (loc2idem, loc2corr)
         print ("Testing linear algebra: overlap of active and unactive orbitals = {}".format (linalg.norm (err)))
@@ -491,6 +594,31 @@ class localintegrals:
         DMguess = 2 * np.dot( eigvecs[ :, :numPairs ], eigvecs[ :, :numPairs ].T )
         return DMguess
 
+    def _cderi_ao2mo (self, ao2i, ao2j, compact=False, out=None):
+        ijmosym, mij_pair, moij, ijslice = ao2mo.incore._conc_mos (ao2i, ao2j, compact=compact)
+        if out is None: out = np.empty ((self.with_df.get_naoaux (), mij_pair), dtype=ao2i.dtype)
+        b0 = 0
+        for eri1 in self.with_df.loop ():
+            b1 = b0 + eri1.shape[0]
+            eri2 = out[b0:b1]
+            eri2 = ao2mo._ao2mo.nr_e2 (eri1, moij, ijslice, aosym='s2', mosym=ijmosym, out=eri2)
+            b0 = b1
+        return out
+
+    def _cderi_ao2mo_batch (self, ao2mo_list, compact=False):
+        ''' _cderi_ao2mo (ao2i, ao2i) for each ao2i in ao2mo_list. If the CDERIs are held in memory, one AO index is contracted
+        with all of the bases in a single sparse pass over them (sparsedf_array.contract1_batch); otherwise the bases are
+        transformed one at a time. '''
+        if not isinstance (getattr (self.with_df, '_cderi', None), np.ndarray):
+            return [self._cderi_ao2mo (ao2i, ao2i, compact=compact) for ao2i in ao2mo_list]
+        naux = self.with_df.get_naoaux ()
+        cderi_list = []
+        for ao2i, bmiP in zip (ao2mo_list, get_sparsedf (self.with_df).contract1_batch (ao2mo_list)):
+            nmo = ao2i.shape[1]
+            cderi = np.ascontiguousarray (np.tensordot (ao2i, np.asarray (bmiP), axes=((0),(0))).transpose (2,0,1))
+            cderi_list.append (pack_tril (cderi) if compact else cderi.reshape (naux, nmo*nmo))
+        return cderi_list
+
     def dmet_cderi (self, loc2dmet, numAct=None):
 
         t0 = time.clock ()
@@ -507,13 +635,7 @@ class localintegrals:
         print ("Size comparison: cderi is ({0},{1},{1})->{2:.0f} MB compacted; eri is ({1},{1},{1},{1})->{3:.0f} MB compacted".format (
                 norbs_aux, numAct, imp_cderi_size, imp_eri_size))
         ao2imp = np.dot (self.ao2loc, loc2imp)
-        ijmosym, mij_pair, moij, ijslice = ao2mo.incore._conc_mos (ao2imp, ao2imp, compact=True)
-        b0 = 0
-        for eri1 in self.with_df.loop ():
-            b1 = b0 + eri1.shape[0]
-            eri2 = CDERI[b0:b1]
-            eri2 = ao2mo._ao2mo.nr_e2 (eri1, moij, ijslice, aosym='s2', mosym=ijmosym, out=eri2)
-            b0 = b1
+        CDERI = self._cderi_ao2mo (ao2imp, ao2imp, compact=True, out=CDERI)
         t1 = time.clock ()
         w1 = time.time ()
         print (("({0}, {1}) seconds to turn {2:.0f}-MB full"
@@ -529,6 +651,81 @@ class localintegrals:
         TEI = symmetrize_tensor (self.general_tei ([loc2imp for i in range(4)], compact=True))
         return ao2mo.restore (symmetry, TEI, numAct)
 
+    def dmet_tei_batch (self, loc2dmet_list, symmetry=1):
+        ''' dmet_tei for each of several bases. With density fitting, the CDERIs of all of them are transformed together
+        (_cderi_ao2mo_batch). '''
+        if self.with_df is None: return [self.dmet_tei (loc2dmet, symmetry=symmetry) for loc2dmet in loc2dmet_list]
+        ao2mo_list = [self.with_df.loc2eri_bas (loc2dmet) for loc2dmet in loc2dmet_list]
+        cderi_list = self._cderi_ao2mo_batch (ao2mo_list, compact=True)
+        return [ao2mo.restore (symmetry, np.dot (cderi.T, cderi), loc2dmet.shape[1])
+            for loc2dmet, cderi in zip (loc2dmet_list, cderi_list)]
+
+    def get_imp_update_basis (self, loc2old, loc2new, lindep=1e-8):
+        ''' Express a new impurity basis in terms of an old one plus as few new orthonormal directions as possible:
+
+            loc2new = np.append (loc2old, loc2xtra, axis=1) @ umat
+
+        Args:
+            loc2old : ndarray of shape (norbs_tot, nold)
+            loc2new : ndarray of shape (norbs_tot, nnew)
+
+        Kwargs:
+            lindep : float
+                Components of loc2new outside of the span of loc2old with singular values smaller than this are dropped
+
+        Returns:
+            loc2xtra : ndarray of shape (norbs_tot, nxtra)
+            umat : ndarray of shape (nold+nxtra, nnew)
+        '''
+        ovlp = loc2old.conjugate ().T @ loc2new
+        resid = loc2new - loc2old @ ovlp
+        u, svals, vh = scipy.linalg.svd (resid, full_matrices=False)
+        loc2xtra = u[:,svals > lindep]
+        umat = np.append (ovlp, loc2xtra.conjugate ().T @ loc2new, axis=0)
+        return loc2xtra, umat
+
+    def dmet_cderi_update (self, loc2old, cderi_old, loc2new, lindep=1e-8, update_basis=None):
+        ''' Impurity CDERIs in the basis loc2new, given those (cderi_old, lower-triangular packed) in the basis loc2old. Only
+        the pairs involving directions of loc2new outside of the span of loc2old are transformed from the AO basis; if there
+        are none, this is just a rotation of cderi_old. update_basis is the output of get_imp_update_basis, if the caller
+        has already computed it. '''
+        if update_basis is None: update_basis = self.get_imp_update_basis (loc2old, loc2new, lindep=lindep)
+        loc2xtra, umat = update_basis
+        nold, nxtra = loc2old.shape[1], loc2xtra.shape[1]
+        ncomb = nold + nxtra
+        cderi = np.zeros ((cderi_old.shape[0], ncomb, ncomb), dtype=cderi_old.dtype)
+        cderi[:,:nold,:nold] = unpack_tril (cderi_old)
+        if nxtra:
+            ao2xtra = self.ao2loc @ loc2xtra
+            ao2comb = self.ao2loc @ np.append (loc2old, loc2xtra, axis=1)
+            cderi_xc = self._cderi_ao2mo (ao2xtra, ao2comb, compact=False).reshape (-1, nxtra, ncomb)
+            cderi[:,nold:,:] = cderi_xc
+            cderi[:,:nold,nold:] = cderi_xc[:,:,:nold].transpose (0,2,1)
+        cderi = np.dot (np.tensordot (umat.T, cderi, axes=((1),(1))), umat).transpose (1,0,2)
+        return pack_tril (cderi)
+
+    def dmet_tei_update (self, loc2old, tei_old, loc2new, symmetry=1, lindep=1e-8, update_basis=None):
+        ''' Impurity ERIs in the basis loc2new, given those (tei_old, in any pyscf.ao2mo.restore format) in the basis
+        loc2old. Only the integrals involving directions of loc2new outside of the span of loc2old are transformed from
+        the AO basis; if there are none, this is just a rotation of tei_old. update_basis is as in dmet_cderi_update. '''
+        if update_basis is None: update_basis = self.get_imp_update_basis (loc2old, loc2new, lindep=lindep)
+        loc2xtra, umat = update_basis
+        nold, nxtra = loc2old.shape[1], loc2xtra.shape[1]
+        nnew = loc2new.shape[1]
+        ncomb = nold + nxtra
+        eri = np.zeros ((ncomb, ncomb, ncomb, ncomb), dtype=tei_old.dtype)
+        eri[:nold,:nold,:nold,:nold] = ao2mo.restore (1, tei_old, nold)
+        if nxtra:
+            # (xc|cc) gives every integral with at least one index in the new directions, by permutational symmetry
+            loc2comb = np.append (loc2old, loc2xtra, axis=1)
+            eri_xccc = self.general_tei ([loc2xtra, loc2comb, loc2comb, loc2comb])
+            eri[nold:,:,:,:] = eri_xccc
+            eri[:,nold:,:,:] = eri_xccc.transpose (1,0,2,3)
+            eri[:,:,nold:,:] = eri_xccc.transpose (2,3,0,1)
+            eri[:,:,:,nold:] = eri_xccc.transpose (2,3,1,0)
+        TEI = symmetrize_tensor (ao2mo.incore.full (ao2mo.restore (8, eri, ncomb), umat, compact=False).reshape ([nnew,]*4))
+        return ao2mo.restore (symmetry, TEI, nnew)
+
     def dmet_const (self, loc2dmet, norbs_imp, oneRDMfroz_loc, oneSDMfroz_loc):
         norbs_core = self.norbs_tot - norbs_imp
         if norbs_core == 0:
@@ -564,6 +761,41 @@ class localintegrals:
 
         return TEI
 
+    def general_tei_blocks (self, loc2bas_list, max_memory=None):
+        ''' Generate the two-electron integrals (ij|kl) of general_tei (compact=False) in slabs of the first index, as
+        (i0, i1, eri[i0:i1,:,:,:]), so that callers which only contract the tensor need never hold all of it. Slabs are
+        sized to fit in max_memory (MB; default: what remains of self.max_memory). With density fitting, only the (P|kl)
+        half-transformed CDERIs are kept throughout; with neither CDERIs nor stored integrals, the tensor is transformed
+        out of core into a temporary HDF5 file and read back one slab at a time. '''
+        norbs = [loc2bas.shape[1] for loc2bas in loc2bas_list]
+        if max_memory is None: max_memory = self.max_memory - current_memory ()[0]
+        row_size = 8 * norbs[1] * norbs[2] * norbs[3] / 1e6
+        def get_blksize (mem_avail, mem_row):
+            return max (1, min (norbs[0], int (mem_avail / max (mem_row, 1e-12))))
+        if self.with_df is not None:
+            a2b_list = [self.with_df.loc2eri_bas (l2b) for l2b in loc2bas_list]
+            cderi_kl = self._cderi_ao2mo (a2b_list[2], a2b_list[3], compact=False)
+            blksize = get_blksize (max_memory - cderi_kl.nbytes / 1e6,
+                row_size + 8 * cderi_kl.shape[0] * norbs[1] / 1e6)
+            for i0, i1 in lib.prange (0, norbs[0], blksize):
+                cderi_ij = self._cderi_ao2mo (a2b_list[0][:,i0:i1], a2b_list[1], compact=False)
+                yield i0, i1, lib.dot (cderi_ij.T, cderi_kl).reshape (i1-i0, *norbs[1:])
+        elif self._eri is not None:
+            a2b_list = [self._eri.loc2eri_bas (l2b) for l2b in loc2bas_list]
+            blksize = get_blksize (max_memory, 2 * row_size)
+            for i0, i1 in lib.prange (0, norbs[0], blksize):
+                TEI = ao2mo.incore.general (self._eri, [a2b_list[0][:,i0:i1]] + a2b_list[1:], compact=False)
+                yield i0, i1, TEI.reshape (i1-i0, *norbs[1:])
+        else:
+            a2b_list = [np.dot (self.ao2loc, l2b) for l2b in loc2bas_list]
+            blksize = get_blksize (max_memory, row_size)
+            with lib.H5TmpFile () as feri:
+                ao2mo.outcore.general (self.mol, a2b_list, feri, dataname='eri_mo', max_memory=max (max_memory, 100),
+                    compact=False)
+                eri = feri['eri_mo']
+                for i0, i1 in lib.prange (0, norbs[0], blksize):
+                    yield i0, i1, eri[i0*norbs[1]:i1*norbs[1]].reshape (i1-i0, *norbs[1:])
+
     def compare_basis_to_loc (self, loc2bas, frags, nlead=3, quiet=True):
         nfrags = len (frags)
         norbs_tot, norbs_bas = loc2bas.shape
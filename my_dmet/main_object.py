@@ -29,7 +29,7 @@ import numpy as np
 from scipy import optimize, linalg
 import time, ctypes
 #import tracemalloc
-from pyscf import scf, mcscf
+from pyscf import scf, mcscf, lib
 from pyscf.lo import orth, nao
 from pyscf.lib import logger as pyscf_logger
 from pyscf.gto import mole, same_mol
@@ -125,6 +125,10 @@ class dmet:
         self.examine_ifrag_olap = False
         self.examine_wmcs = False
         self.ofc_emb_init_ncycles = 3
+        self.fd_nproc = 1 # Processes for the displaced SCFs of verify_gradient and hessian_eigenvalues
+        self.chempot_slope = None # d(Nelec)/d(chempot) from the last chemical-potential search
+        self.chempot_resolve_thresh = 1e-8 # Fragments whose predicted change in nelec_frag is smaller are not re-solved
+        self.chempot_maxiter = 50
 
         self.acceptable_errvec_check ()
         if self.altcostfunc:
@@ -274,13 +278,21 @@ class dmet:
         H1col   = np.array( H1col,   dtype=ctypes.c_int )
         return ( H1start, H1row, H1col )
         
-    def doexact( self, chempot_frag=0.0 ):
+    def solve_impurity_problems( self, frags, chempot_frag ):
+        ''' Solve the impurity problems of frags at chempot_frag, one after the other. The solvers update the state of
+        their fragments in place and are not thread-safe; the numerical work inside each is already parallel. '''
+        for frag in frags:
+            frag.solve_impurity_problem (chempot_frag)
+
+    def doexact( self, chempot_frag=0.0, frags_to_solve=None ):
+        ''' Solve the impurity problems at the chemical potential chempot_frag and return the total number of electrons.
+        If frags_to_solve is given, the other fragments keep their last solution. '''
         oneRDM_loc = self.helper.construct1RDM_loc( self.doSCF, self.umat ) 
         self.energy = 0.0												
         self.spin = 0.0
 
+        self.solve_impurity_problems (self.fragments if frags_to_solve is None else frags_to_solve, chempot_frag)
         for frag in self.fragments:
-            frag.solve_impurity_problem (chempot_frag)
             self.energy += frag.E_frag
             self.spin += frag.S2_frag
 
@@ -385,14 +397,21 @@ class dmet:
         
     def costfunction_derivative( self, newumatflat ):
         
+        # Back-propagate the error vector through the mean-field response in one shot, instead of building the derivative of
+        # the 1RDM with respect to every element of umat (see rdm_differences_derivative)
+        errors = self.rdm_differences( newumatflat )
+        newumatsquare_loc = self.flat2square( newumatflat )
+        adj_1RDM = self.rdm_differences_adjoint (errors)
+        thegradient = 2 * self.helper.contract1RDM_response( self.doSCF, newumatsquare_loc, self.loc2fno, adj_1RDM )
+        assert (len (thegradient) == len (newumatflat))
+        return thegradient
+
+    def costfunction_derivative_dense( self, newumatflat ):
+        
         errors = self.rdm_differences( newumatflat )
-#        error_derivs = self.rdm_differences_derivative( newumatflat )
         thegradient = np.zeros([ len( newumatflat ) ])
-#        for counter in range( len( newumatflat ) ):
         idx = 0
         for error_derivs in self.rdm_differences_derivative (newumatflat):
-            #thegradient[ counter ] = 2 * np.sum( np.multiply( error_derivs[ : , counter ], errors ) )
-            #thegradient[ counter ] = 2 * np.dot( error_derivs[ : , counter ], errors )
             thegradient[ idx ] = 2 * np.dot( error_derivs, errors )
             idx += 1
         assert (idx == len (newumatflat))
@@ -414,10 +433,40 @@ class dmet:
         
         return errvec
 
+    def rdm_differences_batch( self, umatflat_batch, oneRDMguess_loc=None ):
+        ''' rdm_differences for a stack of flattened correlation potentials of shape (nbatch, len (umatflat)), with the
+        mean-field 1RDMs computed all at once by helper.construct1RDM_loc_batch. Returns the error vectors as an array of
+        shape (nbatch, nerr) and the 1RDMs. '''
+        self.acceptable_errvec_check ()
+        umatsquare_batch = np.stack ([self.flat2square (umatflat) for umatflat in umatflat_batch], axis=0)
+        oneRDMs_loc = self.helper.construct1RDM_loc_batch( self.doSCF, umatsquare_batch, oneRDMguess_loc=oneRDMguess_loc,
+            nproc=self.fd_nproc )
+        errvecs = np.stack ([np.concatenate ([frag.get_errvec (self, oneRDM_loc) for frag in self.fragments])
+            for oneRDM_loc in oneRDMs_loc], axis=0)
+        return errvecs, oneRDMs_loc
+
+    def costfunction_derivative_batch( self, umatflat_batch, oneRDMguess_loc=None ):
+        ''' costfunction_derivative for a stack of flattened correlation potentials, reusing the 1RDMs of
+        rdm_differences_batch in the response contraction '''
+        errvecs, oneRDMs_loc = self.rdm_differences_batch (umatflat_batch, oneRDMguess_loc=oneRDMguess_loc)
+        gradients = [2 * self.helper.contract1RDM_response( self.doSCF, self.flat2square( umatflat ), self.loc2fno,
+            self.rdm_differences_adjoint (errvec), oneRDM_loc=oneRDM_loc )
+            for umatflat, errvec, oneRDM_loc in zip (umatflat_batch, errvecs, oneRDMs_loc)]
+        return np.stack (gradients, axis=0)
+
     def rdm_differences_derivative( self, newumatflat ):
         
         self.acceptable_errvec_check ()
         newumatsquare_loc = self.flat2square( newumatflat )
+        # If every fragment only needs to pick out elements of the response 1RDMs, the sparse kernel computes just those
+        rsp_idx = [frag.get_rsp_1RDM_idx (self) for frag in self.fragments]
+        if not (self.doLASSCF or any ([idx is None for idx in rsp_idx])):
+            outrow = np.concatenate ([idx[0] for idx in rsp_idx])
+            outcol = np.concatenate ([idx[1] for idx in rsp_idx])
+            for errvec in self.helper.construct1RDM_response_elements( self.doSCF, newumatsquare_loc, self.loc2fno,
+                    outrow, outcol ):
+                yield errvec
+            return
         # RDMderivs_rot appears to be in the natural-orbital basis if doDET_NO is specified and the local basis otherwise
         RDMderivs_rot = self.helper.construct1RDM_response( self.doSCF, newumatsquare_loc, self.loc2fno )
         gradient = []
@@ -433,17 +482,43 @@ class dmet:
         
 #        return gradient
         
+    def rdm_differences_adjoint( self, errvec ):
+        ''' The matrix A such that np.dot (errvec, d(errvec)/du) = np.sum (A * d(oneRDM)/du), in the same basis as the output
+        of helper.construct1RDM_response; i.e., the adjoint of the map from the mean-field 1RDM response to the response
+        of the error vector in rdm_differences_derivative '''
+        zero_1RDM = np.zeros ((self.norbs_tot, self.norbs_tot), dtype=errvec.dtype)
+        adj_1RDM = np.zeros_like (zero_1RDM)
+        i = 0
+        for frag in self.fragments:
+            j = i + len (frag.get_rsp_1RDM_elements (self, zero_1RDM))
+            adj_1RDM += frag.get_rsp_1RDM_adjoint (self, errvec[i:j])
+            i = j
+        assert (i == len (errvec))
+        if self.doLASSCF:
+            adj_1RDM = project_operator_into_subspace (adj_1RDM, self.ints.loc2idem)
+        return adj_1RDM
+
+    def displaced_umatflat_blocks( self, umatflat, stepsize ):
+        ''' Generate (p0, p1, umatbis) where umatbis[i] is umatflat with stepsize added to element p0+i, in blocks small
+        enough that the batched mean-field 1RDMs of all of them fit in ints.max_memory '''
+        nparam = len( umatflat )
+        blksize = self.helper.get_batch_blksize( nparam )
+        for p0, p1 in lib.prange( 0, nparam, blksize ):
+            umatbis = np.repeat( umatflat[None,:], p1-p0, axis=0 )
+            umatbis[np.arange( p1-p0 ),np.arange( p0, p1 )] += stepsize
+            yield p0, p1, umatbis
+
     def verify_gradient( self, umatflat ):
     
+        # All displaced cost functions are evaluated in one batch, warm-started from the undisplaced 1RDM
         gradient = self.costfunction_derivative( umatflat )
-        cost_reference = self.costfunction( umatflat )
-        gradientbis = np.zeros( [ len( gradient ) ])
+        errvec, oneRDM_reference = self.rdm_differences_batch( umatflat[None,:] )
+        cost_reference = linalg.norm( errvec[0] )**2
         stepsize = 1e-7
-        for cnt in range( len( gradient ) ):
-            umatbis = np.array( umatflat, copy=True )
-            umatbis[cnt] += stepsize
-            costbis = self.costfunction( umatbis )
-            gradientbis[ cnt ] = ( costbis - cost_reference ) / stepsize
+        gradientbis = np.empty_like( gradient )
+        for p0, p1, umatbis in self.displaced_umatflat_blocks( umatflat, stepsize ):
+            errvecs = self.rdm_differences_batch( umatbis, oneRDMguess_loc=oneRDM_reference[0] )[0]
+            gradientbis[p0:p1] = ( np.sum( errvecs**2, axis=1 ) - cost_reference ) / stepsize
         print ("   Norm( gradient difference ) =", linalg.norm( gradient - gradientbis ))
         print ("   Norm( gradient )            =", linalg.norm( gradient ))
         
@@ -452,18 +527,17 @@ class dmet:
         stepsize = 1e-7
         print ('Calculating hessian eigenvalues...')
         grad_start = time.time ()
-        gradient_reference = self.costfunction_derivative( umatflat )
+        oneRDM_reference = self.helper.construct1RDM_loc( self.doSCF, self.flat2square( umatflat ) )
+        gradient_reference = self.costfunction_derivative_batch( umatflat[None,:], oneRDMguess_loc=oneRDM_reference )[0]
         grad_end = time.time ()
         print ("Gradient-reference calculated in {} seconds".format (grad_end - grad_start))
         print ("Gradient is an array of length {}".format (gradient_reference.shape))
         print ("Hessian is a {}-by-{} matrix".format (len (umatflat), len (umatflat)))
         hess_start = time.time ()
-        hessian = np.zeros( [ len( umatflat ), len( umatflat ) ] )
-        for cnt in range( len( umatflat ) ):
-            gradient = umatflat.copy()
-            gradient[ cnt ] += stepsize
-            gradient = self.costfunction_derivative( gradient )
-            hessian[ :, cnt ] = ( gradient - gradient_reference ) / stepsize
+        hessian = np.empty( [ len( umatflat ), len( umatflat ) ] )
+        for p0, p1, umatbis in self.displaced_umatflat_blocks( umatflat, stepsize ):
+            gradients = self.costfunction_derivative_batch( umatbis, oneRDMguess_loc=oneRDM_reference )
+            hessian[:,p0:p1] = ( gradients - gradient_reference[None,:] ).T / stepsize
         hessian = 0.5 * ( hessian + hessian.T )
         hess_end = time.time ()
         print ("Hessian evaluated in {} seconds".format (hess_end - hess_start))
@@ -496,14 +570,14 @@ class dmet:
                 umatsquare_bis += umatflat[ cnt ] * self.helper.list_H1[ cnt ]
             print "Verification flat2square = ", linalg.norm( umatsquare - umatsquare_bis )'''
         
-        if ( self.loc2fno != None ):
+        if ( self.loc2fno is not None ):
             umatsquare = np.dot( np.dot( self.loc2fno, umatsquare ), self.loc2fno.T )
         return umatsquare
         
     def square2flat( self, umatsquare ):
     
         umatsquare_bis = np.array( umatsquare, copy=True )
-        if ( self.loc2fno != None ):
+        if ( self.loc2fno is not None ):
             umatsquare_bis = np.dot( np.dot( self.loc2fno.T, umatsquare_bis ), self.loc2fno )
         umat_idx = np.diag_indices (self.norbs_tot) if self.doDET else self.umat_ftriu_idx
         umatflat = umatsquare_bis[ umat_idx ]
@@ -516,6 +590,46 @@ class dmet:
         print ("      (chemical potential , number of electrons) = (", chempot_imp, "," , Nelec_dmet ,")")
         return Nelec_dmet - Nelec_target
 
+    def solve_chempot( self ):
+        ''' Find the chemical potential at which the fragments hold the total number of electrons, by Newton steps with the
+        slope d(Nelec)/d(chempot) taken from the secant through the last two solutions or, before there are two or if the
+        secant is unusable, from the last secant of the previous call (chempot_slope) or the mean-field response of each
+        fragment (frag.get_chempot_response). After the first step, a fragment is not re-solved if its predicted change in
+        electron number since it was last solved is below chempot_resolve_thresh; until it is, that predicted change is
+        added to the electron count. Converged when the step is smaller than chempot_tol, as for scipy.optimize.newton,
+        but returns the last chemical potential at which the impurity problems were solved. '''
+        Nelec_target = self.ints.nelec_tot
+        frag_slopes = np.asarray ([frag.get_chempot_response () for frag in self.fragments])
+        mu, err = self.chempot, self.numeleccostfunction (self.chempot)
+        frag_mu = np.full (len (self.fragments), mu)
+        mu_last = err_last = None
+        nsolves = len (self.fragments)
+        for it in range (self.chempot_maxiter):
+            if err == 0: return mu
+            slope = np.sum (frag_slopes)
+            if self.chempot_slope is not None: slope = self.chempot_slope
+            if mu_last is not None and mu != mu_last:
+                secant = (err - err_last) / (mu - mu_last)
+                if np.isfinite (secant) and secant > 0: slope = self.chempot_slope = secant
+            if slope > params.num_zero_atol:
+                dmu = -err / slope
+            else:
+                dmu = (mu * 1e-4 + (1e-4 if mu >= 0 else -1e-4)) * (1 if err <= 0 else -1)
+            if abs (dmu) < self.chempot_tol:
+                print ("Chemical potential converged after {} impurity solves".format (nsolves))
+                return mu
+            mu_last, err_last = mu, err
+            mu = mu + dmu
+            idx_solve = np.abs (frag_slopes * (mu - frag_mu)) >= self.chempot_resolve_thresh
+            if not np.any (idx_solve): idx_solve[:] = True
+            nsolves += np.count_nonzero (idx_solve)
+            Nelec_dmet = self.doexact (mu, frags_to_solve=[f for f, i in zip (self.fragments, idx_solve) if i])
+            frag_mu[idx_solve] = mu
+            print ("      (chemical potential , number of electrons) = (", mu, "," , Nelec_dmet ,")")
+            err = Nelec_dmet - Nelec_target + np.dot (frag_slopes, mu - frag_mu)
+        raise RuntimeError ("Chemical potential not converged after {} iterations; value is {}".format (
+            self.chempot_maxiter, mu))
+
     def doselfconsistent (self):
     
         #scfinit = tracemalloc.take_snapshot ()
@@ -634,6 +748,7 @@ class dmet:
             result = optimize.minimize( self.costfunction, self.square2flat( self.umat ), jac=self.costfunction_derivative, options={'disp': True} )
             self.umat = self.flat2square( result.x )
             print ("BFGS done after {} seconds".format (time.time () - bfgs_start))
+            if self.doSCF: self.helper.print_scf_stats ()
         if self.do1EMB:
             # You NEED the diagonal component if the molecule isn't tiled out with fragments!
             # But otherwise, it's a redundant chemical potential term
@@ -726,7 +841,7 @@ class dmet:
             self.chempot = 0.0
             self.doexact (self.chempot)
         else:
-            self.chempot = optimize.newton( self.numeleccostfunction, self.chempot, tol=self.chempot_tol )
+            self.chempot = self.solve_chempot ()
             print ("   Chemical potential =", self.chempot)
         #for frag in self.fragments:
             #frag.impurity_molden ('natorb', natorb=True)
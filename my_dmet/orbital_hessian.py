@@ -1,13 +1,25 @@
-import time
+import time, hashlib
 import numpy as np
-from pyscf import ao2mo
+from pyscf import ao2mo, lib, __config__
 from pyscf.lib import current_memory, numpy_helper
 from pyscf.mcscf.mc1step import gen_g_hop
 from mrh.util.basis import represent_operator_in_basis, is_basis_orthonormal, measure_basis_olap, orthonormalize_a_basis, get_complementary_states, get_overlapping_states, is_basis_orthonormal_and_complete
 from mrh.util.rdm import get_2CDM_from_2RDM
-from mrh.my_pyscf.df.sparse_df import sparsedf_array
+from mrh.my_pyscf.df.sparse_df import sparsedf_array, get_sparsedf
 from scipy import linalg
 from itertools import product
+from collections import OrderedDict
+
+# Number of sets of (w,x,y,z) orbital ranges for which HessianERITransformer intermediates are kept by each calculator
+ERI_CACHE_SIZE = getattr(__config__, 'dmet_orbital_hessian_ERI_CACHE_SIZE', 2)
+
+def _basis_key (*bases):
+    h = hashlib.sha1 ()
+    for b in bases:
+        b = np.ascontiguousarray (b)
+        h.update (repr (b.shape).encode ())
+        h.update (b.tobytes ())
+    return h.hexdigest ()
 
 ''' Always remember: ~spin-restricted orbitals~ means the unitary group generator is spin-symmetric regardless of the wave function!
     This means you NEVER handle an alpha fock matrix and a beta fock matrix separately and you must do the "fake" semi-cumulant decomposition
@@ -19,6 +31,8 @@ class HessianCalculator (object):
     LASSCF wave function. This is not designed to be efficient in orbital optimization; it is designed to collect
     slices of the Hessian stored explicitly for some kind of spectral analysis. '''
 
+    verbose = lib.logger.NOTE # HessianERITransformer timings are printed at DEBUG and above
+
     def get_operator (self, r, s):
         return HessianOperator (self, r, s)
 
@@ -37,6 +51,8 @@ class HessianCalculator (object):
                     molecular orbital coefficients for the active space(s)
         '''
         self.scf = mf
+        self.verbose = mf.verbose
+        self.eri_cache = OrderedDict ()
         self.oneRDMs = np.asarray (oneRDMs)
         if self.oneRDMs.ndim == 3: #== 2:
             dm = sum (self.oneRDMs) / 2
@@ -141,6 +157,7 @@ class HessianCalculator (object):
         hess -= self._get_Fock2 (q, p, r, s, eris).transpose (1,0,2,3)
         hess -= self._get_Fock2 (p, q, s, r, eris).transpose (0,1,3,2)
         hess += self._get_Fock2 (q, p, s, r, eris).transpose (1,0,3,2)
+        if self.verbose >= lib.logger.DEBUG: eris.report ()
         return hess / 2
 
     def _get_eri (self, orbs_list, compact=False):
@@ -148,16 +165,32 @@ class HessianCalculator (object):
             orbs_list = [orbs_list, orbs_list, orbs_list, orbs_list]
         # Tragically, I have to go back to the AO basis to interact with PySCF's eri modules. This is the greatest form of racism.
         orbs_list = [self.mo @ o for o in orbs_list]
+        with_df = getattr (self.scf, 'with_df', None)
         if self.scf._eri is not None:
             eri = ao2mo.incore.general (self.scf._eri, orbs_list, compact=compact) 
-        elif self.with_df is not None:
-            eri = self.with_df.ao2mo (orbs_list, compact=compact)
+        elif with_df is not None:
+            eri = with_df.ao2mo (orbs_list, compact=compact)
         else:
             eri = ao2mo.outcore.general_iofree (self.scf.mol, orbs_list, compact=compact)
         norbs = [o.shape[1] for o in orbs_list]
         if not compact: eri = eri.reshape (*norbs)
         return eri
 
+    def _get_cderi (self, orbs_pair):
+        ''' Density-fitting factors b^P_ij of (ij|kl) = sum_P b^P_ij b^P_kl for the orbital ranges i, j, with shape
+        (naux, ni, nj), or None if the two-electron integrals are not density-fitted '''
+        with_df = getattr (self.scf, 'with_df', None)
+        if self.scf._eri is not None or with_df is None: return None
+        i, j = [self.mo @ o for o in orbs_pair]
+        ijmosym, nij_pair, moij, ijslice = ao2mo.incore._conc_mos (i, j, compact=False)
+        cderi = np.empty ((with_df.get_naoaux (), nij_pair), dtype=i.dtype)
+        b0 = 0
+        for eri1 in with_df.loop ():
+            b1 = b0 + eri1.shape[0]
+            ao2mo._ao2mo.nr_e2 (eri1, moij, ijslice, aosym='s2', mosym=ijmosym, out=cderi[b0:b1])
+            b0 = b1
+        return cderi.reshape (-1, i.shape[1], j.shape[1])
+
     def _get_collective_basis (self, *args):
         p = np.concatenate (args, axis=-1)
         try: # Linear algebra problem sometimes if one of the arguments is a complete basis? Can I exception-handle my way out of this?
@@ -462,7 +495,9 @@ class LASSCFHessianCalculator (HessianCalculator):
 
     def __init__(self, ints, oneRDM_loc, all_frags, fock_c, fock_s, Hop_noxc=False):
         self.ints = ints
+        self.verbose = ints.mol.verbose
         self.Hop_noxc = Hop_noxc
+        self.eri_cache = OrderedDict ()
         active_frags = [f for f in all_frags if f.norbs_as]
 
         # Global things. fock_s is zero because of the semi-cumulant decomposition; this only works because I
@@ -494,6 +529,11 @@ class LASSCFHessianCalculator (HessianCalculator):
 
     def _get_eri (self, orbs_list, compact=False):
         return self.ints.general_tei (orbs_list, compact=compact)
+
+    def _get_cderi (self, orbs_pair):
+        if self.ints.with_df is None: return None
+        i, j = [self.ints.with_df.loc2eri_bas (o) for o in orbs_pair]
+        return self.ints._cderi_ao2mo (i, j, compact=False).reshape (-1, i.shape[1], j.shape[1])
         
     def get_jk (self, dm1s):
         if dm1s.ndim == 2: dm1s = dm1s[None,:,:]
@@ -557,23 +597,70 @@ class HessianERITransformer (object):
             (wx|yz) = (yz|wx) = (xw|yz) = (wx|zy), I can generate all the eris I need for the Hessian
             calculation from this cache. Since this calls _get_eri, it will also automatically take advantage
             of _eri_kernel if it's available.
+
+            If the parent has density-fitting factors (_get_cderi), only b^P_wx and b^P_yz are stored and each block
+            is assembled from its two half-transformed factors. Either way the intermediates are kept in
+            parent.eri_cache, keyed on the orbital ranges w,x,y,z, so that later transformers (e.g., the next
+            Hessian call or a HessianOperator made from the same calculator) reuse them instead of repeating the
+            transformation. Time and memory spent in each phase are accumulated in self.timing; see report.
         '''
+        self.timing = OrderedDict ((phase, [0.0, 0.0, 0.0]) for phase in ('basis', 'eri', 'lookup', 'grind'))
+        t0, w0 = time.clock (), time.time ()
         p,q,r,s = (parent._append_entangled (z) for z in (p,q,r,s))
         a = np.concatenate (parent.mo2amo, axis=1)
         self.w = w = parent._get_collective_basis (a, p)[0]
         self.x = x = parent._get_collective_basis (a, s, r, q)[0] 
         self.y = y = parent._get_collective_basis (a, s, r)[0]
         self.z = z = parent._get_collective_basis (a, s, q)[0]
-        self._eri = parent._get_eri ([w,x,y,z])
+        self._lookup_cache = {}
+        t0, w0 = self._tick ('basis', t0, w0)
+        self.cached = False
+        eri_cache = getattr (parent, 'eri_cache', None)
+        key = _basis_key (w, x, y, z)
+        if eri_cache is not None and key in eri_cache:
+            self._eri, self._cderi = eri_cache[key]
+            eri_cache.move_to_end (key)
+            self.cached = True
+        else:
+            cderi_wx = parent._get_cderi ([w,x])
+            if cderi_wx is not None:
+                self._eri, self._cderi = None, (cderi_wx, parent._get_cderi ([y,z]))
+            else:
+                self._eri, self._cderi = parent._get_eri ([w,x,y,z]), None
+            if eri_cache is not None:
+                eri_cache[key] = (self._eri, self._cderi)
+                while len (eri_cache) > max (ERI_CACHE_SIZE, 0): eri_cache.popitem (last=False)
+        self._tick ('eri', t0, w0)
         return
 
+    def _tick (self, phase, t0, w0):
+        t1, w1 = time.clock (), time.time ()
+        self.timing[phase][0] += t1 - t0
+        self.timing[phase][1] += w1 - w0
+        self.timing[phase][2] = max (self.timing[phase][2], current_memory ()[0])
+        return t1, w1
+
+    @property
+    def nbytes (self):
+        if self._cderi is not None: return sum ([b.nbytes for b in self._cderi])
+        return self._eri.nbytes
+
+    def report (self):
+        print ("HessianERITransformer: {:.1f} MB of {} intermediates{}".format (self.nbytes / 1e6,
+            'density-fitted' if self._cderi is not None else 'dense', ' (reused from cache)' if self.cached else ''))
+        for phase, (tcpu, twall, mem) in self.timing.items ():
+            print ("HessianERITransformer {:>6s}: {:.3f} s clock, {:.3f} s wall, {:.0f} MB peak".format (
+                phase, tcpu, twall, mem))
+
     def __call__(self, p, q, r, s, _first_call=True):
         ''' Because of several necessary index permutations, I cannot know in advance which of w,x,y,z
         encloses each of p, q, r, s, but I should have prepared it so that any call I make can be carried out.
         yz is the more restrictive pair in my cache, so first see if r, s is in yz and if not, flip pq<->rs.
         wx contains all pairs that I should ever need so. ''' 
+        t0, w0 = time.clock (), time.time ()
         rs_yz, rs_correct = self.pq_in_cd (self.y, self.z, r, s)
         pq_wx, pq_correct = self.pq_in_cd (self.w, self.x, p, q)
+        self._tick ('lookup', t0, w0)
         if _first_call and (not (pq_wx and rs_yz)): return self.__call__(r, s, p, q, _first_call=False).transpose (2, 3, 0, 1)
         try:
             assert (pq_wx and rs_yz), "Can't place orbital sets in this eri array"
@@ -593,10 +680,13 @@ class HessianERITransformer (object):
             print ("Is z orthonormal? {}".format (linalg.eigh (self.z.conjugate ().T @ self.z)[0]))
             raise (e)
         # Permute the order of the pairs individually
-        if pq_correct and rs_correct: return self._grind (p, q, r, s)
-        elif pq_correct: return self._grind (p, q, s, r).transpose (0, 1, 3, 2)
-        elif rs_correct: return self._grind (q, p, r, s).transpose (1, 0, 2, 3)
-        else: return self._grind (q, p, s, r).transpose (1, 0, 3, 2)
+        t0, w0 = time.clock (), time.time ()
+        if pq_correct and rs_correct: pqrs = self._grind (p, q, r, s)
+        elif pq_correct: pqrs = self._grind (p, q, s, r).transpose (0, 1, 3, 2)
+        elif rs_correct: pqrs = self._grind (q, p, r, s).transpose (1, 0, 2, 3)
+        else: pqrs = self._grind (q, p, s, r).transpose (1, 0, 3, 2)
+        self._tick ('grind', t0, w0)
+        return pqrs
 
     def _grind (self, p, q, r, s):
         assert (self.p_in_c (self.w, p)), 'p not in w after permuting!'
@@ -607,7 +697,15 @@ class HessianERITransformer (object):
         x2q = self.x.conjugate ().T @ q
         y2r = self.y.conjugate ().T @ r
         z2s = self.z.conjugate ().T @ s
-        pqrs = np.tensordot (p2w, self._eri, axes=1)
+        if self._cderi is not None:
+            b_wx, b_yz = self._cderi
+            naux = b_wx.shape[0]
+            b_pq = lib.dot (np.dot (p2w, b_wx).transpose (1,0,2).reshape (-1, b_wx.shape[-1]), x2q)
+            b_rs = lib.dot (np.dot (y2r.T, b_yz).transpose (1,0,2).reshape (-1, b_yz.shape[-1]), z2s)
+            b_pq = b_pq.reshape (naux, -1)
+            b_rs = b_rs.reshape (naux, -1)
+            return lib.dot (b_pq.T, b_rs).reshape (p.shape[1], q.shape[1], r.shape[1], s.shape[1])
+        pqrs = lib.dot (p2w, self._eri.reshape (self.w.shape[1], -1)).reshape (p.shape[1], *self._eri.shape[1:])
         pqrs = np.tensordot (pqrs, x2q, axes=((1),(0)))
         pqrs = np.tensordot (pqrs, y2r, axes=((1),(0)))
         pqrs = np.tensordot (pqrs, z2s, axes=((1),(0)))
@@ -615,10 +713,16 @@ class HessianERITransformer (object):
 
     def p_in_c (self, c, p, _return_numbers=False):
         ''' Return c == complete basis for p '''
-        svals = linalg.svd (c.conjugate ().T @ p)[1]
-        val = np.count_nonzero (np.isclose (svals, 1, rtol=1e-3)) == p.shape[1]
-        if _return_numbers: return val, svals-1, p.shape[1]
-        else: return val
+        if _return_numbers:
+            svals = linalg.svd (c.conjugate ().T @ p)[1]
+            val = np.count_nonzero (np.isclose (svals, 1, rtol=1e-3)) == p.shape[1]
+            return val, svals-1, p.shape[1]
+        # The same orbital ranges are looked up many times per Hessian; remember the answers
+        key = (id (c), _basis_key (p))
+        if key not in self._lookup_cache:
+            svals = linalg.svd (c.conjugate ().T @ p, compute_uv=False)
+            self._lookup_cache[key] = np.count_nonzero (np.isclose (svals, 1, rtol=1e-3)) == p.shape[1]
+        return self._lookup_cache[key]
 
     def pq_in_cd (self, c, d, p, q):
         testmat = np.asarray ([[self.p_in_c (e, r) for e in (c, d)] for r in (p, q)])
@@ -742,7 +846,7 @@ class DFLASSCFHessianOperator (LASSCFHessianOperator):
         qH = q.conjugate ().T
         dm_pp = np.dot (pH, np.dot (self.oneRDMs, p)).transpose (1,0,2)
         dm_qq = np.dot (qH, np.dot (self.oneRDMs, q)).transpose (1,0,2)
-        b_mqP = sparsedf_array (self.ints.with_df._cderi).contract1 (m2q)
+        b_mqP = get_sparsedf (self.ints.with_df).contract1 (m2q)
         b_rqP = np.tensordot (m2r, b_mqP, axes=((0),(0)))
         g_mqrq = np.tensordot (b_mqP, b_rqP, axes=((2),(2)))
         tdm_qr = np.dot (tdm1s, r2q.conjugate ().T)
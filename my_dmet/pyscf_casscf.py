@@ -86,11 +86,7 @@ def solve (frag, guess_1RDM, chempot_imp):
     mf.get_hcore = lambda *args: OEI
     mf.get_ovlp = lambda *args: np.eye(frag.norbs_imp)
     mf.energy_nuc = lambda *args: frag.impham_CONST
-    if frag.impham_CDERI is not None:
-        mf = mf.density_fit ()
-        mf.with_df._cderi = frag.impham_CDERI
-    else:
-        mf._eri = ao2mo.restore(8, frag.impham_TEI, frag.norbs_imp)
+    mf = frag.impham_attach_eri (mf)
     mf = fix_my_RHF_for_nonsinglet_env (mf, frag.impham_OEI_S)
     mf.__dict__.update (frag.mf_attr)
     if guess_orbs_av: mf.max_cycle = 2
@@ -112,7 +108,7 @@ def solve (frag, guess_1RDM, chempot_imp):
             mf = scf.RHF(mol)
             mf.get_hcore = lambda *args: OEI
             mf.get_ovlp = lambda *args: np.eye(frag.norbs_imp)
-            mf._eri = ao2mo.restore(8, frag.impham_TEI, frag.norbs_imp)
+            mf = frag.impham_attach_eri (mf)
             mf = fix_my_RHF_for_nonsinglet_env (mf, frag.impham_OEI_S)
             mf.scf (guess_1RDM)
             if not mf.converged:
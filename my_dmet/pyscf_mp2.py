@@ -38,7 +38,7 @@ def solve (frag, guess_1RDM, chempot_imp):
     mf = scf.RHF( mol )
     mf.get_hcore = lambda *args: OEI
     mf.get_ovlp = lambda *args: np.eye( frag.norbs_imp )
-    mf._eri = ao2mo.restore(8, frag.impham_TEI, frag.norbs_imp)
+    mf = frag.impham_attach_eri (mf)
     mf.scf( guess_1RDM )
     DMloc = np.dot(np.dot( mf.mo_coeff, np.diag( mf.mo_occ )), mf.mo_coeff.T )
     if ( mf.converged == False ):
@@ -58,7 +58,7 @@ def solve (frag, guess_1RDM, chempot_imp):
     if frag.quasidirect:
         mf.get_jk = frag.impham_get_jk 
     else:
-        mf._eri = ao2mo.restore(8, frag.impham_TEI, frag.norbs_imp)
+        mf = frag.impham_attach_eri (mf)
     mf = fix_my_RHF_for_nonsinglet_env (mf, sign_MS * frag.impham_OEI_S)
     mf.__dict__.update (frag.mf_attr)
     mf.scf( guess_1RDM )
@@ -80,7 +80,7 @@ def solve (frag, guess_1RDM, chempot_imp):
         if frag.quasidirect:
             mf.get_jk = frag.impham_get_jk 
         else:
-            mf._eri = ao2mo.restore(8, frag.impham_TEI, frag.norbs_imp)
+            mf = frag.impham_attach_eri (mf)
         mf = fix_my_RHF_for_nonsinglet_env (mf, sign_MS * frag.impham_OEI_S)
         mf.scf( guess_1RDM )
         if ( mf.converged == False ):
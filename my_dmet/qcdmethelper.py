@@ -22,10 +22,21 @@ import mrh.my_dmet.rhf
 from mrh.util.rdm import get_1RDM_from_OEI_in_subspace
 from mrh.util.basis import represent_operator_in_basis, project_operator_into_subspace
 import numpy as np
-import ctypes
+import ctypes, multiprocessing
+from scipy import linalg
+from pyscf import lib
 from mrh.lib.helper import load_library
 lib_qcdmet = load_library ('libqcdmet')
 
+# Set in each worker process of construct1RDM_loc_batch by its Pool initializer
+_scf_batch_args = None
+def _scf_batch_init (locints, oei, umat_loc_batch, oneRDMguess_loc):
+    global _scf_batch_args
+    _scf_batch_args = (locints, oei, umat_loc_batch, oneRDMguess_loc)
+def _scf_batch_item (i):
+    locints, oei, umat_loc_batch, oneRDMguess_loc = _scf_batch_args
+    return locints.get_wm_1RDM_from_scf_on_OEI (oei + umat_loc_batch[i], oneRDMguess_loc=oneRDMguess_loc)
+
 class qcdmethelper:
 
     def __init__( self, theLocalIntegrals, list_H1, altcf, minFunc ):
@@ -47,6 +58,62 @@ class qcdmethelper:
         self.H1row = H1row
         self.H1col = H1col
         self.Nterms = len( self.H1start ) - 1
+        self.H1term = np.repeat (np.arange (self.Nterms), np.diff (self.H1start))
+
+        # Cache of converged mean-field solutions (doSCF), to warm-start the SCFs at nearby correlation potentials
+        self.scf_cache_size = 4
+        self.scf_cache_predict = True # Guess from the Fock matrix of the nearest solution plus the change in umat
+        self.scf_cache = []
+        self.scf_stats = {'exact_hits': 0, 'cold_calls': 0, 'cold_cycles': 0, 'warm_calls': 0, 'warm_cycles': 0,
+            'newton_cycles': 0}
+
+    def get_scf_1RDM( self, umat_loc ):
+        ''' The self-consistent mean-field 1RDM for the correlation potential umat_loc, from the cache if this exact problem
+        has already been solved. Otherwise the SCF is started from the nearest cached solution: either its 1RDM or, if
+        scf_cache_predict, the 1RDM of its Fock matrix shifted by the change in the one-electron Hamiltonian, which
+        includes the first-order response to the change. The last scf_cache_size solutions are kept. '''
+        locints = self.locints
+        OEI = locints.loc_oei () + umat_loc
+        context = (locints.nelec_idem, locints.loc2idem, locints.oneRDMcorr_loc)
+        def same_context (ctx):
+            return ctx[0] == context[0] and all ([np.array_equal (a, b) for a, b in zip (ctx[1:], context[1:])])
+        dists = [linalg.norm (OEI - entry['OEI']) for entry in self.scf_cache]
+        guess = None
+        if len (dists):
+            inear = int (np.argmin (dists))
+            near = self.scf_cache[inear]
+            if dists[inear] == 0 and same_context (near['context']):
+                self.scf_stats['exact_hits'] += 1
+                self.scf_cache.append (self.scf_cache.pop (inear))
+                return near['oneRDM'].copy ()
+            guess = near['oneRDM']
+            if self.scf_cache_predict:
+                if near['FOCK'] is None:
+                    near['FOCK'] = locints.loc_rhf_fock_bis (near['oneRDM']) + near['OEI'] - locints.loc_oei ()
+                guess = locints.get_wm_1RDM_from_OEI (near['FOCK'] + OEI - near['OEI'])
+        stats = {'scf_cycles': 0, 'newton_cycles': 0}
+        oneRDM = locints.get_wm_1RDM_from_scf_on_OEI (OEI, oneRDMguess_loc=guess, stats=stats)
+        key = 'cold' if guess is None else 'warm'
+        self.scf_stats[key+'_calls'] += 1
+        self.scf_stats[key+'_cycles'] += stats['scf_cycles']
+        self.scf_stats['newton_cycles'] += stats['newton_cycles']
+        self.scf_cache.append ({'OEI': OEI, 'oneRDM': oneRDM, 'FOCK': None,
+            'context': (context[0], context[1].copy (), context[2].copy ())})
+        self.scf_cache = self.scf_cache[-self.scf_cache_size:] if self.scf_cache_size > 0 else []
+        return oneRDM.copy ()
+
+    def print_scf_stats( self ):
+        stats = self.scf_stats
+        ncalls = stats['exact_hits'] + stats['cold_calls'] + stats['warm_calls']
+        if not ncalls: return
+        print ("Correlation-potential SCFs: {} requested, {} reused, {} cold-started ({} cycles), {} warm-started ({} cycles)".format (
+            ncalls, stats['exact_hits'], stats['cold_calls'], stats['cold_cycles'], stats['warm_calls'], stats['warm_cycles']))
+        if stats['newton_cycles']:
+            print ("Of those cycles, {} were second-order fallbacks for unconverged SCFs".format (stats['newton_cycles']))
+        if stats['cold_calls']:
+            cold_avg = stats['cold_cycles'] / stats['cold_calls']
+            saved = cold_avg * (stats['exact_hits'] + stats['warm_calls']) - stats['warm_cycles']
+            print ("Estimated SCF cycles saved by the cache: {:.0f}".format (saved))
         
     def convertH1sparse( self ):
     
@@ -71,18 +138,69 @@ class qcdmethelper:
         
         # Everything in this functions works in the original local AO / lattice basis!
         if doSCF:
-            return self.locints.get_wm_1RDM_from_scf_on_OEI (self.locints.loc_oei ()      + umat_loc)
+            return self.get_scf_1RDM (umat_loc)
         elif self.altcf and self.minFunc == 'OEI' :
             return self.locints.get_wm_1RDM_from_OEI        (self.locints.loc_oei ()      + umat_loc)
         else:
             return self.locints.get_wm_1RDM_from_OEI        (self.locints.loc_rhf_fock () + umat_loc)
     
+    def get_batch_blksize( self, nbatch, max_memory=None ):
+        ''' Number of correlation potentials whose mean-field 1RDMs are built at once by construct1RDM_loc_batch. Each
+        costs a few (norbs_tot, norbs_tot) arrays: umat, OEI, eigenvectors and 1RDM. '''
+        if max_memory is None: max_memory = self.locints.max_memory - lib.current_memory ()[0]
+        mem_item = 4 * 8 * self.locints.norbs_tot**2 / 1e6
+        return max (1, min (nbatch, int (max_memory / mem_item)))
+
+    def construct1RDM_loc_batch( self, doSCF, umat_loc_batch, oneRDMguess_loc=None, nproc=1, max_memory=None ):
+        ''' construct1RDM_loc for a stack of correlation potentials, as for finite-difference checks of the DMET cost
+        function. Without doSCF, the 1RDMs are obtained from batched eigensolver calls over as many correlation potentials
+        at a time as fit in max_memory. With doSCF, the mean-field problems are solved independently, starting from
+        oneRDMguess_loc (for instance, the converged 1RDM of the undisplaced correlation potential) and distributed over
+        nproc forked processes if nproc > 1.
+
+        Args:
+            doSCF : logical
+            umat_loc_batch : ndarray of shape (nbatch, norbs_tot, norbs_tot)
+
+        Kwargs:
+            oneRDMguess_loc : ndarray of shape (norbs_tot, norbs_tot)
+                Initial guess for every SCF (doSCF only)
+            nproc : integer
+                Number of processes (doSCF only)
+            max_memory : float
+                Memory in MB available for the batched eigensolver (not doSCF). Default is whatever is left of
+                locints.max_memory
+
+        Returns:
+            oneRDMs_loc : ndarray of shape (nbatch, norbs_tot, norbs_tot)
+        '''
+        umat_loc_batch = np.asarray (umat_loc_batch)
+        if not doSCF:
+            if self.altcf and self.minFunc == 'OEI':
+                OEI = self.locints.loc_oei ()
+            else:
+                OEI = self.locints.loc_rhf_fock ()
+            oneRDMs_loc = np.empty (umat_loc_batch.shape, dtype=OEI.dtype)
+            blksize = self.get_batch_blksize (len (umat_loc_batch), max_memory=max_memory)
+            for i0, i1 in lib.prange (0, len (umat_loc_batch), blksize):
+                oneRDMs_loc[i0:i1] = self.locints.get_wm_1RDM_from_OEI_batch (OEI[None,:,:] + umat_loc_batch[i0:i1])
+            return oneRDMs_loc
+        OEI = self.locints.loc_oei ()
+        if nproc > 1 and len (umat_loc_batch) > 1:
+            with multiprocessing.get_context ('fork').Pool (min (nproc, len (umat_loc_batch)), initializer=_scf_batch_init,
+                    initargs=(self.locints, OEI, umat_loc_batch, oneRDMguess_loc)) as pool:
+                oneRDMs_loc = pool.map (_scf_batch_item, range (len (umat_loc_batch)))
+        else:
+            oneRDMs_loc = [self.locints.get_wm_1RDM_from_scf_on_OEI (OEI + umat_loc, oneRDMguess_loc=oneRDMguess_loc)
+                for umat_loc in umat_loc_batch]
+        return np.stack (oneRDMs_loc, axis=0)
+
     def construct1RDM_response( self, doSCF, umat_loc, NOrotation ):
 
         # This part is local-basis        
         if doSCF:
-            oneRDM = self.locints.get_wm_1RDM_from_scf_on_OEI (self.loc_oei () + umat_loc)
-            OEI    = self.locints.loc_rhf_fock_bis (oneRDM)
+            oneRDM = self.get_scf_1RDM (umat_loc)
+            OEI    = self.locints.loc_rhf_fock_bis (oneRDM) + umat_loc
         else:
             OEI    = self.locints.loc_rhf_fock() + umat_loc
 
@@ -97,7 +215,7 @@ class qcdmethelper:
 
         # This part works in the rotated NO basis if NOrotation is specified
         rdm_deriv_rot = np.ones( [ self.locints.norbs_tot * self.locints.norbs_tot * self.Nterms ], dtype=ctypes.c_double )
-        if ( NOrotation != None ):
+        if ( NOrotation is not None ):
             OEI = np.dot( np.dot( NOrotation.T, OEI ), NOrotation )
         OEI = np.array( OEI.reshape( (self.locints.norbs_tot * self.locints.norbs_tot) ), dtype=ctypes.c_double )
         
@@ -112,6 +230,120 @@ class qcdmethelper:
         
         rdm_deriv_rot = rdm_deriv_rot.reshape( (self.Nterms, self.locints.norbs_tot, self.locints.norbs_tot), order='C' )
         return rdm_deriv_rot
+
+    def construct1RDM_response_elements( self, doSCF, umat_loc, NOrotation, outrow, outcol, thresh=0.0 ):
+        ''' Selected elements of the 1RDM derivatives of construct1RDM_response, computed by the sparse C kernel without
+        building the (Nterms, norbs_tot, norbs_tot) array
+
+        Args:
+            doSCF : logical
+            umat_loc : ndarray of shape (norbs_tot, norbs_tot)
+            NOrotation : ndarray of shape (norbs_tot, norbs_tot) or None
+            outrow, outcol : sequences of integers of the same length Nout
+                Row and column indices (in the rotated NO basis if NOrotation is specified) of the requested elements
+
+        Kwargs:
+            thresh : float
+                Occupied-virtual response amplitudes smaller than this are neglected; 0 reproduces construct1RDM_response
+
+        Returns:
+            rdm_deriv : ndarray of shape (Nterms, Nout)
+                rdm_deriv[k,i] = construct1RDM_response (doSCF, umat_loc, NOrotation)[k,outrow[i],outcol[i]]
+        '''
+        if doSCF:
+            oneRDM = self.get_scf_1RDM (umat_loc)
+            OEI    = self.locints.loc_rhf_fock_bis (oneRDM) + umat_loc
+        else:
+            OEI    = self.locints.loc_rhf_fock() + umat_loc
+        if ( NOrotation is not None ):
+            OEI = np.dot( np.dot( NOrotation.T, OEI ), NOrotation )
+        OEI = np.ascontiguousarray (OEI, dtype=ctypes.c_double)
+        outrow = np.ascontiguousarray (outrow, dtype=ctypes.c_int)
+        outcol = np.ascontiguousarray (outcol, dtype=ctypes.c_int)
+        assert (outrow.shape == outcol.shape)
+        rdm_deriv = np.empty ((self.Nterms, outrow.size), dtype=ctypes.c_double)
+        lib_qcdmet.rhf_response_sparse( ctypes.c_int( self.locints.norbs_tot ),
+                                        ctypes.c_int( self.Nterms ),
+                                        ctypes.c_int( self.numPairs ),
+                                        self.H1start.ctypes.data_as( ctypes.c_void_p ),
+                                        self.H1row.ctypes.data_as( ctypes.c_void_p ),
+                                        self.H1col.ctypes.data_as( ctypes.c_void_p ),
+                                        OEI.ctypes.data_as( ctypes.c_void_p ),
+                                        ctypes.c_int( outrow.size ),
+                                        outrow.ctypes.data_as( ctypes.c_void_p ),
+                                        outcol.ctypes.data_as( ctypes.c_void_p ),
+                                        ctypes.c_double( thresh ),
+                                        rdm_deriv.ctypes.data_as( ctypes.c_void_p ) )
+        return rdm_deriv
+
+    def contract1RDM_response( self, doSCF, umat_loc, NOrotation, adj_1RDM, conv_tol=1e-10, max_cycle=50, oneRDM_loc=None ):
+        ''' Contract the derivatives of the mean-field 1RDM with respect to each term of the correlation potential with
+        a fixed matrix, without ever building the (Nterms, norbs_tot, norbs_tot) array of construct1RDM_response:
+
+            grad[k] = sum_pq adj_1RDM[p,q] d(oneRDM[p,q]) / du_k
+
+        If the 1RDM is self-consistent (doSCF), the response of the Fock matrix is included by solving one set of
+        coupled-perturbed equations for the adjoint of adj_1RDM. Otherwise the result is the same as contracting the output
+        of construct1RDM_response, at O(norbs_tot^3) cost and O(norbs_tot^2) memory.
+
+        Args:
+            doSCF : logical
+            umat_loc : ndarray of shape (norbs_tot, norbs_tot)
+            NOrotation : ndarray of shape (norbs_tot, norbs_tot) or None
+            adj_1RDM : ndarray of shape (norbs_tot, norbs_tot)
+                In the rotated NO basis if NOrotation is specified, like the output of construct1RDM_response
+
+        Kwargs:
+            conv_tol : float
+                Convergence threshold for the coupled-perturbed equations (doSCF only)
+            max_cycle : integer
+                Maximum number of Krylov iterations for the coupled-perturbed equations (doSCF only). RuntimeError is
+                raised if they are not converged within it
+            oneRDM_loc : ndarray of shape (norbs_tot, norbs_tot)
+                The self-consistent 1RDM of umat_loc, if it is already known (doSCF only)
+
+        Returns:
+            grad : ndarray of shape (Nterms,)
+        '''
+        if doSCF:
+            oneRDM = oneRDM_loc
+            if oneRDM is None:
+                oneRDM = self.get_scf_1RDM (umat_loc)
+            OEI    = self.locints.loc_rhf_fock_bis (oneRDM) + umat_loc
+        else:
+            OEI    = self.locints.loc_rhf_fock() + umat_loc
+        rot = NOrotation if NOrotation is not None else np.eye (self.locints.norbs_tot)
+        OEI = rot.T @ OEI @ rot
+        eigvals, eigvecs = linalg.eigh (OEI)
+        occ  = eigvecs[:,:self.numPairs]
+        virt = eigvecs[:,self.numPairs:]
+        # Same as temp in rhf_response
+        denom = -1.0 / (eigvals[self.numPairs:,None] - eigvals[None,:self.numPairs])
+        def zvec (adj):
+            # adj (symmetric) -> Z such that sum_pq adj[p,q] dD[p,q] = sum_pq Z[p,q] H1[p,q] for any H1
+            return 2 * (virt @ (denom * (virt.T @ (adj + adj.T) @ occ)) @ occ.T)
+        adj = (adj_1RDM + adj_1RDM.T) / 2
+        if doSCF:
+            # The Fock matrix responds to the 1RDM: dD = R (H1 + G dD), with R the uncoupled response and G the
+            # Coulomb-exchange potential. Its adjoint y satisfies y = adj + G R y.
+            def resp (y):
+                dD = zvec (y) / 2
+                return dD + dD.T
+            def get_jk (dm_rot):
+                return rot.T @ self.locints.loc_rhf_jk_bis (rot @ dm_rot @ rot.T) @ rot
+            def aop (ys):
+                ys = np.asarray (ys).reshape (-1, adj.size)
+                return np.stack ([-get_jk (resp (y.reshape (adj.shape))).ravel () for y in ys], axis=0)
+            y = lib.krylov (aop, adj.ravel (), tol=conv_tol, max_cycle=max_cycle)
+            # Older versions of lib.krylov return their last iterate silently if they run out of cycles
+            rnorm = linalg.norm (y + aop (y)[0] - adj.ravel ())
+            if rnorm > np.sqrt (conv_tol):
+                raise RuntimeError ("contract1RDM_response: coupled-perturbed equations not converged in {} cycles "
+                    "(residual norm = {})".format (max_cycle, rnorm))
+            adj = y.reshape (adj.shape)
+            adj = (adj + adj.T) / 2
+        zmat = zvec (adj)
+        return np.bincount (self.H1term, weights=zmat[self.H1row,self.H1col], minlength=self.Nterms)
         
     def constructbath( self, OneDM, impurityOrbs, numBathOrbs, threshold=1e-13 ):
     
@@ -125,9 +125,29 @@ def wrap_my_veff (get_veff_ao, ao2basis ):
         
     return my_veff
 
+def _count_newton_cycles (mf, stats):
+    ''' Wrap the kernel of the second-order SCF object mf, which doesn't set mf.cycles, so that it adds its number of macro
+    cycles to stats['scf_cycles'] and stats['newton_cycles'] '''
+    if stats is None: return mf
+    stats.setdefault ('newton_cycles', 0)
+    ncycles = [0]
+    def callback (envs):
+        ncycles[0] = envs['imacro'] + 1
+    mf.callback = callback
+    mf_kernel = mf.kernel
+    def kernel (*args, **kwargs):
+        ncycles[0] = 0
+        try:
+            return mf_kernel (*args, **kwargs)
+        finally:
+            stats['scf_cycles'] = stats.get ('scf_cycles', 0) + ncycles[0]
+            stats['newton_cycles'] += ncycles[0]
+    mf.kernel = kernel
+    return mf
+
 def solve_JK(CONST, OEI, ao2basis, oneRDMguess_loc, numPairs, num_mf_stab_checks, get_veff_ao, get_jk_ao,
     groupname=None, symm_orb=None, irrep_name=None, irrep_id=None, enforce_symmetry=False,
-    verbose=logger.INFO, output=None):
+    verbose=logger.INFO, output=None, stats=None):
 
     mol = gto.Mole()
     mol.atom.append(('C', (0, 0, 0)))
@@ -155,8 +175,9 @@ def solve_JK(CONST, OEI, ao2basis, oneRDMguess_loc, numPairs, num_mf_stab_checks
     
     mf.scf( oneRDMguess_loc )
     oneRDM_loc = mf.make_rdm1 ()
+    if stats is not None: stats['scf_cycles'] = stats.get ('scf_cycles', 0) + getattr (mf, 'cycles', 0)
     if not mf.converged:
-        mf = mf.newton ()
+        mf = _count_newton_cycles (mf.newton (), stats)
         def my_intor (intor, comp=None, hermi=0, aosym='s1', out=None, shls_slice=None):
             if intor == 'int1e_ovlp':
                 return np.eye (L)
@@ -181,8 +202,9 @@ def solve_JK(CONST, OEI, ao2basis, oneRDMguess_loc, numPairs, num_mf_stab_checks
         mf.verbose=0
         mf.scf( oneRDMguess_loc )
         oneRDM_loc = mf.make_rdm1 ()
+        if stats is not None: stats['scf_cycles'] = stats.get ('scf_cycles', 0) + getattr (mf, 'cycles', 0)
         if ( mf.converged == False ):
-            mf.newton ().kernel ( oneRDM_loc )
+            _count_newton_cycles (mf.newton (), stats).kernel ( oneRDM_loc )
             oneRDM_loc = mf.make_rdm1 () #np.dot(np.dot( mf.mo_coeff, np.diag( mf.mo_occ )), mf.mo_coeff.T )
 
     return oneRDM_loc
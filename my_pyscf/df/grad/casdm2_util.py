@@ -162,7 +162,7 @@ def solve_df_eri (mc_or_mc_grad, mo_cas=None, compact=True):
     int3c = get_int3c_mo (mol, auxmol, mo_cas, compact=compact, max_memory=mc_or_mc_grad.max_memory)
 
     # Solve (P|Q) g_Qij = (P|ij)
-    dferi = linalg.cho_solve (int2c, int3c)
+    dferi = linalg.cho_solve (int2c, int3c.reshape (naux, -1))
     if int3c.ndim == 2:
         dferi = dferi.reshape (naux, -1)
     else:
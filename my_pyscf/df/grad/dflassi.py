@@ -0,0 +1,32 @@
+from mrh.my_pyscf.grad import lassi as lassi_grad
+from mrh.my_pyscf.df.grad import dfcasscf as dfcasscf_grad
+from mrh.my_pyscf.df.grad import dfsacasscf as dfsacasscf_grad
+from mrh.my_pyscf.df.grad import rhf as dfrhf_grad
+
+class Gradients (lassi_grad.Gradients):
+    ''' LASSI nuclear gradients with density fitting. The two-electron terms are evaluated with the DF-CASSCF and
+    DF-SA-CASSCF gradient kernels (see casdm2_util). '''
+
+    def __init__(self, las, si=None, state=None):
+        self.auxbasis_response = True
+        lassi_grad.Gradients.__init__(self, las, si=si, state=state)
+
+    def kernel (self, **kwargs):
+        mf_grad = kwargs['mf_grad'] if 'mf_grad' in kwargs else None
+        if mf_grad is None: kwargs['mf_grad'] = dfrhf_grad.Gradients (self.base._scf)
+        return lassi_grad.Gradients.kernel (self, **kwargs)
+
+    def make_fcasscf_grad (self, fcasscf):
+        fcasscf_grad = dfcasscf_grad.Gradients (fcasscf)
+        fcasscf_grad.auxbasis_response = self.auxbasis_response
+        return fcasscf_grad
+
+    def Lci_dot_dgci_dx (self, Lci, weights, fcasscf, **kwargs):
+        return dfsacasscf_grad.Lci_dot_dgci_dx (Lci, weights, fcasscf, auxbasis_response=self.auxbasis_response,
+            **kwargs)
+
+    def Lorb_dot_dgorb_dx (self, Lorb, fcasscf, **kwargs):
+        return dfsacasscf_grad.Lorb_dot_dgorb_dx (Lorb, fcasscf, auxbasis_response=self.auxbasis_response,
+            **kwargs)
+
+Grad = Gradients
@@ -188,10 +188,10 @@ def get_jk(mf_grad, mol=None, dm=None, hermi=0, with_j=True, with_k=True, ishf=T
         idx = numpy.abs (mo_occ[i])>1e-8
         nocc.append (numpy.count_nonzero (idx))
         c = mo_coeff[i][:,idx]
-        orbol_stack = numpy.append (orbol_stack, c, axis=1)
+        orbol_stack = numpy.asfortranarray (numpy.append (orbol_stack, c, axis=1))
         orbol.append (orbol_stack[:,offs:offs+nocc[-1]])
         cn = lib.einsum('pi,i->pi', c, mo_occ[i][idx])
-        orbor_stack = numpy.append (orbor_stack, cn, axis=1)
+        orbor_stack = numpy.asfortranarray (numpy.append (orbor_stack, cn, axis=1))
         orbor.append (orbor_stack[:,offs:offs+nocc[-1]])
         offs += nocc[-1]
 
@@ -308,8 +308,8 @@ def get_jk(mf_grad, mol=None, dm=None, hermi=0, with_j=True, with_k=True, ishf=T
                      ctypes.c_int (3*(p1-p0)), ctypes.c_int (nao),
                      (ctypes.c_int*4)(0, nocc_i, 0, nao),
                      null, ctypes.c_int(0))
-            int3c = [[lib.dot (buf.reshape (-1, nao), orb).reshape (3, p1-p0, -1, norb)
-                for orb, norb in zip (orbor, nocc)] for buf in tmp] # pim,mj,j -> pij
+            int3c = [[lib.dot (buf.reshape (-1, nao), orb).reshape (3, p1-p0, nocc_i, norb)
+                for orb, norb in zip (orbor, nocc)] for buf, nocc_i in zip (tmp, nocc)] # pim,mj,j -> pij
             t2 = logger.timer_debug1 (mf_grad, "df grad einsum (P'|mn) u_mi u_nj N_j = v_Pmn", *t2)
             for i, j in product (range (nset), repeat=2):
                 k = (i*nset) + j
@@ -0,0 +1,37 @@
+import unittest
+import numpy as np
+from pyscf import lib, gto, scf
+from mrh.my_pyscf.mcscf.lasscf_testing import LASSCF
+from mrh.my_pyscf.mcscf.lassi import lassi
+from mrh.my_pyscf.df.grad.dflassi import Gradients
+
+mol = gto.M (atom='H 0 0 0; H 0.8 0 0.1; H 0.1 0 2.5; H 0.9 0.1 2.5', basis='6-31g', verbose=lib.logger.INFO,
+    output='test_dflassi.log')
+mf = scf.RHF (mol).density_fit (auxbasis='weigend').run (conv_tol=1e-12)
+las = LASSCF (mf, (2,2), (2,2), spin_sub=(1,1))
+las.state_average_(weights=[0.4,0.3,0.3], charges=[[0,0],[1,-1],[-1,1]], spins=[[0,0],[1,-1],[-1,1]],
+    smults=[[1,1],[2,2],[2,2]])
+las.conv_tol_grad = 1e-9
+las.kernel (las.localize_init_guess (([0,1],[2,3]), mf.mo_coeff))
+e_roots, si = lassi (las)
+
+def tearDownModule():
+    global mol, mf, las
+    mol.stdout.close ()
+    del mol, mf, las
+
+class KnownValues(unittest.TestCase):
+    def test_grad_root0 (self):
+        # Central finite differences of the DF-LASSI ground state with 1e-4 Angstrom steps
+        de_num = np.array ([[-3.0989326553e-02,  9.2263158867e-05, -1.4778511183e-03],
+                            [ 3.1078598134e-02,  5.8170593455e-06,  6.7024921584e-03],
+                            [-3.1027059104e-02, -3.9717372120e-03, -2.7810406260e-03],
+                            [ 3.0937930534e-02,  3.8737761257e-03, -2.4435174197e-03]])
+        de = Gradients (las, si=si).kernel (state=0)
+        for i, j in np.ndindex (*de.shape):
+            with self.subTest (atom=i, xyz=j):
+                self.assertAlmostEqual (de[i,j], de_num[i,j], 6)
+
+if __name__ == "__main__":
+    print("Full Tests for DF-LASSI analytical nuclear gradients")
+    unittest.main()
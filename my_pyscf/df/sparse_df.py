@@ -1,10 +1,16 @@
-from pyscf import lib
+from pyscf import lib, __config__
 import numpy as np
 from scipy import linalg
 from mrh.lib.helper import load_library
-import ctypes, time
+import ctypes, time, os
 libsint = load_library ('libsint')
 
+SPARSITY_THRESH = getattr (__config__, 'df_sparse_df_sparsity_thresh', 1e-8)
+# If True, get_sparsedf saves the sparsity pattern next to the CDERI file (with_df._cderi_to_save) and reads it back
+# from there in later runs
+SAVE_SPARSITY = getattr (__config__, 'df_sparse_df_save_sparsity', False)
+SPARSITY_KEYS = ('iao_nent', 'iao_entlist', 'iao_sort', 'nent_max', 'nentpair', 'entpair')
+
 class sparsedf_array (np.ndarray):
     def __new__(cls, inp, nmo=None):
         assert (inp.flags['C_CONTIGUOUS'] or inp.flags['F_CONTIGUOUS'])
@@ -34,6 +40,7 @@ class sparsedf_array (np.ndarray):
         self.nent_max = getattr(obj, 'nent_max', None)
         self.nentpair = getattr(obj, 'nentpair', None)
         self.entpair = getattr(obj, 'entpair', None)
+        self.sparsity_thresh = getattr(obj, 'sparsity_thresh', None)
 
     def pack_mo (self):
         if self.ndim == 2: return self
@@ -50,12 +57,55 @@ class sparsedf_array (np.ndarray):
         return sparsedf_array (lib.numpy_helper.transpose (self, axes=(0,2,1), inplace=(self.nmo[0] == self.nmo[1])), nmo=(self.nmo[1], self.nmo[0]))
         
     def naux_fast (self): # Since naux is always the first index, this corresponds to making the array F-contiguous
-        return sparsedf_array (np.asfortranarray (self), nmo=self.nmo)
+        return sparsedf_array (np.asfortranarray (self), nmo=self.nmo).set_sparsity_ (self.get_sparsity ())
 
     def naux_slow (self): # Since naux is always the first index, this corresponds to making the array C-contiguous
-        return sparsedf_array (np.ascontiguousnarray (self), nmo=self.nmo)
+        return sparsedf_array (np.ascontiguousarray (self), nmo=self.nmo).set_sparsity_ (self.get_sparsity ())
+
+    def get_sparsity (self):
+        ''' Sparsity pattern as a dict, which can be handed to set_sparsity_ of another view of the same CDERIs.
+        None if it hasn't been computed. '''
+        if self.nent_max is None: return None
+        sparsity = {key: getattr (self, key) for key in SPARSITY_KEYS}
+        sparsity['sparsity_thresh'] = self.sparsity_thresh
+        return sparsity
+
+    def set_sparsity_ (self, sparsity):
+        if sparsity is None: return self
+        for key, val in sparsity.items (): setattr (self, key, val)
+        return self
+
+    def _sparsity_fingerprint (self):
+        # Cheap (one row of the CDERIs) check that a saved sparsity pattern belongs to this array
+        return np.asarray ([self.naux, self.shape[1], np.sum (self[0]), np.sum (self[-1])])
 
-    def get_sparsity_ (self, thresh=1e-8):
+    def dump_sparsity (self, fname):
+        ''' Save the sparsity pattern to an npz file '''
+        if self.nent_max is None: self.get_sparsity_ ()
+        sparsity = self.get_sparsity ()
+        np.savez (fname, fingerprint=self._sparsity_fingerprint (), **sparsity)
+
+    def load_sparsity_ (self, fname, thresh=SPARSITY_THRESH):
+        ''' Read a sparsity pattern saved by dump_sparsity, if it exists and matches this array and thresh
+
+        Returns:
+            loaded : logical
+        '''
+        if not os.path.isfile (fname): return False
+        try:
+            with np.load (fname) as f:
+                if f['sparsity_thresh'] != thresh: return False
+                if not np.allclose (f['fingerprint'], self._sparsity_fingerprint (), rtol=1e-12, atol=0): return False
+                sparsity = {key: f[key] for key in SPARSITY_KEYS}
+        except (OSError, KeyError, ValueError):
+            return False
+        for key in ('nent_max', 'nentpair'): sparsity[key] = int (sparsity[key])
+        sparsity['sparsity_thresh'] = thresh
+        self.set_sparsity_ (sparsity)
+        return True
+
+    def get_sparsity_ (self, thresh=SPARSITY_THRESH):
+        self.sparsity_thresh = thresh
         metric = linalg.norm (self, axis=0)
         if metric.ndim == 1: metric = lib.unpack_tril (metric)
         metric = metric > thresh
@@ -98,6 +148,39 @@ class sparsedf_array (np.ndarray):
         wrk = None
         return vPuv
 
+    def contract1_batch (self, cmats):
+        ''' Contract 1 AO index with each of several dense matrices in a single pass over the CDERIs. Cheaper than
+        calling contract1 once per matrix, because the sparse CDERI blocks are only gathered once.
+
+        Args:
+            cmats : list of np.ndarray of shape (nao, nmo[i])
+
+        Returns:
+            vPuvs : list of np.ndarray of shape (nao, nmo[i], naux) stored in row-major order
+        '''
+        if not len (cmats): return []
+        if not self.flags['C_CONTIGUOUS']: self = self.naux_slow ()
+        nao = self.nmo[0]
+        imat_nmo = np.asarray ([cmat.shape[1] for cmat in cmats], dtype=np.int32)
+        cmat = np.ascontiguousarray (np.concatenate (cmats, axis=1), dtype=self.dtype)
+        if self.nent_max is None: self.get_sparsity_ ()
+        vPuvs = [np.zeros ((nao, nmo, self.naux), dtype=self.dtype).view (sparsedf_array) for nmo in imat_nmo]
+        vPuv_ptrs = (ctypes.c_void_p * len (vPuvs)) (*[vPuv.ctypes.data for vPuv in vPuvs])
+        wrk = np.zeros ((lib.num_threads (), self.nent_max, (self.naux+cmat.shape[1])), dtype = self.dtype)
+        libsint.SINT_SDCDERI_DDMAT_BATCH (self.ctypes.data_as (ctypes.c_void_p),
+            cmat.ctypes.data_as (ctypes.c_void_p),
+            vPuv_ptrs,
+            wrk.ctypes.data_as (ctypes.c_void_p),
+            self.iao_sort.ctypes.data_as (ctypes.c_void_p),
+            self.iao_nent.ctypes.data_as (ctypes.c_void_p),
+            self.iao_entlist.ctypes.data_as (ctypes.c_void_p),
+            imat_nmo.ctypes.data_as (ctypes.c_void_p),
+            ctypes.c_int (len (vPuvs)),
+            ctypes.c_int (nao), ctypes.c_int (self.naux),
+            ctypes.c_int (self.nent_max))
+        wrk = None
+        return vPuvs
+
     def contract2 (self, vPuv):
         ''' Contract the auxbasis and one AO basis indices with multiplicand vPuv, as when computing the exchange matrix of Hartree--Fock.
         
@@ -173,3 +256,38 @@ class sparsedf_array (np.ndarray):
         return vk
 
 
+
+def _sparsity_file (with_df):
+    cderi_file = getattr (with_df, '_cderi_to_save', None)
+    cderi_file = getattr (cderi_file, 'filename', cderi_file)
+    if not isinstance (cderi_file, str): return None
+    return cderi_file + '.sparsity.npz'
+
+def get_sparsedf (with_df, thresh=SPARSITY_THRESH, save=SAVE_SPARSITY):
+    ''' Wrap with_df._cderi in a sparsedf_array. The sparsity pattern is only computed once per _cderi array: it is
+    stored on with_df and attached to every array this function returns afterwards.
+
+    Args:
+        with_df : instance of pyscf.df.DF with the CDERIs in memory
+
+    Kwargs:
+        thresh : float
+            AO pairs are screened out if the norm of their CDERI vector is less than this
+        save : logical
+            If True, also save the sparsity pattern next to the CDERI file and read it from there if it exists
+
+    Returns:
+        bPmn : sparsedf_array
+    '''
+    cderi = with_df._cderi
+    bPmn = sparsedf_array (cderi)
+    cache = getattr (with_df, '_sparsedf_sparsity', None)
+    if cache is not None and cache[0] is cderi and cache[1] == thresh:
+        return bPmn.set_sparsity_ (cache[2])
+    fname = _sparsity_file (with_df) if save else None
+    if not (fname and bPmn.load_sparsity_ (fname, thresh=thresh)):
+        bPmn.get_sparsity_ (thresh=thresh)
+        if fname: bPmn.dump_sparsity (fname)
+    with_df._sparsedf_sparsity = (cderi, thresh, bPmn.get_sparsity ())
+    return bPmn
+
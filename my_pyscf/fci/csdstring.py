@@ -23,41 +23,99 @@ def check_csd_mask_size (norb, neleca, nelecb):
     assert (mask_size / 1e9 <= mask_size_lim_gd), '{:.2f} billion determinants; more than {:.2f} billion not supported'.format (mask_size / 1e9, mask_size_lim_gd)
     return mask_size
 
+def get_mask_dtype (maxval):
+    ''' Smallest signed integer dtype able to hold every index from 0 to maxval '''
+    for dtype in (np.int8, np.int16, np.int32):
+        if maxval <= np.iinfo (dtype).max: return dtype
+    return np.int64
+
+def make_csd_masks (norb, neleca, nelecb):
+    ''' Get both csd_mask (see make_csd_mask) and econf_det_mask (see make_econf_det_mask) from a single pass over
+    all determinant pairs in C, each in the smallest safe integer dtype
+
+    Args:
+    norb, neleca, nelecb are integers
+
+    Returns:
+    csd_mask, 1d ndarray of integers
+        csd_mask[idx_csd] = idx_dd
+    econf_det_mask, 1d ndarray of integers
+        econf_det_mask[idx_dd] = iconf
+    '''
+    assert (norb < 64), 'Only up to 63 orbitals supported'
+    check_csd_mask_size (norb, neleca, nelecb)
+    stra = np.ascontiguousarray (cistring.make_strings (range (norb), neleca), dtype=np.uint64)
+    strb = np.ascontiguousarray (cistring.make_strings (range (norb), nelecb), dtype=np.uint64)
+    ndeta, ndetb = len (stra), len (strb)
+    min_npair, npair_offset, npair_dconf_size, npair_sconf_size, npair_spins_size = get_csdaddrs_shape (norb, neleca, nelecb)
+    npair_conf_size = npair_dconf_size.astype (np.int64) * npair_sconf_size.astype (np.int64)
+    npair_conf_offset = np.ascontiguousarray (np.cumsum (npair_conf_size) - npair_conf_size, dtype=np.int64)
+    npair_csd_offset = np.ascontiguousarray (npair_offset, dtype=np.int64)
+    npair_nsconf = np.ascontiguousarray (npair_sconf_size, dtype=np.int64)
+    npair_nspins = np.ascontiguousarray (npair_spins_size, dtype=np.int64)
+    binom = np.zeros ((norb+1, norb+1), dtype=np.int64)
+    for n in range (norb+1):
+        binom[n,:n+1] = [special.comb (n, k, exact=True) for k in range (n+1)]
+    csd_mask = np.empty (ndeta*ndetb, dtype=np.uint32)
+    econf_det_mask = np.empty (ndeta*ndetb, dtype=np.uint32)
+    libcsf.FCICSFmakemasks (csd_mask.ctypes.data_as (ctypes.c_void_p),
+        econf_det_mask.ctypes.data_as (ctypes.c_void_p),
+        stra.ctypes.data_as (ctypes.c_void_p),
+        strb.ctypes.data_as (ctypes.c_void_p),
+        ctypes.c_int (ndeta), ctypes.c_int (ndetb), ctypes.c_int (norb), ctypes.c_int (min_npair),
+        npair_csd_offset.ctypes.data_as (ctypes.c_void_p),
+        npair_conf_offset.ctypes.data_as (ctypes.c_void_p),
+        npair_nsconf.ctypes.data_as (ctypes.c_void_p),
+        npair_nspins.ctypes.data_as (ctypes.c_void_p),
+        binom.ctypes.data_as (ctypes.c_void_p))
+    csd_mask = csd_mask.astype (get_mask_dtype (ndeta*ndetb - 1), copy=False)
+    econf_det_mask = econf_det_mask.astype (get_mask_dtype (np.sum (npair_conf_size) - 1), copy=False)
+    return csd_mask, econf_det_mask
+
 def make_csd_mask (norb, neleca, nelecb):
     ''' Get a mask index to reorder a (flattened) CI vector matrix in terms of
         (double_configuration, single_configuration, spin_configuration) 
 
     mask[idx_csd] = idx_dd '''
+    return make_csd_masks (norb, neleca, nelecb)[0]
 
-    t_start = time.time ()
-    ndeta = int (special.comb (norb, neleca))
-    ndetb = int (special.comb (norb, nelecb))
-    mask = np.empty (ndeta*ndetb, dtype=np.uint32)
+def make_econf_det_mask (norb, neleca, nelecb, csd_mask=None):
+    ''' Get a mask index to identify the electron configuration (i.e., in csd order) of a given determinant pair address (in determinant-pair order)
+
+    csd_mask is no longer needed and is ignored '''
+    return make_csd_masks (norb, neleca, nelecb)[1]
+
+def make_econf_strs (norb, neleca, nelecb):
+    ''' Get the orbital occupation strings of every electron configuration, in the canonical order used by
+        econf_det_mask (number of pairs, then pair configuration, then unpaired-electron configuration)
+
+    Args:
+    norb, neleca, nelecb are integers
+
+    Returns:
+    dconf_strs, 1d ndarray of int64
+        dconf_strs[iconf] has bit p set if orbital p is doubly occupied in configuration iconf
+    sconf_strs, 1d ndarray of int64
+        sconf_strs[iconf] has bit p set if orbital p is singly occupied in configuration iconf
+        (unlike the sconf strings of csdstrs, these index all norb orbitals, not the norb - npair unpaired ones)
+    '''
     min_npair, npair_offset, npair_dconf_size, npair_sconf_size, npair_spins_size = get_csdaddrs_shape (norb, neleca, nelecb)
-    pair_size = npair_dconf_size * npair_sconf_size * npair_spins_size
+    dconf_strs = []
+    sconf_strs = []
     for npair in range (min_npair, min (neleca, nelecb)+1):
-        ipair = npair - min_npair
         nspin = neleca + nelecb - 2*npair
-        mask[npair_offset[ipair]:][:pair_size[ipair]] = get_nspin_dets (norb, neleca, nelecb, nspin).flat
-    #print ("Time to make csf mask index array: {:.2f} seconds, memory: {:.2f} MB".format (
-    #        time.time () - t_start, mask.nbytes / 1e6, ndeta*ndetb*4 / 1e6))
-    return mask
-
-def make_econf_det_mask (norb, neleca, nelecb, csd_mask):
-    ''' Get a mask index to identify the electron configuration (i.e., in csd order) of a given determinant pair address (in determinant-pair order) '''
-    ndeta = int (special.comb (norb, neleca))
-    ndetb = int (special.comb (norb, nelecb))
-    mask = np.empty (ndeta*ndetb, dtype=np.uint32)
-    min_npair, npair_offset, npair_dconf_size, npair_sconf_size, npair_spins_size = get_csdaddrs_shape (norb, neleca, nelecb)
-    npair_conf_size = npair_dconf_size * npair_sconf_size
-    npair_det_size = npair_conf_size * npair_spins_size
-    iconf = 0
-    for npair in range (min_npair, min (neleca, nelecb)+1):
-        ipair = npair - min_npair
-        irange = np.arange (iconf, iconf+npair_conf_size[ipair], dtype=np.uint32)
-        iconf += npair_conf_size[ipair]
-        mask[npair_offset[ipair]:][:npair_det_size[ipair]] = np.repeat (irange, npair_spins_size[ipair])
-    return mask[np.argsort (csd_mask)]
+        dstrs = cistring.make_strings (range (norb), npair)
+        sstrs_packed = cistring.make_strings (range (norb - npair), nspin)
+        for dstr in dstrs:
+            free_orbs = [iorb for iorb in range (norb) if not (int (dstr) >> iorb) & 1]
+            sstrs = np.zeros_like (sstrs_packed)
+            for ifree, iorb in enumerate (free_orbs):
+                sstrs |= ((sstrs_packed >> ifree) & 1) << iorb
+            dconf_strs.append (np.full (sstrs.size, dstr, dtype=np.int64))
+            sconf_strs.append (sstrs)
+    dconf_strs = np.ascontiguousarray (np.concatenate (dconf_strs), dtype=np.int64)
+    sconf_strs = np.ascontiguousarray (np.concatenate (sconf_strs), dtype=np.int64)
+    return dconf_strs, sconf_strs
 
 def get_nspin_dets (norb, neleca, nelecb, nspin):
     ''' Grab all determinant pair addresses corresponding to nspin unpaired electrons, sorted by spin configuration
@@ -2,12 +2,14 @@ import numpy as np
 import scipy
 import ctypes
 import time
+from collections import OrderedDict
 from pyscf import lib, ao2mo, __config__
 from pyscf.fci import direct_spin1, cistring, direct_uhf
 from pyscf.fci.direct_spin1 import _unpack, _unpack_nelec, _get_init_guess, kernel_ms1
 from pyscf.lib.numpy_helper import tag_array
-from mrh.my_pyscf.fci.csdstring import get_csdaddrs_shape 
-from mrh.my_pyscf.fci.csfstring import count_all_csfs, get_spin_evecs
+from scipy import special
+from mrh.my_pyscf.fci.csdstring import get_csdaddrs_shape, make_econf_strs
+from mrh.my_pyscf.fci.csfstring import count_all_csfs, get_spin_evecs, get_onebody_coupling
 from mrh.my_pyscf.fci.csfstring import get_csfvec_shape
 from mrh.my_pyscf.fci.csfstring import CSFTransformer
 from mrh.lib.helper import load_library as mrh_load_library
@@ -26,6 +28,11 @@ from mrh.lib.helper import load_library as mrh_load_library
 libfci = lib.load_library('libfci')
 libcsf = mrh_load_library('libcsf')
 
+# The CSF-basis hop is only faster than the determinant-basis one if there are many fewer CSFs than determinants
+CSF_HOP_MIN_RATIO = getattr(__config__, 'fci_csf_CSF_HOP_MIN_RATIO', 4)
+# Max number of (norb, neleca, nelecb, smult) configuration spaces kept by _get_confspace (least recently used dropped)
+CONFSPACE_CACHE_SIZE = getattr(__config__, 'fci_csf_CONFSPACE_CACHE_SIZE', 16)
+
 def unpack_h1e_ab (h1e):
     h = np.asarray (h1e)
     if h.ndim == 3 and h.shape[0] == 2:
@@ -66,63 +73,38 @@ def make_hdiag_det (fci, h1e, eri, norb, nelec):
     return direct_uhf.make_hdiag (unpack_h1e_ab (h1e), [eri, eri, eri], norb, nelec)
 
 def make_hdiag_csf (h1e, eri, norb, nelec, transformer, hdiag_det=None):
-    smult = transformer.smult
-    if hdiag_det is None:
-        hdiag_det = make_hdiag_det (None, h1e, eri, norb, nelec)
-    eri = ao2mo.restore(1, eri, norb)
-    tlib = wlib = 0
+    ''' Diagonal of the Hamiltonian in the CSF basis, evaluated directly configuration by configuration in libcsf
+    (FCICSFhdiag_conf; OpenMP-parallel over configurations). No determinant-basis diagonal is needed, and hdiag_det
+    is only accepted for backwards compatibility. '''
+    if norb > 63:
+        raise NotImplementedError('norb > 63')
     neleca, nelecb = _unpack_nelec (nelec)
-    min_npair, npair_csd_offset, npair_dconf_size, npair_sconf_size, npair_sdet_size = get_csdaddrs_shape (norb, neleca, nelecb)
-    _, npair_csf_offset, _, _, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
-    npair_econf_size = npair_dconf_size * npair_sconf_size
-    max_npair = min (neleca, nelecb)
-    ncsf_all = count_all_csfs (norb, neleca, nelecb, smult)
-    ndeta_all = cistring.num_strings(norb, neleca)
-    ndetb_all = cistring.num_strings(norb, nelecb)
-    ndet_all = ndeta_all * ndetb_all
-    hdiag_csf = np.ascontiguousarray (np.zeros (ncsf_all, dtype=np.float64))
-    hdiag_csf_check = np.ones (ncsf_all, dtype=np.bool)
-    for npair in range (min_npair, max_npair+1):
-        ipair = npair - min_npair
-        nconf = npair_econf_size[ipair]
-        ndet = npair_sdet_size[ipair]
-        ncsf = npair_csf_size[ipair]
-        if ncsf == 0:
-            continue
-        nspin = neleca + nelecb - 2*npair
-        csd_offset = npair_csd_offset[ipair]
-        csf_offset = npair_csf_offset[ipair]
-        hdiag_conf = np.ascontiguousarray (np.zeros ((nconf, ndet, ndet), dtype=np.float64))
-        det_addr = transformer.csd_mask[csd_offset:][:nconf*ndet]
-        if ndet == 1:
-            # Closed-shell singlets
-            assert (ncsf == 1)
-            hdiag_csf[csf_offset:][:nconf] = hdiag_det[det_addr.flat]
-            hdiag_csf_check[csf_offset:][:nconf] = False
-            continue
-        det_addra, det_addrb = divmod (det_addr, ndetb_all)
-        det_stra = np.ascontiguousarray (cistring.addrs2str (norb, neleca, det_addra).reshape (nconf, ndet, order='C'))
-        det_strb = np.ascontiguousarray (cistring.addrs2str (norb, nelecb, det_addrb).reshape (nconf, ndet, order='C'))
-        det_addr = det_addr.reshape (nconf, ndet, order='C')
-        hdiag_conf = np.ascontiguousarray (np.zeros ((nconf, ndet, ndet), dtype=np.float64))
-        hdiag_conf_det = np.ascontiguousarray (hdiag_det[det_addr], dtype=np.float64)
-        t1 = time.clock ()
-        w1 = time.time ()
-        libcsf.FCICSFhdiag (hdiag_conf.ctypes.data_as (ctypes.c_void_p),
-                            hdiag_conf_det.ctypes.data_as (ctypes.c_void_p),
-                            eri.ctypes.data_as (ctypes.c_void_p),
-                            det_stra.ctypes.data_as (ctypes.c_void_p),
-                            det_strb.ctypes.data_as (ctypes.c_void_p),
-                            ctypes.c_uint (norb), ctypes.c_uint (nconf), ctypes.c_uint (ndet))
-        tlib += time.clock () - t1
-        wlib += time.time () - w1
-        umat = get_spin_evecs (nspin, neleca, nelecb, smult)
-        hdiag_conf = np.tensordot (hdiag_conf, umat, axes=1)
-        hdiag_conf *= umat[np.newaxis,:,:]
-        hdiag_csf[csf_offset:][:nconf*ncsf] = hdiag_conf.sum (1).ravel (order='C')
-        hdiag_csf_check[csf_offset:][:nconf*ncsf] = False
-    assert (np.count_nonzero (hdiag_csf_check) == 0), np.count_nonzero (hdiag_csf_check)
-    #print ("Time in hdiag_csf library: {}, {}".format (tlib, wlib))
+    h1ea, h1eb = (np.ascontiguousarray (h, dtype=np.float64) for h in unpack_h1e_ab (h1e))
+    eri = np.ascontiguousarray (ao2mo.restore (1, eri, norb), dtype=np.float64)
+    conf_tabs, spin_tabs, csf_addr = _get_confspace (norb, neleca, nelecb, transformer.smult)
+    dconf_strs, sconf_strs, conf_nspin, conf_csf_offset = conf_tabs
+    umat, umat_offset, spinstrs, spinstrs_offset, nspin_ndet, nspin_ncsf = spin_tabs
+    ncsf_all = count_all_csfs (norb, neleca, nelecb, transformer.smult)
+    assert (csf_addr.size == ncsf_all)
+    hdiag_csf = np.zeros (ncsf_all, dtype=np.float64)
+    libcsf.FCICSFhdiag_conf (hdiag_csf.ctypes.data_as (ctypes.c_void_p),
+                             dconf_strs.ctypes.data_as (ctypes.c_void_p),
+                             sconf_strs.ctypes.data_as (ctypes.c_void_p),
+                             conf_nspin.ctypes.data_as (ctypes.c_void_p),
+                             conf_csf_offset.ctypes.data_as (ctypes.c_void_p),
+                             ctypes.c_int (dconf_strs.size),
+                             umat.ctypes.data_as (ctypes.c_void_p),
+                             umat_offset.ctypes.data_as (ctypes.c_void_p),
+                             spinstrs.ctypes.data_as (ctypes.c_void_p),
+                             spinstrs_offset.ctypes.data_as (ctypes.c_void_p),
+                             nspin_ndet.ctypes.data_as (ctypes.c_void_p),
+                             nspin_ncsf.ctypes.data_as (ctypes.c_void_p),
+                             ctypes.c_int (int (np.amax (nspin_ndet))),
+                             ctypes.c_int (int (np.amax (nspin_ncsf))),
+                             h1ea.ctypes.data_as (ctypes.c_void_p),
+                             h1eb.ctypes.data_as (ctypes.c_void_p),
+                             eri.ctypes.data_as (ctypes.c_void_p),
+                             ctypes.c_int (norb))
     return hdiag_csf
 
 
@@ -225,21 +207,218 @@ def _debug_g2e (fci, g2e, eri, norb):
     raise ValueError ('g2e has {} infs and {} nans (norb = {}; shape = {})'.format (g2e_ninf, g2e_nnan, norb, g2e.shape))
     return
 
+_confspace_cache = OrderedDict ()
+def _get_confspace (norb, neleca, nelecb, smult, econf_addr=None):
+    ''' Gather the configuration strings and spin-coupling tables used by FCICSFhmat and FCICSFhdiag_conf for the
+    electron configurations econf_addr (default: all configurations, in which case the tables are kept in an LRU cache
+    of CONFSPACE_CACHE_SIZE entries).
+    Configurations which have no CSFs of spin smult are dropped.
+
+    Returns:
+        conf_tabs: list of ndarrays
+            (dconf_strs, sconf_strs, conf_nspin, conf_csf_offset) of the retained configurations
+        spin_tabs: list of ndarrays
+            (umat, umat_offset, spinstrs, spinstrs_offset, nspin_ndet, nspin_ncsf), indexed by number of unpaired electrons
+        csf_addr: ndarray of ints
+            Canonical addresses of the CSFs spanned by the retained configurations, in the order used by libcsf
+    '''
+    cache_key = (norb, neleca, nelecb, smult) if econf_addr is None else None
+    if cache_key in _confspace_cache:
+        _confspace_cache.move_to_end (cache_key)
+        return _confspace_cache[cache_key]
+    min_npair, npair_csf_offset, npair_dconf_size, npair_sconf_size, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
+    npair_econf_size = npair_dconf_size * npair_sconf_size
+    npair_econf_offset = np.cumsum (npair_econf_size) - npair_econf_size
+    dconf_strs, sconf_strs = make_econf_strs (norb, neleca, nelecb)
+    nconf_all = dconf_strs.size
+    conf_ipair = np.repeat (np.arange (npair_econf_size.size), npair_econf_size)
+    conf_nspin = neleca + nelecb - 2*(conf_ipair + min_npair)
+    conf_ncsf = npair_csf_size[conf_ipair]
+    conf_csf_addr = npair_csf_offset[conf_ipair] + (np.arange (nconf_all) - npair_econf_offset[conf_ipair]) * conf_ncsf
+    if econf_addr is None:
+        econf_addr = np.arange (nconf_all)
+    econf_addr = np.unique (econf_addr)
+    econf_addr = econf_addr[conf_ncsf[econf_addr] > 0]
+    dconf_strs, sconf_strs = dconf_strs[econf_addr], sconf_strs[econf_addr]
+    conf_nspin, conf_ncsf, conf_csf_addr = conf_nspin[econf_addr], conf_ncsf[econf_addr], conf_csf_addr[econf_addr]
+    conf_csf_offset = np.cumsum (conf_ncsf) - conf_ncsf
+    csf_addr = np.repeat (conf_csf_addr - conf_csf_offset, conf_ncsf) + np.arange (np.sum (conf_ncsf))
+
+    max_nspin = neleca + nelecb - 2*min_npair
+    nspin_ndet = np.zeros (max_nspin+1, dtype=np.int32)
+    nspin_ncsf = np.zeros (max_nspin+1, dtype=np.int32)
+    umat_offset = np.zeros (max_nspin+1, dtype=np.int64)
+    spinstrs_offset = np.zeros (max_nspin+1, dtype=np.int64)
+    umat = [np.zeros (0)]
+    spinstrs = [np.zeros (0, dtype=np.int64)]
+    for nspin in np.unique (conf_nspin):
+        na = (nspin + neleca - nelecb) // 2
+        umat_offset[nspin] = sum ([u.size for u in umat])
+        spinstrs_offset[nspin] = sum ([s.size for s in spinstrs])
+        spinstrs.append (np.asarray (cistring.make_strings (range (nspin), na), dtype=np.int64))
+        umat.append (np.asarray_chkfinite (get_spin_evecs (nspin, neleca, nelecb, smult)).ravel ())
+        nspin_ndet[nspin] = spinstrs[-1].size
+        nspin_ncsf[nspin] = umat[-1].size // spinstrs[-1].size
+    conf_tabs = [np.ascontiguousarray (dconf_strs, dtype=np.int64), np.ascontiguousarray (sconf_strs, dtype=np.int64),
+                 np.ascontiguousarray (conf_nspin, dtype=np.int32), np.ascontiguousarray (conf_csf_offset, dtype=np.int32)]
+    spin_tabs = [np.ascontiguousarray (np.concatenate (umat), dtype=np.float64), umat_offset,
+                 np.ascontiguousarray (np.concatenate (spinstrs), dtype=np.int64), spinstrs_offset,
+                 nspin_ndet, nspin_ncsf]
+    if cache_key is not None:
+        _confspace_cache[cache_key] = conf_tabs, spin_tabs, csf_addr
+        while len (_confspace_cache) > CONFSPACE_CACHE_SIZE: _confspace_cache.popitem (last=False)
+    return conf_tabs, spin_tabs, csf_addr
+
+def make_hmat_csf (h1e, eri, norb, nelec, transformer, econf_addr=None):
+    ''' Evaluate the Hamiltonian matrix directly in the CSF basis spanning the electron configurations econf_addr
+    (default: all configurations), without building any determinant-basis intermediates larger than the determinants of
+    one configuration. Only pairs of configurations differing by at most a double excitation are visited.
+
+    Args:
+        h1e: ndarray of shape (norb,norb) or (2,norb,norb)
+        eri: ndarray of 2-electron integrals in any ao2mo-compatible packing
+        norb, nelec: int, tuple or int
+        transformer: instance of CSFTransformer
+
+    Kwargs:
+        econf_addr: ndarray of ints
+            Canonical addresses of electron configurations (see csdstring.make_econf_det_mask)
+
+    Returns:
+        hmat: ndarray of shape (ncsf, ncsf)
+        csf_addr: ndarray of shape (ncsf,), ints
+            Canonical (unpacked) addresses of the CSFs spanned by hmat, in ascending order
+    '''
+    if norb > 63:
+        raise NotImplementedError('norb > 63')
+    neleca, nelecb = _unpack_nelec (nelec)
+    h1ea, h1eb = (np.ascontiguousarray (h, dtype=np.float64) for h in unpack_h1e_ab (h1e))
+    eri = np.ascontiguousarray (ao2mo.restore (1, eri, norb), dtype=np.float64)
+    conf_tabs, spin_tabs, csf_addr = _get_confspace (norb, neleca, nelecb, transformer.smult, econf_addr=econf_addr)
+    dconf_strs, sconf_strs, conf_nspin, conf_csf_offset = conf_tabs
+    umat, umat_offset, spinstrs, spinstrs_offset, nspin_ndet, nspin_ncsf = spin_tabs
+    ncsf = csf_addr.size
+    hmat = np.zeros ((ncsf, ncsf), dtype=np.float64)
+    libcsf.FCICSFhmat (hmat.ctypes.data_as (ctypes.c_void_p), ctypes.c_int (ncsf),
+                       dconf_strs.ctypes.data_as (ctypes.c_void_p),
+                       sconf_strs.ctypes.data_as (ctypes.c_void_p),
+                       conf_nspin.ctypes.data_as (ctypes.c_void_p),
+                       conf_csf_offset.ctypes.data_as (ctypes.c_void_p),
+                       ctypes.c_int (dconf_strs.size),
+                       umat.ctypes.data_as (ctypes.c_void_p),
+                       umat_offset.ctypes.data_as (ctypes.c_void_p),
+                       spinstrs.ctypes.data_as (ctypes.c_void_p),
+                       spinstrs_offset.ctypes.data_as (ctypes.c_void_p),
+                       nspin_ndet.ctypes.data_as (ctypes.c_void_p),
+                       nspin_ncsf.ctypes.data_as (ctypes.c_void_p),
+                       ctypes.c_int (int (np.amax (nspin_ndet))),
+                       ctypes.c_int (int (np.amax (nspin_ncsf))),
+                       h1ea.ctypes.data_as (ctypes.c_void_p),
+                       h1eb.ctypes.data_as (ctypes.c_void_p),
+                       eri.ctypes.data_as (ctypes.c_void_p),
+                       ctypes.c_int (norb))
+    return hmat, csf_addr
+
+def make_hop_csf (h1e, eri, norb, nelec, transformer, max_memory=None):
+    ''' Build the Hamiltonian-vector product directly in the CSF basis, without transforming to determinants:
+
+        H = sum_pq h'_pq E_pq + 1/2 sum_pqrs (pq|rs) E_pq E_rs (+ sum_pq h1e_s[p,q] (E^a_pq - E^b_pq))
+        h'_pq = h1e_c[p,q] - 1/2 sum_r (pr|rq)
+
+    The one-body coupling coefficients <I|E_pq|J> are tabulated once per open-shell pattern (see
+    csfstring.get_onebody_coupling) and the two-body part is factorized through the intermediate
+    D[K,rs] = <K|E_rs|ci>, which is contracted with the integrals by dgemm.
+
+    Args:
+        h1e, eri, norb, nelec, transformer: as in make_hdiag_csf
+
+    Kwargs:
+        max_memory: float
+            In MB. If the intermediate D would not fit, return None so that the caller can fall back
+            to the determinant-basis hop
+
+    Returns:
+        hop: callable or None
+            Takes a (symmetry-packed) CSF vector and returns H times it
+    '''
+    neleca, nelecb = _unpack_nelec (nelec)
+    smult = transformer.smult
+    if norb >= 64: return None
+    ncsf_all = count_all_csfs (norb, neleca, nelecb, smult)
+    if max_memory is not None:
+        mem_reqd = (ncsf_all * norb * (norb+1) * 4 / 1e6) * 1.2
+        if mem_reqd > max_memory - lib.current_memory ()[0]: return None
+    h1e_c, h1e_s = unpack_h1e_cs (h1e)
+    with_spin = bool (np.any (h1e_s != 0))
+    f1e = h1e_c - 0.5 * np.einsum ('prrq->pq', ao2mo.restore (1, eri, norb))
+    f1e = lib.pack_tril (0.5 * (f1e + f1e.T))
+    h1e_s = np.ascontiguousarray (h1e_s, dtype=np.float64)
+    eri = 0.5 * ao2mo.restore (4, eri, norb)
+    norb_pair = norb * (norb+1) // 2
+
+    min_npair, npair_csf_offset, npair_dconf_size, npair_sconf_size, npair_ncsf = get_csfvec_shape (norb, neleca, nelecb, smult)
+    max_npair = min (neleca, nelecb)
+    max_nspin = neleca + nelecb - 2*min_npair
+    dconf_strs, sconf_strs = make_econf_strs (norb, neleca, nelecb)
+    nconf = len (dconf_strs)
+    npair_nconf = npair_dconf_size.astype (np.int64) * npair_sconf_size.astype (np.int64)
+    conf_offset = np.concatenate ([off + ncsf * np.arange (n, dtype=np.int64) for off, ncsf, n
+        in zip (npair_csf_offset, npair_ncsf, npair_nconf)]).astype (np.int64)
+    nspin_ncsf = np.zeros (max_nspin+1, dtype=np.int64)
+    for npair, ncsf in zip (range (min_npair, max_npair+1), npair_ncsf):
+        nspin_ncsf[neleca+nelecb-2*npair] = ncsf
+    npair_nsconf = np.ascontiguousarray (npair_sconf_size, dtype=np.int64)
+    npair_csf_offset = np.ascontiguousarray (npair_csf_offset, dtype=np.int64)
+    npair_ncsf = np.ascontiguousarray (npair_ncsf, dtype=np.int64)
+    binom = np.zeros ((norb+1, norb+1), dtype=np.int64)
+    for n in range (norb+1):
+        binom[n,:n+1] = [special.comb (n, k, exact=True) for k in range (n+1)]
+    blk_offset, blk_E, blk_T = get_onebody_coupling (max_nspin, neleca, nelecb, smult)
+    conf_args = [dconf_strs.ctypes.data_as (ctypes.c_void_p),
+        sconf_strs.ctypes.data_as (ctypes.c_void_p),
+        conf_offset.ctypes.data_as (ctypes.c_void_p),
+        ctypes.c_int (nconf), ctypes.c_int (norb), ctypes.c_int (min_npair), ctypes.c_int (max_nspin),
+        nspin_ncsf.ctypes.data_as (ctypes.c_void_p),
+        npair_nsconf.ctypes.data_as (ctypes.c_void_p),
+        npair_csf_offset.ctypes.data_as (ctypes.c_void_p),
+        npair_ncsf.ctypes.data_as (ctypes.c_void_p),
+        binom.ctypes.data_as (ctypes.c_void_p),
+        blk_offset.ctypes.data_as (ctypes.c_void_p),
+        blk_E.ctypes.data_as (ctypes.c_void_p)]
+    # Keep the arrays behind the pointers alive for as long as hop is
+    arrs = (dconf_strs, sconf_strs, conf_offset, nspin_ncsf, npair_nsconf, npair_csf_offset, npair_ncsf,
+        binom, blk_offset, blk_E, blk_T)
+    blksize = max (1, (1 << 21) // norb_pair) # columns of gket per dgemm
+
+    def hop (x, _arrs=arrs):
+        ci = np.ascontiguousarray (transformer.unpack_csf (np.asarray (x).ravel ()), dtype=np.float64)
+        # gket[pq,I] = <I|E_pq+E_qp|ci> -> 1/2 (pq|rs) gket[rs,I] + h'_pq ci[I], with pq, rs lower-triangular packed
+        gket = np.zeros ((norb_pair, ncsf_all), dtype=np.float64)
+        libcsf.FCICSFcontract1e_ket (gket.ctypes.data_as (ctypes.c_void_p),
+            ci.ctypes.data_as (ctypes.c_void_p), ctypes.c_int64 (ncsf_all), *conf_args)
+        for i0, i1 in lib.prange (0, ncsf_all, blksize):
+            gket[:,i0:i1] = lib.dot (eri, gket[:,i0:i1])
+            gket[:,i0:i1] += f1e[:,None] * ci[None,i0:i1]
+        hx = np.zeros (ncsf_all, dtype=np.float64)
+        libcsf.FCICSFcontract1e_bra (hx.ctypes.data_as (ctypes.c_void_p),
+            gket.ctypes.data_as (ctypes.c_void_p),
+            ci.ctypes.data_as (ctypes.c_void_p), ctypes.c_int64 (ncsf_all),
+            h1e_s.ctypes.data_as (ctypes.c_void_p),
+            ctypes.c_int (with_spin), *conf_args,
+            blk_T.ctypes.data_as (ctypes.c_void_p))
+        return transformer.pack_csf (hx)
+
+    return hop
+
 def pspace (fci, h1e, eri, norb, nelec, transformer, hdiag_det=None, hdiag_csf=None, npsp=200):
-    ''' Note that getting pspace for npsp CSFs is substantially more costly than getting it for npsp determinants,
-    until I write code than can evaluate Hamiltonian matrix elements of CSFs directly. On the other hand
-    a pspace of determinants contains many redundant degrees of freedom for the same reason. Therefore I have
-    reduced the default pspace size by a factor of 2.'''
+    ''' Model-space Hamiltonian of the npsp CSFs with the lowest diagonal energies. The Hamiltonian matrix elements are
+    evaluated directly between the CSFs of the electron configurations spanned by these CSFs (see make_hmat_csf), so
+    the cost scales with the number of connected configuration pairs rather than with the square of the number of
+    determinants spanned by those configurations. '''
     if norb > 63:
         raise NotImplementedError('norb > 63')
 
     t0 = (time.clock (), time.time ())
-    neleca, nelecb = _unpack_nelec(nelec)
-    h1e = np.ascontiguousarray(h1e)
-    eri = ao2mo.restore(1, eri, norb)
-    nb = cistring.num_strings(norb, nelecb)
-    if hdiag_det is None:
-        hdiag_det = fci.make_hdiag(h1e, eri, norb, nelec)
     if hdiag_csf is None:
         hdiag_csf = fci.make_hdiag_csf(h1e, eri, norb, nelec, hdiag_det=hdiag_det)
     csf_addr = np.arange (hdiag_csf.size, dtype=np.int)
@@ -255,63 +434,13 @@ def pspace (fci, h1e, eri, norb, nelec, transformer, hdiag_det=None, hdiag_csf=N
         except AttributeError:
             csf_addr = csf_addr[np.argsort(hdiag_csf[csf_addr])[:npsp]]
 
-    # To build 
     econf_addr = np.unique (transformer.econf_csf_mask[csf_addr])
-    det_addr = np.concatenate ([np.nonzero (transformer.econf_det_mask == conf)[0]
-        for conf in econf_addr])
-    lib.logger.debug (fci, ("csf.pspace: Lowest-energy %s CSFs correspond to %s configurations"
-        " which are spanned by %s determinants"), npsp, econf_addr.size, det_addr.size)
-
-    addra, addrb = divmod(det_addr, nb)
-    stra = cistring.addrs2str(norb, neleca, addra)
-    strb = cistring.addrs2str(norb, nelecb, addrb)
-    npsp_det = len(det_addr)
-    h0 = np.zeros((npsp_det,npsp_det))
-    h1e_ab = unpack_h1e_ab (h1e)
-    h1e_a = np.ascontiguousarray(h1e_ab[0])
-    h1e_b = np.ascontiguousarray(h1e_ab[1])
-    g2e = ao2mo.restore(1, eri, norb)
-    g2e_ab = g2e_bb = g2e_aa = g2e
-    _debug_g2e (fci, g2e, eri, norb) # Exploring g2e nan bug; remove later?
+    lib.logger.debug (fci, "csf.pspace: Lowest-energy %s CSFs correspond to %s configurations",
+        npsp, econf_addr.size)
     t0 = lib.logger.timer (fci, "csf.pspace: index manipulation", *t0)
-    libfci.FCIpspace_h0tril_uhf(h0.ctypes.data_as(ctypes.c_void_p),
-                                h1e_a.ctypes.data_as(ctypes.c_void_p),
-                                h1e_b.ctypes.data_as(ctypes.c_void_p),
-                                g2e_aa.ctypes.data_as(ctypes.c_void_p),
-                                g2e_ab.ctypes.data_as(ctypes.c_void_p),
-                                g2e_bb.ctypes.data_as(ctypes.c_void_p),
-                                stra.ctypes.data_as(ctypes.c_void_p),
-                                strb.ctypes.data_as(ctypes.c_void_p),
-                                ctypes.c_int(norb), ctypes.c_int(npsp_det))
-    t0 = lib.logger.timer (fci, "csf.pspace: pspace Hamiltonian in determinant basis", *t0)
-
-    for i in range(npsp_det):
-        h0[i,i] = hdiag_det[det_addr[i]]
-    h0 = lib.hermi_triu(h0)
-
-    try:
-        if fci.verbose >= lib.logger.DEBUG: evals_before = scipy.linalg.eigh (h0)[0]
-    except ValueError as e:
-        lib.logger.debug (fci, ("ERROR: h0 has {} infs, {} nans; h1e_a has {} infs, {} nans; "
-            "h1e_b has {} infs, {} nans; g2e has {} infs, {} nans, norb = {}, npsp_det = {}").format (
-            np.count_nonzero (np.isinf (h0)), np.count_nonzero (np.isnan (h0)),
-            np.count_nonzero (np.isinf (h1e_a)), np.count_nonzero (np.isnan (h1e_a)),
-            np.count_nonzero (np.isinf (h1e_b)), np.count_nonzero (np.isnan (h1e_b)),
-            np.count_nonzero (np.isinf (g2e)), np.count_nonzero (np.isnan (g2e)),
-            norb, npsp_det))
-        evals_before = np.zeros (npsp_det)
-
-    h0, csf_addr = transformer.mat_det2csf_confspace (h0, econf_addr)
-    t0 = lib.logger.timer (fci, "csf.pspace: transform pspace Hamiltonian into CSF basis", *t0)
-
-    if fci.verbose >= lib.logger.DEBUG:
-        lib.logger.debug2 (fci, "csf.pspace: eigenvalues of h0 before transformation %s", evals_before)
-        evals_after = scipy.linalg.eigh (h0)[0]
-        lib.logger.debug2 (fci, "csf.pspace: eigenvalues of h0 after transformation %s", evals_after)
-        idx = [np.argmin (np.abs (evals_before - ev)) for ev in evals_after]
-        resid = evals_after - evals_before[idx]
-        lib.logger.debug2 (fci, "csf.pspace: best h0 eigenvalue matching differences after transformation: %s", resid)
-        lib.logger.debug (fci, "csf.pspace: if the transformation of h0 worked the following number will be zero: %s", np.max (np.abs(resid)))
+
+    h0, csf_addr = make_hmat_csf (h1e, eri, norb, nelec, transformer, econf_addr=econf_addr)
+    t0 = lib.logger.timer (fci, "csf.pspace: pspace Hamiltonian in CSF basis", *t0)
 
     # We got extra CSFs from building the configurations most of the time.
     if csf_addr.size > npsp:
@@ -345,9 +474,7 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
     nelec = _unpack_nelec(nelec, fci.spin)
     neleca, nelecb = nelec
     t0 = lib.logger.timer (fci, "csf.kernel: throat-clearing", *t0)
-    hdiag_det = fci.make_hdiag (h1e, eri, norb, nelec)
-    t0 = lib.logger.timer (fci, "csf.kernel: hdiag_det", *t0)
-    hdiag_csf = fci.make_hdiag_csf (h1e, eri, norb, nelec, hdiag_det=hdiag_det)
+    hdiag_csf = fci.make_hdiag_csf (h1e, eri, norb, nelec)
     t0 = lib.logger.timer (fci, "csf.kernel: hdiag_csf", *t0)
     ncsf_all = count_all_csfs (norb, neleca, nelecb, smult)
     if idx_sym is None:
@@ -362,7 +489,7 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
     nb = link_indexb.shape[0]
 
     t0 = lib.logger.timer (fci, "csf.kernel: throat-clearing", *t0)
-    addr, h0 = fci.pspace(h1e, eri, norb, nelec, idx_sym=idx_sym, hdiag_det=hdiag_det, hdiag_csf=hdiag_csf, npsp=max(pspace_size,nroots))
+    addr, h0 = fci.pspace(h1e, eri, norb, nelec, idx_sym=idx_sym, hdiag_csf=hdiag_csf, npsp=max(pspace_size,nroots))
     lib.logger.debug (fci, 'csf.kernel: error of hdiag_csf: %s', np.amax (np.abs (hdiag_csf[addr]-np.diag (h0))))
     t0 = lib.logger.timer (fci, "csf.kernel: make pspace", *t0)
     if pspace_size > 0:
@@ -399,12 +526,17 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
                        tol, lindep, max_cycle, max_space, nroots,
                        davidson_only, pspace_size, ecore=ecore, **kwargs)
     '''
-    h2e = fci.absorb_h1e(h1e, eri, norb, nelec, .5)
-    t0 = lib.logger.timer (fci, "csf.kernel: h2e", *t0)
-    def hop(x):
-        x_det = transformer.vec_csf2det (x)
-        hx = fci.contract_2e(h2e, x_det, norb, nelec, (link_indexa,link_indexb))
-        return transformer.vec_det2csf (hx, normalize=False).ravel ()
+    if max_memory is None: max_memory = fci.max_memory
+    csf_hop = fci.csf_hop
+    if csf_hop is None: csf_hop = (na*nb > CSF_HOP_MIN_RATIO * ncsf_all)
+    hop = fci.make_hop_csf (h1e, eri, norb, nelec, max_memory=max_memory) if csf_hop else None
+    if hop is None:
+        h2e = fci.absorb_h1e(h1e, eri, norb, nelec, .5)
+        t0 = lib.logger.timer (fci, "csf.kernel: h2e", *t0)
+        def hop(x):
+            x_det = transformer.vec_csf2det (x)
+            hx = fci.contract_2e(h2e, x_det, norb, nelec, (link_indexa,link_indexb))
+            return transformer.vec_det2csf (hx, normalize=False).ravel ()
 
     t0 = lib.logger.timer (fci, "csf.kernel: make hop", *t0)
     if ci0 is None:
@@ -436,7 +568,6 @@ def kernel(fci, h1e, eri, norb, nelec, smult=None, idx_sym=None, ci0=None,
     if lindep is None: lindep = fci.lindep
     if max_cycle is None: max_cycle = fci.max_cycle
     if max_space is None: max_space = fci.max_space
-    if max_memory is None: max_memory = fci.max_memory
     tol_residual = getattr(fci, 'conv_tol_residual', None)
 
     #with lib.with_omp_threads(fci.threads):
@@ -459,6 +590,9 @@ class FCISolver (direct_spin1.FCISolver):
     to be in the determinant basis.'''
 
     pspace_size = getattr(__config__, 'fci_csf_FCI_pspace_size', 200)
+    # If true, the Davidson algorithm applies the Hamiltonian directly in the CSF basis (see make_hop_csf); if None,
+    # only when there are many fewer CSFs than determinants
+    csf_hop = getattr(__config__, 'fci_csf_FCI_csf_hop', None)
 
     def __init__(self, mol=None, smult=None):
         self.smult = smult
@@ -478,6 +612,13 @@ class FCISolver (direct_spin1.FCISolver):
         self.check_transformer_cache ()
         return make_hdiag_csf (h1e, eri, norb, nelec, self.transformer, hdiag_det=hdiag_det)
 
+    def make_hop_csf (self, h1e, eri, norb, nelec, max_memory=None):
+        self.norb = norb
+        self.nelec = nelec
+        self.check_transformer_cache ()
+        if max_memory is None: max_memory = self.max_memory
+        return make_hop_csf (h1e, eri, norb, nelec, self.transformer, max_memory=max_memory)
+
     make_hdiag = make_hdiag_det
 
     def absorb_h1e (self, h1e, eri, norb, nelec, fac=1):
@@ -8,6 +8,7 @@ from pyscf.fci.direct_spin1 import _unpack_nelec, _get_init_guess, kernel_ms1
 from pyscf.fci.direct_spin1_symm import _gen_strs_irrep, _id_wfnsym
 from mrh.my_pyscf.fci.csfstring import CSFTransformer
 from mrh.my_pyscf.fci.csf import kernel, pspace, get_init_guess, make_hdiag_csf, make_hdiag_det, unpack_h1e_cs
+from mrh.my_pyscf.fci.csf import make_hop_csf
 '''
     MRH 03/24/2019
     IMPORTANT: this solver will interpret a two-component one-body Hamiltonian as [h1e_charge, h1e_spin] where
@@ -29,6 +30,7 @@ class FCISolver (direct_spin1_symm.FCISolver):
     '''
 
     pspace_size = getattr(__config__, 'fci_csf_FCI_pspace_size', 200)
+    csf_hop = getattr(__config__, 'fci_csf_FCI_csf_hop', None)
 
     def __init__(self, mol=None, smult=None):
         self.smult = smult
@@ -55,6 +57,12 @@ class FCISolver (direct_spin1_symm.FCISolver):
         self.check_transformer_cache ()
         return make_hdiag_csf (h1e, eri, norb, nelec, self.transformer, hdiag_det=hdiag_det)
 
+    def make_hop_csf (self, h1e, eri, norb, nelec, max_memory=None):
+        self.norb, self.nelec = norb, nelec
+        self.check_transformer_cache ()
+        if max_memory is None: max_memory = self.max_memory
+        return make_hop_csf (h1e, eri, norb, nelec, self.transformer, max_memory=max_memory)
+
     def pspace (self, h1e, eri, norb, nelec, hdiag_det=None, hdiag_csf=None, npsp=200, **kwargs):
         self.norb, self.nelec = norb, nelec
         self.check_transformer_cache ()
@@ -4,15 +4,21 @@ import ctypes
 from mrh.my_pyscf.fci import csdstring
 from pyscf.fci import cistring
 from pyscf.fci.spin_op import spin_square0
-from pyscf import lib
+from pyscf import lib, __config__
 from pyscf.lib import numpy_helper
 from scipy import special, linalg
 from mrh.util.io import prettyprint_ndarray
-from functools import reduce
+from functools import reduce, lru_cache
+import hashlib
 from mrh.lib.helper import load_library
 from pyscf.fci.direct_spin1_symm import _gen_strs_irrep
 libcsf = load_library ('libcsf')
 
+# Index tables of CSFTransformer are shared between instances in memory (up to CSF_MASK_CACHE_SIZE sets) and, if
+# CSF_MASK_CACHE_DIR is set, saved to and memory-mapped from .npy files in that directory
+CSF_MASK_CACHE_SIZE = getattr(__config__, 'fci_csfstring_CSF_MASK_CACHE_SIZE', 16)
+CSF_MASK_CACHE_DIR = getattr(__config__, 'fci_csfstring_CSF_MASK_CACHE_DIR', None)
+
 class CSFTransformer (lib.StreamObject):
     def __init__(self, norb, neleca, nelecb, smult, orbsym=None, wfnsym=None):
         self._norb = self._neleca = self._nelecb = self._smult = self._orbsym = None
@@ -84,17 +90,19 @@ class CSFTransformer (lib.StreamObject):
 
     def _update_spin_cache (self, norb, neleca, nelecb, smult):
         if any ([self._norb != norb, self._neleca != neleca, self._nelecb != nelecb, self._smult != smult]):
-            self.csd_mask = csdstring.make_csd_mask (norb, neleca, nelecb)
-            self.econf_det_mask = csdstring.make_econf_det_mask (norb, neleca, nelecb, self.csd_mask)
-            self.econf_csf_mask = make_econf_csf_mask (norb, neleca, nelecb, smult)
+            self.csd_mask, self.econf_det_mask = get_csd_masks (norb, neleca, nelecb)
+            self.econf_csf_mask = get_econf_csf_mask (norb, neleca, nelecb, smult)
+            orbsym, self._orbsym = self._orbsym, None
             self._norb = norb
             self._neleca = neleca
             self._nelecb = nelecb
             self._smult = smult
+            # confsym depends on the electron configurations as well as on orbsym
+            if orbsym is not None and len (orbsym) == norb: self._update_symm_cache (orbsym)
 
     def _update_symm_cache (self, orbsym):
         if (orbsym is not None) and (self._orbsym is None or np.any (orbsym != self._orbsym)):
-            self.confsym = make_confsym (self.norb, self.neleca, self.nelecb, self.econf_det_mask, orbsym)
+            self.confsym = get_confsym (self.norb, self.neleca, self.nelecb, orbsym)
         self._orbsym = orbsym
 
     def printable_largest_csf (self, csfvec, npr, order='C', isdet=False, normalize=True):
@@ -240,15 +248,65 @@ def make_confsym (norb, neleca, nelecb, econf_det_mask, orbsym):
     if neleca != nelecb:
         strsb = cistring.gen_strings4orblist(range(norb), nelecb)
         birreps = _gen_strs_irrep(strsb, orbsym)
-    nconf, addr = np.unique (econf_det_mask, return_index=True)
-    nconf = nconf.size
-    # Note: econf_det_mask[addr] = np.arange (nconf)
-    # All determinants of the same configuration have the same point group
-    conf_addra = addr // len (birreps)
-    conf_addrb = addr % len (birreps)
-    confsym = airreps[conf_addra] ^ birreps[conf_addrb]
+    # All determinants of the same configuration have the same point group, so scattering the determinant irreps
+    # over econf_det_mask is enough; no sorting required
+    dtype = csdstring.get_mask_dtype (max (np.amax (airreps), np.amax (birreps)))
+    airreps, birreps = airreps.astype (dtype), birreps.astype (dtype)
+    confsym = np.empty (int (np.amax (econf_det_mask)) + 1, dtype=dtype)
+    confsym[econf_det_mask] = (airreps[:,None] ^ birreps[None,:]).ravel ()
     return confsym
 
+def _mask_cache_path (label, *key):
+    if not CSF_MASK_CACHE_DIR: return None
+    return os.path.join (CSF_MASK_CACHE_DIR, '_'.join ([label,] + [str (k) for k in key]) + '.npy')
+
+def _load_or_make_masks (labels, key, make_masks):
+    ''' Load index arrays from CSF_MASK_CACHE_DIR (memory-mapped, read-only) if they are there; otherwise call
+    make_masks () and try to save the results. The arrays returned are always read-only, because they are shared. '''
+    paths = [_mask_cache_path (label, *key) for label in labels]
+    if all ([p is not None and os.path.isfile (p) for p in paths]):
+        try:
+            return [np.load (p, mmap_mode='r').view (np.ndarray) for p in paths]
+        except (OSError, ValueError):
+            pass
+    masks = make_masks ()
+    for p, mask in zip (paths, masks):
+        mask.flags.writeable = False
+        if p is None: continue
+        try:
+            os.makedirs (CSF_MASK_CACHE_DIR, exist_ok=True)
+            # Write-then-rename so that concurrent processes never see a partial file
+            ptmp = '{}.{}.tmp'.format (p, os.getpid ())
+            with open (ptmp, 'wb') as f:
+                np.save (f, mask)
+            os.replace (ptmp, p)
+        except OSError:
+            pass
+    return masks
+
+@lru_cache (maxsize=CSF_MASK_CACHE_SIZE)
+def get_csd_masks (norb, neleca, nelecb):
+    ''' Cached, read-only csdstring.make_csd_masks '''
+    return tuple (_load_or_make_masks (('csd_mask', 'econf_det_mask'), (norb, neleca, nelecb),
+        lambda: csdstring.make_csd_masks (norb, neleca, nelecb)))
+
+@lru_cache (maxsize=CSF_MASK_CACHE_SIZE)
+def get_econf_csf_mask (norb, neleca, nelecb, smult):
+    ''' Cached, read-only make_econf_csf_mask '''
+    return _load_or_make_masks (('econf_csf_mask',), (norb, neleca, nelecb, smult),
+        lambda: [make_econf_csf_mask (norb, neleca, nelecb, smult)])[0]
+
+def get_confsym (norb, neleca, nelecb, orbsym):
+    ''' Cached, read-only make_confsym '''
+    return _get_confsym (norb, neleca, nelecb, tuple (int (x) for x in orbsym))
+
+@lru_cache (maxsize=CSF_MASK_CACHE_SIZE)
+def _get_confsym (norb, neleca, nelecb, orbsym):
+    orbsym_hash = hashlib.sha1 (np.asarray (orbsym, dtype=np.int64).tobytes ()).hexdigest ()[:16]
+    econf_det_mask = get_csd_masks (norb, neleca, nelecb)[1]
+    return _load_or_make_masks (('confsym',), (norb, neleca, nelecb, orbsym_hash),
+        lambda: [make_confsym (norb, neleca, nelecb, econf_det_mask, np.asarray (orbsym))])[0]
+
 def check_spinstate_norm (detarr, norb, neleca, nelecb, smult, csd_mask=None):
     ''' Calculate the norm of the given CI vector projected onto spin-state smult (= 2S+1) '''
     return transform_civec_det2csf (detarr, norb, neleca, nelecb, smult, csd_mask=csd_mask)[1]
@@ -697,13 +755,14 @@ def make_econf_csf_mask (norb, neleca, nelecb, smult):
     
     min_npair, npair_offset, npair_dconf_size, npair_sconf_size, npair_csf_size = get_csfvec_shape (norb, neleca, nelecb, smult)
     ncsf = count_all_csfs (norb, neleca, nelecb, smult)
-    mask = np.empty (ncsf, dtype=np.uint32)
     npair_conf_size = npair_dconf_size * npair_sconf_size
+    dtype = csdstring.get_mask_dtype (max (1, np.sum (npair_conf_size)) - 1)
+    mask = np.empty (ncsf, dtype=dtype)
     npair_size = npair_conf_size * npair_csf_size
     iconf = 0
     for npair in range (min_npair, min (neleca, nelecb)+1):
         ipair = npair - min_npair
-        irange = np.arange (iconf, iconf+npair_conf_size[ipair], dtype=np.uint32)
+        irange = np.arange (iconf, iconf+npair_conf_size[ipair], dtype=dtype)
         iconf += npair_conf_size[ipair]
         mask[npair_offset[ipair]:][:npair_size[ipair]] = np.repeat (irange, npair_csf_size[ipair])
     return mask
@@ -838,6 +897,129 @@ def get_spin_evecs (nspin, neleca, nelecb, smult):
 
     return umat
 
+# Types of one-electron excitation E_pq (p != q) connecting configuration Y to configuration X = E_pq Y, labeled by the
+# occupancies of orbitals q and p in Y; type 4 is the spin operator E^alpha_pp - E^beta_pp on a singly-occupied orbital
+ONEBODY_CPL_NTYPES = 5
+_onebody_cpl_occ = ((1,0), (1,1), (2,0), (2,1), (1,1))
+_onebody_cpl_dnspin = (0, -2, 2, 0, 0)
+_onebody_cpl_cache = {}
+
+def onebody_coupling_key (max_nspin, nspin, cpltype, rq, rp, pgtq):
+    ''' Index of a one-body coupling block in the table returned by get_onebody_coupling. rq and rp are the numbers
+    of singly-occupied orbitals of the ket configuration with indices lower than q and p respectively '''
+    nr = max_nspin + 2
+    return (((nspin * ONEBODY_CPL_NTYPES + cpltype) * nr + rq) * nr + rp) * 2 + int (pgtq)
+
+def _onebody_cpl_layouts (nother, cpltype):
+    ''' Positions (obq, obp, pgtq) of orbitals q and p among the nother other singly-occupied orbitals '''
+    if cpltype == 4:
+        for obq in range (nother+1): yield obq, obq, False
+        return
+    for obq in range (nother+1):
+        for obp in range (nother+1):
+            if obp != obq: yield obq, obp, obp > obq
+            else:
+                yield obq, obp, False
+                yield obq, obp, True
+
+def get_onebody_coupling (max_nspin, neleca, nelecb, smult):
+    ''' Get the spin-coupling coefficients <X,i|E_pq|Y,j> between the CSFs i and j of two configurations X = E_pq Y.
+    Up to a phase factor (-1)**(number of doubly-occupied orbitals of Y between p and q), these depend only on the
+    excitation type, the number of singly-occupied orbitals in Y and the positions of p and q among them, so they are
+    computed once from the determinant representation and cached.
+
+    Args:
+    max_nspin, neleca, nelecb, smult are integers
+
+    Returns:
+    blk_offset, 1d ndarray of int64
+        Offsets of the row-major (ncsf_X, ncsf_Y) coupling blocks, indexed by onebody_coupling_key; -1 if absent
+    blk_E, 1d ndarray of float64
+        Coupling blocks of the spin-free excitation operator E_pq = E^alpha_pq + E^beta_pq
+    blk_T, 1d ndarray of float64
+        Coupling blocks of the spin excitation operator T_pq = E^alpha_pq - E^beta_pq
+    '''
+    twoMS = neleca - nelecb
+    cache_key = (max_nspin, twoMS, smult)
+    if cache_key in _onebody_cpl_cache: return _onebody_cpl_cache[cache_key]
+    nkey = onebody_coupling_key (max_nspin, max_nspin+1, 0, 0, 0, 0)
+    blk_offset = np.full (nkey, -1, dtype=np.int64)
+    blk_E, blk_T = [], []
+    umats = {}
+    def _get_umat (nspin):
+        if nspin < abs (twoMS) or nspin > max_nspin or (nspin - twoMS) % 2: return None
+        if nspin not in umats:
+            umats[nspin] = None
+            if count_csfs (nspin, smult):
+                umats[nspin] = get_spin_evecs (nspin, (nspin+twoMS)//2, (nspin-twoMS)//2, smult)
+        return umats[nspin]
+    offset = 0
+    for nspin_Y in range (max_nspin+1):
+        umat_Y = _get_umat (nspin_Y)
+        if umat_Y is None: continue
+        spinstrs_Y = np.asarray (cistring.make_strings (range (nspin_Y), (nspin_Y+twoMS)//2), dtype=np.int64)
+        for cpltype in range (ONEBODY_CPL_NTYPES):
+            occq, occp = _onebody_cpl_occ[cpltype]
+            nother = nspin_Y - 1 if cpltype == 4 else nspin_Y - int (occq==1) - int (occp==1)
+            if nother < 0: continue
+            nspin_X = nspin_Y + _onebody_cpl_dnspin[cpltype]
+            umat_X = _get_umat (nspin_X)
+            if umat_X is None: continue
+            na_X = (nspin_X + twoMS) // 2
+            for obq, obp, pgtq in _onebody_cpl_layouts (nother, cpltype):
+                # Representative orbital layout with no doubly-occupied orbitals between p and q
+                labels = []
+                for ib in range (nother+1):
+                    here = ['q'] if obq == ib else []
+                    if cpltype < 4 and obp == ib: here = here + ['p'] if pgtq else ['p'] + here
+                    labels.extend (here)
+                    if ib < nother: labels.append ('o')
+                q = labels.index ('q')
+                p = labels.index ('p') if cpltype < 4 else q
+                occ = np.ones (len (labels), dtype=np.int64)
+                occ[q] = occq
+                if cpltype < 4: occ[p] = occp
+                opens_Y = np.where (occ==1)[0]
+                rq, rp = np.count_nonzero (opens_Y < q), np.count_nonzero (opens_Y < p)
+                key = onebody_coupling_key (max_nspin, nspin_Y, cpltype, rq, rp, p>q)
+                if blk_offset[key] >= 0: continue
+                stra = np.full (len (spinstrs_Y), int (np.sum (1 << np.where (occ==2)[0])), dtype=np.int64)
+                strb = stra.copy ()
+                for ispin, iorb in enumerate (opens_Y):
+                    bit = (spinstrs_Y >> ispin) & 1
+                    stra |= bit << iorb
+                    strb |= (1 - bit) << iorb
+                if cpltype == 4:
+                    bT = np.dot (umat_Y.T, np.where ((stra >> q) & 1, 1.0, -1.0)[:,None] * umat_Y)
+                    bE = np.eye (umat_Y.shape[1])
+                else:
+                    occ[q] -= 1
+                    occ[p] += 1
+                    opens_X = np.where (occ==1)[0]
+                    between = sum (1 << i for i in range (min (p,q)+1, max (p,q)))
+                    ex = np.zeros ((2, umat_X.shape[0], umat_Y.shape[0]))
+                    for ispin, (strs, ostrs) in enumerate (((stra, strb), (strb, stra))):
+                        idx = np.where (((strs >> q) & 1) & (1 - ((strs >> p) & 1)))[0]
+                        if not len (idx): continue
+                        newa = strs[idx] ^ ((1 << q) | (1 << p)) if ispin == 0 else ostrs[idx]
+                        sstrs_X = np.zeros (len (idx), dtype=np.int64)
+                        for jspin, iorb in enumerate (opens_X):
+                            sstrs_X |= ((newa >> iorb) & 1) << jspin
+                        if nspin_X: addr_X = cistring.strs2addr (nspin_X, na_X, sstrs_X)
+                        else: addr_X = np.zeros (len (idx), dtype=np.int64)
+                        sgn = [1 - 2*(bin (int (s) & between).count ('1') % 2) for s in strs[idx]]
+                        np.add.at (ex[ispin], (addr_X, idx), sgn)
+                    bE = reduce (np.dot, (umat_X.T, ex[0]+ex[1], umat_Y))
+                    bT = reduce (np.dot, (umat_X.T, ex[0]-ex[1], umat_Y))
+                blk_offset[key] = offset
+                blk_E.append (bE.ravel ())
+                blk_T.append (bT.ravel ())
+                offset += bE.size
+    blk_E = np.ascontiguousarray (np.concatenate (blk_E + [np.zeros (0)]))
+    blk_T = np.ascontiguousarray (np.concatenate (blk_T + [np.zeros (0)]))
+    _onebody_cpl_cache[cache_key] = blk_offset, blk_E, blk_T
+    return blk_offset, blk_E, blk_T
+
 def test_spin_evecs (nspin, neleca, nelecb, smult, S2mat=None):
     s = (smult - 1) / 2
     ms = (neleca - nelecb) / 2
@@ -0,0 +1,161 @@
+import numpy as np
+from pyscf import lib
+from pyscf.fci import cistring
+from pyscf.fci.direct_spin1 import _unpack_nelec
+
+''' Transition density matrices between all pairs of a stack of bra and a stack of ket CI vectors (in the
+determinant basis, with common norb and nelec) at once. Each vector is expanded once into its single excitations
+E^s_pq|c> using one set of link indices, and all of the pairwise contractions are then single GEMMs across the state
+dimension rather than one pass over the determinant space per pair as in direct_spin1.trans_rdm12s. (For the 2-TDMs,
+bras and kets are expanded in blocks which fit in memory, so a ket may be expanded once per block of bras.) The conventions
+of the returned TDMs are those of direct_spin1.trans_rdm1s and direct_spin1.trans_rdm12s. '''
+
+# Max number of bra (and of ket) vectors expanded at a time by trans_rdm12s_batch
+MAX_BLKSIZE = 64
+
+def _unpack (norb, nelec, link_index):
+    if link_index is not None: return link_index
+    neleca, nelecb = _unpack_nelec (nelec)
+    link_indexa = cistring.gen_linkstr_index (range (norb), neleca)
+    link_indexb = link_indexa if neleca == nelecb else cistring.gen_linkstr_index (range (norb), nelecb)
+    return link_indexa, link_indexb
+
+def _ci_stack (ci, na, nb):
+    ci = np.asarray (ci)
+    return ci.reshape (-1, na, nb)
+
+def excitations (ci, norb, nelec, link_index=None):
+    ''' Single excitations E^a_pq|c> and E^b_pq|c> of a stack of CI vectors
+
+        Args:
+            ci: ndarray or list of ndarrays
+                nvec CI vectors of shape (na,nb)
+            norb: integer
+            nelec: integer or (neleca, nelecb)
+
+        Kwargs:
+            link_index: (link_indexa, link_indexb) as in direct_spin1 (not lower-triangular)
+
+        Returns:
+            ex: ndarray of shape (2,nvec,norb*norb,na*nb)
+                ex[s,i,p*norb+q] = E^s_pq|ci[i]>
+    '''
+    neleca, nelecb = _unpack_nelec (nelec)
+    link_indexa, link_indexb = _unpack (norb, (neleca, nelecb), link_index)
+    na, nb = link_indexa.shape[0], link_indexb.shape[0]
+    ci = _ci_stack (ci, na, nb)
+    nvec = ci.shape[0]
+    ex = np.zeros ((2, nvec, norb*norb, na, nb), dtype=ci.dtype)
+    # Each (pq, str1) pair arises from exactly one string str0, so plain fancy-index assignment suffices
+    for s, link in enumerate ((link_indexa, link_indexb)):
+        nstr, nlink = link.shape[:2]
+        str0 = np.repeat (np.arange (nstr), nlink)
+        p, q, str1, sgn = [x.ravel () for x in link.transpose (2,0,1)]
+        pq = p * norb + q
+        if s == 0:
+            ex[0][:,pq,str1,:] = sgn[None,:,None] * ci[:,str0,:]
+        else:
+            ex[1][:,pq,:,str1] = sgn[:,None,None] * ci[:,:,str0].transpose (2,0,1)
+    return ex.reshape (2, nvec, norb*norb, na*nb)
+
+def trans_rdm1s_batch (cibra, ciket, norb, nelec, link_index=None):
+    ''' Spin-separated 1-TDMs between every bra and every ket
+
+        Returns:
+            dm1a, dm1b: ndarrays of shape (nbra,nket,norb,norb)
+                dm1a[i,j] = direct_spin1.trans_rdm1s (cibra[i], ciket[j], norb, nelec)[0]
+    '''
+    neleca, nelecb = _unpack_nelec (nelec)
+    na, nb = cistring.num_strings (norb, neleca), cistring.num_strings (norb, nelecb)
+    bra = _ci_stack (cibra, na, nb).reshape (-1, na*nb)
+    ex_ket = excitations (ciket, norb, nelec, link_index=link_index)
+    nbra, nket = bra.shape[0], ex_ket.shape[1]
+    dm1 = lib.dot (bra, ex_ket.reshape (-1, na*nb).T).reshape (nbra, 2, nket, norb, norb)
+    # <bra|q'p|ket>, as in direct_spin1
+    dm1 = dm1.transpose (1,0,2,4,3)
+    return dm1[0], dm1[1]
+
+def get_blksize (norb, ndet, nvec, max_memory):
+    ''' Number of bra and of ket vectors, at most MAX_BLKSIZE, whose single excitations and pairwise 2-TDM
+    intermediates (see trans_rdm12s_batch) fit in max_memory (MB) '''
+    n2 = norb * norb
+    blksize = max (1, min (nvec, MAX_BLKSIZE))
+    while blksize > 1 and 8 * (4*blksize*n2*ndet + 2*blksize*blksize*n2*(n2+2)) / 1e6 > max_memory:
+        blksize -= 1
+    return blksize
+
+def _trans_rdm12s_blk (bra, ex_bra, ex_ket, norb, dm1, dm2):
+    ''' 1- and 2-TDMs between one block of bras and one block of kets, given their single excitations, written
+    to the (2,nbra,nket,...) and (4,nbra,nket,...) views dm1 and dm2 '''
+    nbra, ndet = bra.shape
+    nket = ex_ket.shape[1]
+    n2 = norb * norb
+    # <bra|E_ps|ket>
+    e1 = lib.dot (bra, ex_ket.reshape (-1, ndet).T)
+    e1 = e1.reshape (nbra, 2, nket, norb, norb).transpose (1,0,2,3,4)
+    dm1[:] = e1.transpose (0,1,2,4,3)
+    # <bra|E_pq E_rs|ket> = (E_qp|bra>).(E_rs|ket>)
+    ex_bra = ex_bra.reshape (2, nbra, norb, norb, ndet).transpose (0,1,3,2,4).reshape (2, nbra*n2, ndet)
+    for s, (t, u) in ((0, (0,0)), (1, (0,1)), (3, (1,1))):
+        e2 = lib.dot (ex_bra[t], ex_ket[u].reshape (nket*n2, ndet).T).reshape (nbra, norb, norb, nket, norb, norb)
+        e2 = e2.transpose (0,3,1,2,4,5)
+        if t == u:
+            # <p'r'sq> = <E_pq E_rs> - delta_qr <E_ps>
+            for q in range (norb):
+                e2[:,:,:,q,q,:] -= e1[t]
+        dm2[s] = e2
+    # Opposite-spin excitations commute
+    dm2[2] = dm2[1].transpose (0,1,4,5,2,3)
+
+def trans_rdm12s_batch (cibra, ciket, norb, nelec, link_index=None, blksize=None, max_memory=None):
+    ''' Spin-separated 1- and 2-TDMs between every bra and every ket
+
+        Args:
+            cibra: ndarray or list of ndarrays
+            ciket: ndarray or list of ndarrays, or None
+                If None, the kets are the bras. Then only the blocks of pairs with ket >= bra are computed and the
+                others are filled in by hermiticity.
+            norb: integer
+            nelec: integer or (neleca, nelecb)
+
+        Kwargs:
+            blksize: max number of bras and of kets expanded at a time (default: as many as fit in max_memory, up
+                to MAX_BLKSIZE)
+            max_memory: MB available for the expanded vectors and intermediates (default: lib.param.MAX_MEMORY less
+                the memory in use)
+
+        Returns:
+            (dm1a, dm1b): ndarrays of shape (nbra,nket,norb,norb)
+            (dm2aa, dm2ab, dm2ba, dm2bb): ndarrays of shape (nbra,nket,norb,norb,norb,norb)
+                dm2ab[i,j] = direct_spin1.trans_rdm12s (cibra[i], ciket[j], norb, nelec)[1][1], etc.
+    '''
+    hermi = ciket is None
+    neleca, nelecb = _unpack_nelec (nelec)
+    link_index = _unpack (norb, (neleca, nelecb), link_index)
+    na, nb = link_index[0].shape[0], link_index[1].shape[0]
+    ndet = na * nb
+    bra = _ci_stack (cibra, na, nb).reshape (-1, ndet)
+    ket = bra if hermi else _ci_stack (ciket, na, nb).reshape (-1, ndet)
+    nbra, nket = bra.shape[0], ket.shape[0]
+    dtype = np.result_type (bra.dtype, ket.dtype)
+    dm1 = np.empty ((2, nbra, nket, norb, norb), dtype=dtype)
+    dm2 = np.empty ((4, nbra, nket, norb, norb, norb, norb), dtype=dtype)
+    if blksize is None:
+        if max_memory is None: max_memory = lib.param.MAX_MEMORY - lib.current_memory ()[0]
+        blksize = get_blksize (norb, ndet, max (nbra, nket), max_memory)
+    ket_blocks = list (lib.prange (0, nket, blksize))
+    ex_ket = None
+    if len (ket_blocks) == 1 and not hermi:
+        ex_ket = excitations (ket, norb, nelec, link_index=link_index)
+    for i0, i1 in lib.prange (0, nbra, blksize):
+        ex_bra = excitations (bra[i0:i1], norb, nelec, link_index=link_index)
+        for j0, j1 in ket_blocks:
+            if hermi and j0 < i0: continue
+            if hermi and j0 == i0: ex_ket_blk = ex_bra
+            elif ex_ket is not None: ex_ket_blk = ex_ket
+            else: ex_ket_blk = excitations (ket[j0:j1], norb, nelec, link_index=link_index)
+            _trans_rdm12s_blk (bra[i0:i1], ex_bra, ex_ket_blk, norb, dm1[:,i0:i1,j0:j1], dm2[:,i0:i1,j0:j1])
+            if hermi and j0 > i0:
+                dm1[:,j0:j1,i0:i1] = dm1[:,i0:i1,j0:j1].transpose (0,2,1,4,3).conj ()
+                dm2[:,j0:j1,i0:i1] = dm2[:,i0:i1,j0:j1].transpose (0,2,1,4,3,6,5).conj ()
+    return (dm1[0], dm1[1]), (dm2[0], dm2[1], dm2[2], dm2[3])
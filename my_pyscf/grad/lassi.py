@@ -0,0 +1,351 @@
+'''
+LASSI analytical nuclear gradients
+
+The energy E_I of a LASSI root depends on the nuclear coordinates directly and through the SA-LASSCF orbitals and
+fragment CI vectors, which are fixed by the stationarity of the state-averaged LASSCF energy. The latter dependence is
+removed with Lagrange multipliers solving
+
+    (d2E_SA/dp2) z = -dE_I/dp
+
+where p are the nonredundant LASSCF orbital rotations and CI vectors and the Hessian is applied with
+lasci.LASCI_HessianOperator, after which
+
+    dE_I/dx = <dH/dx>_I + z . d2E_SA/dp dx
+
+Both terms on the right are evaluated with the SA-CASSCF gradient machinery (pyscf.grad.casscf and
+pyscf.grad.sacasscf) by handing it the LASSI root density matrices, the state-averaged LAS density matrices, and the
+LAS transition density matrices of the CI multipliers in place of FCI ones.
+'''
+
+import time
+import numpy as np
+from pyscf import mcscf
+from pyscf.lib import logger
+from pyscf.fci import cistring, direct_spin1, selected_ci
+from pyscf.fci.direct_spin1 import _unpack_nelec
+from pyscf.grad import lagrange
+from pyscf.grad import rhf as rhf_grad
+from pyscf.grad import casscf as casscf_grad
+from pyscf.grad import sacasscf as sacasscf_grad
+from mrh.my_pyscf.mcscf import lassi
+from mrh.my_pyscf.mcscf import lassi_op_o0 as op_o0
+from mrh.my_pyscf.mcscf.lasscf_testing import LASSCF_HessianOperator
+
+def get_grad_orb (las, mo_coeff, casdm1, casdm2, h2eff_sub, response=False):
+    ''' Orbital gradient of the energy of one LASSI root, F - F.T, in the same convention as
+    LASCI_HessianOperator.get_grad. F is the generalized Fock matrix of the root's spin-summed active-space 1- and
+    2-RDMs, and h2eff_sub is the (nmo,ncas,ncas,ncas) ERI array of LASCI_HessianOperator. If response is True,
+    casdm1 and casdm2 are instead first-order changes of the density matrices, and the first-order change of the
+    orbital gradient is returned. '''
+    ncore, ncas = las.ncore, las.ncas
+    nocc = ncore + ncas
+    mo_core = mo_coeff[:,:ncore]
+    mo_cas = mo_coeff[:,ncore:nocc]
+    moH_coeff = mo_coeff.conj ().T
+    dm_core = 2 * mo_core @ mo_core.conj ().T
+    dm_cas = mo_cas @ casdm1 @ mo_cas.conj ().T
+    veff = las.get_veff (dm1s=np.stack ([dm_core, dm_cas], axis=0))
+    fock_c = moH_coeff @ (las.get_hcore () + veff[0]) @ mo_coeff
+    va = moH_coeff @ veff[1] @ mo_coeff
+    gfock = np.zeros_like (fock_c)
+    gfock[:,:ncore] = 2 * (va if response else fock_c + va)[:,:ncore]
+    gfock[:,ncore:nocc] = fock_c[:,ncore:nocc] @ casdm1
+    gfock[:,ncore:nocc] += np.tensordot (h2eff_sub, casdm2, axes=((1,2,3),(1,2,3)))
+    return gfock - gfock.T
+
+def get_grad_ci (las, mo_coeff, ci, si, state, h1=None, h2=None):
+    ''' Gradient of the energy of one LASSI root with respect to the fragment CI vectors of every LAS state, in the
+    same convention as LASCI_HessianOperator.get_grad: 2 si[r] <d Phi_r / d c^K_r|H - E|Psi>, projected onto the
+    tangent space of each fragment CI vector. The root is evaluated on the product-state determinant subspace of
+    its symmetry block, as in lassi_op_o0.ham; the gradient is zero for LAS states outside that block. The cost
+    and memory therefore scale with the size of that product space, not with the fragment CI vectors.
+
+    Returns:
+        gci: list of lists of ndarrays
+            gci[K][r] is the raveled gradient with respect to ci[K][r]
+    '''
+    if h1 is None or h2 is None: h1, h2 = lassi.ham_2q (las, mo_coeff)[1:]
+    norb_f = las.ncas_sub
+    nfrags = len (norb_f)
+    norb = sum (norb_f)
+    gci = [[np.zeros (c.size, dtype=c.dtype) for c in cr] for cr in ci]
+
+    statesym = lassi.las_symm_tuple (las)[0]
+    rootsym = (si.nelec[state][0], si.nelec[state][1], si.wfnsym[state])
+    roots = np.where (np.all (np.array (statesym) == rootsym, axis=1))[0]
+    ci_blk = [[cr[i] for i in roots] for cr in ci]
+    nelec_fr = [[_unpack_nelec (fcibox._get_nelec (fcibox.fcisolvers[i], nelecas)) for i in roots]
+        for fcibox, nelecas in zip (las.fciboxes, las.nelecas_sub)]
+    ci_r, nelec = op_o0.ci_outer_product_sparse (ci_blk, norb_f, nelec_fr)
+    strs = ci_r[0]._strs
+    si_r = si[roots,state]
+    psi = selected_ci._as_SCIvector (np.tensordot (si_r, np.stack (ci_r, axis=0), axes=1), strs)
+    h2eff = direct_spin1.absorb_h1e (h1, h2, norb, nelec, 0.5)
+    link_index = selected_ci._all_linkstr_index (strs, norb, nelec)
+    hpsi = np.asarray (selected_ci.contract_2e (h2eff, psi, norb, nelec, link_index=link_index))
+    psi = np.asarray (psi)
+    ovlp = np.dot (psi.ravel (), psi.ravel ())
+    e = np.dot (psi.ravel (), hpsi.ravel ()) / ovlp
+    sigma = 2 * (hpsi - e * psi) / ovlp
+
+    for ix, iroot in enumerate (roots):
+        neleca_f = [nelec_r[ix][0] for nelec_r in nelec_fr]
+        nelecb_f = [nelec_r[ix][1] for nelec_r in nelec_fr]
+        na_f = [cistring.num_strings (n, ne) for n, ne in zip (norb_f, neleca_f)]
+        nb_f = [cistring.num_strings (n, ne) for n, ne in zip (norb_f, nelecb_f)]
+        ia = np.searchsorted (strs[0], op_o0.product_strs (norb_f, neleca_f))
+        ib = np.searchsorted (strs[1], op_o0.product_strs (norb_f, nelecb_f))
+        # Later fragments are the more significant indices (see lassi_op_o0.product_strs)
+        sig = si_r[ix] * sigma[np.ix_(ia,ib)].reshape (na_f[::-1] + nb_f[::-1])
+        c_f = [c[ix].reshape (na, nb) for c, na, nb in zip (ci_blk, na_f, nb_f)]
+        for ifrag in range (nfrags):
+            args = [sig, list (range (2*nfrags))]
+            for jfrag, c in enumerate (c_f):
+                if jfrag != ifrag: args.extend ([c, [nfrags-1-jfrag, 2*nfrags-1-jfrag]])
+            args.append ([nfrags-1-ifrag, 2*nfrags-1-ifrag])
+            g = np.einsum (*args).ravel ()
+            c = c_f[ifrag].ravel ()
+            gci[ifrag][iroot] = g - c * c.dot (g)
+    return gci
+
+def make_trans_casdm12 (las, ci1, ci0=None, weights=None):
+    ''' State-averaged, spin-summed active-space transition density matrices between the LAS states ci0 and the
+    states obtained by replacing, one fragment at a time, a fragment CI vector of ci0 with the corresponding one in
+    ci1:
+
+    sum_r w_r sum_K <ci1[K][r] x {ci0[L][r]}_(L!=K)| ... |ci0[r]>
+
+    ci1 must be orthogonal to ci0 fragment by fragment. The conventions are those of direct_spin1.trans_rdm12 (bra
+    first), so that this provides the fcisolver.trans_rdm12 term required by sacasscf.Lci_dot_dgci_dx. '''
+    if ci0 is None: ci0 = las.ci
+    if weights is None: weights = las.weights
+    ncas_sub = las.ncas_sub
+    ncas = sum (ncas_sub)
+    ncas_cum = np.cumsum ([0] + list (ncas_sub))
+    casdm1frs = las.states_make_casdm1s_sub (ci=ci0)
+    tdm1 = np.zeros ((ncas, ncas), dtype=ci0[0][0].dtype)
+    tdm2 = np.zeros ((ncas, ncas, ncas, ncas), dtype=ci0[0][0].dtype)
+    for isub, (fcibox, c1r, c0r, norb, nelecas) in enumerate (zip (las.fciboxes, ci1, ci0, ncas_sub,
+      las.nelecas_sub)):
+        i = ncas_cum[isub]
+        j = ncas_cum[isub+1]
+        for iroot, (solver, c1, c0, w) in enumerate (zip (fcibox.fcisolvers, c1r, c0r, weights)):
+            nelec = _unpack_nelec (fcibox._get_nelec (solver, nelecas))
+            (t1a, t1b), t2 = direct_spin1.trans_rdm12s (c1.reshape (c0.shape), c0, norb, nelec)
+            tdm1[i:j,i:j] += w * (t1a + t1b)
+            tdm2[i:j,i:j,i:j,i:j] += w * sum (t2)
+            # <c1|p'q|c0>; cf. direct_spin1.trans_rdm1s, which returns <c1|q'p|c0>
+            ta, tb = w * t1a.T, w * t1b.T
+            for jsub, dm1rs in enumerate (casdm1frs):
+                if jsub == isub: continue
+                k = ncas_cum[jsub]
+                l = ncas_cum[jsub+1]
+                dma, dmb = dm1rs[iroot][0], dm1rs[iroot][1]
+                # Coulomb slices
+                tdm2[i:j,i:j,k:l,k:l] += np.multiply.outer (ta+tb, dma+dmb)
+                tdm2[k:l,k:l,i:j,i:j] += np.multiply.outer (dma+dmb, ta+tb)
+                # Exchange slices; unlike in LASCINoSymm.states_make_casdm2, these aren't transposes of each other
+                tdm2x = np.multiply.outer (ta, dma) + np.multiply.outer (tb, dmb)
+                tdm2[i:j,k:l,k:l,i:j] -= tdm2x.transpose (0,3,2,1)
+                tdm2[k:l,i:j,i:j,k:l] -= tdm2x.transpose (2,1,0,3)
+    return tdm1, tdm2
+
+class _LASFCISolver (object):
+    ''' Stand-in for the fcisolver of the CASSCF object passed to pyscf.grad.casscf and pyscf.grad.sacasscf, which
+    returns fixed LAS(SI) density matrices regardless of the CI vectors passed to it '''
+
+    def __init__(self, casdm1, casdm2, tdm1=None, tdm2=None):
+        self.casdm1, self.casdm2 = casdm1, casdm2
+        self.tdm1, self.tdm2 = tdm1, tdm2
+
+    def make_rdm12 (self, ci, ncas, nelecas, **kwargs):
+        return self.casdm1, self.casdm2
+
+    def trans_rdm12 (self, ci1, ci0, ncas, nelecas, **kwargs):
+        # The callers add the transposes in place
+        return self.tdm1.copy (), self.tdm2.copy ()
+
+class Gradients (lagrange.Gradients):
+    ''' Analytical nuclear gradients of a LASSI root (a column of si, as returned by lassi.lassi) of a SA-LASSCF
+    calculation.
+
+    Limitations:
+        The CI part of the gradient of the root (get_grad_ci) is evaluated in the product-state determinant space
+        of the root's symmetry block, as in lassi_op_o0. Its memory and cost grow as the product over fragments of
+        the fragment determinant-space dimensions, times the number of LAS states in the block, so it is limited to
+        active spaces small enough for lassi_op_o0.ham. Only the density matrices of the root (roots_make_rdms) go
+        through the fragment intermediates of lassi_op_o1.
+
+        Every LAS state must have a nonzero weight; kernel raises NotImplementedError otherwise. The CI vectors of
+        a zero-weight state do not enter the state-averaged LASSCF energy, so their rows of the weighted Hessian
+        vanish and the Lagrange equations are singular. They are instead fixed by the state's own, unweighted CI
+        stationarity conditions, which would have to be solved for separately, ahead of the others.
+    '''
+
+    _keys = set (('state', 'si', 'ugg', 'weights', 'eris'))
+
+    def __init__(self, las, si=None, state=None):
+        self.state = state
+        self.si = si
+        self.ugg = las.get_ugg ()
+        self.weights = np.asarray (las.weights)
+        self.eris = None
+        lagrange.Gradients.__init__(self, las, self.ugg.nvar_tot)
+
+    def make_fcasscf (self, casdm1, casdm2, tdm1=None, tdm2=None, mo=None, nelecas=None):
+        ''' Make a fake CASSCF object spanning the collective active space of las, whose fcisolver returns the
+        given density matrices '''
+        las = self.base
+        if mo is None: mo = las.mo_coeff
+        if nelecas is None: nelecas = las.nelecas
+        fcasscf = mcscf.CASSCF (las._scf, las.ncas, nelecas)
+        if getattr (las, 'with_df', None) is not None:
+            fcasscf = fcasscf.density_fit (with_df=las.with_df)
+        fcasscf.ncore = las.ncore
+        fcasscf.mo_coeff = mo
+        fcasscf.verbose = las.verbose
+        fcasscf.stdout = las.stdout
+        fcasscf.max_memory = las.max_memory
+        fcasscf.fcisolver = _LASFCISolver (casdm1, casdm2, tdm1=tdm1, tdm2=tdm2)
+        fcasscf.converged = las.converged
+        # The LASSI root is not stationary with respect to any orbital rotation
+        fcasscf._tag_gfock_ov_nonzero = True
+        return fcasscf
+
+    def make_fcasscf_grad (self, fcasscf):
+        ''' CASSCF gradient object evaluating the Hellmann-Feynman term of the fake CASSCF object fcasscf '''
+        return casscf_grad.Gradients (fcasscf)
+
+    def Lci_dot_dgci_dx (self, Lci, weights, fcasscf, **kwargs):
+        ''' CI Lagrange term of the gradient; see pyscf.grad.sacasscf.Lci_dot_dgci_dx '''
+        return sacasscf_grad.Lci_dot_dgci_dx (Lci, weights, fcasscf, **kwargs)
+
+    def Lorb_dot_dgorb_dx (self, Lorb, fcasscf, **kwargs):
+        ''' Orbital Lagrange term of the gradient; see pyscf.grad.sacasscf.Lorb_dot_dgorb_dx '''
+        return sacasscf_grad.Lorb_dot_dgorb_dx (Lorb, fcasscf, **kwargs)
+
+    def get_weights_vec (self):
+        ''' Weights of the state-averaged LASSCF energy gradient components in the packed (ugg) vector space '''
+        wvec = [np.ones (self.ugg.nvar_orb)]
+        for ncsf_r in self.ugg.ncsf_sub:
+            wvec.extend ([np.full (ncsf, w) for ncsf, w in zip (ncsf_r, self.weights)])
+        return np.concatenate (wvec)
+
+    def project_ci (self, x, ci):
+        ''' Remove the components of the CI part of the packed vector x along the fragment CI vectors ci,
+        which are not LASSCF degrees of freedom '''
+        kappa, ci1 = self.ugg.unpack (x)
+        ci1 = [[c1 - c.ravel () * c.ravel ().dot (c1) for c1, c in zip (c1r, cr)] for c1r, cr in zip (ci1, ci)]
+        return self.ugg.pack (kappa, ci1)
+
+    def kernel (self, state=None, si=None, mo=None, ci=None, **kwargs):
+        ''' Cache the root density matrices and the LASSCF Hessian operator so you don't have to build them twice '''
+        las = self.base
+        if np.any (self.weights == 0):
+            raise NotImplementedError ('LASSI gradients with zero-weight LAS states (see Gradients docstring)')
+        if state is None: state = self.state
+        if state is None: state = 0
+        if mo is None: mo = las.mo_coeff
+        if ci is None: ci = las.ci
+        if si is None: si = self.si
+        if si is None: si = lassi.lassi (las, mo_coeff=mo, ci=ci)[1]
+        hop = las.get_hop (mo_coeff=mo, ci=ci, ugg=self.ugg)
+        if not isinstance (hop, LASSCF_HessianOperator):
+            raise NotImplementedError ('LASSI gradients with LASCI (not LASSCF) orbitals')
+        hop.ah_level_shift = 0
+        self.state, self.si = state, si
+        casdm1, casdm2 = lassi.roots_make_rdms (las, ci, si, roots=[state], form='rdm12')
+        kwargs['casdm12'] = casdm1[0], casdm2[0]
+        return lagrange.Gradients.kernel (self, state=state, si=si, mo=mo, ci=ci, hop=hop, **kwargs)
+
+    def get_wfn_response (self, state=None, si=None, mo=None, ci=None, hop=None, casdm12=None, **kwargs):
+        las = self.base
+        casdm1, casdm2 = casdm12
+        gorb = get_grad_orb (las, mo, casdm1, casdm2, hop.h2eff_sub)
+        gci = get_grad_ci (las, mo, ci, si, state)
+        return self.project_ci (self.ugg.pack (gorb, gci), hop.ci)
+
+    def get_Aop_Adiag (self, mo=None, ci=None, hop=None, **kwargs):
+        ''' Hessian of the state-averaged LASSCF energy. The CI rows of LASCI_HessianOperator differentiate the
+        unweighted CI gradients, so they are weighted here. Its orbital rows differentiate the orbital gradient
+        with respect to kappa/2 rather than x, and its orbital-CI block is only approximate, which is good enough for
+        the LASSCF optimizer but not here: the latter is replaced with the response of the orbital gradient to the
+        transition density matrices of the CI step. '''
+        las = self.base
+        no = self.ugg.nvar_orb
+        wvec = self.get_weights_vec ()
+        def Aop (x):
+            x = self.project_ci (x, hop.ci)
+            x_orb = x.copy ()
+            x_orb[no:] = 0
+            Ax = hop._matvec (x_orb)
+            Ax[no:] += hop._matvec (x - x_orb)[no:]
+            Ax[:no] /= 2
+            tdm1, tdm2 = make_trans_casdm12 (las, self.ugg.unpack (x)[1], ci0=ci, weights=self.weights)
+            tdm1 += tdm1.T
+            tdm2 += tdm2.transpose (1,0,3,2)
+            gorb = get_grad_orb (las, mo, tdm1, tdm2, hop.h2eff_sub, response=True)
+            Ax[:no] += gorb[self.ugg.uniq_orb_idx]
+            return wvec * self.project_ci (Ax, hop.ci)
+        # The CI part of the LASSCF preconditioner is the bare CSF Hamiltonian diagonal; shift it by the fragment
+        # energies, as in the Hessian itself, so that it doesn't make the preconditioner indefinite
+        Adiag = 1 / hop.get_prec ().matvec (np.ones (self.nlag))
+        e0 = [np.full (ncsf, e) for ncsf_r, e_r in zip (self.ugg.ncsf_sub, hop.e0) for ncsf, e in zip (ncsf_r, e_r)]
+        Adiag -= np.concatenate ([np.zeros (no)] + e0)
+        Adiag[:no] /= 2
+        Adiag[no:] *= 2
+        return Aop, wvec * Adiag
+
+    def get_lagrange_precond (self, Adiag, level_shift=None, hop=None, **kwargs):
+        precond = lagrange.Gradients.get_lagrange_precond (self, Adiag, level_shift=level_shift)
+        # LagPrec divides in place, which would clobber the CG residual
+        return lambda x: self.project_ci (precond (x.copy ()), hop.ci)
+
+    def get_ham_response (self, state=None, si=None, atmlst=None, verbose=None, mo=None, ci=None, casdm12=None,
+            **kwargs):
+        if atmlst is None: atmlst = self.atmlst
+        if verbose is None: verbose = self.verbose
+        casdm1, casdm2 = casdm12
+        fcasscf = self.make_fcasscf (casdm1, casdm2, mo=mo, nelecas=si.nelec[state])
+        fcasscf_grad = self.make_fcasscf_grad (fcasscf)
+        # Mute some misleading messages
+        fcasscf_grad._finalize = lambda: None
+        return fcasscf_grad.kernel (mo_coeff=mo, ci=ci, atmlst=atmlst, verbose=verbose)
+
+    def get_LdotJnuc (self, Lvec, atmlst=None, verbose=None, mo=None, ci=None, hop=None, mf_grad=None, **kwargs):
+        las = self.base
+        if atmlst is None: atmlst = self.atmlst
+        if verbose is None: verbose = self.verbose
+        eris = self.eris = hop.cas_type_eris
+
+        # The orbital step of LASCI_HessianOperator is exp (kappa/2)
+        Lorb, Lci = self.ugg.unpack (self.project_ci (Lvec, hop.ci))
+        Lorb = Lorb / 2
+        tdm1, tdm2 = make_trans_casdm12 (las, Lci, ci0=ci, weights=self.weights)
+        casdm1 = las.make_casdm1 (ci=ci)
+        casdm2 = las.make_casdm2 (ci=ci)
+        fcasscf = self.make_fcasscf (casdm1, casdm2, tdm1=tdm1, tdm2=tdm2, mo=mo)
+
+        # CI part
+        t0 = (time.clock (), time.time ())
+        de_Lci = self.Lci_dot_dgci_dx (Lci, self.weights, fcasscf, mo_coeff=mo, ci=ci, atmlst=atmlst,
+            mf_grad=mf_grad, eris=eris, verbose=verbose)
+        logger.info (self, '--------------- %s gradient Lagrange CI response ---------------',
+                     self.base.__class__.__name__)
+        if verbose >= logger.INFO: rhf_grad._write (self, self.mol, de_Lci, atmlst)
+        logger.info (self, '----------------------------------------------------------------')
+        t0 = logger.timer (self, '{} gradient Lagrange CI response'.format (self.base.__class__.__name__), *t0)
+
+        # Orb part
+        de_Lorb = self.Lorb_dot_dgorb_dx (Lorb, fcasscf, mo_coeff=mo, ci=ci, atmlst=atmlst,
+            mf_grad=mf_grad, eris=eris, verbose=verbose)
+        logger.info (self, '--------------- %s gradient Lagrange orbital response ---------------',
+                     self.base.__class__.__name__)
+        if verbose >= logger.INFO: rhf_grad._write (self, self.mol, de_Lorb, atmlst)
+        logger.info (self, '---------------------------------------------------------------------')
+        t0 = logger.timer (self, '{} gradient Lagrange orbital response'.format (self.base.__class__.__name__),
+            *t0)
+
+        return de_Lci + de_Lorb
+
+Grad = Gradients
@@ -6,7 +6,7 @@ from mrh.my_pyscf.mcscf.addons import state_average_n_mix, get_h1e_zipped_fcisol
 from mrh.my_pyscf.fci.csfstring import CSFTransformer
 from mrh.my_pyscf.fci import csf_solver
 from mrh.my_pyscf.scf import hf_as
-from mrh.my_pyscf.df.sparse_df import sparsedf_array
+from mrh.my_pyscf.df.sparse_df import sparsedf_array, get_sparsedf
 from mrh.my_pyscf.mcscf.lassi import lassi
 from itertools import combinations, product
 from scipy.sparse import linalg as sparse_linalg
@@ -1188,8 +1188,10 @@ class LASCINoSymm (casci.CASCI):
         mo = [mo_coeff, mo_cas, mo_cas, mo_cas]
         if getattr (self, 'with_df', None) is not None:
             # Store intermediate with one contracted ao index for faster calculation of exchange corrections!
-            bPmn = sparsedf_array (self.with_df._cderi)
-            bmuP = bPmn.contract1 (mo_cas)
+            # All fragments' active orbitals in one pass over the CDERIs
+            bPmn = get_sparsedf (self.with_df)
+            mo_sub = [self.get_mo_slice (idx, mo_coeff=mo_coeff) for idx in range (len (self.ncas_sub))]
+            bmuP = np.concatenate (bPmn.contract1_batch (mo_sub), axis=1)
             buvP = np.tensordot (mo_cas.conjugate (), bmuP, axes=((0),(0)))
             eri_muxy = np.tensordot (bmuP, buvP, axes=((2),(2)))
             eri = lib.pack_tril (np.tensordot (mo_coeff.conjugate (), eri_muxy, axes=((0),(0))).reshape (nmo*ncas, ncas, ncas)).reshape (nmo, -1)
@@ -1266,6 +1268,8 @@ class LASCINoSymm (casci.CASCI):
 
         self.converged, self.e_tot, self.e_states, self.mo_energy, self.mo_coeff, self.e_cas, self.ci, h2eff_sub, veff = \
                 kernel(self, mo_coeff, ci0=ci0, verbose=verbose, casdm0_fr=casdm0_fr, conv_tol_grad=conv_tol_grad)
+        # Keep the core potential and integrals for lassi.ham_2q; they are only reused for these exact orbitals
+        self._kernel_ints = (self.mo_coeff.copy (), self.ncore, self.ncas, veff.c, h2eff_sub)
 
         return self.e_tot, self.e_cas, self.ci, self.mo_coeff, self.mo_energy, h2eff_sub, veff
 
@@ -1,30 +1,243 @@
 import numpy as np
-import time
+import time, multiprocessing
 from scipy import linalg
 from mrh.my_pyscf.mcscf import lassi_op_o0 as op_o0
 from mrh.my_pyscf.mcscf import lassi_op_o1 as op_o1
-from pyscf import lib, symm
+from pyscf import lib, symm, ao2mo, __config__
 from pyscf.lib.numpy_helper import tag_array
 from pyscf.fci.direct_spin1 import _unpack_nelec
 from itertools import combinations, product
 
 op = (op_o0, op_o1)
 
+# Number of worker processes among which the (neleca, nelecb, irrep) symmetry blocks are distributed
+NPROC = getattr(__config__, 'mcscf_lassi_nproc', 1)
+
+# Set in each worker process of run_blocks by its Pool initializer
+_block_args = None
+def _block_init (fn, blocks):
+    global _block_args
+    _block_args = (fn, blocks)
+def _block_item (i):
+    fn, blocks = _block_args
+    return _run_block (fn, blocks[i])
+def _run_block (fn, args):
+    t0, w0 = time.clock (), time.time ()
+    result = fn (*args)
+    return result, (time.clock () - t0, time.time () - w0)
+
+def block_memory (las, nstates):
+    ''' Rough upper bound (MB) on the memory used to process one symmetry block of nstates LAS states, set by its
+    spin-separated two-body transition density matrices '''
+    return 8 * nstates * nstates * (2 * las.ncas * las.ncas)**2 / 1e6
+
+def fit_nproc (las, mem, nproc=None):
+    ''' Number of worker processes (at most nproc, default NPROC) among which blocks whose predicted memory
+    requirements are mem (list of MB) can be distributed, such that the largest ones running at the same time fit in
+    the remaining max_memory. '''
+    if nproc is None: nproc = NPROC
+    nproc = max (1, min (nproc, len (mem)))
+    if nproc > 1:
+        mem = sorted (mem, reverse=True)
+        max_memory = las.max_memory - lib.current_memory ()[0]
+        while nproc > 1 and sum (mem[:nproc]) > max_memory: nproc -= 1
+    return nproc
+
+def run_blocks (las, fn, blocks, labels, nstates, nproc=None, mem=None):
+    ''' Evaluate fn (*args) for each args in blocks. If nproc > 1, blocks are distributed among forked worker processes,
+    largest (by nstates) first, and the number of workers is reduced until the largest blocks running at the same time
+    fit in the remaining max_memory. Results are returned in the order of blocks and are identical to the serial ones.
+
+    Args:
+        las: LASCI object
+        fn: callable
+        blocks: list of tuples of arguments to fn
+        labels: list of block labels for logging
+        nstates: list of the number of LAS states in each block
+
+    Kwargs:
+        nproc: integer
+            Number of worker processes. Defaults to NPROC
+        mem: list of floats
+            Predicted memory (MB) of each block, i.e., from plan. Defaults to block_memory
+
+    Returns:
+        results: list of returns of fn
+    '''
+    if mem is None: mem = [block_memory (las, n) for n in nstates]
+    nproc = fit_nproc (las, mem, nproc=nproc)
+    order = np.argsort (-np.asarray (nstates, dtype=np.int64), kind='stable')
+    blocks_sorted = [blocks[i] for i in order]
+    if nproc > 1:
+        with multiprocessing.get_context ('fork').Pool (nproc, initializer=_block_init,
+                initargs=(fn, blocks_sorted)) as pool:
+            results = pool.map (_block_item, range (len (blocks)), chunksize=1)
+    else:
+        results = [_run_block (fn, args) for args in blocks_sorted]
+    out = [None for i in range (len (blocks))]
+    for i, (result, (tcpu, twall)) in zip (order, results):
+        lib.logger.info (las, 'LASSI block %s (%d states): CPU time %.2f s, wall time %.2f s', labels[i], nstates[i],
+            tcpu, twall)
+        out[i] = result
+    lib.logger.debug (las, 'LASSI %d symmetry blocks on %d process(es)', len (blocks), nproc)
+    return out
+
+PLAN_TASKS = ('ham', 'stdm12s', 'rdm12s')
+
+class LASSIPlan (object):
+    ''' Dry run of a LASSI task. For each symmetry block of LAS states, holds a dict with the predicted memory (MB)
+    and cost (flops) of every algorithm in op, and the algorithm ('opt'), o0 cross-check ('check'), number of SI
+    vectors per batch ('batch'), and predicted peak memory ('peak') chosen for it. Built by plan; index it with the
+    (neleca, nelecb, irrep) tuple of the block. '''
+
+    def __init__(self, task, max_memory, blocks, nproc):
+        self.task = task
+        self.max_memory = max_memory
+        self.blocks = blocks
+        self.nproc = nproc
+
+    def __getitem__(self, sym):
+        return self.blocks[tuple (sym)]
+
+    def __contains__(self, sym):
+        return tuple (sym) in self.blocks
+
+    def report (self):
+        ''' Tabulate the plan as a string '''
+        lines = ['LASSI {} plan: {:.1f} MB available, {} process(es)'.format (self.task, self.max_memory, self.nproc)]
+        header = ' {:>16s}  {:>7s}  {:>5s}'.format ('(na, nb, irrep)', 'nstates', 'nsi')
+        for k in range (len (op)):
+            header += '  {:>10s}  {:>10s}'.format ('o{} MB'.format (k), 'o{} GFLOP'.format (k))
+        lines.append (header + '  {:>3s}  {:>5s}  {:>5s}  {:>10s}'.format ('opt', 'batch', 'check', 'peak MB'))
+        for sym, blk in self.blocks.items ():
+            line = ' {:>16s}  {:7d}  {:5d}'.format (str (tuple (int (x) for x in sym)), blk['nstates'], blk['nroots_si'])
+            for (mem, mem_si), flops in zip (blk['mem'], blk['flops']):
+                line += '  {:10.1f}  {:10.3f}'.format (mem + mem_si * blk['nroots_si'], flops / 1e9)
+            lines.append (line + '  {:>3d}  {:5d}  {:>5s}  {:10.1f}'.format (blk['opt'], blk['batch'],
+                str (blk['check']), blk['peak']))
+        return '\n'.join (lines)
+
+def _plan_block (las, nelec_frs, task, nroots_si, opt, max_memory):
+    mem, flops = [], []
+    for o in op:
+        m, m_si, f = o.block_cost (las, nelec_frs, task=task, nroots_si=nroots_si)
+        mem.append ((m, m_si))
+        flops.append (f)
+    # Algorithms which batch over SI vectors need room for only one at a time
+    nsi_min = [min (1, nroots_si) if getattr (o, 'BATCH_SI', False) else nroots_si for o in op]
+    peak_min = [m + m_si * n for (m, m_si), n in zip (mem, nsi_min)]
+    fits = [k for k in range (len (op)) if peak_min[k] <= max_memory]
+    if opt in fits: k = opt
+    elif len (fits): k = min (fits, key=lambda k: flops[k])
+    else: k = int (np.argmin (peak_min))
+    batch = nroots_si
+    if getattr (op[k], 'BATCH_SI', False) and mem[k][1] > 0:
+        batch = max (min (1, nroots_si), min (nroots_si, int ((max_memory - mem[k][0]) // mem[k][1])))
+    peak = mem[k][0] + mem[k][1] * batch
+    peak_o0 = mem[0][0] + mem[0][1] * nroots_si
+    check = bool (las.verbose > lib.logger.INFO and k != 0 and peak + peak_o0 <= max_memory)
+    check = check or bool (las.verbose > lib.logger.INFO and k == 0 and peak + peak_min[1] <= max_memory)
+    if check: peak += peak_o0 if k != 0 else peak_min[1]
+    return {'nstates': nelec_frs.shape[1], 'nroots_si': nroots_si, 'mem': mem, 'flops': flops, 'opt': k,
+        'batch': batch, 'check': check, 'peak': peak}
+
+def plan (las, task='ham', opt=1, si=None, roots=None, statesym=None, nproc=None, max_memory=None):
+    ''' Predict the peak memory and cost of every LASSI algorithm for each symmetry block of LAS states from the
+    fragment sizes and numbers of states and SI vectors, and choose the algorithm and SI batch size accordingly.
+    The requested algorithm is used if it fits; otherwise the cheapest one that fits, batching over SI vectors if
+    that is what it takes. If nothing fits, the leanest one is used anyway with a warning: nothing here raises
+    MemoryError. Nothing is computed; print the report () of the returned plan for a dry run.
+
+    Args:
+        las: LASCI object
+
+    Kwargs:
+        task: one of PLAN_TASKS: 'ham' (lassi), 'stdm12s' (make_stdm12s), or 'rdm12s' (roots_make_rdm12s)
+        opt: integer or None
+            Requested algorithm (index into op). If None, the cheapest one that fits is chosen
+        si: ndarray with attributes nelec and wfnsym, as returned by lassi
+            SI vectors, required for task 'rdm12s'
+        roots: list of integers
+            Indices of the SI vectors needed; default is all of them
+        statesym: list of (neleca, nelecb, irrep) tuples of the LAS states, if already known
+        nproc: integer
+            Maximum number of worker processes; see run_blocks
+        max_memory: float
+            Memory (MB) available; defaults to las.max_memory less that already used
+
+    Returns:
+        LASSIPlan
+    '''
+    if task not in PLAN_TASKS:
+        raise RuntimeError ('LASSI plan task must be one of {}; not {}'.format (PLAN_TASKS, task))
+    if max_memory is None: max_memory = las.max_memory - lib.current_memory ()[0]
+    if statesym is None: statesym = las_symm_tuple (las)[0]
+    rootsym = []
+    if si is not None:
+        if roots is None: roots = range (si.shape[1])
+        rootsym = [(si.nelec[r][0], si.nelec[r][1], si.wfnsym[r]) for r in roots]
+    blocks = {}
+    for sym in sorted (set (statesym), key=str):
+        idx = [i for i, ssym in enumerate (statesym) if ssym == sym]
+        if task == 'ham' and len (idx) == 1: continue
+        nroots_si = sum ([rsym == sym for rsym in rootsym]) if task == 'rdm12s' else 0
+        nelec_frs = np.array ([[_unpack_nelec (fcibox._get_nelec (fcibox.fcisolvers[ix], nelec)) for ix in idx]
+            for fcibox, nelec in zip (las.fciboxes, las.nelecas_sub)])
+        blocks[tuple (sym)] = _plan_block (las, nelec_frs, task, nroots_si, opt, max_memory)
+        blk = blocks[tuple (sym)]
+        if blk['peak'] > max_memory:
+            lib.logger.warn (las, 'LASSI %s block %s is predicted to need %.1f MB of %.1f MB available', task,
+                sym, blk['peak'], max_memory)
+        if opt is not None and blk['opt'] != opt:
+            lib.logger.warn (las, 'LASSI %s block %s: algorithm o%d does not fit in memory; using o%d instead',
+                task, sym, opt, blk['opt'])
+    nproc = fit_nproc (las, [blk['peak'] for blk in blocks.values ()], nproc=nproc)
+    p = LASSIPlan (task, max_memory, blocks, nproc)
+    lib.logger.debug (las, '%s', p.report ())
+    return p
+
+def get_kernel_ints (las, mo_coeff):
+    ''' Retrieve the core potential veff_c and the h2eff_sub array left behind by the last LASCI kernel call, if they
+    were computed for the same orbitals and orbital partition as mo_coeff. Returns (None, None) otherwise. '''
+    cache = getattr (las, '_kernel_ints', None)
+    if cache is None: return None, None
+    mo_ref, ncore, ncas, veff_c, h2eff_sub = cache
+    if (ncore, ncas) != (las.ncore, las.ncas): return None, None
+    if mo_ref.shape != mo_coeff.shape or not np.array_equal (mo_ref, mo_coeff): return None, None
+    return veff_c, h2eff_sub
+
+def ao2mo_cas (las, mo_cas):
+    ''' Two-electron integrals (ncas,ncas,ncas,ncas) of the active orbitals alone, which is all LASSI needs; cf.
+    las.ao2mo, which transforms the first index over all nmo orbitals. '''
+    ncas = mo_cas.shape[1]
+    if getattr (las, 'with_df', None) is not None:
+        eri = las.with_df.ao2mo (mo_cas, compact=True)
+    elif getattr (las._scf, '_eri', None) is not None:
+        eri = ao2mo.incore.full (las._scf._eri, mo_cas, compact=True)
+    else:
+        eri = ao2mo.outcore.full_iofree (las.mol, mo_cas, compact=True)
+    return ao2mo.restore (1, eri, ncas)
+
 def ham_2q (las, mo_coeff, veff_c=None, h2eff_sub=None):
     # Construct second-quantization Hamiltonian
     ncore, ncas, nocc = las.ncore, las.ncas, las.ncore + las.ncas
     mo_core = mo_coeff[:,:ncore]
     mo_cas = mo_coeff[:,ncore:nocc]
     hcore = las._scf.get_hcore ()
+    if veff_c is None or h2eff_sub is None:
+        veff_c_ref, h2eff_sub_ref = get_kernel_ints (las, mo_coeff)
+        if veff_c is None: veff_c = veff_c_ref
+        if h2eff_sub is None: h2eff_sub = h2eff_sub_ref
     if veff_c is None: 
         dm_core = 2 * mo_core @ mo_core.conj ().T
         veff_c = las.get_veff (dm1s=dm_core)
-    if h2eff_sub is None:
-        h2eff_sub = las.ao2mo (mo_coeff)
     e0 = las._scf.energy_nuc () + 2 * (((hcore + veff_c/2) @ mo_core) * mo_core).sum ()
     h1 = mo_cas.conj ().T @ (hcore + veff_c) @ mo_cas
-    h2 = h2eff_sub[ncore:nocc].reshape (ncas*ncas, ncas * (ncas+1) // 2)
-    h2 = lib.numpy_helper.unpack_tril (h2).reshape (ncas, ncas, ncas, ncas)
+    if h2eff_sub is None:
+        h2 = ao2mo_cas (las, mo_cas)
+    else:
+        h2 = h2eff_sub[ncore:nocc].reshape (ncas*ncas, ncas * (ncas+1) // 2)
+        h2 = lib.numpy_helper.unpack_tril (h2).reshape (ncas, ncas, ncas, ncas)
     return e0, h1, h2
 
 def las_symm_tuple (las):
@@ -63,8 +276,37 @@ def las_symm_tuple (las):
 
     return statesym, np.asarray (s2_states)
 
-def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None, opt=1):
-    ''' Diagonalize the state-interaction matrix of LASSCF '''
+def _ham_block (las, h1, h2, ci_blk, idx, rootsym, orbsym, opt, o0_memcheck):
+    wfnsym = rootsym[-1]
+    t0 = (time.clock (), time.time ())
+    if (las.verbose > lib.logger.INFO) and (o0_memcheck):
+        ham_ref, s2_ref, ovlp_ref = op_o0.ham (las, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
+        t0 = lib.logger.timer (las, 'LASSI diagonalizer rootsym {} CI algorithm'.format (rootsym), *t0)
+        ham_blk, s2_blk, ovlp_blk = op_o1.ham (las, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
+        t0 = lib.logger.timer (las, 'LASSI diagonalizer rootsym {} TDM algorithm'.format (rootsym), *t0)
+        lib.logger.debug (las, 'LASSI diagonalizer rootsym {}: ham o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (ham_blk - ham_ref))) 
+        lib.logger.debug (las, 'LASSI diagonalizer rootsym {}: S2 o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (s2_blk - s2_ref))) 
+        lib.logger.debug (las, 'LASSI diagonalizer rootsym {}: ovlp o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (ovlp_blk - ovlp_ref))) 
+        errvec = np.concatenate ([(ham_blk-ham_ref).ravel (), (s2_blk-s2_ref).ravel (), (ovlp_blk-ovlp_ref).ravel ()])
+        if np.amax (np.abs (errvec)) > 1e-8:
+            raise RuntimeError (("Congratulations, you have found a bug in either lassi_op_o0 (I really hope not)"
+                " or lassi_op_o1 (much more likely)!\nPlease inspect the last few printed lines of logger output"
+                " for more information.\nError in lassi, max abs: {}; norm: {}").format (np.amax (np.abs (errvec)),
+                linalg.norm (errvec)))
+        if opt == 0:
+            ham_blk = ham_ref
+            s2_blk = s2_ref
+            ovlp_blk = ovlp_ref
+    else:
+        if (las.verbose > lib.logger.INFO): lib.logger.debug (las, 'Insufficient memory to test against o0 LASSI algorithm')
+        ham_blk, s2_blk, ovlp_blk = op[opt].ham (las, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
+        t0 = lib.logger.timer (las, 'LASSI diagonalizer rootsym {}'.format (rootsym), *t0)
+    e, c = linalg.eigh (ham_blk, b=ovlp_blk)
+    return ham_blk, s2_blk, ovlp_blk, e, c
+
+def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None, opt=1, nproc=None):
+    ''' Diagonalize the state-interaction matrix of LASSCF. The symmetry blocks are distributed among nproc
+    worker processes; see run_blocks '''
     if mo_coeff is None: mo_coeff = las.mo_coeff
     if ci is None: ci = las.ci
     if orbsym is None: 
@@ -73,21 +315,20 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
             orbsym = las.label_symmetry_(las.mo_coeff).orbsym
         if orbsym is not None:
             orbsym = orbsym[las.ncore:las.ncore+las.ncas]
-    o0_memcheck = op_o0.memcheck (las, ci)
-    if opt == 0 and o0_memcheck == False:
-        raise RuntimeError ('Insufficient memory to use o0 LASSI algorithm')
 
     # Construct second-quantization Hamiltonian
-    e0, h1, h2 = ham_2q (las, mo_coeff, veff_c=None, h2eff_sub=None)
+    e0, h1, h2 = ham_2q (las, mo_coeff, veff_c=veff_c, h2eff_sub=h2eff_sub)
 
     # Symmetry tuple: neleca, nelecb, irrep
     statesym, s2_states = las_symm_tuple (las)
+    p = plan (las, task='ham', opt=opt, statesym=statesym, nproc=nproc)
 
     # Loop over symmetry blocks
     e_roots = np.zeros (las.nroots, dtype=np.float64)
     s2_roots = np.zeros (las.nroots, dtype=np.float64)
     si = np.zeros ((las.nroots, las.nroots), dtype=np.float64)
     s2_mat = np.zeros ((las.nroots, las.nroots), dtype=np.float64)
+    blocks, rootsyms, idxs = [], [], []
     for rootsym in set (statesym):
         idx = np.all (np.array (statesym) == rootsym, axis=1)
         lib.logger.debug (las, 'Diagonalizing LAS state symmetry block (neleca, nelecb, irrep) = {}'.format (rootsym))
@@ -97,31 +338,13 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
             si[np.ix_(idx,idx)] = 1.0
             s2_roots[idx] = s2_states[idx]
             continue
-        wfnsym = rootsym[-1]
         ci_blk = [[c for c, ix in zip (cr, idx) if ix] for cr in ci]
-        t0 = (time.clock (), time.time ())
-        if (las.verbose > lib.logger.INFO) and (o0_memcheck):
-            ham_ref, s2_ref, ovlp_ref = op_o0.ham (las, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
-            t0 = lib.logger.timer (las, 'LASSI diagonalizer rootsym {} CI algorithm'.format (rootsym), *t0)
-            ham_blk, s2_blk, ovlp_blk = op_o1.ham (las, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
-            t0 = lib.logger.timer (las, 'LASSI diagonalizer rootsym {} TDM algorithm'.format (rootsym), *t0)
-            lib.logger.debug (las, 'LASSI diagonalizer rootsym {}: ham o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (ham_blk - ham_ref))) 
-            lib.logger.debug (las, 'LASSI diagonalizer rootsym {}: S2 o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (s2_blk - s2_ref))) 
-            lib.logger.debug (las, 'LASSI diagonalizer rootsym {}: ovlp o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (ovlp_blk - ovlp_ref))) 
-            errvec = np.concatenate ([(ham_blk-ham_ref).ravel (), (s2_blk-s2_ref).ravel (), (ovlp_blk-ovlp_ref).ravel ()])
-            if np.amax (np.abs (errvec)) > 1e-8:
-                raise RuntimeError (("Congratulations, you have found a bug in either lassi_op_o0 (I really hope not)"
-                    " or lassi_op_o1 (much more likely)!\nPlease inspect the last few printed lines of logger output"
-                    " for more information.\nError in lassi, max abs: {}; norm: {}").format (np.amax (np.abs (errvec)),
-                    linalg.norm (errvec)))
-            if opt == 0:
-                ham_blk = ham_ref
-                s2_blk = s2_ref
-                ovlp_blk = ovlp_ref
-        else:
-            if (las.verbose > lib.logger.INFO): lib.logger.debug (las, 'Insufficient memory to test against o0 LASSI algorithm')
-            ham_blk, s2_blk, ovlp_blk = op[opt].ham (las, h1, h2, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
-            t0 = lib.logger.timer (las, 'LASSI diagonalizer rootsym {}'.format (rootsym), *t0)
+        blocks.append ((las, h1, h2, ci_blk, idx, rootsym, orbsym, p[rootsym]['opt'], p[rootsym]['check']))
+        rootsyms.append (rootsym)
+        idxs.append (idx)
+    results = run_blocks (las, _ham_block, blocks, rootsyms, [np.count_nonzero (idx) for idx in idxs], nproc=nproc,
+        mem=[p[rootsym]['peak'] for rootsym in rootsyms])
+    for rootsym, idx, (ham_blk, s2_blk, ovlp_blk, e, c) in zip (rootsyms, idxs, results):
         lib.logger.debug (las, 'Block Hamiltonian - ecore:')
         lib.logger.debug (las, '{}'.format (ham_blk))
         lib.logger.debug (las, 'Block S**2:')
@@ -135,7 +358,6 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
         for ix, (test, ref) in enumerate (zip (diag_test, diag_ref)):
             lib.logger.debug (las, '{:13.6e} {:13.6e} {:13.6e}'.format (test, ref, test-ref))
         assert (np.allclose (diag_test, diag_ref, atol=1e-5)), 'SI Hamiltonian diagonal element error. Inadequate convergence?'
-        e, c = linalg.eigh (ham_blk, b=ovlp_blk)
         s2_blk = c.conj ().T @ s2_blk @ c
         lib.logger.debug (las, 'Block S**2 in adiabat basis:')
         lib.logger.debug (las, '{}'.format (s2_blk))
@@ -158,7 +380,179 @@ def lassi (las, mo_coeff=None, ci=None, veff_c=None, h2eff_sub=None, orbsym=None
         lib.logger.info (las, ' {:2d}  {:16.10f}  {:6d}  {:6d}  {:6.3f}  {:>6s}'.format (ix, er, neleca, nelecb, s2r, wfnsym))
     return e_roots, si
 
-def make_stdm12s (las, ci=None, orbsym=None, opt=1):
+class SparseSTDM12s (object):
+    ''' Block-sparse container for spin-separated LAS state-transition density matrices
+
+        stdm1s[i,s,p,q,j] = <i|p's q_s|j>
+        stdm2s[i,s,p,q,t,r,u,j] = <i|p's r't u_t q_s|j>
+
+    Only pairs of states i <= j which are in the same symmetry block are stored; the (j,i) element is obtained by
+    hermiticity and all others are zero. The two-body matrices are symmetric under exchange of the index pairs (s,p,q)
+    and (t,r,u), so each is stored as the packed lower triangle of a (2*ncas*ncas, 2*ncas*ncas) matrix. Root density
+    matrices (roots_make_rdm12s) are stored the same way, as the diagonal (i,i) elements. '''
+
+    def __init__(self, nroots, ncas, dtype=np.float64):
+        self.nroots = nroots
+        self.ncas = ncas
+        self.dtype = dtype
+        self._d1s = {}
+        self._d2s = {}
+
+    def set_block (self, idx, d1s, d2s, diag=False):
+        ''' Store the STDMs (d1s of shape (nblk,2,ncas,ncas,nblk), d2s of shape (nblk,2,ncas,ncas,2,ncas,ncas,nblk))
+        among the states idx (an integer or boolean index of length nroots), or, if diag, the RDMs (d1s of shape
+        (nblk,2,ncas,ncas), d2s of shape (nblk,2,ncas,ncas,2,ncas,ncas)) of the states idx '''
+        idx = np.asarray (idx)
+        if idx.dtype == np.bool_: idx = np.where (idx)[0]
+        m = 2 * self.ncas * self.ncas
+        if diag:
+            pairs = [((i,i), (a,a)) for i, a in enumerate (idx)]
+        else:
+            pairs = [((i,j), (a,b)) for (i,a), (j,b) in product (enumerate (idx), repeat=2) if a <= b]
+        for (i,j), key in pairs:
+            d1 = d1s[i] if diag else d1s[i,...,j]
+            d2 = d2s[i] if diag else d2s[i,...,j]
+            self._d1s[key] = np.array (d1, dtype=self.dtype)
+            self._d2s[key] = lib.pack_tril (np.ascontiguousarray (d2, dtype=self.dtype).reshape (m, m))
+
+    def add_pair (self, i, j, d1s=None, d2s=None):
+        ''' Add d1s of shape (2,ncas,ncas) and/or d2s of shape (2,ncas,ncas,2,ncas,ncas), the STDMs <i|...|j>, to
+        those stored for the states i, j. Either ordering of i, j may be given. This lets producers pack each pair of
+        states as soon as it has been computed. '''
+        n = self.ncas
+        m = 2 * n * n
+        if i > j:
+            i, j = j, i
+            if d1s is not None: d1s = d1s.transpose (0,2,1).conj ()
+            if d2s is not None: d2s = d2s.transpose (0,2,1,3,5,4).conj ()
+        key = (i, j)
+        if key not in self._d1s:
+            self._d1s[key] = np.zeros ((2,n,n), dtype=self.dtype)
+            self._d2s[key] = np.zeros (m*(m+1)//2, dtype=self.dtype)
+        if d1s is not None: self._d1s[key] += d1s
+        if d2s is not None:
+            self._d2s[key] += lib.pack_tril (np.ascontiguousarray (d2s, dtype=self.dtype).reshape (m, m))
+
+    def update (self, other):
+        ''' Take over the pairs of states stored in other, another SparseSTDM12s of the same states '''
+        self._d1s.update (other._d1s)
+        self._d2s.update (other._d2s)
+
+    def __contains__(self, key):
+        i, j = key
+        return (min (i,j), max (i,j)) in self._d1s
+
+    def get (self, i, j):
+        ''' Returns d1s, d2s of shape (2,ncas,ncas) and (2,ncas,ncas,2,ncas,ncas) for the states i, j '''
+        n = self.ncas
+        key = (min (i,j), max (i,j))
+        if key not in self._d1s:
+            return np.zeros ((2,n,n), dtype=self.dtype), np.zeros ((2,n,n,2,n,n), dtype=self.dtype)
+        d1 = self._d1s[key]
+        d2 = lib.unpack_tril (self._d2s[key], filltriu=lib.SYMMETRIC).reshape (2,n,n,2,n,n)
+        if i > j:
+            d1 = d1.transpose (0,2,1).conj ()
+            d2 = d2.transpose (0,2,1,3,5,4).conj ()
+        return d1, d2
+
+    def contract (self, h1, h2):
+        ''' Contract with spin-free integrals (h1[p,q] and h2[p,q,r,u] = (pq|ru)) directly in the packed
+        storage, returning the (nroots,nroots) matrix sum_pq h1 D1^ij_pq + 1/2 sum_pqru h2 D2^ij_pqru of the
+        spin-summed density matrices '''
+        n = self.ncas
+        m = 2 * n * n
+        h1 = np.asarray (h1)
+        h2 = np.broadcast_to (np.asarray (h2)[None,:,:,None,:,:], (2,n,n,2,n,n)).reshape (m, m)
+        h2 = h2 * (2 - np.eye (m)) # off-diagonal elements of the lower triangle stand in for the upper as well
+        h2 = lib.pack_tril (np.ascontiguousarray (h2))
+        out = np.zeros ((self.nroots, self.nroots), dtype=np.result_type (self.dtype, h1.dtype, h2.dtype))
+        for (i,j), d1 in self._d1s.items ():
+            out[i,j] = np.tensordot (d1.sum (0), h1, axes=2) + np.dot (self._d2s[(i,j)], h2) / 2
+            if i != j:
+                d1 = d1.transpose (0,2,1).conj ()
+                out[j,i] = np.tensordot (d1.sum (0), h1, axes=2) + np.dot (self._d2s[(i,j)].conj (), h2) / 2
+        return out
+
+    def make_rdm12s (self, si):
+        ''' Contract with the SI vectors (columns of si), returning the RDMs of the corresponding LASSI roots as the
+        diagonal of another SparseSTDM12s. Only one pair of states is unpacked at a time. '''
+        n = self.ncas
+        m = 2 * n * n
+        nroots_si = si.shape[1]
+        rdm12s = SparseSTDM12s (nroots_si, n, dtype=np.result_type (self.dtype, si.dtype))
+        rdm1s = np.zeros ((nroots_si, 2, n, n), dtype=rdm12s.dtype)
+        rdm2s = np.zeros ((nroots_si, m*(m+1)//2), dtype=rdm12s.dtype)
+        for (i,j), d1 in self._d1s.items ():
+            wgt = si[i].conj () * si[j]
+            if not np.any (wgt): continue
+            rdm1s += np.multiply.outer (wgt, d1)
+            if i == j:
+                rdm2s += np.multiply.outer (wgt, self._d2s[(i,j)])
+                continue
+            d1, d2 = self.get (j, i)
+            rdm1s += np.multiply.outer (wgt.conj (), d1)
+            d2 = lib.pack_tril (np.ascontiguousarray (d2).reshape (m, m))
+            rdm2s += np.multiply.outer (wgt, self._d2s[(i,j)]) + np.multiply.outer (wgt.conj (), d2)
+        for r in range (nroots_si):
+            rdm12s._d1s[(r,r)] = rdm1s[r]
+            rdm12s._d2s[(r,r)] = rdm2s[r]
+        return rdm12s
+
+    @property
+    def nbytes (self):
+        return sum ([d.nbytes for d in self._d1s.values ()]) + sum ([d.nbytes for d in self._d2s.values ()])
+
+    def todense (self, diag=False):
+        ''' Unpack to the dense arrays returned by make_stdm12s or, if diag, by roots_make_rdm12s '''
+        n, nroots = self.ncas, self.nroots
+        if diag:
+            d1s = np.zeros ((nroots, 2, n, n), dtype=self.dtype)
+            d2s = np.zeros ((nroots, 2, n, n, 2, n, n), dtype=self.dtype)
+            for i in range (nroots):
+                if (i,i) in self: d1s[i], d2s[i] = self.get (i, i)
+            return d1s, d2s
+        d1s = np.zeros ((nroots, nroots, 2, n, n), dtype=self.dtype).transpose (0,2,3,4,1)
+        d2s = np.zeros ((nroots, nroots, 2, n, n, 2, n, n), dtype=self.dtype).transpose (0,2,3,4,5,6,7,1)
+        for (i,j) in list (self._d1s.keys ()):
+            d1s[i,...,j], d2s[i,...,j] = self.get (i, j)
+            if i != j: d1s[j,...,i], d2s[j,...,i] = self.get (j, i)
+        return d1s, d2s
+
+def _stdm12s_block (las, ci_blk, idx, rootsym, orbsym, opt, o0_memcheck):
+    ''' STDMs among the states idx, packed into a SparseSTDM12s as they are produced (opt=1) or as soon as the
+    block is done (opt=0 or debug cross-check) '''
+    wfnsym = rootsym[-1]
+    t0 = (time.clock (), time.time ())
+    stdm12s = SparseSTDM12s (las.nroots, las.ncas, dtype=ci_blk[0][0].dtype)
+    if (las.verbose > lib.logger.INFO) and (o0_memcheck):
+        d1s, d2s = op_o0.make_stdm12s (las, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
+        t0 = lib.logger.timer (las, 'LASSI make_stdm12s rootsym {} CI algorithm'.format (rootsym), *t0)
+        d1s_test, d2s_test = op_o1.make_stdm12s (las, ci_blk, idx)
+        t0 = lib.logger.timer (las, 'LASSI make_stdm12s rootsym {} TDM algorithm'.format (rootsym), *t0)
+        lib.logger.debug (las, 'LASSI make_stdm12s rootsym {}: D1 o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (d1s_test - d1s))) 
+        lib.logger.debug (las, 'LASSI make_stdm12s rootsym {}: D2 o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (d2s_test - d2s))) 
+        errvec = np.concatenate ([(d1s-d1s_test).ravel (), (d2s-d2s_test).ravel ()])
+        if np.amax (np.abs (errvec)) > 1e-8:
+            raise RuntimeError (("Congratulations, you have found a bug in either lassi_op_o0 (I really hope not)"
+                " or lassi_op_o1 (much more likely)!\nPlease inspect the last few printed lines of logger output"
+                " for more information.\nError in make_stdm12s, max abs: {}; norm: {}").format (np.amax (np.abs (errvec)),
+                linalg.norm (errvec)))
+        if opt == 0:
+            d1s = d1s_test
+            d2s = d2s_test
+        stdm12s.set_block (idx, d1s, d2s)
+    elif opt == 0:
+        if (las.verbose > lib.logger.INFO): lib.logger.debug (las, 'Insufficient memory to test against o0 LASSI algorithm')
+        d1s, d2s = op_o0.make_stdm12s (las, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
+        stdm12s.set_block (idx, d1s, d2s)
+        t0 = lib.logger.timer (las, 'LASSI make_stdm12s rootsym {}'.format (rootsym), *t0)
+    else:
+        if (las.verbose > lib.logger.INFO): lib.logger.debug (las, 'Insufficient memory to test against o0 LASSI algorithm')
+        op_o1.make_stdm12s (las, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym, out=stdm12s)
+        t0 = lib.logger.timer (las, 'LASSI make_stdm12s rootsym {}'.format (rootsym), *t0)
+    return stdm12s
+
+def make_stdm12s (las, ci=None, orbsym=None, opt=1, nproc=None, dense=True):
     ''' Evaluate <I|p'q|J> and <I|p'r'sq|J> where |I>, |J> are LAS states.
 
         Args:
@@ -170,6 +564,9 @@ def make_stdm12s (las, ci=None, orbsym=None, opt=1):
             opt: Optimization level, i.e.,  take outer product of
                 0: CI vectors
                 1: TDMs
+                None: whichever is cheaper and fits in memory; see plan
+            nproc: Number of worker processes among which to distribute the symmetry blocks; see run_blocks
+            dense: If False, return a SparseSTDM12s object instead of the two arrays below
 
         Returns:
             stdm1s: ndarray of shape (nroots,2,ncas,ncas,nroots)
@@ -182,103 +579,169 @@ def make_stdm12s (las, ci=None, orbsym=None, opt=1):
             orbsym = las.label_symmetry_(las.mo_coeff).orbsym
         if orbsym is not None:
             orbsym = orbsym[las.ncore:las.ncore+las.ncas]
-    o0_memcheck = op_o0.memcheck (las, ci)
-    if opt == 0 and o0_memcheck == False:
-        raise RuntimeError ('Insufficient memory to use o0 LASSI algorithm')
-
     norb = las.ncas
     statesym = las_symm_tuple (las)[0]
-    stdm1s = np.zeros ((las.nroots, las.nroots, 2, norb, norb),
-        dtype=ci[0][0].dtype).transpose (0,2,3,4,1)
-    stdm2s = np.zeros ((las.nroots, las.nroots, 2, norb, norb, 2, norb, norb),
-        dtype=ci[0][0].dtype).transpose (0,2,3,4,5,6,7,1)
+    p = plan (las, task='stdm12s', opt=opt, statesym=statesym, nproc=nproc)
+    stdm12s = SparseSTDM12s (las.nroots, norb, dtype=ci[0][0].dtype)
 
+    blocks, rootsyms, idxs = [], [], []
     for rootsym in set (statesym):
         idx = np.all (np.array (statesym) == rootsym, axis=1)
-        wfnsym = rootsym[-1]
         ci_blk = [[c for c, ix in zip (cr, idx) if ix] for cr in ci]
-        t0 = (time.clock (), time.time ())
-        if (las.verbose > lib.logger.INFO) and (o0_memcheck):
-            d1s, d2s = op_o0.make_stdm12s (las, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
-            t0 = lib.logger.timer (las, 'LASSI make_stdm12s rootsym {} CI algorithm'.format (rootsym), *t0)
-            d1s_test, d2s_test = op_o1.make_stdm12s (las, ci_blk, idx)
-            t0 = lib.logger.timer (las, 'LASSI make_stdm12s rootsym {} TDM algorithm'.format (rootsym), *t0)
-            lib.logger.debug (las, 'LASSI make_stdm12s rootsym {}: D1 o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (d1s_test - d1s))) 
-            lib.logger.debug (las, 'LASSI make_stdm12s rootsym {}: D2 o0-o1 algorithm disagreement = {}'.format (rootsym, linalg.norm (d2s_test - d2s))) 
-            errvec = np.concatenate ([(d1s-d1s_test).ravel (), (d2s-d2s_test).ravel ()])
-            if np.amax (np.abs (errvec)) > 1e-8:
-                raise RuntimeError (("Congratulations, you have found a bug in either lassi_op_o0 (I really hope not)"
-                    " or lassi_op_o1 (much more likely)!\nPlease inspect the last few printed lines of logger output"
-                    " for more information.\nError in make_stdm12s, max abs: {}; norm: {}").format (np.amax (np.abs (errvec)),
-                    linalg.norm (errvec)))
-            if opt == 0:
-                d1s = d1s_test
-                d2s = d2s_test
-        else:
-            if (las.verbose > lib.logger.INFO): lib.logger.debug (las, 'Insufficient memory to test against o0 LASSI algorithm')
-            d1s, d2s = op[opt].make_stdm12s (las, ci_blk, idx, orbsym=orbsym, wfnsym=wfnsym)
-            t0 = lib.logger.timer (las, 'LASSI make_stdm12s rootsym {}'.format (rootsym), *t0)
-        idx_int = np.where (idx)[0]
-        for (i,a), (j,b) in product (enumerate (idx_int), repeat=2):
-            stdm1s[a,...,b] = d1s[i,...,j]
-            stdm2s[a,...,b] = d2s[i,...,j]
-    return stdm1s, stdm2s
-
-def roots_make_rdm12s (las, ci, si, orbsym=None, opt=1):
+        blocks.append ((las, ci_blk, idx, rootsym, orbsym, p[rootsym]['opt'], p[rootsym]['check']))
+        rootsyms.append (rootsym)
+        idxs.append (idx)
+    results = run_blocks (las, _stdm12s_block, blocks, rootsyms, [np.count_nonzero (idx) for idx in idxs], nproc=nproc,
+        mem=[p[rootsym]['peak'] for rootsym in rootsyms])
+    for stdm12s_blk in results:
+        stdm12s.update (stdm12s_blk)
+    if not dense: return stdm12s
+    return stdm12s.todense ()
+
+def _roots_rdm12s_block (las, ci_blk, idx_ci, si_blk, idx_si, sym, orbsym, opt, o0_memcheck, batch=None):
+    ''' RDMs of the roots idx_si, packed into (the diagonal of) a SparseSTDM12s '''
+    wfnsym = sym[-1]
+    t0 = (time.clock (), time.time ())
+    if (las.verbose > lib.logger.INFO) and (o0_memcheck):
+        d1s, d2s = op_o0.roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, orbsym=orbsym, wfnsym=wfnsym)
+        t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {} CI algorithm'.format (sym), *t0)
+        d1s_test, d2s_test = op_o1.roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, batch=batch)
+        t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {} TDM algorithm'.format (sym), *t0)
+        lib.logger.debug (las, 'LASSI make_rdm12s rootsym {}: D1 o0-o1 algorithm disagreement = {}'.format (sym, linalg.norm (d1s_test - d1s))) 
+        lib.logger.debug (las, 'LASSI make_rdm12s rootsym {}: D2 o0-o1 algorithm disagreement = {}'.format (sym, linalg.norm (d2s_test - d2s))) 
+        errvec = np.concatenate ([(d1s-d1s_test).ravel (), (d2s-d2s_test).ravel ()])
+        if np.amax (np.abs (errvec)) > 1e-8:
+            raise RuntimeError (("Congratulations, you have found a bug in either lassi_op_o0 (I really hope not)"
+                " or lassi_op_o1 (much more likely)!\nPlease inspect the last few printed lines of logger output"
+                " for more information.\nError in make_stdm12s, max abs: {}; norm: {}").format (np.amax (np.abs (errvec)),
+                linalg.norm (errvec)))
+        if opt == 0:
+            d1s = d1s_test
+            d2s = d2s_test
+    else:
+        if (las.verbose > lib.logger.INFO): lib.logger.debug (las, 'Insufficient memory to test against o0 LASSI algorithm')
+        d1s, d2s = op[opt].roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, orbsym=orbsym, wfnsym=wfnsym,
+            batch=batch)
+        t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {}'.format (sym), *t0)
+    rdm12s = SparseSTDM12s (las.nroots, las.ncas, dtype=ci_blk[0][0].dtype)
+    rdm12s.set_block (idx_si, d1s, d2s, diag=True)
+    return rdm12s
+
+def roots_make_rdm12s (las, ci, si, orbsym=None, opt=1, nproc=None, dense=True):
+    ''' Spin-separated 1- and 2-RDMs of the LASSI roots, of shape (nroots,2,ncas,ncas) and
+    (nroots,2,ncas,ncas,2,ncas,ncas), or, if not dense, packed into a SparseSTDM12s object (as its diagonal) '''
     if orbsym is None: 
         orbsym = getattr (las.mo_coeff, 'orbsym', None)
         if orbsym is None and callable (getattr (las, 'label_symmetry_', None)):
             orbsym = las.label_symmetry_(las.mo_coeff).orbsym
         if orbsym is not None:
             orbsym = orbsym[las.ncore:las.ncore+las.ncas]
-    o0_memcheck = op_o0.memcheck (las, ci)
-    if opt == 0 and o0_memcheck == False:
-        raise RuntimeError ('Insufficient memory to use o0 LASSI algorithm')
-
     # Symmetry tuple: neleca, nelecb, irrep
     norb = las.ncas
     statesym = las_symm_tuple (las)[0]
-    rdm1s = np.zeros ((las.nroots, 2, norb, norb),
-        dtype=ci[0][0].dtype)
-    rdm2s = np.zeros ((las.nroots, 2, norb, norb, 2, norb, norb),
-        dtype=ci[0][0].dtype)
+    p = plan (las, task='rdm12s', opt=opt, si=si, statesym=statesym, nproc=nproc)
+    rdm12s = SparseSTDM12s (las.nroots, norb, dtype=ci[0][0].dtype)
     rootsym = [(ne[0], ne[1], wfnsym) for ne, wfnsym in zip (si.nelec, si.wfnsym)]
 
+    blocks, syms = [], []
     for sym in set (statesym):
         idx_ci = np.all (np.array (statesym) == sym, axis=1)
         idx_si = np.all (np.array (rootsym)  == sym, axis=1)
-        wfnsym = sym[-1]
         ci_blk = [[c for c, ix in zip (cr, idx_ci) if ix] for cr in ci]
         si_blk = si[np.ix_(idx_ci,idx_si)]
-        t0 = (time.clock (), time.time ())
-        if (las.verbose > lib.logger.INFO) and (o0_memcheck):
-            d1s, d2s = op_o0.roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, orbsym=orbsym, wfnsym=wfnsym)
-            t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {} CI algorithm'.format (sym), *t0)
-            d1s_test, d2s_test = op_o1.roots_make_rdm12s (las, ci_blk, idx_ci, si_blk)
-            t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {} TDM algorithm'.format (sym), *t0)
-            lib.logger.debug (las, 'LASSI make_rdm12s rootsym {}: D1 o0-o1 algorithm disagreement = {}'.format (sym, linalg.norm (d1s_test - d1s))) 
-            lib.logger.debug (las, 'LASSI make_rdm12s rootsym {}: D2 o0-o1 algorithm disagreement = {}'.format (sym, linalg.norm (d2s_test - d2s))) 
-            errvec = np.concatenate ([(d1s-d1s_test).ravel (), (d2s-d2s_test).ravel ()])
-            if np.amax (np.abs (errvec)) > 1e-8:
-                raise RuntimeError (("Congratulations, you have found a bug in either lassi_op_o0 (I really hope not)"
-                    " or lassi_op_o1 (much more likely)!\nPlease inspect the last few printed lines of logger output"
-                    " for more information.\nError in make_stdm12s, max abs: {}; norm: {}").format (np.amax (np.abs (errvec)),
-                    linalg.norm (errvec)))
-            if opt == 0:
-                d1s = d1s_test
-                d2s = d2s_test
-        else:
-            if (las.verbose > lib.logger.INFO): lib.logger.debug (las, 'Insufficient memory to test against o0 LASSI algorithm')
-            d1s, d2s = op[opt].roots_make_rdm12s (las, ci_blk, idx_ci, si_blk, orbsym=orbsym, wfnsym=wfnsym)
-            t0 = lib.logger.timer (las, 'LASSI make_rdm12s rootsym {}'.format (sym), *t0)
-        idx_int = np.where (idx_si)[0]
-        for (i,a) in enumerate (idx_int):
-            rdm1s[a] = d1s[i]
-            rdm2s[a] = d2s[i]
-    return rdm1s, rdm2s
+        blocks.append ((las, ci_blk, idx_ci, si_blk, idx_si, sym, orbsym, p[sym]['opt'], p[sym]['check'],
+            p[sym]['batch']))
+        syms.append (sym)
+    results = run_blocks (las, _roots_rdm12s_block, blocks, syms, [len (b[3]) for b in blocks], nproc=nproc,
+        mem=[p[sym]['peak'] for sym in syms])
+    for rdm12s_blk in results:
+        rdm12s.update (rdm12s_blk)
+    if not dense: return rdm12s
+    return rdm12s.todense (diag=True)
+
+RDM_FORMS = ('rdm12s', 'rdm12', 'rdm1s', 'rdm1', 'natorb')
+
+def _roots_rdms_block (las, ci_blk, idx_ci, si_blk, sym, rdm2, spin_sum, batch, screen):
+    t0 = (time.clock (), time.time ())
+    dms = op_o1.roots_make_rdms (las, ci_blk, idx_ci, si_blk, rdm2=rdm2, spin_sum=spin_sum, batch=batch,
+        screen=screen)
+    lib.logger.timer (las, 'LASSI roots_make_rdms rootsym {}'.format (sym), *t0)
+    return dms
 
+def roots_make_rdms (las, ci, si, roots=None, form='rdm12s', nproc=None, screen=None):
+    ''' RDMs of a subset of the LASSI roots, computed directly from the SI vectors without building any STDMs.
+    Only the symmetry blocks of LAS states which contain the requested roots are visited, and nothing beyond
+    what the requested form needs (2-RDMs, spin components) is ever built.
 
+    Args:
+        las: LASCI or LASSCF instance
+        ci: list of list of ndarrays
+            CI vectors of the LAS states
+        si: ndarray of shape (nstates,nroots)
+            SI vectors, with the attributes nelec and wfnsym as returned by lassi
 
+    Kwargs:
+        roots: integer or list of integers
+            Indices of the requested LASSI roots; default is all of them. Negative indices count from the last
+            root, as in Python sequences; indices outside [-nroots,nroots) raise IndexError
+        form: string
+            One of
+            'rdm12s': spin-separated 1- and 2-RDMs, of shape (nr,2,ncas,ncas) and (nr,2,ncas,ncas,2,ncas,ncas)
+            'rdm12': spin-summed 1- and 2-RDMs, of shape (nr,ncas,ncas) and (nr,ncas,ncas,ncas,ncas)
+            'rdm1s': spin-separated 1-RDMs only
+            'rdm1': spin-summed 1-RDMs only
+            'natorb': natural-orbital occupancies, shape (nr,ncas), in descending order and the natural orbitals
+                in the basis of the active orbitals, shape (nr,ncas,ncas)
+        nproc: integer
+            Number of worker processes over which to distribute the symmetry blocks (see run_blocks)
+        screen: float
+            Pairs of LAS states whose weight |si[i,r] si[j,r]| in every requested root r is at or below this are
+            skipped. Defaults to lassi_op_o1.RDM_SCREEN
 
+    Returns:
+        Depending on form, a tuple (rdm1s, rdm2s), (rdm1, rdm2), or (occ, no), or a single ndarray rdm1s or rdm1.
+        The first dimension runs over the requested roots in the order given.
+    '''
+    if form not in RDM_FORMS:
+        raise RuntimeError ('LASSI RDM form must be one of {}; not {}'.format (RDM_FORMS, form))
+    nroots_si = si.shape[1]
+    if roots is None: roots = range (nroots_si)
+    roots = np.atleast_1d (np.asarray (roots, dtype=int))
+    if np.any ((roots < -nroots_si) | (roots >= nroots_si)):
+        raise IndexError ('LASSI roots must be in [{}, {}); not {}'.format (-nroots_si, nroots_si, roots))
+    roots[roots<0] += nroots_si
+    rdm2 = form in ('rdm12s', 'rdm12')
+    spin_sum = form in ('rdm12', 'rdm1', 'natorb')
 
+    # Symmetry tuple: neleca, nelecb, irrep
+    statesym = las_symm_tuple (las)[0]
+    rootsym = [(si.nelec[r][0], si.nelec[r][1], si.wfnsym[r]) for r in roots]
+    p = plan (las, task='rdm12s', opt=1, si=si, roots=roots, statesym=statesym, nproc=nproc)
+    blocks, syms, idxs = [], [], []
+    for sym in sorted (set (rootsym), key=str):
+        idx_ci = np.all (np.array (statesym) == sym, axis=1)
+        idx_r = [i for i, rsym in enumerate (rootsym) if rsym == sym]
+        ci_blk = [[c for c, ix in zip (cr, idx_ci) if ix] for cr in ci]
+        si_blk = si[np.ix_(idx_ci,roots[idx_r])]
+        blocks.append ((las, ci_blk, idx_ci, si_blk, sym, rdm2, spin_sum, p[sym]['batch'], screen))
+        syms.append (sym)
+        idxs.append (idx_r)
+    results = run_blocks (las, _roots_rdms_block, blocks, syms, [len (b[3]) for b in blocks], nproc=nproc,
+        mem=[p[sym]['peak'] for sym in syms])
+
+    norb = las.ncas
+    shape1 = [len (roots),] + ([] if spin_sum else [2,]) + [norb,norb]
+    rdm1s = np.zeros (shape1, dtype=si.dtype)
+    rdm2s = None
+    if rdm2:
+        shape2 = [len (roots),] + ([norb,]*4 if spin_sum else [2,norb,norb,2,norb,norb])
+        rdm2s = np.zeros (shape2, dtype=si.dtype)
+    for idx_r, (d1, d2) in zip (idxs, results):
+        rdm1s[idx_r] = d1
+        if rdm2: rdm2s[idx_r] = d2
+    if form == 'natorb':
+        occ, no = np.linalg.eigh (rdm1s)
+        return occ[:,::-1], no[:,:,::-1]
+    if rdm2: return rdm1s, rdm2s
+    return rdm1s
 
@@ -1,12 +1,17 @@
 import sys
+import functools
 import numpy as np
 from scipy import linalg
-from pyscf.fci import cistring
+from pyscf.fci import cistring, direct_spin1, selected_ci
 from pyscf import fci, lib
 from pyscf.fci.direct_spin1 import _unpack_nelec
 from pyscf.fci.spin_op import contract_ss
+from pyscf import __config__
 from itertools import combinations
 
+# Max number of distinct (norb_f, nelec_f) string maps kept by product_strs and addr_outer_product
+ADDR_CACHE_SIZE = getattr (__config__, 'mcscf_lassi_op_o0_addr_cache_size', 256)
+
 def memcheck (las, ci):
     nfrags = len (ci)
     nroots = len (ci[0])
@@ -20,21 +25,74 @@ def memcheck (las, ci):
         max_memory, las.max_memory))
     return mem < max_memory
 
-def addr_outer_product (norb_f, nelec_f):
-    norb = sum (norb_f)
-    nelec = sum (nelec_f)
-    # Must skip over cases where there are no electrons of a specific spin in a particular subspace
-    norbrange = np.cumsum (norb_f)
-    addrs = []
-    for i in range (0, len (norbrange)):
-        new_addrs = cistring.sub_addrs (norb, nelec, range (norbrange[i]-norb_f[i], norbrange[i]), nelec_f[i]) if nelec_f[i] else []
-        if len (addrs) == 0:
-            addrs = new_addrs
-        elif len (new_addrs) > 0:
-            addrs = np.intersect1d (addrs, new_addrs)
+def block_cost (las, nelec_frs, task='ham', nroots_si=0):
+    ''' Predicted memory and cost of this (CI vector outer product) algorithm for one symmetry block of LAS states
+
+        Args:
+            las: LASCI object
+            nelec_frs: ndarray of shape (nfrags,nroots,2)
+                Number of spin-up and spin-down electrons in each fragment and LAS state
+
+        Kwargs:
+            task: one of 'ham', 'stdm12s', or 'rdm12s'
+            nroots_si: number of SI vectors (task 'rdm12s' only)
+
+        Returns:
+            mem: float
+                MB needed regardless of nroots_si
+            mem_si: float
+                Additional MB needed per SI vector processed at once
+            flops: float
+                Rough floating-point operation count
+    '''
+    norb = las.ncas
+    nroots = nelec_frs.shape[1]
+    neleca, nelecb = nelec_frs[:,0,:].sum (0)
+    # Upper bound for 'ham' and 'rdm12s', which only span the strings of the product states
+    ndet = cistring.num_strings (norb, neleca) * cistring.num_strings (norb, nelecb)
+    ndm1, ndm2 = 2*norb*norb, 4*norb**4
+    ci_flops = ndet * norb**4 # one contract_2e or (trans_)rdm12s call
+    mem_si = 0
+    if task == 'ham':
+        mem = 3 * nroots * ndet + norb**4
+        flops = nroots * ci_flops + 3 * nroots * nroots * ndet
+    elif task == 'stdm12s':
+        mem = nroots * ndet + nroots * nroots * (ndm1 + ndm2)
+        flops = nroots * (nroots + 1) // 2 * ci_flops
+    else:
+        mem = nroots * ndet
+        mem_si = ndet + ndm1 + ndm2
+        flops = nroots_si * (ci_flops + nroots * ndet)
+    return 8 * mem / 1e6, 8 * mem_si / 1e6, float (flops)
+
+@functools.lru_cache (maxsize=ADDR_CACHE_SIZE)
+def _product_strs (norb_f, nelec_f):
+    strs = np.zeros (1, dtype=np.int64)
+    offs = 0
+    for norb, nelec in zip (norb_f, nelec_f):
+        fstrs = np.asarray (cistring.make_strings (range (norb), nelec), dtype=np.int64) << offs
+        # Later fragments occupy higher bits and are the more significant index of the outer product
+        strs = np.add.outer (fstrs, strs).ravel ()
+        offs += norb
+    strs.flags.writeable = False
+    return strs
+
+def product_strs (norb_f, nelec_f):
+    ''' Determinant strings of the whole active space spanned by products of fragment strings, in the order of the
+        rows (or columns) of the outer product of the fragment CI vectors, which is also ascending order. Cached. '''
+    return _product_strs (tuple (int (n) for n in norb_f), tuple (int (n) for n in nelec_f))
+
+@functools.lru_cache (maxsize=ADDR_CACHE_SIZE)
+def _addr_outer_product (norb_f, nelec_f):
+    addrs = cistring.strs2addr (sum (norb_f), sum (nelec_f), _product_strs (norb_f, nelec_f))
+    addrs.flags.writeable = False
     return addrs
 
-def _ci_outer_product (ci_f, norb_f, nelec_f):
+def addr_outer_product (norb_f, nelec_f):
+    ''' Addresses in the whole active space of the products of fragment strings (see product_strs). Cached. '''
+    return _addr_outer_product (tuple (int (n) for n in norb_f), tuple (int (n) for n in nelec_f))
+
+def _ci_outer_product_dp (ci_f, norb_f, nelec_f):
     # There may be an ambiguous factor of -1, but it should apply to the entire product CI vector so maybe it doesn't matter?
     neleca_f = [ne[0] for ne in nelec_f]
     nelecb_f = [ne[1] for ne in nelec_f]
@@ -45,11 +103,15 @@ def _ci_outer_product (ci_f, norb_f, nelec_f):
         ndeta, ndetb = ci_dp.shape
         ci_dp = np.multiply.outer (ci_dp, ci_r.reshape (ndet))
         ci_dp = ci_dp.transpose (0,2,1,3).reshape (ndeta*ndet[0], ndetb*ndet[1])
+    return ci_dp / linalg.norm (ci_dp), neleca_f, nelecb_f
+
+def _ci_outer_product (ci_f, norb_f, nelec_f):
+    ci_dp, neleca_f, nelecb_f = _ci_outer_product_dp (ci_f, norb_f, nelec_f)
     addrs_a = addr_outer_product (norb_f, neleca_f)
     addrs_b = addr_outer_product (norb_f, nelecb_f)
     ci = np.zeros ((cistring.num_strings (sum (norb_f), sum (neleca_f)), cistring.num_strings (sum (norb_f), sum (nelecb_f))),
         dtype=ci_dp.dtype)
-    ci[np.ix_(addrs_a,addrs_b)] = ci_dp[:,:] / linalg.norm (ci_dp)
+    ci[np.ix_(addrs_a,addrs_b)] = ci_dp[:,:]
     return ci
 
 def ci_outer_product (ci_fr, norb_f, nelec_fr):
@@ -62,19 +124,43 @@ def ci_outer_product (ci_fr, norb_f, nelec_fr):
              sum ([ne[1] for ne in nelec_f]))
     return ci_r, nelec
 
+def ci_outer_product_sparse (ci_fr, norb_f, nelec_fr):
+    ''' As ci_outer_product, but the product vectors are selected_ci.SCIvectors spanning only the union of the
+        spin-up and the union of the spin-down strings which occur in any of them, rather than the whole active
+        space. H and S**2 conserve neither set, but <I|H|J> = <I|PHP|J> for I, J inside the subspace. '''
+    ci_dp, strsa, strsb = [], [], []
+    for state in range (len (ci_fr[0])):
+        ci_f = [ci[state] for ci in ci_fr]
+        nelec_f = [nelec[state] for nelec in nelec_fr]
+        c, neleca_f, nelecb_f = _ci_outer_product_dp (ci_f, norb_f, nelec_f)
+        ci_dp.append (c)
+        strsa.append (product_strs (norb_f, neleca_f))
+        strsb.append (product_strs (norb_f, nelecb_f))
+    nelec = (sum ([ne[0] for ne in nelec_f]),
+             sum ([ne[1] for ne in nelec_f]))
+    ci_strs = (np.unique (np.concatenate (strsa)), np.unique (np.concatenate (strsb)))
+    ci_r = []
+    for c, sa, sb in zip (ci_dp, strsa, strsb):
+        ci = np.zeros ((len (ci_strs[0]), len (ci_strs[1])), dtype=c.dtype)
+        ci[np.ix_(np.searchsorted (ci_strs[0], sa), np.searchsorted (ci_strs[1], sb))] = c
+        ci_r.append (selected_ci._as_SCIvector (ci, ci_strs))
+    return ci_r, nelec
+
 def ham (las, h1, h2, ci_fr, idx_root, orbsym=None, wfnsym=None):
-    mol = las.mol
+    ''' Model-space Hamiltonian, S**2, and overlap matrices of a block of LAS states, evaluated with selected_ci
+        on the product-state determinant subspace (see ci_outer_product_sparse). orbsym and wfnsym are unused. '''
     norb_f = las.ncas_sub
     nelec_fr = [[_unpack_nelec (fcibox._get_nelec (solver, nelecas)) for solver, ix in zip (fcibox.fcisolvers, idx_root) if ix] for fcibox, nelecas in zip (las.fciboxes, las.nelecas_sub)]
-    ci, nelec = ci_outer_product (ci_fr, norb_f, nelec_fr)
-    solver = fci.solver (mol).set (orbsym=orbsym, wfnsym=wfnsym)
+    ci, nelec = ci_outer_product_sparse (ci_fr, norb_f, nelec_fr)
     norb = sum (norb_f)
-    h2eff = solver.absorb_h1e (h1, h2, norb, nelec, 0.5)
-    ham_ci = [solver.contract_2e (h2eff, c, norb, nelec) for c in ci]
-    s2_ci = [contract_ss (c, norb, nelec) for c in ci]
-    ham_eff = np.array ([[c.ravel ().dot (hc.ravel ()) for hc in ham_ci] for c in ci])
-    s2_eff = np.array ([[c.ravel ().dot (s2c.ravel ()) for s2c in s2_ci] for c in ci])
-    ovlp_eff = np.array ([[bra.ravel ().dot (ket.ravel ()) for ket in ci] for bra in ci])
+    h2eff = direct_spin1.absorb_h1e (h1, h2, norb, nelec, 0.5)
+    link_index = selected_ci._all_linkstr_index (ci[0]._strs, norb, nelec)
+    ham_ci = [selected_ci.contract_2e (h2eff, c, norb, nelec, link_index=link_index) for c in ci]
+    s2_ci = [selected_ci.contract_ss (c, norb, nelec) for c in ci]
+    ci = np.stack ([c.ravel () for c in ci], axis=0)
+    ham_eff = ci.conj () @ np.stack ([hc.ravel () for hc in ham_ci], axis=1)
+    s2_eff = ci.conj () @ np.stack ([s2c.ravel () for s2c in s2_ci], axis=1)
+    ovlp_eff = ci.conj () @ ci.T
     return ham_eff, s2_eff, ovlp_eff
 
 def make_stdm12s (las, ci_fr, idx_root, orbsym=None, wfnsym=None):
@@ -111,19 +197,26 @@ def make_stdm12s (las, ci_fr, idx_root, orbsym=None, wfnsym=None):
             stdm2s[j,p,:,:,q,:,:,i] = tdm2.transpose (1,0,3,2)
     return stdm1s, stdm2s 
 
-def roots_make_rdm12s (las, ci_fr, idx_root, si, orbsym=None, wfnsym=None):
-    mol = las.mol
+def roots_make_rdm12s (las, ci_fr, idx_root, si, orbsym=None, wfnsym=None, **kwargs):
+    ''' Spin-separated 1- and 2-RDMs of the LASSI roots (columns of si), evaluated with selected_ci on the
+        product-state determinant subspace (see ci_outer_product_sparse). orbsym and wfnsym are unused. '''
     norb_f = las.ncas_sub
     nelec_fr = [[_unpack_nelec (fcibox._get_nelec (solver, nelecas)) for solver, ix in zip (fcibox.fcisolvers, idx_root) if ix] for fcibox, nelecas in zip (las.fciboxes, las.nelecas_sub)]
-    ci_r, nelec = ci_outer_product (ci_fr, norb_f, nelec_fr)
+    ci_r, nelec = ci_outer_product_sparse (ci_fr, norb_f, nelec_fr)
     norb = sum (norb_f)
-    solver = fci.solver (mol).set (orbsym=orbsym, wfnsym=wfnsym)
-    nroots = len (ci_r)
+    strsa, strsb = ci_strs = ci_r[0]._strs
+    link_index = (selected_ci.cre_des_linkstr (strsa, norb, nelec[0]),
+                  selected_ci.des_des_linkstr (strsa, norb, nelec[0]),
+                  selected_ci.cre_des_linkstr (strsb, norb, nelec[1]),
+                  selected_ci.des_des_linkstr (strsb, norb, nelec[1]))
     ci_r = np.tensordot (si.conj ().T, np.stack (ci_r, axis=0), axes=1)
+    nroots = len (ci_r)
     rdm1s = np.zeros ((nroots, 2, norb, norb), dtype=ci_r.dtype)
     rdm2s = np.zeros ((nroots, 2, norb, norb, 2, norb, norb), dtype=ci_r.dtype)
     for ix, ci in enumerate (ci_r):
-        d1s, d2s = solver.make_rdm12s (ci, norb, nelec)
+        ci = selected_ci._as_SCIvector (np.ascontiguousarray (ci), ci_strs)
+        d1s = selected_ci.make_rdm1s (ci, norb, nelec, link_index=link_index)
+        d2s = selected_ci.make_rdm2s (ci, norb, nelec, link_index=link_index)
         rdm1s[ix,0,:,:] = d1s[0]
         rdm1s[ix,1,:,:] = d1s[1]
         rdm2s[ix,0,:,:,0,:,:] = d2s[0]
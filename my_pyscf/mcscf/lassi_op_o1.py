@@ -1,9 +1,24 @@
 import numpy as np
-from pyscf import lib, fci
+from pyscf import lib, fci, __config__
+from pyscf.fci import cistring
 from pyscf.fci.direct_spin1 import _unpack_nelec
 from pyscf.fci.addons import cre_a, cre_b, des_a, des_b
+from mrh.my_pyscf.fci.rdm import trans_rdm1s_batch, trans_rdm12s_batch
 from itertools import product, combinations
-import time
+from collections import OrderedDict
+from scipy import linalg
+import time, hashlib
+
+# If the 2-density and 1-particle 3-operator tables of a fragment's intermediates would take more than this fraction
+# of the memory available to it, they are moved to disk, and this fraction is the size of their working set in memory
+OUTCORE_MEMORY_FRAC = getattr (__config__, 'mcscf_lassi_op_o1_outcore_memory_frac', 0.5)
+
+# Fragment CI vectors of different LAS states closer than this (2-norm of the difference) share intermediates
+DEDUP_TOL = getattr (__config__, 'mcscf_lassi_op_o1_dedup_tol', 1e-12)
+
+# Pairs of LAS states whose weight |c_i c_j| in every requested LASSI root is at or below this are skipped when
+# computing root RDMs
+RDM_SCREEN = getattr (__config__, 'mcscf_lassi_op_o1_rdm_screen', 1e-14)
 
 def fermion_spin_shuffle (na_list, nb_list):
     ''' Compute the sign factor corresponding to the convention
@@ -126,11 +141,68 @@ def lst_hopping_index (fciboxes, nlas, nelelas, idx_root):
     onep_index = symm_index & (np.abs (hopping_index).sum ((0,1)) == 2)
     return hopping_index, zerop_index, onep_index
 
+class TDMTable (object):
+    ''' Table of single-fragment intermediates indexed by (bra, ket) pairs. Entries that have not been set are None.
+
+        If outcore, each entry is written to its own dataset (and therefore HDF5 chunk) of a temporary file, since the
+        _crunch_*_ functions of LSTDMint2 always read a whole (bra, ket) entry at once, and read back through a
+        least-recently-used working set of at most max_memory MB. '''
+
+    def __init__(self, outcore=False, max_memory=None):
+        self.outcore = outcore
+        self.max_memory = max_memory
+        self._data = {}
+        self._feri = lib.H5TmpFile () if outcore else None
+        self._lru = OrderedDict ()
+        self._lru_nbytes = 0
+        self.nbytes = 0
+
+    def __contains__(self, key):
+        return tuple (key) in self._data
+
+    def __getitem__(self, key):
+        key = tuple (key)
+        if not self.outcore: return self._data.get (key, None)
+        if key not in self._data: return None
+        if key in self._lru:
+            self._lru.move_to_end (key)
+            return self._lru[key]
+        x = self._feri[self._data[key]][()]
+        self._lru_add (key, x)
+        return x
+
+    def __setitem__(self, key, x):
+        key = tuple (key)
+        x = np.ascontiguousarray (x)
+        if key in self._data: self.nbytes -= self[key].nbytes
+        self.nbytes += x.nbytes
+        if not self.outcore:
+            self._data[key] = x
+            return
+        name = '{}_{}'.format (*key)
+        if name in self._feri: del self._feri[name]
+        self._feri[name] = x
+        self._data[key] = name
+        if key in self._lru:
+            self._lru_nbytes -= self._lru.pop (key).nbytes
+        self._lru_add (key, x)
+
+    def _lru_add (self, key, x):
+        self._lru[key] = x
+        self._lru_nbytes += x.nbytes
+        max_nbytes = (self.max_memory or 0) * 1e6
+        while len (self._lru) > 1 and self._lru_nbytes > max_nbytes:
+            self._lru_nbytes -= self._lru.popitem (last=False)[1].nbytes
+
 class LSTDMint1 (object):
     ''' Quasi-sparse-memory storage for LAS-state transition density matrix 
-        single-fragment intermediates. '''
+        single-fragment intermediates. The 2-density and 1-particle 3-operator intermediates, which dominate, are
+        kept in TDMTables, on disk if outcore.
+
+        The intermediates are computed and stored (set_*) only among the unique fragment states (see dedup), and
+        looked up (get_*) by LAS state through the index table uroot. '''
 
-    def __init__(self, fcibox, norb, nelec, nroots, idx_root, dtype=np.float64):
+    def __init__(self, fcibox, norb, nelec, nroots, idx_root, dtype=np.float64, outcore=False, max_memory=None):
         # I'm not sure I need linkstrl
         self.linkstrl = fcibox.states_gen_linkstr (norb, nelec, tril=True)
         self.linkstr = fcibox.states_gen_linkstr (norb, nelec, tril=False)
@@ -142,16 +214,20 @@ class LSTDMint1 (object):
         self.nroots = nroots
         self.ovlp = np.zeros ((nroots, nroots), dtype=dtype)
         self.nelec_r = [_unpack_nelec (fcibox._get_nelec (solver, nelec)) for solver in self.fcisolvers]
+        self.uroot = np.arange (nroots)
         self._h = [[[None for i in range (nroots)] for j in range (nroots)] for s in (0,1)]
         self._hh = [[[None for i in range (nroots)] for j in range (nroots)] for s in (-1,0,1)] 
-        self._phh = [[[None for i in range (nroots)] for j in range (nroots)] for s in (0,1)]
+        self.max_memory = max_memory
+        if max_memory is not None: max_memory = max_memory / 3
+        self._phh = [TDMTable (outcore=outcore, max_memory=max_memory) for s in (0,1)]
         self._sm = [[None for i in range (nroots)] for j in range (nroots)]
         self.dm1 = [[None for i in range (nroots)] for j in range (nroots)]
-        self.dm2 = [[None for i in range (nroots)] for j in range (nroots)]
+        self.dm2 = TDMTable (outcore=outcore, max_memory=max_memory)
 
     # 1-particle 1-operator intermediate
 
     def get_h (self, i, j, s):
+        i, j = self.uroot[i], self.uroot[j]
         return self._h[s][i][j]
 
     def set_h (self, i, j, s, x):
@@ -159,11 +235,13 @@ class LSTDMint1 (object):
         return x
 
     def get_p (self, i, j, s):
+        i, j = self.uroot[i], self.uroot[j]
         return self._h[s][j][i].conj ()
 
     # 2-particle intermediate
 
     def get_hh (self, i, j, s):
+        i, j = self.uroot[i], self.uroot[j]
         return self._hh[s][i][j]
 
     def set_hh (self, i, j, s, x):
@@ -171,23 +249,27 @@ class LSTDMint1 (object):
         return x
 
     def get_pp (self, i, j, s):
+        i, j = self.uroot[i], self.uroot[j]
         return self._hh[s][j][i].conj ().T
 
     # 1-particle 3-operator intermediate
 
     def get_phh (self, i, j, s):
-        return self._phh[s][i][j]
+        i, j = self.uroot[i], self.uroot[j]
+        return self._phh[s][i,j]
 
     def set_phh (self, i, j, s, x):
-        self._phh[s][i][j] = x
+        self._phh[s][i,j] = x
         return x
 
     def get_pph (self, i, j, s):
-        return self._phh[s][j][i].conj ().transpose (0,3,2,1)
+        i, j = self.uroot[i], self.uroot[j]
+        return self._phh[s][j,i].conj ().transpose (0,3,2,1)
 
     # spin-hop intermediate
 
     def get_sm (self, i, j):
+        i, j = self.uroot[i], self.uroot[j]
         return self._sm[i][j]
 
     def set_sm (self, i, j, x):
@@ -195,11 +277,13 @@ class LSTDMint1 (object):
         return x
 
     def get_sp (self, i, j):
+        i, j = self.uroot[i], self.uroot[j]
         return self._sm[j][i].conj ().T
 
     # 1-density intermediate
 
     def get_dm1 (self, i, j):
+        i, j = self.uroot[i], self.uroot[j]
         if j > i:
             return self.dm1[j][i].conj ().transpose (0, 2, 1)
         return self.dm1[i][j]
@@ -213,17 +297,55 @@ class LSTDMint1 (object):
     # 2-density intermediate
 
     def get_dm2 (self, i, j):
-        k, l = max (i, j), min (i, j)
-        return self.dm2[k][l]
+        i, j = self.uroot[i], self.uroot[j]
+        if j > i:
+            return self.dm2[j,i].conj ().transpose (0, 2, 1, 4, 3)
+        return self.dm2[i,j]
 
     def set_dm2 (self, i, j, x):
         if j > i:
-            self.dm2[j][i] = x.conj ().transpose (0, 2, 1, 4, 3)
+            self.dm2[j,i] = x.conj ().transpose (0, 2, 1, 4, 3)
         else:
-            self.dm2[i][j] = x
+            self.dm2[i,j] = x
+
+    @property
+    def nbytes_tables (self):
+        ''' Size of the 2-density and 1-particle 3-operator tables, in memory or on disk '''
+        return self.dm2.nbytes + sum ([t.nbytes for t in self._phh])
+
+    def dedup (self, ci):
+        ''' Identify the fragment states which are the same CI vector, first by hash and then, among those with the
+        same electron numbers and unit overlap, to within DEDUP_TOL, so that the intermediates can be computed
+        among the unique ones only. Requires the overlap matrix.
+
+        Returns:
+            uroot: ndarray of shape (nroots,)
+                Index of each fragment state among the unique ones
+            uniq: list of length nuniq
+                Representative fragment state of each unique one
+        '''
+        uroot = np.zeros (self.nroots, dtype=int)
+        uniq, hashes = [], {}
+        for i in range (self.nroots):
+            c = np.ascontiguousarray (ci[i])
+            key = (self.nelec_r[i], c.shape, c.dtype.str, hashlib.sha1 (c.tobytes ()).hexdigest ())
+            if key in hashes:
+                uroot[i] = hashes[key]
+                continue
+            uroot[i] = len (uniq)
+            for u, j in enumerate (uniq):
+                if self.nelec_r[i] != self.nelec_r[j]: continue
+                if type (self.fcisolvers[i]) is not type (self.fcisolvers[j]): continue
+                if abs (self.ovlp[i,j] - self.ovlp[j,j]) > 1e-8 or abs (self.ovlp[i,i] - self.ovlp[j,j]) > 1e-8: continue
+                if linalg.norm (c - ci[j]) <= DEDUP_TOL:
+                    uroot[i] = u
+                    break
+            if uroot[i] == len (uniq): uniq.append (i)
+            hashes[key] = uroot[i]
+        return uroot, uniq
 
     def kernel (self, ci, hopping_index, zerop_index, onep_index):
-        nroots, norb = self.nroots, self.norb
+        norb = self.norb
         t0 = (time.clock (), time.time ())
 
         # Overlap matrix
@@ -234,17 +356,40 @@ class LSTDMint1 (object):
         for i in range (self.nroots):
             self.ovlp[i,i] = ci[i].conj ().ravel ().dot (ci[i].ravel ())
 
-        # Spectator fragment contribution
+        # Everything else only among unique fragment states. Pairs of them need whatever any of the pairs of
+        # LAS states they stand for need.
+        self.uroot, uniq = self.dedup (ci)
+        nroots = len (uniq)
+        ci = [ci[i] for i in uniq]
+        fcisolvers = [self.fcisolvers[i] for i in uniq]
+        linkstrs = [self.linkstr[i] for i in uniq]
+        nelec_r = [self.nelec_r[i] for i in uniq]
+        hopping_index = hopping_index[:,uniq,:][:,:,uniq]
+        uidx = (self.uroot[:,None], self.uroot[None,:])
+        zerop_u = np.zeros ((nroots, nroots), dtype=bool)
+        np.logical_or.at (zerop_u, uidx, zerop_index)
+        zerop_index = zerop_u | zerop_u.T
+        onep_u = np.zeros ((nroots, nroots), dtype=bool)
+        np.logical_or.at (onep_u, uidx, onep_index)
+        onep_index = onep_u
+
+        # Spectator fragment contribution, batched over all fragment states with the same electron numbers
         spectator_index = np.all (hopping_index == 0, axis=0)
-        spectator_index[np.triu_indices (self.nroots, k=1)] = False
-        spectator_index = np.stack (np.where (spectator_index), axis=1)
-        for i, j in spectator_index:
-            solver = self.fcisolvers[j]
-            linkstr = self.linkstr[j]
-            nelec = self.nelec_r[j]
-            dm1s, dm2s = solver.trans_rdm12s (ci[i], ci[j], norb, nelec, link_index=linkstr) 
-            self.set_dm1 (i, j, np.stack (dm1s, axis=0).transpose (0,2,1)) # Based on docstring of direct_spin1.trans_rdm12s
-            if zerop_index[i,j]: self.set_dm2 (i, j, dm2s)
+        spectator_index[np.triu_indices (nroots, k=1)] = False
+        for nelec in sorted (set (nelec_r)):
+            idx = [i for i in range (nroots) if nelec_r[i] == nelec]
+            ci_idx = [ci[i] for i in idx]
+            linkstr = linkstrs[idx[0]]
+            if np.any ((spectator_index & zerop_index)[np.ix_(idx,idx)]):
+                dm1s, dm2s = trans_rdm12s_batch (ci_idx, None, norb, nelec, link_index=linkstr,
+                    max_memory=self.max_memory)
+            else:
+                dm1s, dm2s = trans_rdm1s_batch (ci_idx, ci_idx, norb, nelec, link_index=linkstr), None
+            for (a, i), (b, j) in product (enumerate (idx), repeat=2):
+                if not spectator_index[i,j]: continue
+                # Based on docstring of direct_spin1.trans_rdm12s
+                self.set_dm1 (i, j, np.stack ([dm1s[0][a,b], dm1s[1][a,b]], axis=0).transpose (0,2,1))
+                if zerop_index[i,j]: self.set_dm2 (i, j, np.stack ([dm2[a,b] for dm2 in dm2s], axis=0))
 
         # Cache some b_p|i> beforehand for the sake of the spin-flip intermediate 
         hidx_ket_a = np.where (np.any (hopping_index[0] < 0, axis=0))[0]
@@ -252,11 +397,11 @@ class LSTDMint1 (object):
         bpvec_list = [None for ket in range (nroots)]
         for ket in hidx_ket_b:
             if np.any (np.all (hopping_index[:,:,ket] == np.array ([1,-1])[:,None], axis=0)):
-                bpvec_list[ket] = np.stack ([des_b (ci[ket], norb, self.nelec_r[ket], p) for p in range (norb)], axis=0)
+                bpvec_list[ket] = np.stack ([des_b (ci[ket], norb, nelec_r[ket], p) for p in range (norb)], axis=0)
 
         # a_p|i>
         for ket in hidx_ket_a:
-            nelec = self.nelec_r[ket]
+            nelec = nelec_r[ket]
             apket = np.stack ([des_a (ci[ket], norb, nelec, p) for p in range (norb)], axis=0)
             nelec = (nelec[0]-1, nelec[1])
             for bra in np.where (hopping_index[0,:,ket] < 0)[0]:
@@ -266,11 +411,9 @@ class LSTDMint1 (object):
                     self.set_h (bra, ket, 0, bravec.dot (apket.reshape (norb,-1).T))
                     # <j|a'_q a_r a_p|i>, <j|b'_q b_r a_p|i> - how do I tell if I have a consistent sign rule...?
                     if onep_index[bra,ket]:
-                        solver = self.fcisolvers[bra]
-                        linkstr = self.linkstr[bra]
-                        phh = np.stack ([solver.trans_rdm12s (ketmat, ci[bra], norb,
-                            self.nelec_r[bra], link_index=linkstr)[0] for ketmat in apket],
-                            axis=-1)# Arg order switched based on docstring of direct_spin1.trans_rdm12s
+                        phh = np.stack (trans_rdm1s_batch (apket, ci[bra], norb, nelec_r[bra],
+                            link_index=linkstrs[bra]), axis=0)[:,:,0].transpose (0,2,3,1)
+                        # ^ Arg order switched based on docstring of direct_spin1.trans_rdm12s
                         err = np.abs (phh[0] + phh[0].transpose (0,2,1))
                         assert (np.amax (err) < 1e-8), '{}'.format (np.amax (err)) 
                         # ^ Passing this assert proves that I have the correct index
@@ -296,7 +439,7 @@ class LSTDMint1 (object):
                 
         # b_p|i>
         for ket in hidx_ket_b:
-            nelec = self.nelec_r[ket]
+            nelec = nelec_r[ket]
             bpket = np.stack ([des_b (ci[ket], norb, nelec, p)
                 for p in range (norb)], axis=0) if bpvec_list[ket] is None else bpvec_list[ket]
             nelec = (nelec[0], nelec[1]-1)
@@ -307,11 +450,9 @@ class LSTDMint1 (object):
                     self.set_h (bra, ket, 1, bravec.dot (bpket.reshape (norb,-1).T))
                     # <j|a'_q a_r b_p|i>, <j|b'_q b_r b_p|i> - how do I tell if I have a consistent sign rule...?
                     if onep_index[bra,ket]:
-                        solver = self.fcisolvers[bra]
-                        linkstr = self.linkstr[bra]
-                        phh = np.stack ([solver.trans_rdm12s (ketmat, ci[bra], norb,
-                            self.nelec_r[bra], link_index=linkstr)[0] for ketmat in bpket],
-                            axis=-1) # Arg order switched based on docstring of direct_spin1.trans_rdm12s
+                        phh = np.stack (trans_rdm1s_batch (bpket, ci[bra], norb, nelec_r[bra],
+                            link_index=linkstrs[bra]), axis=0)[:,:,0].transpose (0,2,3,1)
+                        # ^ Arg order switched based on docstring of direct_spin1.trans_rdm12s
                         err = np.abs (phh[1] + phh[1].transpose (0,2,1))
                         assert (np.amax (err) < 1e-8), '{}'.format (np.amax (err))
                         # ^ Passing this assert proves that I have the correct index
@@ -473,17 +614,20 @@ class LSTDMint2 (object):
         s21l = s1       # aa: 0 OR ab: 1
         s21h = s21l + 2 # ba: 2 OR bb: 3
         s1s1 = s1 * 3   # aa: 0 OR bb: 3
-        def _crunch_1c_tdm2 (d2_ijkk, i0, i1, j0, j1, k0, k1):
+        def _crunch_1c_tdm2 (d2_ijkk, i0, i1, j0, j1, k0, k1, exchange=True):
             d2[(s12l,s12h), i0:i1, j0:j1, k0:k1, k0:k1] = d2_ijkk
             d2[(s21l,s21h), k0:k1, k0:k1, i0:i1, j0:j1] = d2_ijkk.transpose (0,3,4,1,2)
+            if not exchange: return
             d2[s1s1, i0:i1, k0:k1, k0:k1, j0:j1] = -d2_ijkk[s1,...].transpose (0,3,2,1)
             d2[s1s1, k0:k1, j0:j1, i0:i1, k0:k1] = -d2_ijkk[s1,...].transpose (2,1,0,3)
+        # If k is i or j, the exchange blocks are the same as the direct ones (the pph and phh tables are
+        # antisymmetric), so each element is only assigned once; see _SpinSumD2
         # pph (transpose is from Dirac order to Mulliken order)
         d2_ijii = fac * np.multiply.outer (self.ints[i].get_pph (bra, ket, s1), self.ints[j].get_h (bra, ket, s1)).transpose (0,1,4,2,3)
-        _crunch_1c_tdm2 (d2_ijii, p, q, r, s, p, q)
+        _crunch_1c_tdm2 (d2_ijii, p, q, r, s, p, q, exchange=False)
         # phh (transpose is to bring spin onto the outside and then from Dirac order to Mulliken order)
         d2_ijjj = fac * np.multiply.outer (self.ints[i].get_p (bra, ket, s1), self.ints[j].get_phh (bra, ket, s1)).transpose (1,0,4,2,3)
-        _crunch_1c_tdm2 (d2_ijjj, p, q, r, s, r, s)
+        _crunch_1c_tdm2 (d2_ijjj, p, q, r, s, r, s, exchange=False)
         # spectator fragment mean-field (should automatically be in Mulliken order)
         for k in range (self.nfrags):
             if k in (i, j): continue
@@ -554,8 +698,9 @@ class LSTDMint2 (object):
         t, u = self.get_range (k) 
         v, w = self.get_range (l)
         d2[s2, p:q,r:s,t:u,v:w] = d2_ijkl
-        d2[s2T,t:u,v:w,p:q,r:s] = d2_ijkl.transpose (2,3,0,1)
-        if s2 == s2T: # same-spin only: exchange happens
+        if s2 == s2T and i == k and j == l: pass # the e1 <-> e2 permutation is the same block
+        else: d2[s2T,t:u,v:w,p:q,r:s] = d2_ijkl.transpose (2,3,0,1)
+        if s2 == s2T and i != k and j != l: # same-spin only: exchange happens (unless it's the same block)
             d2[s2,p:q,v:w,t:u,r:s] = -d2_ijkl.transpose (0,3,2,1)
             d2[s2,t:u,r:s,p:q,v:w] = -d2_ijkl.transpose (2,1,0,3)
         self._put_D2_(bra, ket, d2)
@@ -622,15 +767,68 @@ class HamS2ovlpint (LSTDMint2):
         ovlp *= np.multiply.outer (self.spin_shuffle, self.spin_shuffle)
         return self.ham, self.s2, ovlp, t0
 
+class SparseSTDMint (LSTDMint2):
+    ''' For packing the LAS-state tdm12s of each pair of states into a block-sparse container (lassi.SparseSTDM12s)
+        as soon as they are crunched, without ever storing the whole stdm12s arrays '''
+
+    def __init__(self, ints, nlas, hopping_index, out, idx_root, dtype=np.float64):
+        LSTDMint2.__init__(self, ints, nlas, hopping_index, dtype=dtype)
+        self.out = out
+        self.idx_root = idx_root
+
+    def _get_D1_(self, bra, ket):
+        self.d1[:] = 0.0
+        return self.d1
+
+    def _get_D2_(self, bra, ket):
+        self.d2[:] = 0.0
+        return self.d2
+
+    def _put_D1_(self, bra, ket, D1):
+        self.out.add_pair (self.idx_root[bra], self.idx_root[ket], d1s=D1)
+
+    def _put_D2_(self, bra, ket, D2):
+        n = self.norb
+        D2 = D2.reshape (2, 2, n, n, n, n).transpose (0,2,3,1,4,5)
+        self.out.add_pair (self.idx_root[bra], self.idx_root[ket], d2s=D2)
+
+    def _add_transpose_(self):
+        pass # the container stores each pair of states once and transposes on demand
+
+    def kernel (self):
+        t0 = (time.clock (), time.time ())
+        self.d1 = np.zeros ([2,]+[self.norb,]*2, dtype=self.dtype)
+        self.d2 = np.zeros ([4,]+[self.norb,]*4, dtype=self.dtype)
+        self._crunch_all_()
+        return self.out, t0
+
+class _SpinSumD2 (object):
+    ''' Stand-in for the spin-separated (4,norb,norb,norb,norb) D2 buffer of the LSTDMint2 crunchers, which only
+    ever assign to it. Each assigned block is summed over spin and added to the spin-summed d2 instead. '''
+    def __init__(self, d2):
+        self.d2 = d2
+
+    def __setitem__(self, key, x):
+        if not isinstance (key[0], (int, np.integer)): x = x.sum (0)
+        self.d2[key[1:]] += x
+
 class LRRDMint (LSTDMint2):
-    ''' For computing RDMs of LASSI roots without cacheing the whole damn STDM12s array '''
+    ''' For computing RDMs of LASSI roots without cacheing the whole damn STDM12s array
+
+        The SI vectors are folded in before the second pass: pairs of LAS states whose weight in every requested
+        root is at or below screen are never crunched, the 2-body parts are never built if rdm2=False, and with
+        spin_sum=True the 2-body densities are accumulated directly in spin-summed form. '''
     # TODO: at some point, if it ever becomes rate-limiting, make this multithread better
 
-    def __init__(self, ints, nlas, hopping_index, si, dtype=np.float64):
+    def __init__(self, ints, nlas, hopping_index, si, dtype=np.float64, rdm2=True, spin_sum=False,
+            screen=RDM_SCREEN):
         LSTDMint2.__init__(self, ints, nlas, hopping_index, dtype=dtype)
         self.nroots_si = si.shape[-1]
         self.si_dm = np.stack ([np.dot (si[:,i:i+1],si[:,i:i+1].conj ().T)
             for i in range (self.nroots_si)], axis=-1)
+        self.rdm2 = rdm2
+        self.spin_sum = spin_sum
+        self.screen = screen
 
     def _get_D1_(self, bra, ket):
         self.d1[:] = 0.0
@@ -638,44 +836,156 @@ class LRRDMint (LSTDMint2):
 
     def _get_D2_(self, bra, ket):
         self.d2[:] = 0.0
+        if self.spin_sum: return _SpinSumD2 (self.d2)
         return self.d2
 
     def _put_D1_(self, bra, ket, D1):
+        if self.spin_sum: D1 = D1.sum (0)
         self.rdm1s[:] += np.multiply.outer (self.si_dm[bra,ket,:], D1)
 
     def _put_D2_(self, bra, ket, D2):
+        if self.spin_sum: D2 = D2.d2
         self.rdm2s[:] += np.multiply.outer (self.si_dm[bra,ket,:], D2)
 
+    def _crunch_null_(self, bra, ket):
+        if self.rdm2: return LSTDMint2._crunch_null_(self, bra, ket)
+        d1 = self._get_D1_(bra, ket)
+        for i, inti in enumerate (self.ints):
+            p, q = self.get_range (i)
+            d1[:,p:q,p:q] = self.get_ovlp_fac (bra, ket, i) * np.asarray (inti.get_dm1 (bra, ket))
+        self._put_D1_(bra, ket, d1)
+
+    def _crunch_1c_(self, bra, ket, i, j, s1):
+        if self.rdm2: return LSTDMint2._crunch_1c_(self, bra, ket, i, j, s1)
+        d1 = self._get_D1_(bra, ket)
+        p, q = self.get_range (i)
+        r, s = self.get_range (j)
+        fac = self.get_ovlp_fac (bra, ket, i, j)
+        fac *= fermion_des_shuffle (self.nelec_rf[bra], (i, j), i)
+        fac *= fermion_des_shuffle (self.nelec_rf[ket], (i, j), j)
+        d1[s1,p:q,r:s] = fac * np.multiply.outer (self.ints[i].get_p (bra, ket, s1), self.ints[j].get_h (bra, ket, s1))
+        self._put_D1_(bra, ket, d1)
+
+    def _crunch_all_(self):
+        wgt = np.amax (np.abs (self.si_dm), axis=-1) > self.screen
+        rows = lambda exc: [row for row in exc if wgt[row[0],row[1]]]
+        for row in rows (self.exc_null): self._crunch_null_(*row)
+        for row in rows (self.exc_1c): self._crunch_1c_(*row)
+        if self.rdm2:
+            for row in rows (self.exc_1s): self._crunch_1s_(*row)
+            for row in rows (self.exc_1s1c): self._crunch_1s1c_(*row)
+            for row in rows (self.exc_2c): self._crunch_2c_(*row)
+        self._add_transpose_()
+        for state in range (self.nroots):
+            if wgt[state,state]: self._crunch_null_(state, state)
+
     def _add_transpose_(self):
-        self.rdm1s += self.rdm1s.conj ().transpose (0,1,3,2)
-        self.rdm2s += self.rdm2s.conj ().transpose (0,1,3,2,5,4)
+        if self.spin_sum:
+            self.rdm1s += self.rdm1s.conj ().transpose (0,2,1)
+            if self.rdm2: self.rdm2s += self.rdm2s.conj ().transpose (0,2,1,4,3)
+        else:
+            self.rdm1s += self.rdm1s.conj ().transpose (0,1,3,2)
+            if self.rdm2: self.rdm2s += self.rdm2s.conj ().transpose (0,1,3,2,5,4)
 
     def kernel (self):
         t0 = (time.clock (), time.time ())
         self.d1 = np.zeros ([2,]+[self.norb,]*2, dtype=self.dtype)
-        self.d2 = np.zeros ([4,]+[self.norb,]*4, dtype=self.dtype)
-        self.rdm1s = np.zeros ([self.nroots_si,] + list (self.d1.shape), dtype=self.dtype)
-        self.rdm2s = np.zeros ([self.nroots_si,] + list (self.d2.shape), dtype=self.dtype)
+        shape2 = [self.norb,]*4 if self.spin_sum else [4,]+[self.norb,]*4
+        self.d2 = np.zeros (shape2, dtype=self.dtype) if self.rdm2 else None
+        shape1 = list (self.d1.shape[1:]) if self.spin_sum else list (self.d1.shape)
+        self.rdm1s = np.zeros ([self.nroots_si,] + shape1, dtype=self.dtype)
+        self.rdm2s = None
+        if self.rdm2:
+            self.rdm2s = np.zeros ([self.nroots_si,] + shape2, dtype=self.dtype)
         self._crunch_all_()
         return self.rdm1s, self.rdm2s, t0
 
 
-def make_ints (las, ci, idx_root):
+# roots_make_rdm12s can process the SI vectors in batches; see lassi.plan
+BATCH_SI = True
+
+def block_cost (las, nelec_frs, task='ham', nroots_si=0):
+    ''' Predicted memory and cost of this (TDM outer product) algorithm for one symmetry block of LAS states
+
+        Args:
+            las: LASCI object
+            nelec_frs: ndarray of shape (nfrags,nroots,2)
+                Number of spin-up and spin-down electrons in each fragment and LAS state
+
+        Kwargs:
+            task: one of 'ham', 'stdm12s', or 'rdm12s'
+            nroots_si: number of SI vectors (task 'rdm12s' only)
+
+        Returns:
+            mem: float
+                MB needed regardless of nroots_si
+            mem_si: float
+                Additional MB needed per SI vector processed at once
+            flops: float
+                Rough floating-point operation count
+    '''
+    nroots = nelec_frs.shape[1]
+    npair = nroots * nroots
+    ncas = las.ncas
+    nfrags = len (las.ncas_sub)
+    mem = flops = 0
+    for no, nelec_rs in zip (las.ncas_sub, nelec_frs):
+        ndet = max ([cistring.num_strings (no, na) * cistring.num_strings (no, nb) for na, nb in nelec_rs])
+        # dm1, h, hh, and sm for every pair of states, plus the dm2 and phh tables, which go to disk (see make_ints)
+        # if they are too big
+        mem += npair * (2*no*no + 2*no + 3*no*no + no*no)
+        mem += min (tables_memory (no, nroots), OUTCORE_MEMORY_FRAC * las.max_memory / nfrags) * 1e6 / 8
+        flops += npair * ndet * no**4
+    ndm1, ndm2 = 2*ncas*ncas, 4*ncas**4
+    mem += ndm1 + ndm2
+    mem_si = 0
+    if task == 'ham':
+        mem += 3 * npair
+        flops += npair * ncas**4
+    elif task == 'stdm12s':
+        # packed as they are crunched (see SparseSTDMint): pairs i <= j, two-body part as a lower triangle
+        npack = (npair + nroots) // 2
+        mem += npack * (ndm1 + (ndm2 + ndm1) // 2)
+        flops += npair * (ndm1 + ndm2)
+    else:
+        mem_si = npair + ndm1 + ndm2
+        flops += npair * nroots_si * (ndm1 + ndm2)
+    return 8 * mem / 1e6, 8 * mem_si / 1e6, float (flops)
+
+def tables_memory (norb, nroots):
+    ''' Upper bound (MB) on the size of the 2-density and 1-particle 3-operator tables of LSTDMint1 '''
+    return 8 * nroots * nroots * (4*norb**4 + 2*norb**3) / 1e6
+
+def make_ints (las, ci, idx_root, outcore=None):
+    ''' Single-fragment intermediates. If outcore is None, the tables of each fragment go to disk if they would take
+    more than OUTCORE_MEMORY_FRAC of its share of the available memory. '''
     fciboxes = las.fciboxes
     nfrags = len (fciboxes)
     nroots = idx_root.size
     nlas = las.ncas_sub
     nelelas = [sum (_unpack_nelec (ne)) for ne in las.nelecas_sub]
     hopping_index, zerop_index, onep_index = lst_hopping_index (fciboxes, nlas, nelelas, idx_root)
+    max_memory = OUTCORE_MEMORY_FRAC * (las.max_memory - lib.current_memory ()[0]) / nfrags
     ints = []
     for ifrag in range (nfrags):
-        tdmint = LSTDMint1 (fciboxes[ifrag], nlas[ifrag], nelelas[ifrag], nroots, idx_root)
+        frag_outcore = outcore
+        if frag_outcore is None: frag_outcore = tables_memory (nlas[ifrag], nroots) > max_memory
+        tdmint = LSTDMint1 (fciboxes[ifrag], nlas[ifrag], nelelas[ifrag], nroots, idx_root,
+            outcore=frag_outcore, max_memory=max_memory)
         t0 = tdmint.kernel (ci[ifrag], hopping_index[ifrag], zerop_index, onep_index)
         lib.logger.timer (las, 'LAS-state TDM12s fragment {} intermediate crunching'.format (ifrag), *t0)        
+        lib.logger.debug (las, 'LAS-state TDM12s fragment %d: %d unique of %d states', ifrag,
+            len (np.unique (tdmint.uroot)), nroots)
+        if frag_outcore:
+            lib.logger.debug (las, 'LAS-state TDM12s fragment %d intermediates out of core: %.1f MB on disk, '
+                'working set %.1f MB', ifrag, tdmint.nbytes_tables / 1e6, max_memory)
         ints.append (tdmint)
     return hopping_index, ints
 
-def make_stdm12s (las, ci, idx_root, **kwargs):
+def make_stdm12s (las, ci, idx_root, out=None, **kwargs):
+    ''' STDMs among the LAS states idx_root, as dense arrays of shape (nroots,2,ncas,ncas,nroots) and
+    (nroots,2,ncas,ncas,2,ncas,ncas,nroots) or, if out (a lassi.SparseSTDM12s) is given, added to out pair by pair
+    as they are crunched, in which case out is returned '''
     nlas = las.ncas_sub
     ncas = las.ncas
     nroots = np.count_nonzero (idx_root)
@@ -686,6 +996,12 @@ def make_stdm12s (las, ci, idx_root, **kwargs):
 
     # Second pass: upper-triangle
     t0 = (time.clock (), time.time ())
+    if out is not None:
+        outerprod = SparseSTDMint (ints, nlas, hopping_index, out, idx_root, dtype=ci[0][0].dtype)
+        lib.logger.timer (las, 'LAS-state TDM12s second intermediate indexing setup', *t0)
+        out, t0 = outerprod.kernel ()
+        lib.logger.timer (las, 'LAS-state TDM12s second intermediate crunching', *t0)
+        return out
     outerprod = LSTDMint2 (ints, nlas, hopping_index, dtype=ci[0][0].dtype)
     lib.logger.timer (las, 'LAS-state TDM12s second intermediate indexing setup', *t0)        
     tdm1s, tdm2s, t0 = outerprod.kernel ()
@@ -709,20 +1025,46 @@ def ham (las, h1, h2, ci, idx_root, **kwargs):
     return ham, s2, ovlp
 
 
-def roots_make_rdm12s (las, ci, idx_root, si, **kwargs):
+def roots_make_rdm12s (las, ci, idx_root, si, batch=None, **kwargs):
+    return roots_make_rdms (las, ci, idx_root, si, batch=batch)
+
+def roots_make_rdms (las, ci, idx_root, si, rdm2=True, spin_sum=False, batch=None, screen=None, **kwargs):
+    ''' RDMs of the LASSI roots whose SI vectors are the columns of si
+
+        Kwargs:
+            rdm2: if False, compute only the 1-RDMs and return None for the 2-RDMs
+            spin_sum: if True, return spin-summed RDMs of shape (nroots_si,ncas,ncas) and
+                (nroots_si,ncas,ncas,ncas,ncas) instead of spin-separated ones of shape
+                (nroots_si,2,ncas,ncas) and (nroots_si,2,ncas,ncas,2,ncas,ncas)
+            batch: if given, the second pass is carried out for at most this many SI vectors at a time,
+                reusing the single-fragment intermediates
+            screen: pairs of LAS states whose weight |si[i,r] si[j,r]| in every root r is at or below this are
+                skipped. Defaults to RDM_SCREEN
+    '''
     nlas = las.ncas_sub
     ncas = las.ncas
     nroots_si = si.shape[-1]
     idx_root = np.where (idx_root)[0]
+    batch = max (1, batch or nroots_si)
+    if screen is None: screen = RDM_SCREEN
 
     # First pass: single-fragment intermediates
     hopping_index, ints = make_ints (las, ci, idx_root)
 
     # Second pass: upper-triangle
-    t0 = (time.clock (), time.time ())
-    outerprod = LRRDMint (ints, nlas, hopping_index, si, dtype=ci[0][0].dtype)
-    lib.logger.timer (las, 'LASSI root RDM12s second intermediate indexing setup', *t0)        
-    rdm1s, rdm2s, t0 = outerprod.kernel ()
-    lib.logger.timer (las, 'LASSI root RDM12s second intermediate crunching', *t0)        
-    return rdm1s, rdm2s.reshape (nroots_si, 2, 2, ncas, ncas, ncas, ncas).transpose (0,1,3,4,2,5,6)
+    rdm1s, rdm2s = [], []
+    for i0, i1 in lib.prange (0, nroots_si, batch):
+        t0 = (time.clock (), time.time ())
+        outerprod = LRRDMint (ints, nlas, hopping_index, si[:,i0:i1], dtype=ci[0][0].dtype, rdm2=rdm2,
+            spin_sum=spin_sum, screen=screen)
+        lib.logger.timer (las, 'LASSI root RDM12s second intermediate indexing setup', *t0)        
+        d1, d2, t0 = outerprod.kernel ()
+        lib.logger.timer (las, 'LASSI root RDM12s second intermediate crunching', *t0)        
+        rdm1s.append (d1)
+        rdm2s.append (d2)
+    rdm1s = np.concatenate (rdm1s, axis=0)
+    rdm2s = np.concatenate (rdm2s, axis=0) if rdm2 else None
+    if rdm2 and not spin_sum:
+        rdm2s = rdm2s.reshape (nroots_si, 2, 2, ncas, ncas, ncas, ncas).transpose (0,1,3,4,2,5,6)
+    return rdm1s, rdm2s
 
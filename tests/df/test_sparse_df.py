@@ -0,0 +1,86 @@
+import os
+import tempfile
+import numpy as np
+import unittest
+from pyscf import gto, df, lib
+from mrh.my_pyscf.df import sparse_df
+from mrh.my_pyscf.df.sparse_df import sparsedf_array, get_sparsedf
+
+mol = gto.M (atom='H 0 0 0; H 1 0 0; H 0 0 6; H 1 0 6; H 0 0 12; H 1 0 12', basis='6-31g', verbose=0)
+with_df = df.DF (mol, auxbasis='weigend')
+with_df.build ()
+
+def tearDownModule():
+    global mol, with_df
+    del mol, with_df
+
+class KnownValues(unittest.TestCase):
+
+    def test_contract1 (self):
+        nao = mol.nao_nr ()
+        np.random.seed (0)
+        cmat = np.random.rand (nao, 3)
+        bPmn = get_sparsedf (with_df)
+        # The far-apart H2 units make sure some AO pairs are actually screened out
+        self.assertLess (bPmn.nentpair, nao*(nao+1)//2)
+        ref = np.einsum ('Pmn,nu->muP', lib.unpack_tril (with_df._cderi), cmat)
+        self.assertAlmostEqual (np.amax (np.abs (np.asarray (bPmn.contract1 (cmat)) - ref)), 0, 9)
+
+    def test_contract1_batch (self):
+        nao = mol.nao_nr ()
+        np.random.seed (1)
+        cmats = [np.random.rand (nao, nmo) for nmo in (3, 1, 0, 4)]
+        bPmn = get_sparsedf (with_df)
+        test = bPmn.contract1_batch (cmats)
+        self.assertEqual (len (test), len (cmats))
+        for i, (cmat, vPuv) in enumerate (zip (cmats, test)):
+            with self.subTest (i=i):
+                ref = bPmn.contract1 (cmat)
+                self.assertEqual (vPuv.shape, ref.shape)
+                self.assertAlmostEqual (np.amax (np.abs (np.asarray (vPuv) - np.asarray (ref)), initial=0), 0, 12)
+        self.assertEqual (bPmn.contract1_batch ([]), [])
+
+    def test_sparsity_cache (self):
+        bPmn0 = get_sparsedf (with_df)
+        bPmn1 = get_sparsedf (with_df)
+        self.assertIsNot (bPmn0, bPmn1)
+        self.assertIs (bPmn0.iao_entlist, bPmn1.iao_entlist)
+        bPmn2 = get_sparsedf (with_df, thresh=1e-4)
+        self.assertIsNot (bPmn0.iao_entlist, bPmn2.iao_entlist)
+
+    def test_dump_load (self):
+        bPmn = sparsedf_array (with_df._cderi)
+        bPmn.get_sparsity_ ()
+        ref = bPmn.get_sparsity ()
+        with tempfile.TemporaryDirectory () as tmpdir:
+            fname = os.path.join (tmpdir, 'cderi.sparsity.npz')
+            self.assertFalse (sparsedf_array (with_df._cderi).load_sparsity_ (fname))
+            bPmn.dump_sparsity (fname)
+            bPmn1 = sparsedf_array (with_df._cderi)
+            self.assertTrue (bPmn1.load_sparsity_ (fname))
+            sparsity = bPmn1.get_sparsity ()
+            for key in sparse_df.SPARSITY_KEYS:
+                with self.subTest (key):
+                    self.assertTrue (np.array_equal (sparsity[key], ref[key]))
+                    if isinstance (ref[key], np.ndarray): self.assertEqual (sparsity[key].dtype, ref[key].dtype)
+            with self.subTest ('thresh mismatch'):
+                self.assertFalse (sparsedf_array (with_df._cderi).load_sparsity_ (fname, thresh=1e-4))
+            with self.subTest ('fingerprint mismatch'):
+                cderi = with_df._cderi.copy ()
+                cderi[0] *= 2
+                self.assertFalse (sparsedf_array (cderi).load_sparsity_ (fname))
+            with self.subTest ('get_sparsedf save'):
+                with_df1 = df.DF (mol, auxbasis='weigend')
+                with_df1._cderi_to_save = os.path.join (tmpdir, 'cderi.h5')
+                with_df1._cderi = with_df._cderi
+                get_sparsedf (with_df1, save=True)
+                self.assertTrue (os.path.isfile (with_df1._cderi_to_save + '.sparsity.npz'))
+                with_df1._sparsedf_sparsity = None
+                bPmn2 = get_sparsedf (with_df1, save=True)
+                self.assertTrue (np.array_equal (bPmn2.iao_entlist, ref['iao_entlist']))
+                self.assertTrue (np.allclose (bPmn2.contract1 (np.eye (mol.nao_nr ())),
+                                              bPmn.contract1 (np.eye (mol.nao_nr ()))))
+
+if __name__ == "__main__":
+    print("Full Tests for sparse DF arrays")
+    unittest.main()
@@ -0,0 +1,88 @@
+import numpy as np
+import unittest
+from scipy import optimize
+from mrh.my_dmet.main_object import dmet
+
+class FakeInts (object):
+    nelec_tot = 12
+    def const (self):
+        return 0.0
+
+class FakeHelper (object):
+    def construct1RDM_loc (self, doSCF, umat):
+        return None
+
+class FakeFragment (object):
+    ''' An impurity whose electron number is a smooth, increasing function of the chemical potential. The mean-field
+    response is deliberately inaccurate, as it is in practice. '''
+    mol_output = None
+    def __init__(self, n0, a, b, c):
+        self.n0, self.a, self.b, self.c = n0, a, b, c
+        self.nsolves = 0
+        self.solve_impurity_problem (0.0)
+    def nelec (self, mu):
+        return self.n0 + self.a * np.arctan (self.b * (mu - self.c))
+    def get_chempot_response (self):
+        return 1.5 * self.a * self.b
+    def solve_impurity_problem (self, chempot_frag):
+        self.nsolves += 1
+        self.mu = chempot_frag
+        self.nelec_frag = self.nelec (chempot_frag)
+        self.E_frag = -chempot_frag * self.nelec_frag
+        self.S2_frag = 0.0
+
+class FakeDMET (object):
+    ''' Just enough of main_object.dmet for the chemical-potential search '''
+    solve_chempot = dmet.solve_chempot
+    numeleccostfunction = dmet.numeleccostfunction
+    doexact = dmet.doexact
+    solve_impurity_problems = dmet.solve_impurity_problems
+    doDET = doDET_NO = TransInv = doSCF = False
+    norbs_allcore = 0
+    umat = None
+    chempot_tol = 1e-8
+    chempot_resolve_thresh = 1e-3
+    chempot_maxiter = 50
+    def __init__(self):
+        self.ints = FakeInts ()
+        self.helper = FakeHelper ()
+        self.chempot = 0.0
+        self.chempot_slope = None
+        # The last fragment barely responds, so it is rarely re-solved
+        self.fragments = [FakeFragment (3.8, 1.0, 2.0, 0.1), FakeFragment (4.1, 0.7, 3.0, -0.2),
+                          FakeFragment (4.0, 1e-6, 1.0, 0.0)]
+
+def get_mu_ref (fragments, nelec_tot):
+    return optimize.brentq (lambda mu: sum ([f.nelec (mu) for f in fragments]) - nelec_tot, -10, 10, xtol=1e-12)
+
+class KnownValues(unittest.TestCase):
+
+    def test_newton_vs_brentq (self):
+        mydmet = FakeDMET ()
+        mu = mydmet.solve_chempot ()
+        mu_ref = get_mu_ref (mydmet.fragments, mydmet.ints.nelec_tot)
+        self.assertAlmostEqual (mu, mu_ref, 7)
+        self.assertIsNotNone (mydmet.chempot_slope)
+        # Every fragment holds a solution at the returned chemical potential, to within chempot_resolve_thresh electrons
+        for frag in mydmet.fragments:
+            with self.subTest (frag=mydmet.fragments.index (frag)):
+                self.assertLess (abs (frag.nelec_frag - frag.nelec (mu)), mydmet.chempot_resolve_thresh)
+        self.assertLess (mydmet.fragments[2].nsolves, mydmet.fragments[0].nsolves)
+
+    def test_slope_carryover (self):
+        mydmet = FakeDMET ()
+        mydmet.solve_chempot ()
+        nsolves_cold = sum ([f.nsolves for f in mydmet.fragments])
+        # Next DMET iteration: the impurities change a little
+        mydmet.chempot = 0.0
+        for frag in mydmet.fragments:
+            frag.c += 0.05
+            frag.nsolves = 0
+            frag.solve_impurity_problem (0.0)
+        mu = mydmet.solve_chempot ()
+        self.assertAlmostEqual (mu, get_mu_ref (mydmet.fragments, mydmet.ints.nelec_tot), 7)
+        self.assertLess (sum ([f.nsolves for f in mydmet.fragments]), nsolves_cold)
+
+if __name__ == "__main__":
+    print("Full Tests for the DMET chemical-potential search")
+    unittest.main()
@@ -0,0 +1,139 @@
+import numpy as np
+import unittest
+from scipy import linalg
+from pyscf import gto, scf, ao2mo
+from pyscf.lib.numpy_helper import unpack_tril
+from mrh.my_dmet import localintegrals
+from mrh.my_dmet.fragments import fragment_object
+from mrh.my_dmet import pyscf_mp2, pyscf_cc
+
+mol = gto.M (atom='H 0 0 0; H 1 0 0; H 0 0 2; H 1 0 2; H 0 0 4; H 1 0 4', basis='6-31g', verbose=0, output='/dev/null')
+mf = scf.RHF (mol).density_fit (auxbasis='weigend').run ()
+ints = localintegrals.localintegrals (mf, range (mol.nao_nr ()), 'meta_lowdin', use_loc_cache=False)
+np.random.seed (0)
+norb = ints.norbs_tot
+# The new impurity basis is a rotation of the old one plus one new direction
+loc2old = linalg.qr (np.random.rand (norb, 5), mode='economic')[0]
+loc2new = np.append (loc2old, linalg.qr (np.random.rand (norb, norb))[0][:,:1], axis=1)
+loc2new = linalg.qr (loc2new, mode='economic')[0] @ linalg.qr (np.random.rand (6, 6))[0]
+
+def tearDownModule():
+    global mol, mf, ints
+    mol.stdout.close ()
+    del mol, mf, ints
+
+class FakeFragment (object):
+    ''' Just enough of fragment_object for get_impham_integrals '''
+    get_impham_integrals = fragment_object.get_impham_integrals
+    plan_impham_integrals = fragment_object.plan_impham_integrals
+    imp_solver_name = 'CASSCF'
+    quasidirect = False
+    project_cderi = False
+    impham_cache_lindep = 1e-8
+    impham_cache_maxfrac = 0.5
+    def __init__(self, loc2imp):
+        self.ints = ints
+        self.loc2imp = self.loc2emb = loc2imp
+        self.norbs_imp = loc2imp.shape[1]
+        self.impham_cache = None
+
+class FakeSolverFragment (object):
+    ''' Just enough of fragment_object for the MP2 and CC impurity solvers '''
+    impham_attach_eri = fragment_object.impham_attach_eri
+    def __init__(self, loc2imp, nelec_imp, kind):
+        self.loc2imp = loc2imp
+        self.imp2loc = loc2imp.conjugate ().T
+        self.norbs_imp = loc2imp.shape[1]
+        self.nelec_imp = nelec_imp
+        self.impham_CONST = 0.5
+        self.impham_OEI_C = self.imp2loc @ ints.activeFOCK @ loc2imp
+        self.oneRDMfroz_loc = np.zeros ((norb, norb))
+        self.impham_TEI = self.impham_CDERI = None
+        if kind == 'tei': self.impham_TEI = ints.dmet_tei (loc2imp, symmetry=8)
+        else: self.impham_CDERI = ints.dmet_cderi (loc2imp)
+
+class KnownValues(unittest.TestCase):
+
+    def test_tei_update (self):
+        tei_old = ints.dmet_tei (loc2old, symmetry=8)
+        ref = ints.dmet_tei (loc2new, symmetry=1)
+        test = ints.dmet_tei_update (loc2old, tei_old, loc2new, symmetry=1)
+        self.assertAlmostEqual (np.amax (np.abs (test - ref)), 0, 9)
+
+    def test_tei_batch (self):
+        loc2bas_list = [loc2old, loc2new, loc2new[:,:2]]
+        test = ints.dmet_tei_batch (loc2bas_list, symmetry=1)
+        for i, loc2bas in enumerate (loc2bas_list):
+            with self.subTest (i=i):
+                ref = ints.dmet_tei (loc2bas, symmetry=1)
+                # The batched transformation screens AO pairs at sparse_df.SPARSITY_THRESH
+                self.assertAlmostEqual (np.amax (np.abs (test[i] - ref)), 0, 7)
+
+    def test_cderi_update (self):
+        cderi_old = ints.dmet_cderi (loc2old)
+        ref = ints.dmet_cderi (loc2new)
+        test = ints.dmet_cderi_update (loc2old, cderi_old, loc2new)
+        ref = np.dot (ref.T, ref)
+        test = np.dot (test.T, test)
+        self.assertAlmostEqual (np.amax (np.abs (test - ref)), 0, 9)
+
+    def test_update_basis_once (self):
+        ncalls = [0]
+        get_imp_update_basis = ints.get_imp_update_basis
+        def counter (*args, **kwargs):
+            ncalls[0] += 1
+            return get_imp_update_basis (*args, **kwargs)
+        for kind in ('tei', 'cderi'):
+            with self.subTest (kind):
+                frag = FakeFragment (loc2old)
+                frag.get_impham_integrals (kind)
+                frag.loc2imp = frag.loc2emb = loc2new
+                frag.norbs_imp = loc2new.shape[1]
+                ncalls[0] = 0
+                ints.get_imp_update_basis = counter
+                try:
+                    test = frag.get_impham_integrals (kind)
+                finally:
+                    del ints.get_imp_update_basis
+                self.assertEqual (ncalls[0], 1)
+                ref = ints.dmet_tei (loc2new, symmetry=8) if kind == 'tei' else ints.dmet_cderi (loc2new)
+                if kind == 'cderi': test, ref = np.dot (test.T, test), np.dot (ref.T, ref)
+                self.assertAlmostEqual (np.amax (np.abs (test - ref)), 0, 9)
+
+    def test_plan (self):
+        frag = FakeFragment (loc2new)
+        max_memory = ints.max_memory
+        try:
+            for solver in ('RHF', 'MP2', 'CASSCF', 'FCI', 'CC'):
+                frag.imp_solver_name = solver
+                dense_only = solver == 'FCI'
+                with self.subTest (solver=solver):
+                    ints.max_memory = max_memory
+                    self.assertEqual (frag.plan_impham_integrals (), 'tei')
+                    frag.project_cderi = True
+                    self.assertEqual (frag.plan_impham_integrals (), 'tei' if dense_only else 'cderi')
+                    frag.project_cderi = False
+                    ints.max_memory = 0
+                    self.assertEqual (frag.plan_impham_integrals (), 'tei' if dense_only else 'cderi')
+        finally:
+            ints.max_memory = max_memory
+
+    def test_solver_cderi (self):
+        for solver in (pyscf_mp2, pyscf_cc):
+            results = []
+            for kind in ('tei', 'cderi'):
+                frag = FakeSolverFragment (loc2new, 4, kind)
+                chempot_imp = np.zeros ((frag.norbs_imp, frag.norbs_imp))
+                guess_1RDM = np.zeros_like (chempot_imp)
+                guess_1RDM[np.diag_indices (2)] = 2
+                solver.solve (frag, guess_1RDM, chempot_imp)
+                results.append (frag)
+            ref, test = results
+            with self.subTest (solver=solver.__name__):
+                self.assertAlmostEqual (test.E_imp, ref.E_imp, 8)
+                self.assertAlmostEqual (np.amax (np.abs (test.oneRDM_loc - ref.oneRDM_loc)), 0, 6)
+                self.assertAlmostEqual (np.amax (np.abs (test.twoCDM_imp - ref.twoCDM_imp)), 0, 6)
+
+if __name__ == "__main__":
+    print("Full Tests for DMET impurity integral updates")
+    unittest.main()
@@ -0,0 +1,80 @@
+import numpy as np
+import unittest
+from unittest.mock import patch
+from pyscf import gto, scf
+from pyscf.lo import boys
+from mrh.my_dmet import localintegrals
+
+def get_mol (dz=0.0, charge=0):
+    return gto.M (atom='H 0 0 0; H 1 0 0; H 0 0 2; H 1 0 {}; H 0 0 4; H 1 0 4'.format (2+dz), basis='6-31g',
+        charge=charge, verbose=0, output='/dev/null')
+
+mol = get_mol ()
+mf = scf.RHF (mol).run ()
+mf_cation = scf.RHF (get_mol (charge=2)).run ()
+mf_disp = scf.RHF (get_mol (dz=0.05)).run ()
+
+def tearDownModule():
+    global mol, mf, mf_cation, mf_disp
+    for m in (mf, mf_cation, mf_disp): m.mol.stdout.close ()
+    del mol, mf, mf_cation, mf_disp
+
+def get_ints (the_mf, **kwargs):
+    kwargs.setdefault ('use_loc_cache', True)
+    return localintegrals.localintegrals (the_mf, range (the_mf.mol.nao_nr ()), 'meta_lowdin', **kwargs)
+
+class KnownValues(unittest.TestCase):
+
+    def setUp (self):
+        localintegrals._loc_cache.clear ()
+        localintegrals._boys_last.clear ()
+
+    def test_cache_hit (self):
+        ref = get_ints (mf)
+        self.assertEqual (len (localintegrals._loc_cache), 1)
+        # A sign flip leaves the operators unchanged but shows that the orbitals come from the cache
+        entry = next (iter (localintegrals._loc_cache.values ()))
+        entry['ao2loc'] = -entry['ao2loc']
+        test = get_ints (mf)
+        self.assertAlmostEqual (np.amax (np.abs (test.ao2loc + ref.ao2loc)), 0, 12)
+        self.assertAlmostEqual (np.amax (np.abs (test.activeFOCK - ref.activeFOCK)), 0, 12)
+        self.assertEqual (len (localintegrals._loc_cache), 1)
+
+    def test_ops_key_miss (self):
+        get_ints (mf)
+        key, entry_old = next (iter (localintegrals._loc_cache.items ()))
+        # Same molecule signature, so the orbitals are reused, but the frozen part and the Fock matrix differ
+        test = get_ints (mf_cation)
+        ref = get_ints (mf_cation, use_loc_cache=False)
+        self.assertAlmostEqual (np.amax (np.abs (test.activeOEI - ref.activeOEI)), 0, 12)
+        self.assertAlmostEqual (np.amax (np.abs (test.activeFOCK - ref.activeFOCK)), 0, 12)
+        self.assertEqual (list (localintegrals._loc_cache.keys ()), [key])
+        entry_new = localintegrals._loc_cache[key]
+        self.assertIsNot (entry_new, entry_old)
+        self.assertAlmostEqual (np.amax (np.abs (entry_new['activeFOCK'] - ref.activeFOCK)), 0, 12)
+        self.assertNotEqual (str (entry_new['ops_key']), str (entry_old['ops_key']))
+
+    def test_eviction (self):
+        with patch.object (localintegrals, 'LOC_CACHE_SIZE', 1):
+            get_ints (mf)
+            key_old = next (iter (localintegrals._loc_cache.keys ()))
+            get_ints (mf_disp)
+            self.assertEqual (len (localintegrals._loc_cache), 1)
+            self.assertNotIn (key_old, localintegrals._loc_cache)
+
+    def test_boys_warm_start (self):
+        active = list (range (mol.nao_nr ()))
+        def boys_cost (ints):
+            return boys.Boys (ints.mol, ints.ao2loc).cost_function ()
+        localintegrals.localintegrals (mf, active, 'boys', use_loc_cache=False, boys_warm_start=True)
+        self.assertEqual (len (localintegrals._boys_last), 1)
+        warm = localintegrals.localintegrals (mf_disp, active, 'boys', use_loc_cache=False, boys_warm_start=True)
+        cold = localintegrals.localintegrals (mf_disp, active, 'boys', use_loc_cache=False)
+        self.assertAlmostEqual (boys_cost (warm), boys_cost (cold), 6)
+        # Same localized orbitals, up to order and sign
+        ovlp = np.abs (warm.ao2loc.T @ mf_disp.get_ovlp () @ cold.ao2loc)
+        self.assertAlmostEqual (np.amax (np.abs (np.sort (np.amax (ovlp, axis=0)) - 1)), 0, 4)
+
+if __name__ == "__main__":
+    print("Full Tests for the localized-orbital cache")
+    unittest.main()
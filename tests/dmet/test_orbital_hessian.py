@@ -0,0 +1,105 @@
+import io
+import contextlib
+import numpy as np
+import unittest
+from pyscf import gto, scf, mcscf, lib
+from mrh.util.rdm import get_2CDM_from_2RDM
+from mrh.my_dmet import orbital_hessian
+from mrh.my_dmet.orbital_hessian import HessianCalculator, HessianERITransformer
+
+mol = gto.M (atom='H 0 0 0; H 1 0 0; H 0.2 0 2; H 1 0 2.1', basis='6-31g', verbose=0, output='/dev/null')
+mf = scf.RHF (mol).run ()
+mf_df = scf.RHF (mol).density_fit (auxbasis='weigend').run ()
+
+def make_calc (mf):
+    mc = mcscf.CASSCF (mf, 2, 2).run ()
+    casdm1s = mc.fcisolver.make_rdm1s (mc.ci, mc.ncas, mc.nelecas)
+    casdm1, casdm2 = mc.fcisolver.make_rdm12 (mc.ci, mc.ncas, mc.nelecas)
+    ao2amo = mc.mo_coeff[:,mc.ncore:mc.ncore+mc.ncas]
+    calc = HessianCalculator (mf, mc.make_rdm1s (), get_2CDM_from_2RDM (casdm2, casdm1s), ao2amo)
+    nocc = mc.ncore + mc.ncas
+    ranges = {'i': mc.mo_coeff[:,:mc.ncore], 'u': ao2amo, 'a': mc.mo_coeff[:,nocc:]}
+    return calc, ranges
+
+def tearDownModule():
+    global mol, mf, mf_df
+    mol.stdout.close ()
+    del mol, mf, mf_df
+
+class KnownValues(unittest.TestCase):
+
+    def _get_hessians (self, calc, ranges, blocks):
+        return [calc (*[ranges[x] for x in blk]) for blk in blocks]
+
+    def _check_cache (self, mf):
+        calc, ranges = make_calc (mf)
+        # Three distinct sets of intermediates, then the first one again
+        blocks = ('uiui', 'aiai', 'auau', 'uiui')
+        cache_size = orbital_hessian.ERI_CACHE_SIZE
+        try:
+            orbital_hessian.ERI_CACHE_SIZE = 0
+            ref = self._get_hessians (calc, ranges, blocks)
+            self.assertEqual (len (calc.eri_cache), 0)
+            orbital_hessian.ERI_CACHE_SIZE = 2
+            ntrans = [0]
+            get_eri, get_cderi = calc._get_eri, calc._get_cderi
+            def count_eri (*args, **kwargs):
+                ntrans[0] += 1
+                return get_eri (*args, **kwargs)
+            def count_cderi (orbs_pair):
+                ntrans[0] += 1
+                return get_cderi (orbs_pair)
+            calc._get_eri, calc._get_cderi = count_eri, count_cderi
+            for blk, r in zip (blocks, ref):
+                ntrans[0] = 0
+                with self.subTest (blk):
+                    self.assertAlmostEqual (np.amax (np.abs (calc (*[ranges[x] for x in blk]) - r)), 0, 10)
+                    self.assertLessEqual (len (calc.eri_cache), 2)
+                    # The repeated first block was evicted by the third one
+                    self.assertGreater (ntrans[0], 0)
+            # The last two blocks are now cached, so repeating them transforms nothing
+            ntrans[0] = 0
+            for blk, r in zip (blocks[2:], ref[2:]):
+                with self.subTest (blk, cached=True):
+                    self.assertAlmostEqual (np.amax (np.abs (calc (*[ranges[x] for x in blk]) - r)), 0, 10)
+            self.assertEqual (ntrans[0], 0)
+        finally:
+            orbital_hessian.ERI_CACHE_SIZE = cache_size
+        return calc, ranges, ref
+
+    def test_eri_cache (self):
+        calc, ranges, ref = self._check_cache (mf)
+        self.assertIsNotNone (next (iter (calc.eri_cache.values ()))[0])
+
+    def test_cderi_cache (self):
+        calc, ranges, ref = self._check_cache (mf_df)
+        self.assertIsNotNone (next (iter (calc.eri_cache.values ()))[1])
+        # The density-fitted intermediates give the same Hessian as the DF ERIs themselves
+        calc.eri_cache.clear ()
+        calc._get_cderi = lambda orbs_pair: None
+        test = calc (*[ranges[x] for x in 'uiui'])
+        self.assertAlmostEqual (np.amax (np.abs (test - ref[0])), 0, 10)
+
+    def test_p_in_c (self):
+        calc, ranges = make_calc (mf)
+        p, q, r, s = [calc.moHS @ ranges[x] for x in 'aiau']
+        eris = HessianERITransformer (calc, p, q, r, s)
+        for c in (eris.w, eris.x, eris.y, eris.z):
+            for x in (p, q, r, s):
+                ref = eris.p_in_c (c, x, _return_numbers=True)[0]
+                self.assertEqual (eris.p_in_c (c, x), ref)
+                self.assertEqual (eris.p_in_c (c, x), ref) # from the lookup cache
+
+    def test_report_verbose (self):
+        calc, ranges = make_calc (mf)
+        for verbose, expected in ((lib.logger.NOTE, False), (lib.logger.DEBUG, True)):
+            calc.verbose = verbose
+            out = io.StringIO ()
+            with contextlib.redirect_stdout (out):
+                calc (*[ranges[x] for x in 'aiai'])
+            with self.subTest (verbose=verbose):
+                self.assertEqual ('HessianERITransformer' in out.getvalue (), expected)
+
+if __name__ == "__main__":
+    print("Full Tests for the DMET orbital Hessian")
+    unittest.main()
@@ -0,0 +1,164 @@
+import numpy as np
+import unittest
+import ctypes
+from scipy import linalg
+from pyscf import gto, scf, lo
+from mrh.my_dmet.qcdmethelper import qcdmethelper
+from mrh.my_dmet.localintegrals import localintegrals
+from mrh.my_dmet.rhf import _count_newton_cycles
+
+np.random.seed (7)
+norb, npair = 12, 5
+
+class FakeInts (object):
+    ''' Just enough of localintegrals for the one-body response '''
+    norbs_tot = norb
+    nelec_tot = 2 * npair
+    def __init__(self):
+        self.fock = np.random.rand (norb, norb) - 0.5
+        self.fock += self.fock.T
+        self.fock[np.diag_indices (norb)] += np.arange (norb)
+    def loc_rhf_fock (self):
+        return self.fock
+
+class FakeSCFInts (object):
+    ''' Just enough of localintegrals for the self-consistent (doSCF) response: a real RHF problem in Lowdin orbitals '''
+    def __init__(self):
+        self.mol = gto.M (atom='H 0 0 0; H 0.9 0 0; H 1.9 0.2 0; H 2.8 0 0.1; H 3.9 0 0; H 4.7 0.1 0', basis='sto-3g',
+            verbose=0)
+        self.mf = scf.RHF (self.mol)
+        self.ao2loc = lo.orth_ao (self.mol, 'lowdin')
+        self.loc2ao = self.ao2loc.T @ self.mol.intor ('int1e_ovlp')
+        self.norbs_tot = self.ao2loc.shape[1]
+        self.nelec_tot = self.nelec_idem = self.mol.nelectron
+        self.loc2idem = np.eye (self.norbs_tot)
+        self.oneRDMcorr_loc = np.zeros ((self.norbs_tot, self.norbs_tot))
+        self.oei = self.ao2loc.T @ self.mf.get_hcore () @ self.ao2loc
+        self.max_memory = 4000
+    get_wm_1RDM_from_OEI_batch = localintegrals.get_wm_1RDM_from_OEI_batch
+    def loc_rhf_fock (self):
+        return self.loc_rhf_fock_bis (self.get_wm_1RDM_from_OEI (self.oei))
+    def loc_oei (self):
+        return self.oei
+    def loc_rhf_jk_bis (self, DMloc):
+        return self.ao2loc.T @ self.mf.get_veff (dm=self.ao2loc @ DMloc @ self.ao2loc.T) @ self.ao2loc
+    def loc_rhf_fock_bis (self, DMloc):
+        return self.oei + self.loc_rhf_jk_bis (DMloc)
+    def get_wm_1RDM_from_OEI (self, OEI):
+        mo = linalg.eigh (OEI)[1][:,:self.nelec_idem//2]
+        return 2 * mo @ mo.T
+    def get_wm_1RDM_from_scf_on_OEI (self, OEI, oneRDMguess_loc=None, stats=None):
+        mf = scf.RHF (self.mol)
+        mf.conv_tol = 1e-13
+        mf.get_hcore = lambda *args: self.loc2ao.T @ OEI @ self.loc2ao
+        dm0 = None if oneRDMguess_loc is None else self.ao2loc @ oneRDMguess_loc @ self.ao2loc.T
+        mf.kernel (dm0)
+        if stats is not None: stats['scf_cycles'] += mf.cycles
+        return self.loc2ao @ mf.make_rdm1 () @ self.loc2ao.T
+
+def make_list_H1 (frag_orbs):
+    # Upper-triangular fragment-block umat terms, as in main_object.makelist_H1
+    H1start, H1row, H1col = [0], [], []
+    for i, row in enumerate (frag_orbs):
+        for col in frag_orbs[i:]:
+            H1row.extend ([row] if row == col else [row, col])
+            H1col.extend ([col] if row == col else [col, row])
+            H1start.append (len (H1row))
+    return [np.array (x, dtype=ctypes.c_int) for x in (H1start, H1row, H1col)]
+
+class KnownValues(unittest.TestCase):
+
+    def test_sparse_vs_dense (self):
+        frag_orbs = [1, 2, 4, 7]
+        helper = qcdmethelper (FakeInts (), make_list_H1 (frag_orbs), False, None)
+        umat = np.random.rand (norb, norb) * 0.1
+        umat += umat.T
+        rot = linalg.qr (np.random.rand (norb, norb))[0]
+        cols, rows = np.meshgrid (frag_orbs, frag_orbs, indexing='ij')
+        rows, cols = rows.ravel (), cols.ravel ()
+        for NOrotation in (None, rot):
+            with self.subTest (NOrotation=(NOrotation is not None)):
+                dense = helper.construct1RDM_response (False, umat, NOrotation)[:,rows,cols]
+                sparse = helper.construct1RDM_response_elements (False, umat, NOrotation, rows, cols)
+                self.assertAlmostEqual (np.amax (np.abs (sparse - dense)), 0, 12)
+                sparse = helper.construct1RDM_response_elements (False, umat, NOrotation, rows, cols, thresh=1e-8)
+                self.assertAlmostEqual (np.amax (np.abs (sparse - dense)), 0, 6)
+
+    def test_adjoint_vs_dense (self):
+        frag_orbs = [0, 3, 5]
+        helper = qcdmethelper (FakeInts (), make_list_H1 (frag_orbs), False, None)
+        umat = np.random.rand (norb, norb) * 0.1
+        umat += umat.T
+        adj_1RDM = np.random.rand (norb, norb)
+        dense = np.tensordot (helper.construct1RDM_response (False, umat, None), adj_1RDM, axes=2)
+        adjoint = helper.contract1RDM_response (False, umat, None, adj_1RDM)
+        self.assertAlmostEqual (np.amax (np.abs (adjoint - dense)), 0, 12)
+
+    def test_adjoint_doSCF (self):
+        ints = FakeSCFInts ()
+        norb = ints.norbs_tot
+        frag_orbs = [0, 1, 2]
+        helper = qcdmethelper (ints, make_list_H1 (frag_orbs), False, None)
+        helper.scf_cache_size = 0
+        umat = np.zeros ((norb, norb))
+        umat[np.ix_(frag_orbs, frag_orbs)] = np.random.rand (3, 3) * 0.05
+        umat += umat.T
+        adj_1RDM = np.random.rand (norb, norb)
+        adjoint = helper.contract1RDM_response (True, umat, None, adj_1RDM)
+        # Central finite differences of the self-consistent 1RDM along each umat term
+        h = 1e-4
+        for k in range (helper.Nterms):
+            du = np.zeros ((norb, norb))
+            idx = slice (helper.H1start[k], helper.H1start[k+1])
+            du[helper.H1row[idx],helper.H1col[idx]] = h
+            dD = helper.construct1RDM_loc (True, umat + du) - helper.construct1RDM_loc (True, umat - du)
+            with self.subTest (term=k):
+                self.assertAlmostEqual (adjoint[k], np.sum (adj_1RDM * dD) / (2*h), 6)
+        with self.assertRaises (RuntimeError):
+            helper.contract1RDM_response (True, umat, None, adj_1RDM, max_cycle=1)
+
+    def test_batch_vs_serial (self):
+        ints = FakeSCFInts ()
+        norb = ints.norbs_tot
+        helper = qcdmethelper (ints, make_list_H1 ([0, 1, 2]), False, None)
+        umats = np.random.rand (5, norb, norb) * 0.05
+        umats += umats.transpose (0,2,1)
+        for doSCF in (False, True):
+            ref = np.stack ([helper.construct1RDM_loc (doSCF, umat) for umat in umats], axis=0)
+            kwargs = [{}, {'max_memory': 0}]
+            if doSCF:
+                oneRDMguess_loc = helper.construct1RDM_loc (True, np.zeros ((norb, norb)))
+                kwargs = [{'oneRDMguess_loc': oneRDMguess_loc, 'nproc': nproc} for nproc in (1, 2)]
+            for kw in kwargs:
+                with self.subTest (doSCF=doSCF, nproc=kw.get ('nproc', 1), max_memory=kw.get ('max_memory')):
+                    test = helper.construct1RDM_loc_batch (doSCF, umats, **kw)
+                    self.assertAlmostEqual (np.amax (np.abs (test - ref)), 0, 7)
+
+    def test_scf_cache (self):
+        ints = FakeSCFInts ()
+        norb = ints.norbs_tot
+        helper = qcdmethelper (ints, make_list_H1 ([0, 1, 2]), False, None)
+        umat = np.random.rand (norb, norb) * 0.05
+        umat += umat.T
+        ref = helper.construct1RDM_loc (True, umat)
+        test = helper.construct1RDM_loc (True, umat)
+        self.assertTrue (np.array_equal (test, ref))
+        test[0,0] += 1 # The cache must hand out copies
+        self.assertTrue (np.array_equal (helper.construct1RDM_loc (True, umat), ref))
+        helper.construct1RDM_loc (True, umat * 1.01)
+        stats = helper.scf_stats
+        self.assertEqual ((stats['exact_hits'], stats['cold_calls'], stats['warm_calls']), (2, 1, 1))
+
+    def test_newton_cycles (self):
+        mol = FakeSCFInts ().mol
+        mf = scf.RHF (mol).newton ()
+        stats = {'scf_cycles': 3}
+        _count_newton_cycles (mf, stats).kernel ()
+        self.assertTrue (mf.converged)
+        self.assertGreater (stats['newton_cycles'], 0)
+        self.assertEqual (stats['scf_cycles'], stats['newton_cycles'] + 3)
+
+if __name__ == "__main__":
+    print("Full Tests for DMET RHF response")
+    unittest.main()
+
@@ -0,0 +1,55 @@
+import numpy as np
+import unittest
+from scipy import linalg
+from pyscf import gto, scf
+from mrh.my_dmet import localintegrals
+
+mol = gto.M (atom='H 0 0 0; H 1 0 0; H 0 0 2; H 1 0 2; H 0 0 4; H 1 0 4', basis='6-31g', verbose=0, output='/dev/null')
+mf = scf.RHF (mol).run ()
+mf_df = scf.RHF (mol).density_fit (auxbasis='weigend').run ()
+ints = localintegrals.localintegrals (mf, range (mol.nao_nr ()), 'meta_lowdin', use_loc_cache=False)
+ints_df = localintegrals.localintegrals (mf_df, range (mol.nao_nr ()), 'meta_lowdin', use_loc_cache=False)
+np.random.seed (0)
+norb = ints.norbs_tot
+loc2bas_list = [linalg.qr (np.random.rand (norb, n), mode='economic')[0] for n in (5, 4, 3, 4)]
+
+def tearDownModule():
+    global mol, mf, mf_df, ints, ints_df
+    mol.stdout.close ()
+    del mol, mf, mf_df, ints, ints_df
+
+class KnownValues(unittest.TestCase):
+
+    def _check (self, myints):
+        ref = myints.general_tei (loc2bas_list)
+        # Slabs of one and two rows of the first index, and all of it at once
+        row_size = 8 * np.prod (ref.shape[1:]) / 1e6
+        for max_memory in (0, 2.5*row_size, None):
+            with self.subTest (max_memory=max_memory):
+                test = np.zeros_like (ref)
+                nblk = 0
+                for i0, i1, eri in myints.general_tei_blocks (loc2bas_list, max_memory=max_memory):
+                    test[i0:i1] = eri
+                    nblk += 1
+                self.assertAlmostEqual (np.amax (np.abs (test - ref)), 0, 10)
+                if max_memory == 0: self.assertEqual (nblk, ref.shape[0])
+
+    def test_eri (self):
+        self.assertIsNotNone (ints._eri)
+        self._check (ints)
+
+    def test_outcore (self):
+        eri = ints._eri
+        ints._eri = None
+        try:
+            self._check (ints)
+        finally:
+            ints._eri = eri
+
+    def test_df (self):
+        self.assertIsNotNone (ints_df.with_df)
+        self._check (ints_df)
+
+if __name__ == "__main__":
+    print("Full Tests for slabs of DMET two-electron integrals")
+    unittest.main()
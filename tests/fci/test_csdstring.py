@@ -0,0 +1,107 @@
+import os
+import tempfile
+import numpy as np
+import unittest
+from scipy import special
+from pyscf.fci import cistring
+from mrh.my_pyscf.fci import csdstring, csfstring
+from mrh.my_pyscf.fci.csfstring import CSFTransformer, _gen_strs_irrep
+
+cases = ((4, 2, 2), (5, 3, 2), (6, 3, 3), (6, 4, 1), (7, 4, 3), (8, 4, 4), (6, 0, 2))
+
+# The pure-Python mask builders which make_csd_masks and make_confsym replace
+def csd_mask_ref (norb, neleca, nelecb):
+    ndeta = int (special.comb (norb, neleca))
+    ndetb = int (special.comb (norb, nelecb))
+    mask = np.empty (ndeta*ndetb, dtype=np.uint32)
+    min_npair, npair_offset, npair_dconf_size, npair_sconf_size, npair_spins_size = csdstring.get_csdaddrs_shape (
+        norb, neleca, nelecb)
+    pair_size = npair_dconf_size * npair_sconf_size * npair_spins_size
+    for npair in range (min_npair, min (neleca, nelecb)+1):
+        ipair = npair - min_npair
+        nspin = neleca + nelecb - 2*npair
+        mask[npair_offset[ipair]:][:pair_size[ipair]] = csdstring.get_nspin_dets (norb, neleca, nelecb, nspin).flat
+    return mask
+
+def econf_det_mask_ref (norb, neleca, nelecb, csd_mask):
+    ndeta = int (special.comb (norb, neleca))
+    ndetb = int (special.comb (norb, nelecb))
+    mask = np.empty (ndeta*ndetb, dtype=np.uint32)
+    min_npair, npair_offset, npair_dconf_size, npair_sconf_size, npair_spins_size = csdstring.get_csdaddrs_shape (
+        norb, neleca, nelecb)
+    npair_conf_size = npair_dconf_size * npair_sconf_size
+    npair_det_size = npair_conf_size * npair_spins_size
+    iconf = 0
+    for npair in range (min_npair, min (neleca, nelecb)+1):
+        ipair = npair - min_npair
+        irange = np.arange (iconf, iconf+npair_conf_size[ipair], dtype=np.uint32)
+        iconf += npair_conf_size[ipair]
+        mask[npair_offset[ipair]:][:npair_det_size[ipair]] = np.repeat (irange, npair_spins_size[ipair])
+    return mask[np.argsort (csd_mask)]
+
+def confsym_ref (norb, neleca, nelecb, econf_det_mask, orbsym):
+    airreps = _gen_strs_irrep (cistring.gen_strings4orblist (range (norb), neleca), orbsym)
+    birreps = _gen_strs_irrep (cistring.gen_strings4orblist (range (norb), nelecb), orbsym)
+    addr = np.unique (econf_det_mask, return_index=True)[1]
+    return airreps[addr // len (birreps)] ^ birreps[addr % len (birreps)]
+
+class KnownValues(unittest.TestCase):
+
+    def test_csd_masks (self):
+        for norb, neleca, nelecb in cases:
+            csd_mask, econf_det_mask = csdstring.make_csd_masks (norb, neleca, nelecb)
+            ref = csd_mask_ref (norb, neleca, nelecb)
+            with self.subTest (norb=norb, nelec=(neleca,nelecb)):
+                self.assertEqual (csd_mask.dtype, csdstring.get_mask_dtype (ref.size - 1))
+                self.assertTrue (np.array_equal (csd_mask, ref))
+                ref = econf_det_mask_ref (norb, neleca, nelecb, ref)
+                self.assertEqual (econf_det_mask.dtype, csdstring.get_mask_dtype (np.amax (ref)))
+                self.assertTrue (np.array_equal (econf_det_mask, ref))
+
+    def test_confsym (self):
+        for norb, neleca, nelecb in cases:
+            orbsym = np.arange (norb) % 4
+            econf_det_mask = csdstring.make_csd_masks (norb, neleca, nelecb)[1]
+            confsym = csfstring.make_confsym (norb, neleca, nelecb, econf_det_mask, orbsym)
+            with self.subTest (norb=norb, nelec=(neleca,nelecb)):
+                self.assertTrue (np.array_equal (confsym, confsym_ref (norb, neleca, nelecb, econf_det_mask, orbsym)))
+
+    def test_mask_cache_dir (self):
+        norb, neleca, nelecb, smult = 6, 4, 2, 3
+        orbsym = [0,1,2,3,0,1]
+        np.random.seed (1)
+        ci = np.random.rand (int (special.comb (norb, neleca)), int (special.comb (norb, nelecb)))
+        def get_all ():
+            t = CSFTransformer (norb, neleca, nelecb, smult, orbsym=orbsym, wfnsym=1)
+            return [t.csd_mask, t.econf_det_mask, t.econf_csf_mask, t.confsym, t.vec_det2csf (ci, normalize=False)]
+        cache_dir = csfstring.CSF_MASK_CACHE_DIR
+        def clear_caches ():
+            for fn in (csfstring.get_csd_masks, csfstring.get_econf_csf_mask, csfstring._get_confsym):
+                fn.cache_clear ()
+        try:
+            clear_caches ()
+            csfstring.CSF_MASK_CACHE_DIR = None
+            ref = get_all ()
+            with tempfile.TemporaryDirectory () as tmpdir:
+                csfstring.CSF_MASK_CACHE_DIR = tmpdir
+                clear_caches ()
+                made = get_all ()
+                self.assertEqual (len ([f for f in os.listdir (tmpdir) if f.endswith ('.npy')]), 4)
+                clear_caches ()
+                loaded = get_all ()
+                for lbl, x, y, z in zip (('csd_mask', 'econf_det_mask', 'econf_csf_mask', 'confsym', 'ci_csf'),
+                        ref, made, loaded):
+                    with self.subTest (lbl):
+                        self.assertEqual (x.dtype, z.dtype)
+                        self.assertTrue (np.array_equal (x, y))
+                        self.assertTrue (np.array_equal (x, z))
+                for x in loaded[:4]:
+                    self.assertIsInstance (x.base, np.memmap)
+                    self.assertFalse (x.flags.writeable)
+        finally:
+            csfstring.CSF_MASK_CACHE_DIR = cache_dir
+            clear_caches ()
+
+if __name__ == "__main__":
+    print("Full Tests for CSD/CSF index masks")
+    unittest.main()
@@ -0,0 +1,85 @@
+import numpy as np
+import unittest
+from pyscf.fci import direct_uhf, cistring
+from mrh.my_pyscf.fci import csf
+from mrh.my_pyscf.fci.csfstring import CSFTransformer
+from itertools import product
+
+np.random.seed(1)
+def random_ham (norb, with_spin=False):
+    h1e = np.random.rand (norb, norb)
+    h1e += h1e.T
+    if with_spin:
+        h1e_b = np.random.rand (norb, norb)
+        h1e = np.stack ([h1e, h1e_b + h1e_b.T], axis=0)
+    eri = np.random.rand (norb, norb, norb, norb)
+    eri = eri + eri.transpose (1,0,2,3)
+    eri = eri + eri.transpose (0,1,3,2)
+    eri = eri + eri.transpose (2,3,0,1)
+    return h1e, eri
+
+def det_hop (h1e, eri, norb, nelec, transformer, x):
+    h2e = direct_uhf.absorb_h1e (csf.unpack_h1e_ab (h1e), (eri, eri, eri), norb, nelec, .5)
+    x_det = transformer.vec_csf2det (x, normalize=False)
+    hx = direct_uhf.contract_2e (h2e, x_det.reshape (transformer.ndeta, transformer.ndetb), norb, nelec)
+    return transformer.vec_det2csf (hx, normalize=False).ravel ()
+
+class KnownValues(unittest.TestCase):
+
+    def test_hop_csf (self):
+        for norb, nelec, smult, with_spin in ((5, (3,2), 2, False), (5, (3,2), 4, False), (6, (3,3), 1, False),
+                (6, (3,3), 3, True), (6, (4,2), 3, True), (6, (3,3), 5, True), (6, (5,5), 1, False)):
+            h1e, eri = random_ham (norb, with_spin=with_spin)
+            transformer = CSFTransformer (norb, nelec[0], nelec[1], smult)
+            hop = csf.make_hop_csf (h1e, eri, norb, nelec, transformer)
+            x = np.random.rand (transformer.ncsf)
+            with self.subTest (norb=norb, nelec=nelec, smult=smult, with_spin=with_spin):
+                hx_ref = det_hop (h1e, eri, norb, nelec, transformer, x)
+                self.assertAlmostEqual (np.amax (np.abs (hop (x) - hx_ref)), 0, 9)
+
+    def test_hmat_csf (self):
+        for norb, nelec, smult, with_spin in ((5, (3,2), 2, False), (6, (3,3), 1, False), (6, (4,2), 3, True)):
+            h1e, eri = random_ham (norb, with_spin=with_spin)
+            transformer = CSFTransformer (norb, nelec[0], nelec[1], smult)
+            econf_addr = np.unique (transformer.econf_csf_mask)[::2]
+            hmat, csf_addr = csf.make_hmat_csf (h1e, eri, norb, nelec, transformer, econf_addr=econf_addr)
+            with self.subTest (norb=norb, nelec=nelec, smult=smult, with_spin=with_spin):
+                self.assertTrue (np.all (np.isin (transformer.econf_csf_mask[csf_addr], econf_addr)))
+                hmat_ref = np.stack ([det_hop (h1e, eri, norb, nelec, transformer, x)[csf_addr]
+                    for x in np.eye (transformer.ncsf)[csf_addr]], axis=-1)
+                self.assertAlmostEqual (np.amax (np.abs (hmat - hmat_ref)), 0, 9)
+
+    def test_hdiag_csf (self):
+        for norb, nelec, smult, with_spin in ((5, (3,2), 2, False), (6, (3,3), 3, True), (6, (4,2), 5, False)):
+            h1e, eri = random_ham (norb, with_spin=with_spin)
+            transformer = CSFTransformer (norb, nelec[0], nelec[1], smult)
+            hdiag = csf.make_hdiag_csf (h1e, eri, norb, nelec, transformer)
+            hdiag_ref = [det_hop (h1e, eri, norb, nelec, transformer, x)[i]
+                for i, x in enumerate (np.eye (transformer.ncsf))]
+            with self.subTest (norb=norb, nelec=nelec, smult=smult, with_spin=with_spin):
+                self.assertAlmostEqual (np.amax (np.abs (hdiag - hdiag_ref)), 0, 9)
+
+    def test_confspace_cache (self):
+        cache_size = csf.CONFSPACE_CACHE_SIZE
+        csf.CONFSPACE_CACHE_SIZE = 2
+        try:
+            csf._confspace_cache.clear ()
+            h1e, eri = random_ham (5)
+            hdiag_ref = {}
+            for smult in (2, 4, 2, 6, 2):
+                transformer = CSFTransformer (5, 3, 2, smult)
+                hdiag = csf.make_hdiag_csf (h1e, eri, 5, (3,2), transformer)
+                if smult in hdiag_ref:
+                    with self.subTest (smult=smult):
+                        self.assertAlmostEqual (np.amax (np.abs (hdiag - hdiag_ref[smult])), 0, 12)
+                hdiag_ref[smult] = hdiag
+                self.assertLessEqual (len (csf._confspace_cache), 2)
+            # smult=2 was used most recently, so smult=4 is the one evicted
+            self.assertEqual (list (csf._confspace_cache.keys ()), [(5,3,2,6), (5,3,2,2)])
+        finally:
+            csf.CONFSPACE_CACHE_SIZE = cache_size
+
+if __name__ == "__main__":
+    print("Full Tests for CSF-basis Hamiltonian")
+    unittest.main()
+
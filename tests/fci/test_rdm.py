@@ -0,0 +1,56 @@
+import numpy as np
+import unittest
+from pyscf.fci import direct_spin1, cistring
+from mrh.my_pyscf.fci.rdm import trans_rdm1s_batch, trans_rdm12s_batch, get_blksize
+
+np.random.seed(1)
+def random_ci (norb, nelec, nroots):
+    na = cistring.num_strings (norb, nelec[0])
+    nb = cistring.num_strings (norb, nelec[1])
+    return np.random.rand (nroots, na, nb) - 0.5
+
+class KnownValues(unittest.TestCase):
+
+    def test_trans_rdm1s_batch (self):
+        for norb, nelec in ((4, (2,2)), (5, (3,1)), (3, (0,2)), (4, (4,0))):
+            bra, ket = random_ci (norb, nelec, 3), random_ci (norb, nelec, 4)
+            dm1a, dm1b = trans_rdm1s_batch (bra, ket, norb, nelec)
+            for i, j in np.ndindex (3, 4):
+                ref = direct_spin1.trans_rdm1s (bra[i], ket[j], norb, nelec)
+                with self.subTest (norb=norb, nelec=nelec, bra=i, ket=j):
+                    self.assertAlmostEqual (np.amax (np.abs (dm1a[i,j] - ref[0])), 0, 9)
+                    self.assertAlmostEqual (np.amax (np.abs (dm1b[i,j] - ref[1])), 0, 9)
+
+    def test_trans_rdm12s_batch (self):
+        for norb, nelec in ((4, (2,2)), (5, (3,1)), (3, (0,2)), (6, (3,3))):
+            bra, ket = random_ci (norb, nelec, 3), random_ci (norb, nelec, 2)
+            dm1s, dm2s = trans_rdm12s_batch (bra, ket, norb, nelec, blksize=2)
+            for i, j in np.ndindex (3, 2):
+                ref1s, ref2s = direct_spin1.trans_rdm12s (bra[i], ket[j], norb, nelec)
+                with self.subTest (norb=norb, nelec=nelec, bra=i, ket=j):
+                    for dm, ref in zip (dm1s + dm2s, ref1s + ref2s):
+                        self.assertAlmostEqual (np.amax (np.abs (dm[i,j] - ref)), 0, 9)
+
+    def test_trans_rdm12s_batch_blocks (self):
+        norb, nelec, nvec = 4, (2,1), 7
+        bra, ket = random_ci (norb, nelec, nvec), random_ci (norb, nelec, 5)
+        for blksize in (1, 2, 3, None):
+            for lbl, ciket, kets in (('bra-ket', ket, ket), ('hermi', None, bra)):
+                dm1s, dm2s = trans_rdm12s_batch (bra, ciket, norb, nelec, blksize=blksize)
+                for i, j in np.ndindex (nvec, len (kets)):
+                    ref1s, ref2s = direct_spin1.trans_rdm12s (bra[i], kets[j], norb, nelec)
+                    with self.subTest (lbl, blksize=blksize, bra=i, ket=j):
+                        for dm, ref in zip (dm1s + dm2s, ref1s + ref2s):
+                            self.assertAlmostEqual (np.amax (np.abs (dm[i,j] - ref)), 0, 9)
+        # Block size from the available memory
+        ndet = bra[0].size
+        self.assertEqual (get_blksize (norb, ndet, nvec, 1e9), nvec)
+        self.assertEqual (get_blksize (norb, ndet, nvec, 0), 1)
+        blksize = get_blksize (norb, ndet, 100, 0.1)
+        self.assertLess (blksize, get_blksize (norb, ndet, 100, 1e9))
+        self.assertGreater (blksize, 1)
+
+if __name__ == "__main__":
+    print("Full Tests for batched transition density matrices")
+    unittest.main()
+
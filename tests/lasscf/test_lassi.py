@@ -21,7 +21,7 @@ from pyscf import lib, gto, scf, dft, fci, mcscf, df
 from pyscf.tools import molden
 from c2h4n4_struct import structure as struct
 from mrh.my_pyscf.mcscf.lasscf_testing import LASSCF
-from mrh.my_pyscf.mcscf.lassi import roots_make_rdm12s, make_stdm12s, ham_2q
+from mrh.my_pyscf.mcscf.lassi import roots_make_rdm12s, make_stdm12s, ham_2q, roots_make_rdms, plan
 
 dr_nn = 2.0
 mol = struct (dr_nn, dr_nn, '6-31g', symmetry=False)
@@ -88,6 +88,42 @@ class KnownValues(unittest.TestCase):
         self.assertAlmostEqual (lib.fp (rdm1s_test), lib.fp (rdm1s), 9)
         self.assertAlmostEqual (lib.fp (rdm2s_test), lib.fp (rdm2s), 9)
 
+    def test_stdm12s_sparse (self):
+        h0, h1, h2 = ham_2q (las, las.mo_coeff)
+        stdm12s = make_stdm12s (las, dense=False)
+        self.assertAlmostEqual (lib.fp (h0 + np.diag (stdm12s.contract (h1, h2))), lib.fp (las.e_states), 8)
+        stdm1s, stdm2s = make_stdm12s (las)
+        for i, j in ((0,0), (0,1), (1,0), (3,4)):
+            d1s, d2s = stdm12s.get (i, j)
+            with self.subTest (bra=i, ket=j):
+                self.assertAlmostEqual (lib.fp (d1s), lib.fp (stdm1s[i,...,j]), 9)
+                self.assertAlmostEqual (lib.fp (d2s), lib.fp (stdm2s[i,...,j]), 9)
+
+    def test_sparse_consumers (self):
+        stdm12s = make_stdm12s (las, dense=False)
+        stdm1s, stdm2s = make_stdm12s (las)
+        # Packed storage: pairs i <= j only and the two-body part as a lower triangle
+        self.assertLess (stdm12s.nbytes, (stdm1s.nbytes + stdm2s.nbytes) / 2)
+        h0, h1, h2 = ham_2q (las, las.mo_coeff)
+        ham_ref = np.einsum ('asijb,ij->ab', stdm1s, h1) + np.einsum ('asijtklb,ijkl->ab', stdm2s, h2) / 2
+        self.assertAlmostEqual (lib.fp (stdm12s.contract (h1, h2)), lib.fp (ham_ref), 9)
+        rdm12s = stdm12s.make_rdm12s (si)
+        rdm12s_test = roots_make_rdm12s (las, las.ci, si, dense=False)
+        for root in range (si.shape[1]):
+            with self.subTest (root=root):
+                for d_test, d_ref in zip (rdm12s.get (root, root), (rdm1s[root], rdm2s[root])):
+                    self.assertAlmostEqual (lib.fp (d_test), lib.fp (d_ref), 9)
+                for d_test, d_ref in zip (rdm12s_test.get (root, root), (rdm1s[root], rdm2s[root])):
+                    self.assertAlmostEqual (lib.fp (d_test), lib.fp (d_ref), 9)
+
+    def test_ham_2q (self):
+        # No kernel call above, so nothing is cached and ham_2q transforms the active orbitals only
+        h0, h1, h2 = ham_2q (las, las.mo_coeff)
+        h0_ref, h1_ref, h2_ref = ham_2q (las, las.mo_coeff, h2eff_sub=las.ao2mo (las.mo_coeff))
+        self.assertAlmostEqual (h0, h0_ref, 9)
+        self.assertAlmostEqual (lib.fp (h1), lib.fp (h1_ref), 9)
+        self.assertAlmostEqual (lib.fp (h2), lib.fp (h2_ref), 9)
+
     def test_rdms (self):    
         h0, h1, h2 = ham_2q (las, las.mo_coeff)
         d1_r = rdm1s.sum (1)
@@ -101,6 +137,58 @@ class KnownValues(unittest.TestCase):
         for e1, e0 in zip (e_roots_test, e_roots):
             self.assertAlmostEqual (e1, e0, 8)
 
+    def test_roots_make_rdms (self):
+        roots = [3,0]
+        d1s, d2s = roots_make_rdms (las, las.ci, si, roots=roots)
+        d1, d2 = roots_make_rdms (las, las.ci, si, roots=roots, form='rdm12')
+        occ, no = roots_make_rdms (las, las.ci, si, roots=roots, form='natorb')
+        for ix, root in enumerate (roots):
+            with self.subTest (root=root):
+                self.assertAlmostEqual (lib.fp (d1s[ix]), lib.fp (rdm1s[root]), 9)
+                self.assertAlmostEqual (lib.fp (d2s[ix]), lib.fp (rdm2s[root]), 9)
+                self.assertAlmostEqual (lib.fp (d1[ix]), lib.fp (rdm1s[root].sum (0)), 9)
+                self.assertAlmostEqual (lib.fp (d2[ix]), lib.fp (rdm2s[root].sum ((0,3))), 9)
+                self.assertAlmostEqual (lib.fp (occ[ix]), lib.fp (linalg.eigh (rdm1s[root].sum (0))[0][::-1]), 9)
+        d1 = roots_make_rdms (las, las.ci, si, roots=roots, form='rdm1')
+        self.assertAlmostEqual (lib.fp (d1), lib.fp (rdm1s[roots].sum (1)), 9)
+        d1 = roots_make_rdms (las, las.ci, si, roots=[-1,-si.shape[1]], form='rdm1')
+        self.assertAlmostEqual (lib.fp (d1), lib.fp (rdm1s[[-1,0]].sum (1)), 9)
+        for bad in (si.shape[1], -si.shape[1]-1):
+            with self.subTest (bad_root=bad):
+                with self.assertRaises (IndexError):
+                    roots_make_rdms (las, las.ci, si, roots=bad, form='rdm1')
+
+    def test_rdm_screen (self):
+        # Screened RDMs are those of the STDMs with the screened pairs of LAS states left out
+        stdm1s, stdm2s = make_stdm12s (las)
+        wgt = np.amax (np.abs (si[:,None,:] * si[None,:,:]), axis=-1)
+        for screen in (0.0, np.median (wgt)):
+            mask = (wgt > screen).astype (si.dtype)
+            d1s_ref = np.einsum ('ar,asijb,br,ab->rsij', si.conj (), stdm1s, si, mask)
+            d2s_ref = np.einsum ('ar,asijtklb,br,ab->rsijtkl', si.conj (), stdm2s, si, mask)
+            d1s, d2s = roots_make_rdms (las, las.ci, si, screen=screen)
+            d1, d2 = roots_make_rdms (las, las.ci, si, form='rdm12', screen=screen)
+            with self.subTest (screen=screen):
+                self.assertAlmostEqual (lib.fp (d1s), lib.fp (d1s_ref), 9)
+                self.assertAlmostEqual (lib.fp (d2s), lib.fp (d2s_ref), 9)
+                self.assertAlmostEqual (lib.fp (d1), lib.fp (d1s_ref.sum (1)), 9)
+                self.assertAlmostEqual (lib.fp (d2), lib.fp (d2s_ref.sum ((1,4))), 9)
+        self.assertFalse (np.allclose (d2s, rdm2s)) # the last screen actually left something out
+
+    def test_plan (self):
+        for task in ('ham', 'stdm12s', 'rdm12s'):
+            p = plan (las, task=task, si=si)
+            with self.subTest (task=task):
+                self.assertTrue (len (p.report ()) > 0)
+                for blk in p.blocks.values (): self.assertEqual (blk['opt'], 1)
+        # No memory at all: plan anyway, one SI vector at a time, instead of raising
+        p = plan (las, task='rdm12s', si=si, max_memory=0)
+        for blk in p.blocks.values ():
+            self.assertEqual (blk['batch'], min (1, blk['nroots_si']))
+        d1s, d2s = roots_make_rdm12s (las, las.ci, si, opt=None)
+        self.assertAlmostEqual (lib.fp (d1s), lib.fp (rdm1s), 9)
+        self.assertAlmostEqual (lib.fp (d2s), lib.fp (rdm2s), 9)
+
 if __name__ == "__main__":
     print("Full Tests for SA-LASSI")
     unittest.main()
@@ -0,0 +1,58 @@
+#!/usr/bin/env python
+# Copyright 2014-2020 The PySCF Developers. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#     http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import unittest
+import numpy as np
+from pyscf import lib, gto, scf
+from mrh.my_pyscf.mcscf.lasscf_testing import LASSCF
+from mrh.my_pyscf.mcscf.lassi import lassi
+from mrh.my_pyscf.grad.lassi import Gradients
+
+mol = gto.M (atom='H 0 0 0; H 0.8 0 0.1; H 0.1 0 2.5; H 0.9 0.1 2.5', basis='6-31g', verbose=lib.logger.INFO,
+    output='test_lassi_grad.log')
+mf = scf.RHF (mol).run (conv_tol=1e-12)
+las = LASSCF (mf, (2,2), (2,2), spin_sub=(1,1))
+las.state_average_(weights=[0.4,0.3,0.3], charges=[[0,0],[1,-1],[-1,1]], spins=[[0,0],[1,-1],[-1,1]],
+    smults=[[1,1],[2,2],[2,2]])
+las.conv_tol_grad = 1e-9
+las.kernel (las.localize_init_guess (([0,1],[2,3]), mf.mo_coeff))
+e_roots, si = lassi (las)
+
+def tearDownModule():
+    global mol, mf, las
+    mol.stdout.close ()
+    del mol, mf, las
+
+class KnownValues(unittest.TestCase):
+    def test_grad_root0 (self):
+        # Central finite differences of the LASSI ground state with 1e-4 Angstrom steps
+        de_num = np.array ([[-3.0916250756e-02,  9.0532285350e-05, -1.5268885865e-03],
+                            [ 3.0994056359e-02,  5.7239962472e-06,  6.6755761418e-03],
+                            [-3.0944888344e-02, -3.9609564252e-03, -2.7477485499e-03],
+                            [ 3.0867158616e-02,  3.8646232321e-03, -2.4010428328e-03]])
+        de = Gradients (las, si=si).kernel (state=0)
+        for i, j in np.ndindex (*de.shape):
+            with self.subTest (atom=i, xyz=j):
+                self.assertAlmostEqual (de[i,j], de_num[i,j], 6)
+
+    def test_zero_weight (self):
+        las1 = LASSCF (mf, (2,2), (2,2), spin_sub=(1,1))
+        las1.state_average_(weights=[1.0,0.0], spins=[[0,0],[0,0]], smults=[[1,1],[3,3]])
+        with self.assertRaises (NotImplementedError):
+            Gradients (las1).kernel ()
+
+if __name__ == "__main__":
+    print("Full Tests for LASSI analytical nuclear gradients")
+    unittest.main()
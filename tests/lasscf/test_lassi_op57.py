@@ -20,6 +20,8 @@ from scipy import linalg
 from copy import deepcopy
 from itertools import product
 from pyscf import lib, gto, scf, dft, fci, mcscf, df
+from pyscf.fci import cistring
+from pyscf.fci.direct_spin1 import _unpack_nelec
 from pyscf.tools import molden
 from c2h4n4_struct import structure as struct
 from mrh.my_pyscf.mcscf.lasscf_testing import LASSCF
@@ -118,6 +120,19 @@ class KnownValues(unittest.TestCase):
             with self.subTest(matrix=lbl):
                 self.assertAlmostEqual (lib.fp (mat), fp, 9)
 
+    def test_addr_outer_product (self):
+        norb = sum (las.ncas_sub)
+        for nelec_f in product (*[range (n+1) for n in las.ncas_sub]):
+            addrs = None
+            for i, (n, ne) in enumerate (zip (las.ncas_sub, nelec_f)):
+                if not ne: continue # sub_addrs doesn't constrain empty subspaces
+                i0 = sum (las.ncas_sub[:i])
+                sub = cistring.sub_addrs (norb, sum (nelec_f), range (i0, i0+n), ne)
+                addrs = sub if addrs is None else np.intersect1d (addrs, sub)
+            if addrs is None: addrs = [0] # vacuum
+            with self.subTest (nelec=nelec_f):
+                self.assertTrue (np.array_equal (op_o0.addr_outer_product (las.ncas_sub, nelec_f), addrs))
+
     def test_rdm12s (self):
         d12_o0 = op_o0.roots_make_rdm12s (las, las.ci, idx_all, si, orbsym=orbsym, wfnsym=wfnsym)
         d12_o1 = op_o1.roots_make_rdm12s (las, las.ci, idx_all, si, orbsym=orbsym, wfnsym=wfnsym)
@@ -127,6 +142,63 @@ class KnownValues(unittest.TestCase):
                     self.assertAlmostEqual (lib.fp (d12_o0[r][i]),
                         lib.fp (d12_o1[r][i]), 9)
 
+    def test_rdm12_spin_sum (self):
+        # Spin-summed 2-RDMs are accumulated directly, so every cruncher must assign each element only once
+        d1s, d2s = op_o1.roots_make_rdms (las, las.ci, idx_all, si[:,:6])
+        d1, d2 = op_o1.roots_make_rdms (las, las.ci, idx_all, si[:,:6], spin_sum=True)
+        self.assertAlmostEqual (np.amax (np.abs (d1 - d1s.sum (1))), 0, 12)
+        self.assertAlmostEqual (np.amax (np.abs (d2 - d2s.sum ((1,4)))), 0, 12)
+
+    def test_dedup (self):
+        # Give every fragment state the CI vector of the first one with the same electrons, spin and symmetry
+        ci = [[c.copy () for c in ci_f] for ci_f in las.ci]
+        nuniq = []
+        for ifrag, fcibox in enumerate (las.fciboxes):
+            first = {}
+            for iroot, solver in enumerate (fcibox.fcisolvers):
+                nelec = tuple (_unpack_nelec (fcibox._get_nelec (solver, las.nelecas_sub[ifrag])))
+                key = (nelec, solver.smult, getattr (solver, 'wfnsym', None))
+                ci[ifrag][iroot] = ci[ifrag][first.setdefault (key, iroot)].copy ()
+            nuniq.append (len (first))
+        hopping_index, ints = op_o1.make_ints (las, ci, np.where (idx_all)[0])
+        for ifrag, inti in enumerate (ints):
+            with self.subTest (frag=ifrag):
+                self.assertEqual (len (np.unique (inti.uroot)), nuniq[ifrag])
+                for i, j in product (range (nroots), repeat=2):
+                    same = inti.nelec_r[i] == inti.nelec_r[j] and np.array_equal (ci[ifrag][i], ci[ifrag][j])
+                    self.assertEqual (inti.uroot[i] == inti.uroot[j], same)
+        h1, h2 = ham_2q (las, las.mo_coeff, veff_c=None, h2eff_sub=None)[1:]
+        d12_test = op_o1.make_stdm12s (las, ci, idx_all)
+        mats_test = op_o1.ham (las, h1, h2, ci, idx_all, orbsym=orbsym, wfnsym=wfnsym)
+        dedup = op_o1.LSTDMint1.dedup
+        op_o1.LSTDMint1.dedup = lambda self, ci: (np.arange (self.nroots), list (range (self.nroots)))
+        try:
+            d12_ref = op_o1.make_stdm12s (las, ci, idx_all)
+            mats_ref = op_o1.ham (las, h1, h2, ci, idx_all, orbsym=orbsym, wfnsym=wfnsym)
+        finally:
+            op_o1.LSTDMint1.dedup = dedup
+        for r in range (2):
+            with self.subTest (rank=r+1):
+                self.assertAlmostEqual (np.amax (np.abs (d12_test[r] - d12_ref[r])), 0, 12)
+        for lbl, mat_test, mat_ref in zip (('ham','s2','ovlp'), mats_test, mats_ref):
+            with self.subTest (matrix=lbl):
+                self.assertAlmostEqual (np.amax (np.abs (mat_test - mat_ref)), 0, 12)
+
+    def test_outcore (self):
+        # A tiny working set puts every fragment's tables on disk and evicts all but one entry of each
+        frac = op_o1.OUTCORE_MEMORY_FRAC
+        op_o1.OUTCORE_MEMORY_FRAC = 1e-9
+        try:
+            hopping_index, ints = op_o1.make_ints (las, las.ci, np.where (idx_all)[0])
+            self.assertTrue (all ([i.dm2.outcore for i in ints]))
+            d12_o1 = op_o1.roots_make_rdm12s (las, las.ci, idx_all, si, orbsym=orbsym, wfnsym=wfnsym)
+        finally:
+            op_o1.OUTCORE_MEMORY_FRAC = frac
+        d12_o0 = op_o0.roots_make_rdm12s (las, las.ci, idx_all, si, orbsym=orbsym, wfnsym=wfnsym)
+        for r in range (2):
+            with self.subTest (rank=r+1):
+                self.assertAlmostEqual (lib.fp (d12_o0[r]), lib.fp (d12_o1[r]), 9)
+
 if __name__ == "__main__":
     print("Full Tests for LASSI matrix elements of 57-state manifold")
     unittest.main()
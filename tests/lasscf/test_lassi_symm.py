@@ -104,6 +104,20 @@ class KnownValues(unittest.TestCase):
         for e1, e0 in zip (e_roots_test, e_roots):
             self.assertAlmostEqual (e1, e0, 8)
 
+    def test_nproc (self):
+        # Several symmetry blocks, distributed among worker processes even in debug mode
+        for nproc in (1, 2):
+            e_test, si_test = las.lassi (nproc=nproc)
+            with self.subTest ('ham', nproc=nproc):
+                self.assertAlmostEqual (np.amax (np.abs (e_test - e_roots)), 0, 9)
+                self.assertAlmostEqual (np.amax (np.abs (si_test.s2_mat - si.s2_mat)), 0, 9)
+                self.assertAlmostEqual (np.amax (np.abs (np.abs (si_test) - np.abs (si))), 0, 6)
+        d12_ref = make_stdm12s (las, nproc=1)
+        d12_test = make_stdm12s (las, nproc=2)
+        for r in range (2):
+            with self.subTest ('stdm12s', rank=r+1):
+                self.assertAlmostEqual (np.amax (np.abs (d12_test[r] - d12_ref[r])), 0, 12)
+
 if __name__ == "__main__":
     print("Full Tests for SA-LASSI with pointgroup symmetry")
     unittest.main()